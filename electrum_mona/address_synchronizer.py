@@ -25,6 +25,7 @@ import asyncio
 import threading
 import asyncio
 import itertools
+import bisect
 from collections import defaultdict
 from typing import TYPE_CHECKING, Dict, Optional, Set, Tuple, NamedTuple, Sequence, List
 
@@ -95,6 +96,19 @@ class AddressSynchronizer(Logger):
         self.threadlocal_cache = threading.local()
 
         self._get_addr_balance_cache = {}
+        # Coins of each address: the outputs it received, the ones of them that are spent,
+        # and the unspent ones. Kept up to date as txs are added, removed, or change height.
+        # Access with self.transaction_lock.
+        self._addr_received = {}  # type: Dict[str, Dict[str, Tuple[int, int, bool]]]  # prevout_str -> (height, value, is_cb)
+        self._addr_sent = {}  # type: Dict[str, Dict[str, int]]  # prevout_str -> height of spending tx
+        self._addr_unspent = {}  # type: Dict[str, Set[str]]  # prevout_strs
+        self._outpoints = {}  # type: Dict[str, TxOutpoint]  # prevout_str -> parsed, for received outputs
+
+        # Wallet history, maintained incrementally. Built on first use; None means it needs rebuilding.
+        # Access with self.transaction_lock.
+        self._history_deltas = None  # type: Optional[Dict[str, int]]  # txid -> delta on wallet
+        self._history_sort_keys = {}  # type: Dict[str, Tuple]  # txid -> key in _history_sorted
+        self._history_sorted = []  # type: List[Tuple]  # (txpos, txid), ascending
 
         self.load_and_cleanup()
 
@@ -189,6 +203,9 @@ class AddressSynchronizer(Logger):
 
     def on_blockchain_updated(self, event, *args):
         self._get_addr_balance_cache = {}  # invalidate cache
+        # the height of future txs depends on the local height
+        for txid in list(self.future_tx):
+            self._on_tx_height_changed(txid)
 
     async def stop(self):
         if self.network:
@@ -307,7 +324,6 @@ class AddressSynchronizer(Logger):
                         pass
                     else:
                         self.db.add_txi_addr(tx_hash, addr, ser, v)
-                        self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
             for txi in tx.inputs():
                 if txi.is_coinbase_input():
                     continue
@@ -325,7 +341,6 @@ class AddressSynchronizer(Logger):
                 addr = txo.address
                 if addr and self.is_mine(addr):
                     self.db.add_txo_addr(tx_hash, addr, n, v, is_coinbase)
-                    self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
                     # give v to txi that spends me
                     next_tx = self.db.get_spent_outpoint(tx_hash, n)
                     if next_tx is not None:
@@ -374,13 +389,12 @@ class AddressSynchronizer(Logger):
             tx = self.db.remove_transaction(tx_hash)
             remove_from_spent_outpoints()
             self._remove_tx_from_local_history(tx_hash)
-            for addr in itertools.chain(self.db.get_txi_addresses(tx_hash), self.db.get_txo_addresses(tx_hash)):
-                self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
             self.db.remove_txi(tx_hash)
             self.db.remove_txo(tx_hash)
             self.db.remove_tx_fee(tx_hash)
             self.db.remove_verified_tx(tx_hash)
             self.unverified_tx.pop(tx_hash, None)
+            self._remove_from_history_index(tx_hash)
             if tx:
                 for idx, txo in enumerate(tx.outputs()):
                     scripthash = bitcoin.script_to_scripthash(txo.scriptpubkey.hex())
@@ -409,6 +423,7 @@ class AddressSynchronizer(Logger):
                     # make tx local
                     self.unverified_tx.pop(tx_hash, None)
                     self.db.remove_verified_tx(tx_hash)
+                    self._on_tx_height_changed(tx_hash)
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
             self.db.set_addr_history(addr, hist)
@@ -460,6 +475,11 @@ class AddressSynchronizer(Logger):
                 self.db.clear_history()
                 self._history_local.clear()
                 self._get_addr_balance_cache = {}  # invalidate cache
+                self._addr_received.clear()
+                self._addr_sent.clear()
+                self._addr_unspent.clear()
+                self._outpoints.clear()
+                self.invalidate_history_index()
 
     def get_txpos(self, tx_hash):
         """Returns (height, txpos) tuple, even if the tx is unverified."""
@@ -489,9 +509,8 @@ class AddressSynchronizer(Logger):
     @with_transaction_lock
     @with_local_height_cached
     def get_history(self, *, domain=None) -> Sequence[HistoryItem]:
-        # get domain
         if domain is None:
-            domain = self.get_addresses()
+            return self._get_history_from_index()
         domain = set(domain)
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
@@ -526,6 +545,123 @@ class AddressSynchronizer(Logger):
 
         return h2
 
+    def _get_history_from_index(self) -> Sequence[HistoryItem]:
+        """History of the whole wallet, oldest first, from the maintained index."""
+        if self._history_deltas is None:
+            self._build_history_index()
+        h = []
+        balance = 0
+        for txpos, tx_hash in self._history_sorted:
+            delta = self._history_deltas[tx_hash]
+            balance += delta
+            h.append(HistoryItem(txid=tx_hash,
+                                 tx_mined_status=self.get_tx_height(tx_hash),
+                                 delta=delta,
+                                 fee=self.get_tx_fee(tx_hash),
+                                 balance=balance))
+        return h
+
+    @profiler
+    def _build_history_index(self):
+        with self.lock, self.transaction_lock:
+            self._history_deltas = {}
+            self._history_sort_keys = {}
+            self._history_sorted = []
+            for txid in set(itertools.chain(self.db.list_txi(), self.db.list_txo())):
+                self._update_history_index(txid)
+
+    def invalidate_history_index(self):
+        with self.transaction_lock:
+            self._history_deltas = None
+
+    def _update_history_index(self, txid: str) -> None:
+        """Recomputes the entry of txid in the history index.
+        To be called when its delta or position might have changed.
+        """
+        # we need self.transaction_lock but get_txpos will take self.lock
+        with self.lock, self.transaction_lock:
+            if self._history_deltas is None:
+                return
+            addrs = set(itertools.chain(self.db.get_txi_addresses(txid), self.db.get_txo_addresses(txid)))
+            addrs = [addr for addr in addrs if self.is_mine(addr)]
+            if not addrs:
+                self._remove_from_history_index(txid)
+                return
+            self._history_deltas[txid] = sum(self.get_tx_delta(txid, addr) for addr in addrs)
+            key = (self.get_txpos(txid), txid)
+            old_key = self._history_sort_keys.get(txid)
+            if old_key == key:
+                return
+            if old_key is not None:
+                del self._history_sorted[bisect.bisect_left(self._history_sorted, old_key)]
+            bisect.insort(self._history_sorted, key)
+            self._history_sort_keys[txid] = key
+
+    def _on_tx_height_changed(self, txid: str) -> None:
+        # we need self.transaction_lock but get_tx_height will take self.lock
+        with self.lock, self.transaction_lock:
+            self._add_tx_to_addr_coins(txid)
+            self._update_history_index(txid)
+
+    def _invalidate_addr_caches(self, addr: str) -> None:
+        with self.transaction_lock:
+            self._get_addr_balance_cache.pop(addr, None)
+
+    def _add_tx_to_addr_coins(self, txid: str) -> None:
+        """Records the outputs txid pays to our addresses, and the coins of ours
+        it spends, at its current height. Also to be called when it changes.
+        """
+        with self.lock, self.transaction_lock:
+            height = self.get_tx_height(txid).height
+            for addr in self.db.get_txo_addresses(txid):
+                received = self._addr_received.setdefault(addr, {})
+                sent = self._addr_sent.get(addr, {})
+                unspent = self._addr_unspent.setdefault(addr, set())
+                for n, (v, is_cb) in self.db.get_txo_addr(txid, addr).items():
+                    prevout_str = txid + ':%d' % n
+                    received[prevout_str] = (height, v, is_cb)
+                    if prevout_str not in self._outpoints:
+                        self._outpoints[prevout_str] = TxOutpoint(txid=bfh(txid), out_idx=n)
+                    if prevout_str not in sent:
+                        unspent.add(prevout_str)
+                self._invalidate_addr_caches(addr)
+            for addr in self.db.get_txi_addresses(txid):
+                sent = self._addr_sent.setdefault(addr, {})
+                unspent = self._addr_unspent.get(addr, set())
+                for prevout_str, v in self.db.get_txi_addr(txid, addr):
+                    sent[prevout_str] = height
+                    unspent.discard(prevout_str)
+                self._invalidate_addr_caches(addr)
+
+    def _remove_tx_from_addr_coins(self, txid: str) -> None:
+        with self.transaction_lock:
+            for addr in self.db.get_txo_addresses(txid):
+                received = self._addr_received.get(addr, {})
+                unspent = self._addr_unspent.get(addr, set())
+                for n in self.db.get_txo_addr(txid, addr):
+                    prevout_str = txid + ':%d' % n
+                    received.pop(prevout_str, None)
+                    unspent.discard(prevout_str)
+                    self._outpoints.pop(prevout_str, None)
+                self._invalidate_addr_caches(addr)
+            for addr in self.db.get_txi_addresses(txid):
+                received = self._addr_received.get(addr, {})
+                sent = self._addr_sent.get(addr, {})
+                for prevout_str, v in self.db.get_txi_addr(txid, addr):
+                    sent.pop(prevout_str, None)
+                    if prevout_str in received:
+                        self._addr_unspent[addr].add(prevout_str)
+                self._invalidate_addr_caches(addr)
+
+    def _remove_from_history_index(self, txid: str) -> None:
+        with self.transaction_lock:
+            if self._history_deltas is None:
+                return
+            self._history_deltas.pop(txid, None)
+            old_key = self._history_sort_keys.pop(txid, None)
+            if old_key is not None:
+                del self._history_sorted[bisect.bisect_left(self._history_sorted, old_key)]
+
     def _add_tx_to_local_history(self, txid):
         with self.transaction_lock:
             for addr in itertools.chain(self.db.get_txi_addresses(txid), self.db.get_txo_addresses(txid)):
@@ -533,9 +669,12 @@ class AddressSynchronizer(Logger):
                 cur_hist.add(txid)
                 self._history_local[addr] = cur_hist
                 self._mark_address_history_changed(addr)
+            self._add_tx_to_addr_coins(txid)
+            self._update_history_index(txid)
 
     def _remove_tx_from_local_history(self, txid):
         with self.transaction_lock:
+            self._remove_tx_from_addr_coins(txid)
             for addr in itertools.chain(self.db.get_txi_addresses(txid), self.db.get_txo_addresses(txid)):
                 cur_hist = self._history_local.get(addr, set())
                 try:
@@ -565,24 +704,28 @@ class AddressSynchronizer(Logger):
             if tx_height in (TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT):
                 with self.lock:
                     self.db.remove_verified_tx(tx_hash)
+                    self._on_tx_height_changed(tx_hash)
                 if self.verifier:
                     self.verifier.remove_spv_proof_for_tx(tx_hash)
         else:
             with self.lock:
                 # tx will be verified only if height > 0
                 self.unverified_tx[tx_hash] = tx_height
+                self._on_tx_height_changed(tx_hash)
 
     def remove_unverified_tx(self, tx_hash, tx_height):
         with self.lock:
             new_height = self.unverified_tx.get(tx_hash)
             if new_height == tx_height:
                 self.unverified_tx.pop(tx_hash, None)
+                self._on_tx_height_changed(tx_hash)
 
     def add_verified_tx(self, tx_hash: str, info: TxMinedInfo):
         # Remove from the unverified map and add to the verified map
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.db.add_verified_tx(tx_hash, info)
+            self._on_tx_height_changed(tx_hash)
         tx_mined_status = self.get_tx_height(tx_hash)
         util.trigger_callback('verified', self, tx_hash, tx_mined_status)
 
@@ -612,6 +755,7 @@ class AddressSynchronizer(Logger):
                         # into unverified_tx with the old height, and if we get
                         # a status update, that will overwrite it.
                         self.unverified_tx[tx_hash] = tx_height
+                        self._on_tx_height_changed(tx_hash)
                         txs.add(tx_hash)
         return txs
 
@@ -627,6 +771,7 @@ class AddressSynchronizer(Logger):
             tx_was_added = self.add_transaction(tx)
             if tx_was_added:
                 self.future_tx[tx.txid()] = wanted_height
+                self._on_tx_height_changed(tx.txid())
             return tx_was_added
 
     def get_tx_height(self, tx_hash: str) -> TxMinedInfo:
@@ -752,46 +897,44 @@ class AddressSynchronizer(Logger):
         return fee
 
     def get_addr_io(self, address):
-        with self.lock, self.transaction_lock:
-            h = self.get_address_history(address)
-            received = {}
-            sent = {}
-            for tx_hash, height in h:
-                d = self.db.get_txo_addr(tx_hash, address)
-                for n, (v, is_cb) in d.items():
-                    received[tx_hash + ':%d'%n] = (height, v, is_cb)
-            for tx_hash, height in h:
-                l = self.db.get_txi_addr(tx_hash, address)
-                for txi, v in l:
-                    sent[txi] = height
-        return received, sent
-
+        """Returns (received, sent) for address:
+        received: prevout_str -> (height, value, is_coinbase)
+        sent: prevout_str -> height of spending tx
+        """
+        with self.transaction_lock:
+            return dict(self._addr_received.get(address, {})), dict(self._addr_sent.get(address, {}))
+
+    def _make_coin(self, address: str, prevout_str: str) -> PartialTxInput:
+        # note: callers add information to the returned txins when they
+        # spend them, hence new ones are made, only for the coins asked for
+        tx_height, value, is_cb = self._addr_received[address][prevout_str]
+        utxo = PartialTxInput(prevout=self._outpoints[prevout_str], is_coinbase_output=is_cb)
+        utxo._trusted_address = address
+        utxo._trusted_value_sats = value
+        utxo.block_height = tx_height
+        utxo.spent_height = self._addr_sent.get(address, {}).get(prevout_str, None)
+        return utxo
 
     def get_addr_outputs(self, address: str) -> Dict[TxOutpoint, PartialTxInput]:
-        coins, spent = self.get_addr_io(address)
-        out = {}
-        for prevout_str, v in coins.items():
-            tx_height, value, is_cb = v
-            prevout = TxOutpoint.from_str(prevout_str)
-            utxo = PartialTxInput(prevout=prevout, is_coinbase_output=is_cb)
-            utxo._trusted_address = address
-            utxo._trusted_value_sats = value
-            utxo.block_height = tx_height
-            utxo.spent_height = spent.get(prevout_str, None)
-            out[prevout] = utxo
-        return out
+        with self.transaction_lock:
+            out = {}
+            for prevout_str in self._addr_received.get(address, {}):
+                utxo = self._make_coin(address, prevout_str)
+                out[utxo.prevout] = utxo
+            return out
 
     def get_addr_utxo(self, address: str) -> Dict[TxOutpoint, PartialTxInput]:
-        out = self.get_addr_outputs(address)
-        for k, v in list(out.items()):
-            if v.spent_height is not None:
-                out.pop(k)
-        return out
+        with self.transaction_lock:
+            out = {}
+            for prevout_str in self._addr_unspent.get(address, ()):
+                utxo = self._make_coin(address, prevout_str)
+                out[utxo.prevout] = utxo
+            return out
 
     # return the total amount ever received by an address
     def get_addr_received(self, address):
-        received, sent = self.get_addr_io(address)
-        return sum([v for height, v, is_cb in received.values()])
+        with self.transaction_lock:
+            return sum([v for height, v, is_cb in self._addr_received.get(address, {}).values()])
 
     @with_local_height_cached
     def get_addr_balance(self, address, *, excluded_coins: Set[str] = None) -> Tuple[int, int, int]:
@@ -805,23 +948,25 @@ class AddressSynchronizer(Logger):
         if excluded_coins is None:
             excluded_coins = set()
         assert isinstance(excluded_coins, set), f"excluded_coins should be set, not {type(excluded_coins)}"
-        received, sent = self.get_addr_io(address)
         c = u = x = 0
         mempool_height = self.get_local_height() + 1  # height of next block
-        for txo, (tx_height, v, is_cb) in received.items():
-            if txo in excluded_coins:
-                continue
-            if is_cb and tx_height + COINBASE_MATURITY > mempool_height:
-                x += v
-            elif tx_height > 0:
-                c += v
-            else:
-                u += v
-            if txo in sent:
-                if sent[txo] > 0:
-                    c -= v
+        with self.transaction_lock:
+            received = self._addr_received.get(address, {})
+            sent = self._addr_sent.get(address, {})
+            for txo, (tx_height, v, is_cb) in received.items():
+                if txo in excluded_coins:
+                    continue
+                if is_cb and tx_height + COINBASE_MATURITY > mempool_height:
+                    x += v
+                elif tx_height > 0:
+                    c += v
                 else:
-                    u -= v
+                    u += v
+                if txo in sent:
+                    if sent[txo] > 0:
+                        c -= v
+                    else:
+                        u -= v
         result = c, u, x
         # cache result.
         if not excluded_coins:
@@ -856,23 +1001,24 @@ class AddressSynchronizer(Logger):
         if excluded_addresses:
             domain = set(domain) - set(excluded_addresses)
         mempool_height = block_height + 1  # height of next block
-        for addr in domain:
-            txos = self.get_addr_outputs(addr)
-            for txo in txos.values():
-                if txo.spent_height is not None:
-                    if not confirmed_spending_only:
+        with self.transaction_lock:
+            for addr in domain:
+                received = self._addr_received.get(addr, {})
+                sent = self._addr_sent.get(addr, {})
+                # coins spent above block_height are only wanted with confirmed_spending_only
+                prevout_strs = received if confirmed_spending_only else self._addr_unspent.get(addr, ())
+                for prevout_str in prevout_strs:
+                    tx_height, value, is_cb = received[prevout_str]
+                    spent_height = sent.get(prevout_str)
+                    if spent_height is not None and 0 < spent_height <= block_height:
                         continue
-                    if confirmed_spending_only and 0 < txo.spent_height <= block_height:
+                    if confirmed_funding_only and not (0 < tx_height <= block_height):
                         continue
-                if confirmed_funding_only and not (0 < txo.block_height <= block_height):
-                    continue
-                if nonlocal_only and txo.block_height in (TX_HEIGHT_LOCAL, TX_HEIGHT_FUTURE):
-                    continue
-                if (mature_only and txo.is_coinbase_output()
-                        and txo.block_height + COINBASE_MATURITY > mempool_height):
-                    continue
-                coins.append(txo)
-                continue
+                    if nonlocal_only and tx_height in (TX_HEIGHT_LOCAL, TX_HEIGHT_FUTURE):
+                        continue
+                    if mature_only and is_cb and tx_height + COINBASE_MATURITY > mempool_height:
+                        continue
+                    coins.append(self._make_coin(addr, prevout_str))
         return coins
 
     def get_balance(self, domain=None, *, excluded_addresses: Set[str] = None,
@@ -84,6 +84,23 @@ def CKD_pub(parent_pubkey: bytes, parent_chaincode: bytes, child_index: int) ->
                     child_index=bfh(rev_hex(int_to_hex(child_index, 4))))
 
 
+def CKD_pub_range(parent_pubkey: bytes, parent_chaincode: bytes, start: int, count: int) -> List[bytes]:
+    """Returns the pubkeys of children start, ..., start+count-1,
+    same as calling CKD_pub for each, but parent_pubkey is parsed only once.
+    """
+    if start < 0: raise ValueError('the bip32 index needs to be non-negative')
+    if (start + count - 1) & BIP32_PRIME: raise Exception('not possible to derive hardened child from parent pubkey')
+    tweaks = [hmac_oneshot(parent_chaincode, parent_pubkey + child_index.to_bytes(4, byteorder="big"), hashlib.sha512)[0:32]
+              for child_index in range(start, start + count)]
+    try:
+        return ecc.add_tweaks_to_pubkey(parent_pubkey, tweaks)
+    except ecc.InvalidECPointException:
+        pass
+    # an invalid child: let CKD_pub skip it
+    return [CKD_pub(parent_pubkey, parent_chaincode, child_index)[0]
+            for child_index in range(start, start + count)]
+
+
 # helper function, callable with arbitrary 'child_index' byte-string.
 # i.e.: 'child_index' does not need to fit into 32 bits here! (c.f. trustedcoin billing)
 def _CKD_pub(parent_pubkey: bytes, parent_chaincode: bytes, child_index: bytes) -> Tuple[bytes, bytes]:
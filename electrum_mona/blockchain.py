@@ -21,10 +21,13 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import mmap
+import struct
 import threading
-import sys
 import time
-from typing import Optional, Dict, Mapping, Sequence
+import concurrent.futures
+from collections import deque
+from typing import Optional, Dict, Mapping, Sequence, Tuple, List, Union
 
 from . import util
 from .bitcoin import hash_encode, int_to_hex, rev_hex
@@ -39,12 +42,7 @@ _logger = get_logger(__name__)
 MAX_TARGET = 0x00000fffffffffffffffffffffffffffffffffffffffffffffffffffffffffff
 HEADER_SIZE = 80  # bytes
 
-try:
-    import lyra2re2_hash
-except ImportError as e:
-    sys.exit("Please run 'sudo pip3 install lyra2re2-hash'")
-
-from .scrypt import scrypt_1024_1_1_80 as scryptGetHash
+from .powhash import pow_hash_raw_header, pow_hash_raw_headers
 
 
 class MissingHeader(Exception):
@@ -78,6 +76,10 @@ def deserialize_header(s: bytes, height: int) -> dict:
     h['block_height'] = height
     return h
 
+def hash_raw_header_bytes(raw_header: bytes) -> str:
+    return hash_encode(sha256d(raw_header))
+
+
 def hash_header(header: dict) -> str:
     if header is None:
         return '0' * 64
@@ -90,6 +92,51 @@ def hash_raw_header(header: str) -> str:
     return hash_encode(sha256d(bfh(header)))
 
 
+def check_pow_of_raw_headers(items: Sequence[Tuple[int, bytes, int]]) -> Optional[Tuple[int, int, int]]:
+    """Checks the proof-of-work of (height, raw_header, target) items.
+    Returns (height, powhash, target) of the first failing header, or None.
+    Note: this is a top-level function so that it can run in worker processes.
+    """
+    powhashes = pow_hash_raw_headers([raw_header for height, raw_header, target in items],
+                                     [height for height, raw_header, target in items])
+    for (height, raw_header, target), powhash in zip(items, powhashes):
+        if powhash > target:
+            return height, powhash, target
+    return None
+
+
+_pow_executor = None  # type: Optional[concurrent.futures.ProcessPoolExecutor]
+_pow_executor_workers = 0
+_pow_executor_lock = threading.Lock()
+
+
+def get_pow_executor(num_workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    global _pow_executor, _pow_executor_workers
+    with _pow_executor_lock:
+        if _pow_executor is None or _pow_executor_workers != num_workers:
+            if _pow_executor is not None:
+                _pow_executor.shutdown(wait=False)
+            _pow_executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers)
+            _pow_executor_workers = num_workers
+        return _pow_executor
+
+
+def check_pow_of_raw_headers_in_parallel(items: Sequence[Tuple[int, bytes, int]],
+                                         num_workers: int) -> Optional[Tuple[int, int, int]]:
+    """Same as check_pow_of_raw_headers, but the hashing is split across
+    a pool of num_workers processes.
+    """
+    if num_workers <= 1 or len(items) <= 1:
+        return check_pow_of_raw_headers(items)
+    executor = get_pow_executor(num_workers)
+    # contiguous slices, several per worker so that stragglers even out
+    num_slices = min(len(items), num_workers * 4)
+    slice_size = -(-len(items) // num_slices)
+    slices = [items[i:i+slice_size] for i in range(0, len(items), slice_size)]
+    failures = [res for res in executor.map(check_pow_of_raw_headers, slices) if res is not None]
+    return min(failures) if failures else None
+
+
 # key: blockhash hex at forkpoint
 # the chain at some key is the best chain that includes the given hash
 blockchains = {}  # type: Dict[str, Blockchain]
@@ -109,6 +156,7 @@ def read_blockchains(config: 'SimpleConfig'):
         if not header_after_cp or not best_chain.can_connect(header_after_cp, check_height=False):
             _logger.info("[blockchain] deleting best chain. cannot connect header after last cp to last cp.")
             os.unlink(best_chain.path())
+            best_chain.reset_chainwork_index()
             best_chain.update_size()
     # forks
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
@@ -120,6 +168,7 @@ def read_blockchains(config: 'SimpleConfig'):
     def delete_chain(filename, reason):
         _logger.info(f"[blockchain] deleting chain {filename}: {reason}")
         os.unlink(os.path.join(fdir, filename))
+        delete_chainwork_index(os.path.join(fdir, filename))
 
     def instantiate_chain(filename):
         __, forkpoint, prev_hash, first_hash = filename.split('_')
@@ -161,10 +210,233 @@ def read_blockchains(config: 'SimpleConfig'):
 def get_best_chain() -> 'Blockchain':
     return blockchains[constants.net.GENESIS]
 
-# block hash -> chain work; up to and including that block
-_CHAINWORK_CACHE = {
-    "0000000000000000000000000000000000000000000000000000000000000000": 0,  # virtual block at height -1
-}  # type: Dict[str, int]
+def work_from_target(target: int) -> int:
+    """Expected number of hashes needed to meet target."""
+    return ((2 ** 256 - target - 1) // (target + 1)) + 1
+
+
+class ChainworkIndex:
+    """Cumulative chainwork of each header of a chain past the checkpoint
+    region, persisted next to its headers file. The file is a sequence of
+    32-byte big-endian integers; record j is the total work up to and
+    including the header at height first_height+j.
+    """
+
+    RECORD_SIZE = 32
+
+    def __init__(self, path: str, first_height: int):
+        self.path = path
+        self.first_height = first_height
+        self._data = bytearray()
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            self._data = bytearray(data[:len(data) - len(data) % self.RECORD_SIZE])
+
+    def __len__(self) -> int:
+        return len(self._data) // self.RECORD_SIZE
+
+    def get(self, height: int) -> Optional[int]:
+        j = height - self.first_height
+        if 0 <= j < len(self):
+            return int.from_bytes(self._data[j*self.RECORD_SIZE:(j+1)*self.RECORD_SIZE], byteorder='big')
+        return None
+
+    def next_height(self) -> int:
+        return self.first_height + len(self)
+
+    def extend(self, height: int, works: Sequence[int]) -> None:
+        """Appends the records of height and the following ones."""
+        assert height == self.next_height(), (height, self.next_height())
+        data = b''.join(work.to_bytes(self.RECORD_SIZE, byteorder='big') for work in works)
+        with open(self.path, 'ab') as f:
+            f.seek(len(self._data))
+            f.truncate()
+            f.write(data)
+        self._data += data
+
+    def truncate(self, height: int) -> None:
+        """Forgets the records of height and above."""
+        n = max(0, height - self.first_height) * self.RECORD_SIZE
+        if n >= len(self._data):
+            return
+        del self._data[n:]
+        if os.path.exists(self.path):
+            with open(self.path, 'rb+') as f:
+                f.truncate(n)
+
+    def delete(self) -> None:
+        self._data = bytearray()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def chainwork_index_path(headers_path: str) -> str:
+    # note: read_blockchains ignores files with a '.' in their name
+    return headers_path + '.chainwork'
+
+
+def delete_chainwork_index(headers_path: str) -> None:
+    path = chainwork_index_path(headers_path)
+    if os.path.exists(path):
+        os.unlink(path)
+
+
+# bumped on every write to any headers file; cached DGWv3 windows are only valid
+# as long as it did not change, as a window can span several (parent) chains
+_headers_write_counter = 0
+_headers_write_counter_lock = threading.Lock()
+
+
+def _bump_headers_write_counter() -> int:
+    global _headers_write_counter
+    with _headers_write_counter_lock:
+        _headers_write_counter += 1
+        return _headers_write_counter
+
+
+class HeadersFileView:
+    """Read-only, memory-mapped view of a headers file.
+    Header fields are unpacked straight from the mapping; use
+    deserialize_header on read_raw() to get a dict.
+    Headers appended to the file after it was mapped are kept in memory,
+    so the file is only mapped again once MAX_UNMAPPED of them piled up.
+    """
+
+    MAX_UNMAPPED = 2016
+
+    # version, prev_block_hash, merkle_root, timestamp, bits, nonce
+    _FIELDS = struct.Struct('<I32s32sIII')
+    # timestamp, bits
+    _TIMESTAMP_AND_BITS = struct.Struct('<II')
+    _EMPTY_HEADER = bytes(HEADER_SIZE)
+
+    def __init__(self, path: str):
+        self._mmap = None  # type: Optional[mmap.mmap]
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size >= HEADER_SIZE:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mapped_count = size // HEADER_SIZE
+        self._unmapped = bytearray()
+
+    def __len__(self) -> int:
+        return self._mapped_count + len(self._unmapped) // HEADER_SIZE
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._mapped_count = 0
+        self._unmapped.clear()
+
+    def append(self, data: bytes) -> None:
+        """Adds headers that were appended to the file."""
+        assert len(data) % HEADER_SIZE == 0, len(data)
+        self._unmapped += data
+
+    def num_unmapped(self) -> int:
+        return len(self._unmapped) // HEADER_SIZE
+
+    def _locate(self, index: int) -> Tuple[Union[mmap.mmap, bytearray], int]:
+        if not (0 <= index < len(self)):
+            raise IndexError(f'header index out of range: {index}')
+        if index < self._mapped_count:
+            return self._mmap, index * HEADER_SIZE
+        return self._unmapped, (index - self._mapped_count) * HEADER_SIZE
+
+    def read_raw(self, index: int) -> Optional[bytes]:
+        """Returns the 80 bytes of the header at index, or None if that
+        part of the file was not filled yet."""
+        buf, offset = self._locate(index)
+        raw = bytes(buf[offset:offset+HEADER_SIZE])
+        if raw == self._EMPTY_HEADER:
+            return None
+        return raw
+
+    def fields(self, index: int) -> Tuple[int, bytes, bytes, int, int, int]:
+        """(version, prev_block_hash, merkle_root, timestamp, bits, nonce),
+        hashes as raw little-endian bytes."""
+        return self._FIELDS.unpack_from(*self._locate(index))
+
+    def timestamp_and_bits(self, index: int) -> Tuple[int, int]:
+        buf, offset = self._locate(index)
+        return self._TIMESTAMP_AND_BITS.unpack_from(buf, offset + 68)
+
+    def block_hash(self, index: int) -> Optional[bytes]:
+        """Raw (little-endian) block hash, or None for an empty slot."""
+        raw = self.read_raw(index)
+        return sha256d(raw) if raw is not None else None
+
+
+class DGWv3State:
+    """Rolling DGWv3 window over the last PAST_BLOCKS headers up to and
+    including 'height'. Consecutive targets can be computed by pushing
+    headers one by one, without re-reading and deserializing the past
+    headers for every height.
+    """
+
+    PAST_BLOCKS = 24
+
+    def __init__(self, height: int, entries: Sequence[Optional[Tuple[int, int]]]):
+        # entries: (bits, timestamp) for heights height-PAST_BLOCKS+1 .. height,
+        #          or None if the header is missing
+        assert len(entries) == self.PAST_BLOCKS, len(entries)
+        self.height = height
+        self._entries = deque(entries, maxlen=self.PAST_BLOCKS)
+        self._num_missing = sum(1 for e in entries if e is None)
+
+    @classmethod
+    def from_headers(cls, height: int, headers: Sequence[Optional[dict]]) -> 'DGWv3State':
+        entries = [(h['bits'], h['timestamp']) if h is not None else None for h in headers]
+        return DGWv3State(height, entries)
+
+    def copy(self) -> 'DGWv3State':
+        return DGWv3State(self.height, list(self._entries))
+
+    def push(self, header: dict) -> None:
+        """Slides the window forward by one header."""
+        assert header['block_height'] == self.height + 1, (header['block_height'], self.height)
+        if self._entries[0] is None:
+            self._num_missing -= 1
+        self._entries.append((header['bits'], header['timestamp']))
+        self.height += 1
+
+    def get_next_target(self) -> int:
+        """Returns the DGWv3 target for the header at height+1."""
+        height = self.height + 1
+        # DGWv3 PastBlocksMax = 24 Because checkpoint don't have preblock data.
+        if height < len(constants.net.CHECKPOINTS)*2016 + self.PAST_BLOCKS:
+            return 0
+        #thanks watanabe!! http://askmona.org/5288#res_61
+        if self._entries[-1] is None or height-1 < 450024:
+            return MAX_TARGET
+        if self._num_missing:
+            raise MissingHeader(f'DGWv3 window ending at {self.height} is incomplete')
+        # note: this is not a plain average, rounding makes it depend on the order
+        bits_to_target = Blockchain.bits_to_target
+        entries = reversed(self._entries)
+        bits, LastBlockTime = next(entries)
+        PastDifficultyAverage = bits_to_target(bits)
+        CountBlocks = 1
+        for bits, timestamp in entries:
+            CountBlocks += 1
+            bnNum = bits_to_target(bits)
+            PastDifficultyAverage = ((PastDifficultyAverage * CountBlocks) + bnNum) // (CountBlocks + 1)
+        FirstBlockTime = self._entries[0][1]
+        # the per-block time differences telescope
+        nActualTimespan = LastBlockTime - FirstBlockTime
+        nTargetTimespan = CountBlocks * 90 #1.5 miniutes
+
+        nActualTimespan = max(nActualTimespan, nTargetTimespan//3)
+        nActualTimespan = min(nActualTimespan, nTargetTimespan*3)
+
+        # retarget
+        bnNew = PastDifficultyAverage
+        bnNew *= nActualTimespan
+        bnNew //= nTargetTimespan
+        bnNew = min(bnNew, MAX_TARGET)
+        return bnNew
 
 
 def init_headers_file_for_best_chain():
@@ -177,6 +449,7 @@ def init_headers_file_for_best_chain():
                 f.seek(length - 1)
                 f.write(b'\x00')
         util.ensure_sparse_file(filename)
+        b.reset_chainwork_index()
     with b.lock:
         b.update_size()
 
@@ -200,6 +473,11 @@ class Blockchain(Logger):
         self._forkpoint_hash = forkpoint_hash  # blockhash at forkpoint. "first hash"
         self._prev_hash = prev_hash  # blockhash immediately before forkpoint
         self.lock = threading.RLock()
+        self._dgw_state = None  # type: Optional[DGWv3State]  # window ending at our tip
+        self._dgw_state_write_counter = None  # type: Optional[int]
+        self._headers_view = None  # type: Optional[HeadersFileView]
+        self._chainwork_index = None  # type: Optional[ChainworkIndex]
+        self._checkpoint_chainworks = None  # type: Optional[List[int]]
         self.update_size()
 
     @property
@@ -276,6 +554,7 @@ class Blockchain(Logger):
                           prev_hash=parent.get_hash(forkpoint-1))
         self.assert_headers_file_available(parent.path())
         open(self.path(), 'w+').close()
+        self.reset_chainwork_index()
         self.save_header(header)
         # put into global dict. note that in some cases
         # save_header might have already put it there but that's OK
@@ -296,36 +575,79 @@ class Blockchain(Logger):
     def update_size(self) -> None:
         p = self.path()
         self._size = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
+        # the file might have been replaced or resized
+        self._close_headers_view()
+
+    @with_lock
+    def _close_headers_view(self) -> None:
+        if self._headers_view is not None:
+            self._headers_view.close()
+            self._headers_view = None
+
+    @with_lock
+    def _get_headers_view(self) -> HeadersFileView:
+        if self._headers_view is None:
+            name = self.path()
+            self.assert_headers_file_available(name)
+            self._headers_view = HeadersFileView(name)
+        return self._headers_view
 
     @classmethod
-    def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None) -> None:
+    def is_target_checked_at_height(cls, height: int) -> bool:
+        """Whether bits and proof-of-work are verified for the header at height."""
+        # DGWv3 PastBlocksMax = 24 Because checkpoint don't have preblock data.
+        if height // 2016 < len(constants.net.CHECKPOINTS) and height % 2016 != 2015 or \
+                height >= len(constants.net.CHECKPOINTS)*2016 and height <= len(constants.net.CHECKPOINTS)*2016 + 24:
+            return False
+        if constants.net.TESTNET:
+            return False
+        return True
+
+    @classmethod
+    def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None,
+                      *, check_pow: bool = True) -> None:
         height = header.get('block_height')
         _hash = hash_header(header)
         if expected_header_hash and expected_header_hash != _hash:
             raise Exception("hash mismatches with expected: {} vs {}".format(expected_header_hash, _hash))
         if prev_hash != header.get('prev_block_hash'):
             raise Exception("prev hash mismatch: %s vs %s" % (prev_hash, header.get('prev_block_hash')))
-        # DGWv3 PastBlocksMax = 24 Because checkpoint don't have preblock data.
-        if height // 2016 < len(constants.net.CHECKPOINTS) and height % 2016 != 2015 or \
-                height >= len(constants.net.CHECKPOINTS)*2016 and height <= len(constants.net.CHECKPOINTS)*2016 + 24:
-            return
-        if constants.net.TESTNET:
+        if not cls.is_target_checked_at_height(height):
             return
         bits = cls.target_to_bits(target)
         if bits != header.get('bits'):
             raise Exception("bits mismatch: %s vs %s" % (bits, header.get('bits')))
-        if height < 450000 :
-            _powhash = rev_hex(bh2u(scryptGetHash(bfh(serialize_header(header)))))
-        else:
-            _powhash = rev_hex(bh2u(lyra2re2_hash.getPoWHash(bfh(serialize_header(header)))))
-        if int('0x' + _powhash, 16) > target:
-            raise Exception("insufficient proof of work: %s vs target %s" % (int('0x' + _powhash, 16), target))
+        if not check_pow:
+            return
+        _powhash = pow_hash_raw_header(bfh(serialize_header(header)), height)
+        if _powhash > target:
+            raise Exception("insufficient proof of work: %s vs target %s" % (_powhash, target))
+
+    def get_pow_workers(self) -> int:
+        """Number of processes used to check the PoW of chunks.
+        0 or 1 means everything is verified serially on the calling thread.
+        """
+        num_workers = self.config.get('blockchain_pow_workers', 0)
+        try:
+            num_workers = int(num_workers)
+        except (TypeError, ValueError):
+            return 0
+        if num_workers < 0:  # auto
+            num_workers = os.cpu_count() or 1
+        return num_workers
 
     def verify_chunk(self, index: int, data: bytes) -> None:
+        t0 = time.monotonic()
+        num_workers = self.get_pow_workers()
         num = len(data) // HEADER_SIZE
         start_height = index * 2016
         prev_hash = self.get_hash(start_height - 1)
         headers = {}
+        pow_items = []  # type: List[Tuple[int, bytes, int]]
+        dgw_state = None
+        if start_height >= len(self.checkpoints) * 2016 and not constants.net.TESTNET:
+            dgw_state = self.get_dgwv3_state(start_height - 1)
+        # linkage and DGWv3 targets need to be checked in order; the PoW hashing is deferred
         for i in range(num):
             height = start_height + i
             try:
@@ -335,9 +657,25 @@ class Blockchain(Logger):
             raw_header = data[i*HEADER_SIZE : (i+1)*HEADER_SIZE]
             header = deserialize_header(raw_header, index*2016 + i)
             headers[header.get('block_height')] = header
-            target = self.get_target(index*2016 + i, headers)
-            self.verify_header(header, prev_hash, target, expected_header_hash)
+            target = self.get_target(index*2016 + i, headers, dgw_state=dgw_state)
+            if dgw_state is not None:
+                dgw_state.push(header)
+            self.verify_header(header, prev_hash, target, expected_header_hash, check_pow=False)
+            if self.is_target_checked_at_height(height):
+                pow_items.append((height, raw_header, target))
             prev_hash = hash_header(header)
+        if num_workers > 1:
+            failure = check_pow_of_raw_headers_in_parallel(pow_items, num_workers)
+        else:
+            failure = check_pow_of_raw_headers(pow_items)
+        if failure is not None:
+            height, powhash, target = failure
+            raise Exception("insufficient proof of work at height %s: %s vs target %s" % (height, powhash, target))
+        dt = time.monotonic() - t0
+        if pow_items:
+            self.logger.info(f"verified chunk {index}: {num} headers ({len(pow_items)} with PoW) "
+                              f"in {dt:.2f}s, {num / max(dt, 1e-6):.0f} headers/sec, "
+                              f"pow_workers={max(num_workers, 1)}")
 
     @with_lock
     def path(self):
@@ -371,6 +709,9 @@ class Blockchain(Logger):
             delta_bytes = 0
         truncate = not chunk_within_checkpoint_region
         self.write(chunk, delta_bytes, truncate)
+        if not constants.net.TESTNET:
+            # keep the chainwork index up to date with the headers just saved
+            self._get_chainwork(min(index * 2016 + 2015, self.height()))
         self.swap_with_parent()
 
     def swap_with_parent(self) -> None:
@@ -397,9 +738,7 @@ class Blockchain(Logger):
         they will be stored in different files."""
         if self.parent is None:
             return False
-        #That's why I'm going to kill you last.
-        #if self.parent.get_chainwork() >= self.get_chainwork():
-        if self.parent.height() - self.forkpoint + 1 >= self.size():
+        if self.parent.get_chainwork() >= self.get_chainwork():
             return False
         self.logger.info(f"swapping {self.forkpoint} {self.parent.forkpoint}")
         parent_branch_size = self.parent.height() - self.forkpoint + 1
@@ -427,8 +766,16 @@ class Blockchain(Logger):
         self.forkpoint, parent.forkpoint = parent.forkpoint, self.forkpoint
         self._forkpoint_hash, parent._forkpoint_hash = parent._forkpoint_hash, hash_raw_header(bh2u(parent_data[:HEADER_SIZE]))
         self._prev_hash, parent._prev_hash = parent._prev_hash, self._prev_hash
+        # chainwork indices follow the file names: the child takes over the parent's
+        # index (truncated at forkpoint by the write above), the parent starts afresh
+        self._chainwork_index = None
+        parent._chainwork_index = None
+        delete_chainwork_index(child_old_name)
         # parent's new name
+        self._close_headers_view()
+        parent._close_headers_view()
         os.replace(child_old_name, parent.path())
+        delete_chainwork_index(parent.path())
         self.update_size()
         parent.update_size()
         # update pointers
@@ -453,6 +800,16 @@ class Blockchain(Logger):
     def write(self, data: bytes, offset: int, truncate: bool=True) -> None:
         filename = self.path()
         self.assert_headers_file_available(filename)
+        is_append = offset == self._size * HEADER_SIZE
+        if not is_append:
+            # note: on Windows, a mapped file cannot be truncated
+            self._close_headers_view()
+        # forget chainwork of the headers that are about to change, before changing them
+        first_height = self.forkpoint + offset // HEADER_SIZE
+        last_height = first_height + len(data) // HEADER_SIZE - 1
+        cp_region_end = len(self.checkpoints) * 2016
+        if truncate or last_height >= cp_region_end:
+            self._invalidate_chainwork_from(max(first_height, cp_region_end))
         with open(filename, 'rb+') as f:
             if truncate and offset != self._size * HEADER_SIZE:
                 f.seek(offset)
@@ -461,7 +818,18 @@ class Blockchain(Logger):
             f.write(data)
             f.flush()
             os.fsync(f.fileno())
-        self.update_size()
+        if is_append and len(data) % HEADER_SIZE == 0:
+            # the mapped part of the file did not change
+            self._size += len(data) // HEADER_SIZE
+            view = self._headers_view
+            if view is not None:
+                view.append(data)
+                if view.num_unmapped() > HeadersFileView.MAX_UNMAPPED:
+                    self._close_headers_view()
+        else:
+            self.update_size()
+        _bump_headers_write_counter()
+        self._dgw_state = None
 
     @with_lock
     def save_header(self, header: dict) -> None:
@@ -470,26 +838,56 @@ class Blockchain(Logger):
         # headers are only _appended_ to the end:
         assert delta == self.size(), (delta, self.size())
         assert len(data) == HEADER_SIZE
+        height = header.get('block_height')
+        write_counter = _headers_write_counter
+        dgw_state = self._get_cached_dgwv3_state(height - 1)
         self.write(data, delta*HEADER_SIZE)
+        if dgw_state is not None:
+            dgw_state.push(header)
+            # valid after our own write only; if another chain wrote too,
+            # it might have changed headers in the window
+            self._set_cached_dgwv3_state(dgw_state, write_counter + 1)
+        if not constants.net.TESTNET:
+            index = self._get_chainwork_index()
+            if index.next_height() == height:
+                index.extend(height, [self._get_chainwork(height - 1) + self._work_of_header(height, header['bits'])])
         self.swap_with_parent()
 
     @with_lock
-    def read_header(self, height: int) -> Optional[dict]:
+    def read_raw_header(self, height: int) -> Optional[bytes]:
+        if height < 0:
+            return
+        if height < self.forkpoint:
+            return self.parent.read_raw_header(height)
+        if height > self.height():
+            return
+        delta = height - self.forkpoint
+        view = self._get_headers_view()
+        if delta >= len(view):
+            raise Exception('Expected to read a full header at height {}'.format(height))
+        return view.read_raw(delta)
+
+    @with_lock
+    def read_timestamp_and_bits(self, height: int) -> Optional[Tuple[int, int]]:
+        """Returns (timestamp, bits) of the header at height, without deserializing it."""
         if height < 0:
             return
         if height < self.forkpoint:
-            return self.parent.read_header(height)
+            return self.parent.read_timestamp_and_bits(height)
         if height > self.height():
             return
         delta = height - self.forkpoint
-        name = self.path()
-        self.assert_headers_file_available(name)
-        with open(name, 'rb') as f:
-            f.seek(delta * HEADER_SIZE)
-            h = f.read(HEADER_SIZE)
-            if len(h) < HEADER_SIZE:
-                raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
-        if h == bytes([0])*HEADER_SIZE:
+        view = self._get_headers_view()
+        if delta >= len(view):
+            raise Exception('Expected to read a full header at height {}'.format(height))
+        timestamp, bits = view.timestamp_and_bits(delta)
+        if timestamp == 0 and bits == 0 and view.read_raw(delta) is None:
+            return None
+        return timestamp, bits
+
+    def read_header(self, height: int) -> Optional[dict]:
+        h = self.read_raw_header(height)
+        if h is None:
             return None
         return deserialize_header(h, height)
 
@@ -527,10 +925,10 @@ class Blockchain(Logger):
             h, t = self.checkpoints[index]
             return h
         else:
-            header = self.read_header(height)
-            if header is None:
+            raw_header = self.read_raw_header(height)
+            if raw_header is None:
                 raise MissingHeader(height)
-            return hash_header(header)
+            return hash_raw_header_bytes(raw_header)
 
 
     @classmethod
@@ -556,69 +954,61 @@ class Blockchain(Logger):
         return new_bits
 
 
-    def get_target_dgwv3(self, height, chain={}) -> int:
-
-        last = chain.get(height - 1)
-        if last is None:
-            last = self.read_header(height - 1)
-        # for using testdata(checkpoints)
-        #if height == 2206543:
-        #    print(chain)
-        # params
-        BlockLastSolved = last
-        BlockReading = last
-        BlockCreating = height
-        nActualTimespan = 0
-        LastBlockTime = 0
-        PastBlocksMin = 24
-        PastBlocksMax = 24
-        CountBlocks = 0
-        PastDifficultyAverage = 0
-        PastDifficultyAveragePrev = 0
-        bnNum = 0
+    @with_lock
+    def _get_cached_dgwv3_state(self, height: int) -> Optional[DGWv3State]:
+        state = self._dgw_state
+        if state is None or state.height != height:
+            return None
+        if self._dgw_state_write_counter != _headers_write_counter:
+            return None
+        return state.copy()
+
+    @with_lock
+    def _set_cached_dgwv3_state(self, state: DGWv3State, write_counter: int) -> None:
+        # write_counter: value of _headers_write_counter when the headers in state were read
+        if state.height != self.height():
+            return
+        self._dgw_state = state.copy()
+        self._dgw_state_write_counter = write_counter
 
+    def get_dgwv3_state(self, height: int, chain: Mapping[int, dict] = None) -> DGWv3State:
+        """Returns the DGWv3 window ending at height (inclusive).
+        Headers in 'chain' take precedence over the ones we have stored.
+        """
+        if chain is None:
+            chain = {}
+        window = range(height - DGWv3State.PAST_BLOCKS + 1, height + 1)
+        # the cached window only has stored headers
+        use_cache = not any(h in chain for h in window)
+        write_counter = _headers_write_counter
+        if use_cache:
+            state = self._get_cached_dgwv3_state(height)
+            if state is not None:
+                return state
+        entries = []
+        for h in window:
+            header = chain.get(h)
+            if header is not None:
+                entries.append((header['bits'], header['timestamp']))
+                continue
+            timestamp_and_bits = self.read_timestamp_and_bits(h)
+            entries.append((timestamp_and_bits[1], timestamp_and_bits[0]) if timestamp_and_bits else None)
+        state = DGWv3State(height, entries)
+        if use_cache:
+            self._set_cached_dgwv3_state(state, write_counter)
+        return state
+
+    def get_target_dgwv3(self, height, chain={}, dgw_state: DGWv3State = None) -> int:
         # DGWv3 PastBlocksMax = 24 Because checkpoint don't have preblock data.
-        if height < len(constants.net.CHECKPOINTS)*2016 + PastBlocksMax:
+        if height < len(constants.net.CHECKPOINTS)*2016 + DGWv3State.PAST_BLOCKS:
             return 0
-        #thanks watanabe!! http://askmona.org/5288#res_61
-        if BlockLastSolved is None or height-1 < 450024:
-            return MAX_TARGET
-        for i in range(1, PastBlocksMax + 1):
-            CountBlocks += 1
-
-            if CountBlocks <= PastBlocksMin:
-                if CountBlocks == 1:
-                    PastDifficultyAverage = Blockchain.bits_to_target(BlockReading.get('bits'))
-                else:
-                    bnNum = Blockchain.bits_to_target(BlockReading.get('bits'))
-                    PastDifficultyAverage = ((PastDifficultyAveragePrev * CountBlocks)+(bnNum)) // (CountBlocks + 1)
-                PastDifficultyAveragePrev = PastDifficultyAverage
+        if dgw_state is None:
+            dgw_state = self.get_dgwv3_state(height - 1, chain)
+        assert dgw_state.height == height - 1, (dgw_state.height, height)
+        return dgw_state.get_next_target()
 
-            if LastBlockTime > 0:
-                Diff = (LastBlockTime - BlockReading.get('timestamp'))
-                nActualTimespan += Diff
-            LastBlockTime = BlockReading.get('timestamp')
-
-            BlockReading = chain.get((height-1) - CountBlocks)
-            if BlockReading is None:
-                BlockReading = self.read_header((height-1) - CountBlocks)
-
-
-        bnNew = PastDifficultyAverage
-        nTargetTimespan = CountBlocks * 90 #1.5 miniutes
 
-        nActualTimespan = max(nActualTimespan, nTargetTimespan//3)
-        nActualTimespan = min(nActualTimespan, nTargetTimespan*3)
-
-        # retarget
-        bnNew *= nActualTimespan
-        bnNew //= nTargetTimespan
-        bnNew = min(bnNew, MAX_TARGET)
-
-        return bnNew
-
-
-    def get_target(self, height, chain={}) -> int:
+    def get_target(self, height, chain={}, dgw_state: DGWv3State = None) -> int:
         if constants.net.TESTNET:
             return 0
         elif height // 2016 < len(constants.net.CHECKPOINTS) and height % 2016 == 2015:
@@ -629,43 +1019,88 @@ class Blockchain(Logger):
         else:
             # for using testdata(checkpoints)
             #if height == 2206543:
-            #    print(Blockchain.get_target_dgwv3(self, height, chain))
-            return Blockchain.get_target_dgwv3(self, height, chain)
-
-
-    #def chainwork_of_header_at_height(self, height: int) -> int:
-    #    """work done by single header at given height"""
-    #    chunk_idx = height // 2016 - 1
-    #    target = self.get_target(index * 2016)
-    #    work = ((2 ** 256 - target - 1) // (target + 1)) + 1
-    #    return work
-
-    #@with_lock
-    #def get_chainwork(self, height=None) -> int:
-    #    if height is None:
-    #        height = max(0, self.height())
-    #    if constants.net.TESTNET:
+            #    print(self.get_target_dgwv3(height, chain))
+            return self.get_target_dgwv3(height, chain, dgw_state)
+
+
+    def _get_chainwork_index(self) -> ChainworkIndex:
+        path = chainwork_index_path(self.path())
+        first_height = max(self.forkpoint, len(self.checkpoints) * 2016)
+        index = self._chainwork_index
+        if index is None or index.path != path or index.first_height != first_height:
+            index = self._chainwork_index = ChainworkIndex(path, first_height)
+        return index
+
+    @with_lock
+    def reset_chainwork_index(self) -> None:
+        delete_chainwork_index(self.path())
+        self._chainwork_index = None
+
+    @with_lock
+    def _invalidate_chainwork_from(self, height: int) -> None:
+        """Forgets cumulative chainwork of headers at height and above."""
+        self._get_chainwork_index().truncate(height)
+
+    def _work_of_header(self, height: int, bits: Optional[int] = None) -> int:
+        """work done by single header at given height"""
+        if height < len(self.checkpoints) * 2016:
+            # we do not have the headers in the checkpoint region, but the
+            # checkpoints have the target at the end of each chunk
+            h, target = self.checkpoints[height // 2016]
+            return work_from_target(target)
+        if bits is None:
+            timestamp_and_bits = self.read_timestamp_and_bits(height)
+            if timestamp_and_bits is None:
+                raise MissingHeader(height)
+            bits = timestamp_and_bits[1]
+        return work_from_target(self.bits_to_target(bits))
+
+    def _get_checkpoint_chainwork(self, height: int) -> int:
+        """Total work up to and including height, within the checkpoint region.
+        Every header of a checkpointed chunk counts with the checkpoint target.
+        """
+        works = self._checkpoint_chainworks
+        if works is None:
+            works = [0]
+            for index in range(len(self.checkpoints)):
+                works.append(works[-1] + 2016 * self._work_of_header(index * 2016))
+            self._checkpoint_chainworks = works
+        chunk = height // 2016
+        return works[chunk] + (height % 2016 + 1) * self._work_of_header(height)
+
+    @with_lock
+    def _get_chainwork(self, height: int) -> int:
+        """Total work up to and including height."""
+        if height < 0:
+            return 0
+        if height < self.forkpoint:
+            return self.parent._get_chainwork(height)
+        if height < len(self.checkpoints) * 2016:
+            return self._get_checkpoint_chainwork(height)
+        index = self._get_chainwork_index()
+        work = index.get(height)
+        if work is not None:
+            return work
+        if height > self.height():
+            raise MissingHeader(height)
+        # fill in the missing records, oldest first
+        next_height = index.next_height()
+        work = self._get_chainwork(next_height - 1)
+        works = []
+        for h in range(next_height, height + 1):
+            work += self._work_of_header(h)
+            works.append(work)
+        index.extend(next_height, works)
+        return work
+
+    def get_chainwork(self, height=None) -> int:
+        if height is None:
+            height = max(0, self.height())
+        if constants.net.TESTNET:
             # On testnet/regtest, difficulty works somewhat different.
             # It's out of scope to properly implement that.
-    #        return height
-    #    last_retarget = height // 2016 * 2016 - 1
-    #    cached_height = last_retarget
-    #    while _CHAINWORK_CACHE.get(self.get_hash(cached_height)) is None:
-    #        if cached_height <= -1:
-    #            break
-    #        cached_height -= 2016
-    #    assert cached_height >= -1, cached_height
-    #    running_total = _CHAINWORK_CACHE[self.get_hash(cached_height)]
-    #    while cached_height < last_retarget:
-    #        cached_height += 2016
-    #        work_in_single_header = self.chainwork_of_header_at_height(cached_height)
-    #        work_in_chunk = 2016 * work_in_single_header
-    #        running_total += work_in_chunk
-    #        _CHAINWORK_CACHE[self.get_hash(cached_height)] = running_total
-    #    cached_height += 2016
-    #    work_in_single_header = self.chainwork_of_header_at_height(cached_height)
-    #    work_in_last_partial_chunk = (height % 2016 + 1) * work_in_single_header
-    #    return running_total + work_in_last_partial_chunk
+            return height
+        return self._get_chainwork(height)
 
     def can_connect(self, header: dict, check_height: bool=True) -> bool:
         if header is None:
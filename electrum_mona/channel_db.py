@@ -27,22 +27,27 @@ import time
 import random
 import os
 from collections import defaultdict
-from typing import Sequence, List, Tuple, Optional, Dict, NamedTuple, TYPE_CHECKING, Set
+from typing import Sequence, List, Tuple, Optional, Dict, NamedTuple, TYPE_CHECKING, Set, Callable
 import binascii
+import hashlib
+import struct
 import base64
 import asyncio
 import threading
+import concurrent.futures
 from enum import IntEnum
+from functools import partial
 
 from aiorpcx import NetAddress
 
-from .sql_db import SqlDB, sql
+from .sql_db import SqlDB, sql, sql_batched
 from . import constants, util
 from .util import bh2u, profiler, get_headers_dir, is_ip_address, json_normalize
 from .logging import Logger
 from .lnutil import (LNPeerAddr, format_short_channel_id, ShortChannelID,
                      validate_features, IncompatibleOrInsaneFeatures, InvalidGossipMsg)
 from .lnverifier import LNChannelVerifier, verify_sig_for_channel_update
+from .lngraph import CompactChannelGraph, ChangeLog
 from .lnmsg import decode_msg
 from . import ecc
 from .crypto import sha256d
@@ -240,6 +245,185 @@ class CategorizedChannelUpdates(NamedTuple):
     good: List        # good updates
 
 
+# Snapshot of the in-memory gossip data, so that it does not need to be
+# decoded from raw messages at startup (see ChannelDB.load_data).
+# Layout: header, then channels and policies as fixed-size records,
+# then nodes and addresses as variable-size records.
+GOSSIP_SNAPSHOT_MAGIC = b'ELSNAP'
+GOSSIP_SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct('<6sH16s32sIIII')  # magic, version, snapshot_id, sha256(body), counts
+_SNAPSHOT_CHANNEL = struct.Struct('<8s33s33sq')  # capacity_sat: -1 if unknown
+_SNAPSHOT_POLICY = struct.Struct('<41sHQBQIIBBI')  # has_htlc_maximum, htlc_maximum_msat
+_SNAPSHOT_NODE = struct.Struct('<33sIHB')  # timestamp, len(features), len(alias)
+_SNAPSHOT_ADDRESS = struct.Struct('<33sHQB')  # port, timestamp, len(host)
+
+
+class GossipSnapshot(NamedTuple):
+    snapshot_id: bytes
+    channels: Sequence[ChannelInfo]
+    policies: Sequence[Policy]
+    nodes: Sequence[NodeInfo]
+    addresses: Sequence[Tuple[bytes, str, int, int]]  # node_id, host, port, timestamp
+
+    def to_bytes(self) -> bytes:
+        parts = []
+        pack_channel = _SNAPSHOT_CHANNEL.pack
+        for ci in self.channels:
+            parts.append(pack_channel(ci.short_channel_id, ci.node1_id, ci.node2_id,
+                                      ci.capacity_sat if ci.capacity_sat is not None else -1))
+        pack_policy = _SNAPSHOT_POLICY.pack
+        for p in self.policies:
+            parts.append(pack_policy(p.key, p.cltv_expiry_delta, p.htlc_minimum_msat,
+                                     p.htlc_maximum_msat is not None, p.htlc_maximum_msat or 0,
+                                     p.fee_base_msat, p.fee_proportional_millionths,
+                                     p.channel_flags, p.message_flags, p.timestamp))
+        for node_info in self.nodes:
+            features = node_info.features.to_bytes((node_info.features.bit_length() + 7) // 8, 'big')
+            alias = node_info.alias.encode('utf8')
+            parts.append(_SNAPSHOT_NODE.pack(node_info.node_id, node_info.timestamp, len(features), len(alias)))
+            parts.append(features)
+            parts.append(alias)
+        for node_id, host, port, timestamp in self.addresses:
+            host = host.encode('utf8')
+            parts.append(_SNAPSHOT_ADDRESS.pack(node_id, port, timestamp, len(host)))
+            parts.append(host)
+        body = b''.join(parts)
+        header = _SNAPSHOT_HEADER.pack(
+            GOSSIP_SNAPSHOT_MAGIC, GOSSIP_SNAPSHOT_VERSION, self.snapshot_id, hashlib.sha256(body).digest(),
+            len(self.channels), len(self.policies), len(self.nodes), len(self.addresses))
+        return header + body
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'GossipSnapshot':
+        """Raises ValueError if data is not a valid snapshot."""
+        if len(data) < _SNAPSHOT_HEADER.size:
+            raise ValueError('gossip snapshot too short')
+        magic, version, snapshot_id, body_hash, num_channels, num_policies, num_nodes, num_addresses = \
+            _SNAPSHOT_HEADER.unpack_from(data)
+        if magic != GOSSIP_SNAPSHOT_MAGIC or version != GOSSIP_SNAPSHOT_VERSION:
+            raise ValueError('unknown gossip snapshot format')
+        body = memoryview(data)[_SNAPSHOT_HEADER.size:]
+        if hashlib.sha256(body).digest() != body_hash:
+            raise ValueError('gossip snapshot corrupted')
+        pos = 0
+        end = pos + num_channels * _SNAPSHOT_CHANNEL.size
+        # note: NamedTuples are built with positional args, as it is faster
+        channels = [
+            ChannelInfo(ShortChannelID(scid), node1_id, node2_id, capacity_sat if capacity_sat >= 0 else None)
+            for scid, node1_id, node2_id, capacity_sat in _SNAPSHOT_CHANNEL.iter_unpack(body[pos:end])]
+        pos = end
+        end = pos + num_policies * _SNAPSHOT_POLICY.size
+        policies = [
+            Policy(key, cltv_expiry_delta, htlc_minimum_msat, htlc_maximum_msat if has_htlc_maximum else None,
+                   fee_base_msat, fee_proportional_millionths, channel_flags, message_flags, timestamp)
+            for (key, cltv_expiry_delta, htlc_minimum_msat, has_htlc_maximum, htlc_maximum_msat,
+                 fee_base_msat, fee_proportional_millionths, channel_flags, message_flags, timestamp)
+            in _SNAPSHOT_POLICY.iter_unpack(body[pos:end])]
+        pos = end
+        nodes = []
+        for i in range(num_nodes):
+            node_id, timestamp, features_len, alias_len = _SNAPSHOT_NODE.unpack_from(body, pos)
+            pos += _SNAPSHOT_NODE.size
+            features = int.from_bytes(body[pos:pos+features_len], 'big')
+            pos += features_len
+            alias = bytes(body[pos:pos+alias_len]).decode('utf8')
+            pos += alias_len
+            nodes.append(NodeInfo(node_id=node_id, features=features, timestamp=timestamp, alias=alias))
+        addresses = []
+        for i in range(num_addresses):
+            node_id, port, timestamp, host_len = _SNAPSHOT_ADDRESS.unpack_from(body, pos)
+            pos += _SNAPSHOT_ADDRESS.size
+            host = bytes(body[pos:pos+host_len]).decode('utf8')
+            pos += host_len
+            addresses.append((node_id, host, port, timestamp))
+        if pos != len(body):
+            raise ValueError('gossip snapshot has unexpected length')
+        return GossipSnapshot(
+            snapshot_id=snapshot_id,
+            channels=channels,
+            policies=policies,
+            nodes=nodes,
+            addresses=addresses)
+
+
+_gossip_verify_executor = None  # type: Optional[concurrent.futures.ThreadPoolExecutor]
+_gossip_verify_executor_workers = 0
+_gossip_verify_executor_lock = threading.Lock()
+
+# messages per job submitted to the executor
+GOSSIP_VERIFY_MIN_SHARD_SIZE = 16
+
+
+def get_gossip_verify_executor(num_workers: int) -> concurrent.futures.ThreadPoolExecutor:
+    # note: threads are enough, as libsecp256k1 calls through ctypes release the GIL
+    global _gossip_verify_executor, _gossip_verify_executor_workers
+    with _gossip_verify_executor_lock:
+        if _gossip_verify_executor is None or _gossip_verify_executor_workers != num_workers:
+            if _gossip_verify_executor is not None:
+                _gossip_verify_executor.shutdown(wait=False)
+            _gossip_verify_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=num_workers, thread_name_prefix='gossip_verify')
+            _gossip_verify_executor_workers = num_workers
+        return _gossip_verify_executor
+
+
+def _verify_gossip_shard(verify_func: Callable[[dict], None], payloads: Sequence[dict]) -> Optional[InvalidGossipMsg]:
+    for payload in payloads:
+        try:
+            verify_func(payload)
+        except InvalidGossipMsg as e:
+            return e
+    return None
+
+
+def verify_gossip_msgs(verify_func: Callable[[dict], None], payloads: Sequence[dict],
+                       num_workers: int) -> None:
+    """Calls verify_func on every payload, sharding them across a pool of
+    num_workers threads. Raises InvalidGossipMsg if any payload is invalid.
+    """
+    if num_workers <= 1 or len(payloads) < 2 * GOSSIP_VERIFY_MIN_SHARD_SIZE:
+        error = _verify_gossip_shard(verify_func, payloads)
+    else:
+        executor = get_gossip_verify_executor(num_workers)
+        num_shards = min(num_workers, len(payloads) // GOSSIP_VERIFY_MIN_SHARD_SIZE)
+        shard_size = -(-len(payloads) // num_shards)
+        shards = [payloads[i:i+shard_size] for i in range(0, len(payloads), shard_size)]
+        errors = [e for e in executor.map(partial(_verify_gossip_shard, verify_func), shards) if e is not None]
+        error = errors[0] if errors else None
+    if error is not None:
+        raise error
+
+
+class GossipVerificationStats:
+    """Counts verified gossip messages, per message type."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.num_verified = defaultdict(int)  # type: Dict[str, int]
+        self.num_rejected = defaultdict(int)  # type: Dict[str, int]  # msgs in batches that failed
+        self.seconds = defaultdict(float)  # type: Dict[str, float]
+
+    def add(self, msg_type: str, num_msgs: int, seconds: float, *, valid: bool) -> None:
+        with self.lock:
+            if valid:
+                self.num_verified[msg_type] += num_msgs
+            else:
+                self.num_rejected[msg_type] += num_msgs
+            self.seconds[msg_type] += seconds
+
+    def get_stats(self) -> Dict[str, dict]:
+        with self.lock:
+            return {
+                msg_type: {
+                    'verified': self.num_verified[msg_type],
+                    'rejected': self.num_rejected[msg_type],
+                    'seconds': self.seconds[msg_type],
+                    'msgs_per_sec': self.num_verified[msg_type] / self.seconds[msg_type] if self.seconds[msg_type] else 0,
+                }
+                for msg_type in sorted(self.seconds)
+            }
+
+
 def get_mychannel_info(short_channel_id: ShortChannelID,
                        my_channels: Dict[ShortChannelID, 'Channel']) -> Optional[ChannelInfo]:
     chan = my_channels.get(short_channel_id)
@@ -298,14 +482,27 @@ msg BLOB,
 PRIMARY KEY(node_id)
 )"""
 
+create_meta = """
+CREATE TABLE IF NOT EXISTS meta (
+key STRING(64),
+value BLOB,
+PRIMARY KEY(key)
+)"""
+
 
 class ChannelDB(SqlDB):
 
     NUM_MAX_RECENT_PEERS = 20
+    DEFAULT_SNAPSHOT_INTERVAL = 3600  # seconds
 
     def __init__(self, network: 'Network'):
         path = os.path.join(get_headers_dir(network.config), 'gossip_db')
         super().__init__(network.asyncio_loop, path, commit_interval=100)
+        self.snapshot_path = path + '.snapshot'
+        # whether the db has the id of an up-to-date snapshot. only used in the SQL thread.
+        # until load_data has checked, we assume it does, so that writes remove it.
+        self._db_has_snapshot_id = True
+        self._last_snapshot_time = 0
         self.lock = threading.RLock()
         self.num_nodes = 0
         self.num_channels = 0
@@ -327,6 +524,9 @@ class ChannelDB(SqlDB):
 
         self.data_loaded = asyncio.Event()
         self.network = network # only for callback
+        self.verification_stats = GossipVerificationStats()
+        self._compact_graph = None  # type: Optional[CompactChannelGraph]  # built lazily
+        self.channel_changes = ChangeLog()  # used to check cached path finding results
 
     def update_counts(self):
         self.num_nodes = len(self._nodes)
@@ -454,8 +654,10 @@ class ChannelDB(SqlDB):
             self.logger.info(f'policy unchanged: {old_policy.timestamp} -> {new_policy.timestamp}')
         return changed
 
-    def add_channel_update(
-            self, payload, *, max_age=None, verify=True, verbose=True) -> UpdateStatus:
+    def _precheck_channel_update(self, payload, *, max_age=None) -> Optional[UpdateStatus]:
+        """Checks that do not need the signature. Sets payload['start_node'].
+        Returns None if the update should be verified and added.
+        """
         now = int(time.time())
         short_channel_id = ShortChannelID(payload['short_channel_id'])
         timestamp = payload['timestamp']
@@ -471,13 +673,25 @@ class ChannelDB(SqlDB):
         start_node = channel_info.node1_id if direction == 0 else channel_info.node2_id
         payload['start_node'] = start_node
         # compare updates to existing database entries
-        short_channel_id = ShortChannelID(payload['short_channel_id'])
         key = (start_node, short_channel_id)
         old_policy = self._policies.get(key)
         if old_policy and timestamp <= old_policy.timestamp + 60:
             return UpdateStatus.DEPRECATED
+        return None
+
+    def add_channel_update(
+            self, payload, *, max_age=None, verify=True, verbose=True) -> UpdateStatus:
+        status = self._precheck_channel_update(payload, max_age=max_age)
+        if status is not None:
+            return status
         if verify:
             self.verify_channel_update(payload)
+        return self._add_prechecked_channel_update(payload, verbose=verbose)
+
+    def _add_prechecked_channel_update(self, payload, *, verbose: bool) -> UpdateStatus:
+        short_channel_id = ShortChannelID(payload['short_channel_id'])
+        key = (payload['start_node'], short_channel_id)
+        old_policy = self._policies.get(key)
         policy = Policy.from_msg(payload)
         with self.lock:
             self._policies[key] = policy
@@ -490,13 +704,28 @@ class ChannelDB(SqlDB):
             return UpdateStatus.GOOD
 
     def add_channel_updates(self, payloads, max_age=None) -> CategorizedChannelUpdates:
+        # precheck each update once. the updates are added in order, so an update
+        # is deprecated by an earlier one in the batch, like by one in the db
+        statuses = []  # type: List[Optional[UpdateStatus]]
+        timestamps = {}  # type: Dict[Tuple[bytes, ShortChannelID], int]
+        for payload in payloads:
+            status = self._precheck_channel_update(payload, max_age=max_age)
+            if status is None:
+                key = (payload['start_node'], ShortChannelID(payload['short_channel_id']))
+                if key in timestamps and payload['timestamp'] <= timestamps[key] + 60:
+                    status = UpdateStatus.DEPRECATED
+                else:
+                    timestamps[key] = payload['timestamp']
+            statuses.append(status)
+        # verify signatures upfront, in parallel; except for updates we discard anyway
+        self.verify_channel_updates([payload for payload, status in zip(payloads, statuses) if status is None])
         orphaned = []
         expired = []
         deprecated = []
         unchanged = []
         good = []
-        for payload in payloads:
-            r = self.add_channel_update(payload, max_age=max_age, verbose=False, verify=True)
+        for payload, status in zip(payloads, statuses):
+            r = status if status is not None else self._add_prechecked_channel_update(payload, verbose=False)
             if r == UpdateStatus.ORPHANED:
                 orphaned.append(payload)
             elif r == UpdateStatus.EXPIRED:
@@ -522,51 +751,67 @@ class ChannelDB(SqlDB):
         c.execute(create_address)
         c.execute(create_policy)
         c.execute(create_channel_info)
+        c.execute(create_meta)
         self.conn.commit()
 
-    @sql
-    def _db_save_policy(self, key: bytes, msg: bytes):
-        # 'msg' is a 'channel_update' message
+    def _db_invalidate_snapshot(self):
+        # called before every write, in the SQL thread.
+        # note: this is committed together with the write
+        if self._db_has_snapshot_id:
+            c = self.conn.cursor()
+            c.execute("""DELETE FROM meta WHERE key='snapshot_id'""")
+            self._db_has_snapshot_id = False
+
+    @sql_batched
+    def _db_save_policy(self, rows: Sequence[Tuple[bytes, bytes]]):
+        # rows of (key, msg), where 'msg' is a 'channel_update' message
+        self._db_invalidate_snapshot()
         c = self.conn.cursor()
-        c.execute("""REPLACE INTO policy (key, msg) VALUES (?,?)""", [key, msg])
+        c.executemany("""REPLACE INTO policy (key, msg) VALUES (?,?)""", rows)
 
-    @sql
-    def _db_delete_policy(self, node_id: bytes, short_channel_id: ShortChannelID):
-        key = short_channel_id + node_id
+    @sql_batched
+    def _db_delete_policy(self, rows: Sequence[Tuple[bytes, ShortChannelID]]):
+        # rows of (node_id, short_channel_id)
+        self._db_invalidate_snapshot()
         c = self.conn.cursor()
-        c.execute("""DELETE FROM policy WHERE key=?""", (key,))
+        c.executemany("""DELETE FROM policy WHERE key=?""",
+                      [(short_channel_id + node_id,) for node_id, short_channel_id in rows])
 
-    @sql
-    def _db_save_channel(self, short_channel_id: ShortChannelID, msg: bytes):
-        # 'msg' is a 'channel_announcement' message
+    @sql_batched
+    def _db_save_channel(self, rows: Sequence[Tuple[ShortChannelID, bytes]]):
+        # rows of (short_channel_id, msg), where 'msg' is a 'channel_announcement' message
+        self._db_invalidate_snapshot()
         c = self.conn.cursor()
-        c.execute("REPLACE INTO channel_info (short_channel_id, msg) VALUES (?,?)", [short_channel_id, msg])
+        c.executemany("REPLACE INTO channel_info (short_channel_id, msg) VALUES (?,?)", rows)
 
-    @sql
-    def _db_delete_channel(self, short_channel_id: ShortChannelID):
+    @sql_batched
+    def _db_delete_channel(self, rows: Sequence[Tuple[ShortChannelID]]):
+        self._db_invalidate_snapshot()
         c = self.conn.cursor()
-        c.execute("""DELETE FROM channel_info WHERE short_channel_id=?""", (short_channel_id,))
+        c.executemany("""DELETE FROM channel_info WHERE short_channel_id=?""", rows)
 
-    @sql
-    def _db_save_node_info(self, node_id: bytes, msg: bytes):
-        # 'msg' is a 'node_announcement' message
+    @sql_batched
+    def _db_save_node_info(self, rows: Sequence[Tuple[bytes, bytes]]):
+        # rows of (node_id, msg), where 'msg' is a 'node_announcement' message
+        self._db_invalidate_snapshot()
         c = self.conn.cursor()
-        c.execute("REPLACE INTO node_info (node_id, msg) VALUES (?,?)", [node_id, msg])
+        c.executemany("REPLACE INTO node_info (node_id, msg) VALUES (?,?)", rows)
 
-    @sql
-    def _db_save_node_address(self, peer: LNPeerAddr, timestamp: int):
+    @sql_batched
+    def _db_save_node_address(self, rows: Sequence[Tuple[LNPeerAddr, int]]):
+        # rows of (peer, timestamp)
+        self._db_invalidate_snapshot()
         c = self.conn.cursor()
-        c.execute("REPLACE INTO address (node_id, host, port, timestamp) VALUES (?,?,?,?)",
-                  (peer.pubkey, peer.host, peer.port, timestamp))
+        c.executemany("REPLACE INTO address (node_id, host, port, timestamp) VALUES (?,?,?,?)",
+                      [(peer.pubkey, peer.host, peer.port, timestamp) for peer, timestamp in rows])
 
     @sql
     def _db_save_node_addresses(self, node_addresses: Sequence[LNPeerAddr]):
+        self._db_invalidate_snapshot()
         c = self.conn.cursor()
-        for addr in node_addresses:
-            c.execute("SELECT * FROM address WHERE node_id=? AND host=? AND port=?", (addr.pubkey, addr.host, addr.port))
-            r = c.fetchall()
-            if r == []:
-                c.execute("INSERT INTO address (node_id, host, port, timestamp) VALUES (?,?,?,?)", (addr.pubkey, addr.host, addr.port, 0))
+        # note: existing addresses keep their timestamp
+        c.executemany("INSERT OR IGNORE INTO address (node_id, host, port, timestamp) VALUES (?,?,?,?)",
+                      [(addr.pubkey, addr.host, addr.port, 0) for addr in node_addresses])
 
     @classmethod
     def verify_channel_update(cls, payload, *, start_node: bytes = None) -> None:
@@ -596,6 +841,43 @@ class ChannelDB(SqlDB):
         if not ecc.verify_signature(pubkey, signature, h):
             raise InvalidGossipMsg('signature failed')
 
+    def get_gossip_verify_workers(self) -> int:
+        """Number of threads used to verify gossip signatures.
+        0 or 1 means everything is verified serially on the calling thread.
+        """
+        num_workers = self.network.config.get('lightning_gossip_verify_workers', -1)
+        try:
+            num_workers = int(num_workers)
+        except (TypeError, ValueError):
+            return 0
+        if num_workers < 0:  # auto
+            num_workers = min(4, os.cpu_count() or 1)
+        return num_workers
+
+    def _verify_gossip_msgs(self, msg_type: str, verify_func, payloads: Sequence[dict]) -> None:
+        if not payloads:
+            return
+        t0 = time.monotonic()
+        try:
+            verify_gossip_msgs(verify_func, payloads, self.get_gossip_verify_workers())
+        except InvalidGossipMsg:
+            self.verification_stats.add(msg_type, len(payloads), time.monotonic() - t0, valid=False)
+            raise
+        self.verification_stats.add(msg_type, len(payloads), time.monotonic() - t0, valid=True)
+
+    def verify_channel_announcements(self, payloads: Sequence[dict]) -> None:
+        self._verify_gossip_msgs('channel_announcement', self.verify_channel_announcement, payloads)
+
+    def verify_node_announcements(self, payloads: Sequence[dict]) -> None:
+        self._verify_gossip_msgs('node_announcement', self.verify_node_announcement, payloads)
+
+    def verify_channel_updates(self, payloads: Sequence[dict]) -> None:
+        # note: payloads must have 'start_node' set
+        self._verify_gossip_msgs('channel_update', self.verify_channel_update, payloads)
+
+    def get_verification_stats(self) -> Dict[str, dict]:
+        return self.verification_stats.get_stats()
+
     def add_node_announcements(self, msg_payloads):
         # note: signatures have already been verified.
         if type(msg_payloads) is dict:
@@ -671,6 +953,7 @@ class ChannelDB(SqlDB):
         if prev_chanupd == msg_payload:
             return False
         self._channel_updates_for_private_channels[key] = msg_payload
+        self.channel_changes.record(short_channel_id, start_node_id)
         return True
 
     def remove_channel(self, short_channel_id: ShortChannelID):
@@ -697,7 +980,36 @@ class ChannelDB(SqlDB):
     def load_data(self):
         if self.data_loaded.is_set():
             return
-        # Note: this method takes several seconds... mostly due to lnmsg.decode_msg being slow.
+        t0 = time.monotonic()
+        # Decoding the raw messages takes several seconds... mostly due to lnmsg.decode_msg being slow.
+        # So we load the pre-decoded snapshot instead, if it is up-to-date.
+        from_snapshot = self._load_snapshot()
+        if not from_snapshot:
+            self._load_raw_msgs()
+        def newest_ts_for_node_id(node_id):
+            newest_ts = 0
+            for addr, ts in self._addresses[node_id].items():
+                newest_ts = max(newest_ts, ts)
+            return newest_ts
+        sorted_node_ids = sorted(self._addresses.keys(), key=newest_ts_for_node_id, reverse=True)
+        self._recent_peers = sorted_node_ids[:self.NUM_MAX_RECENT_PEERS]
+        for channel_info in self._channels.values():
+            self._channels_for_node[channel_info.node1_id].add(channel_info.short_channel_id)
+            self._channels_for_node[channel_info.node2_id].add(channel_info.short_channel_id)
+            self._update_num_policies_for_chan(channel_info.short_channel_id)
+        self.logger.info(f'data loaded{" from snapshot" if from_snapshot else ""} in {time.monotonic() - t0:.2f} sec. '
+                         f'{len(self._channels)} chans. {len(self._policies)} policies. '
+                         f'{len(self._channels_for_node)} nodes.')
+        self.update_counts()
+        (nchans_with_0p, nchans_with_1p, nchans_with_2p) = self.get_num_channels_partitioned_by_policy_count()
+        self.logger.info(f'num_channels_partitioned_by_policy_count. '
+                         f'0p: {nchans_with_0p}, 1p: {nchans_with_1p}, 2p: {nchans_with_2p}')
+        if from_snapshot:
+            self._last_snapshot_time = time.monotonic()
+        self.asyncio_loop.call_soon_threadsafe(self.data_loaded.set)
+        util.trigger_callback('gossip_db_loaded')
+
+    def _load_raw_msgs(self):
         c = self.conn.cursor()
         c.execute("""SELECT * FROM address""")
         for x in c:
@@ -707,13 +1019,6 @@ class ChannelDB(SqlDB):
             except Exception:
                 continue
             self._addresses[node_id][net_addr] = int(timestamp or 0)
-        def newest_ts_for_node_id(node_id):
-            newest_ts = 0
-            for addr, ts in self._addresses[node_id].items():
-                newest_ts = max(newest_ts, ts)
-            return newest_ts
-        sorted_node_ids = sorted(self._addresses.keys(), key=newest_ts_for_node_id, reverse=True)
-        self._recent_peers = sorted_node_ids[:self.NUM_MAX_RECENT_PEERS]
         c.execute("""SELECT * FROM channel_info""")
         for short_channel_id, msg in c:
             try:
@@ -733,27 +1038,116 @@ class ChannelDB(SqlDB):
         for key, msg in c:
             p = Policy.from_raw_msg(key, msg)
             self._policies[(p.start_node, p.short_channel_id)] = p
-        for channel_info in self._channels.values():
-            self._channels_for_node[channel_info.node1_id].add(channel_info.short_channel_id)
-            self._channels_for_node[channel_info.node2_id].add(channel_info.short_channel_id)
-            self._update_num_policies_for_chan(channel_info.short_channel_id)
-        self.logger.info(f'data loaded. {len(self._channels)} chans. {len(self._policies)} policies. '
-                         f'{len(self._channels_for_node)} nodes.')
-        self.update_counts()
-        (nchans_with_0p, nchans_with_1p, nchans_with_2p) = self.get_num_channels_partitioned_by_policy_count()
-        self.logger.info(f'num_channels_partitioned_by_policy_count. '
-                         f'0p: {nchans_with_0p}, 1p: {nchans_with_1p}, 2p: {nchans_with_2p}')
-        self.asyncio_loop.call_soon_threadsafe(self.data_loaded.set)
-        util.trigger_callback('gossip_db_loaded')
+
+    def _load_snapshot(self) -> bool:
+        """Loads the snapshot, if the db has not changed since it was written.
+        Called from load_data, in the SQL thread.
+        """
+        c = self.conn.cursor()
+        c.execute("""SELECT value FROM meta WHERE key='snapshot_id'""")
+        row = c.fetchone()
+        snapshot = None
+        if row is not None:
+            try:
+                with open(self.snapshot_path, 'rb') as f:
+                    snapshot = GossipSnapshot.from_bytes(f.read())
+            except (OSError, ValueError, struct.error, UnicodeDecodeError) as e:
+                self.logger.info(f'cannot load gossip snapshot: {e!r}')
+            if snapshot is not None and snapshot.snapshot_id != row[0]:
+                self.logger.info('gossip snapshot is stale')
+                snapshot = None
+        self._db_has_snapshot_id = True
+        if snapshot is None:
+            self._db_invalidate_snapshot()
+            return False
+        for ci in snapshot.channels:
+            self._channels[ci.short_channel_id] = ci
+        # note: Policy.short_channel_id is slow, so we look up the instances of channels
+        scids = {scid: scid for scid in self._channels}
+        for p in snapshot.policies:
+            key = p.key
+            scid = scids.get(key[:8]) or ShortChannelID(key[:8])
+            self._policies[(key[8:], scid)] = p
+        for node_info in snapshot.nodes:
+            self._nodes[node_info.node_id] = node_info
+        for node_id, host, port, timestamp in snapshot.addresses:
+            try:
+                net_addr = NetAddress(host, port)
+            except Exception:
+                continue
+            self._addresses[node_id][net_addr] = timestamp
+        return True
+
+    def get_snapshot_interval(self) -> int:
+        """How often (in seconds) the gossip snapshot is written. 0 disables snapshots."""
+        return int(self.network.config.get('lightning_gossip_snapshot_interval', self.DEFAULT_SNAPSHOT_INTERVAL))
+
+    def maybe_save_snapshot(self) -> None:
+        """Writes a snapshot, if the last one is older than the snapshot interval.
+        Called periodically by LNGossip.
+        """
+        interval = self.get_snapshot_interval()
+        if interval <= 0 or time.monotonic() - self._last_snapshot_time < interval:
+            return
+        self._last_snapshot_time = time.monotonic()
+        self._db_save_snapshot()
+
+    @sql
+    def _db_save_snapshot(self):
+        self._save_snapshot()
+
+    def before_close(self):
+        if self.get_snapshot_interval() <= 0:
+            return
+        try:
+            self._save_snapshot()
+        except Exception as e:
+            self.logger.exception(f'failed to save gossip snapshot: {e!r}')
+
+    @profiler
+    def _save_snapshot(self):
+        # called in the SQL thread, so that no write to the db happens concurrently
+        if self._db_has_snapshot_id:
+            return  # db unchanged since the last snapshot, or not loaded yet
+        with self.lock:
+            channels = list(self._channels.values())
+            policies = list(self._policies.values())
+            nodes = list(self._nodes.values())
+            addresses = [(node_id, str(net_addr.host), net_addr.port, ts)
+                         for node_id, addr_to_ts in self._addresses.items()
+                         for net_addr, ts in addr_to_ts.items()]
+        snapshot = GossipSnapshot(
+            snapshot_id=os.urandom(16),
+            channels=channels,
+            policies=policies,
+            nodes=nodes,
+            addresses=addresses)
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(snapshot.to_bytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        c = self.conn.cursor()
+        c.execute("""REPLACE INTO meta (key, value) VALUES ('snapshot_id', ?)""", (snapshot.snapshot_id,))
+        self.conn.commit()
+        self._db_has_snapshot_id = True
+        self.logger.info(f'gossip snapshot saved: {len(channels)} chans, {len(policies)} policies, {len(nodes)} nodes')
 
     def _update_num_policies_for_chan(self, short_channel_id: ShortChannelID) -> None:
+        # note: this is called every time a channel or one of its policies changes
+        graph = self._compact_graph
+        if graph is not None:
+            graph.update_channel(self, short_channel_id)
         channel_info = self.get_channel_info(short_channel_id)
         if channel_info is None:
+            self.channel_changes.record(short_channel_id)
             with self.lock:
                 self._chans_with_0_policies.discard(short_channel_id)
                 self._chans_with_1_policies.discard(short_channel_id)
                 self._chans_with_2_policies.discard(short_channel_id)
             return
+        self.channel_changes.record(short_channel_id, channel_info.node1_id, channel_info.node2_id)
         p1 = self.get_policy_for_node(short_channel_id, channel_info.node1_id)
         p2 = self.get_policy_for_node(short_channel_id, channel_info.node2_id)
         with self.lock:
@@ -767,6 +1161,21 @@ class ChannelDB(SqlDB):
             else:
                 self._chans_with_1_policies.add(short_channel_id)
 
+    def get_compact_graph(self) -> CompactChannelGraph:
+        """Returns the public graph in compact form, for path finding.
+        It is built on first use, and then kept up-to-date.
+        """
+        if not self.data_loaded.is_set():
+            raise Exception("channelDB data not loaded yet!")
+        graph = self._compact_graph
+        if graph is None:
+            # hold the lock so that no update is missed while building
+            with self.lock:
+                if self._compact_graph is None:
+                    self._compact_graph = CompactChannelGraph.from_channel_db(self)
+                graph = self._compact_graph
+        return graph
+
     def get_num_channels_partitioned_by_policy_count(self) -> Tuple[int, int, int]:
         nchans_with_0p = len(self._chans_with_0_policies)
         nchans_with_1p = len(self._chans_with_1_policies)
@@ -24,7 +24,7 @@
 # SOFTWARE.
 from collections import defaultdict
 from math import floor, log10
-from typing import NamedTuple, List, Callable, Sequence, Union, Dict, Tuple
+from typing import NamedTuple, List, Callable, Sequence, Union, Dict, Tuple, Optional
 from decimal import Decimal
 
 from .bitcoin import sha256, COIN, is_address
@@ -83,10 +83,20 @@ class Bucket(NamedTuple):
 
 class ScoredCandidate(NamedTuple):
     penalty: float
-    tx: PartialTransaction
+    tx: Optional[PartialTransaction]  # None if not constructed yet
     buckets: List[Bucket]
 
 
+class SpendParams(NamedTuple):
+    """What make_tx knows about the tx being built, before choosing buckets."""
+    input_value: int              # value of the fixed inputs. in satoshis
+    spent_amount: int             # value of the fixed outputs. in satoshis
+    base_weight: int              # weight of the tx without buckets and change
+    change_weight: int            # weight of one change output
+    fee_estimator_w: Callable[[int], int]
+    dust_threshold: int
+
+
 def strip_unneeded(bkts: List[Bucket], sufficient_funds) -> List[Bucket]:
     '''Remove buckets that are unnecessary in achieving the spend amount'''
     if sufficient_funds([], bucket_value_sum=0):
@@ -324,6 +334,20 @@ class CoinChooserBase(Logger):
                                                             dust_threshold=dust_threshold,
                                                             base_weight=base_weight)
 
+        # guess the change address, as in _construct_tx_from_selected_buckets
+        if change_addrs:
+            change_addr = change_addrs[0]
+        else:
+            change_addr = next((txin.address for txin in list(inputs) + list(coins) if txin.address), None)
+        change_weight = 4 * (Transaction.estimated_output_size_for_address(change_addr)
+                             if change_addr else Transaction.estimated_output_size_for_script('00' * 22))
+        self.spend_params = SpendParams(input_value=input_value,
+                                        spent_amount=spent_amount,
+                                        base_weight=base_weight,
+                                        change_weight=change_weight,
+                                        fee_estimator_w=fee_estimator_w,
+                                        dust_threshold=dust_threshold)
+
         # Collect the coins into buckets
         all_buckets = self.bucketize_coins(coins, fee_estimator_vb=fee_estimator_vb)
         # Filter some buckets out. Only keep those that have positive effective value.
@@ -335,6 +359,8 @@ class CoinChooserBase(Logger):
         scored_candidate = self.choose_buckets(all_buckets, sufficient_funds,
                                                self.penalty_func(base_tx, tx_from_buckets=tx_from_buckets))
         tx = scored_candidate.tx
+        if tx is None:
+            tx, _ = tx_from_buckets(scored_candidate.buckets)
 
         self.logger.info(f"using {len(tx.inputs())} inputs")
         self.logger.info(f"using buckets: {[bucket.desc for bucket in scored_candidate.buckets]}")
@@ -457,8 +483,7 @@ class CoinChooserPrivacy(CoinChooserRandom):
         def penalty(buckets: List[Bucket]) -> ScoredCandidate:
             # Penalize using many buckets (~inputs)
             badness = len(buckets) - 1
-            tx, change_outputs = tx_from_buckets(buckets)
-            change = sum(o.value for o in change_outputs)
+            tx, change = self._tx_and_change(buckets, tx_from_buckets=tx_from_buckets)
             # Penalize change not roughly in output range
             if change == 0:
                 pass  # no change is great!
@@ -475,9 +500,121 @@ class CoinChooserPrivacy(CoinChooserRandom):
 
         return penalty
 
+    def _tx_and_change(self, buckets: List[Bucket], *, tx_from_buckets) -> Tuple[Optional[PartialTransaction], int]:
+        """Returns the tx spending buckets, and the total value of its change outputs."""
+        tx, change_outputs = tx_from_buckets(buckets)
+        return tx, sum(o.value for o in change_outputs)
+
+
+# number of nodes of the search tree visited by CoinChooserBranchAndBound,
+# before falling back to the privacy heuristic
+BNB_MAX_TRIES = 100000
+
+
+class CoinChooserBranchAndBound(CoinChooserPrivacy):
+    """Looks for a set of coins that pays for the transaction without
+    creating change, wasting at most what a change output would cost.
+    This saves the fee of the change output, and the fee of spending it later.
+    If there is no such set, coins are chosen as in the Privacy method.
+    """
+
+    def choose_buckets(self, buckets, sufficient_funds, penalty_func):
+        if not sufficient_funds([], bucket_value_sum=0):
+            # try confirmed coins first, as bucket_candidates_prefer_confirmed
+            tiers = [[bkt for bkt in buckets if bkt.min_height > 0],
+                     [bkt for bkt in buckets if bkt.min_height >= 0],
+                     buckets]
+            tried = set()
+            for bkts in tiers:
+                # each tier contains the previous one, so equal size means equal tiers
+                if len(bkts) in tried:
+                    continue
+                tried.add(len(bkts))
+                selection = self.branch_and_bound(bkts, sufficient_funds)
+                if selection is not None:
+                    winner = penalty_func(selection)
+                    self.logger.info(f"Total number of buckets: {len(buckets)}")
+                    self.logger.info(f"Found changeless solution with {len(selection)} buckets")
+                    return winner
+        return super().choose_buckets(buckets, sufficient_funds, penalty_func)
+
+    def branch_and_bound(self, buckets: List[Bucket], sufficient_funds) -> Optional[List[Bucket]]:
+        """Depth-first search over including or excluding each bucket, largest
+        effective value first, for the selection that pays for the tx without
+        change and with the least fee, i.e. the fee of its buckets plus the
+        excess that would have gone to change.
+        Returns None if there is no such selection, or it was not found in
+        BNB_MAX_TRIES steps.
+        """
+        params = self.spend_params
+        fee_estimator_w = params.fee_estimator_w
+        # effective values already account for the weight of the buckets
+        base_weight = params.base_weight + 2 * any(bkt.witness for bkt in buckets)
+        base_fee = fee_estimator_w(base_weight)
+        target = params.spent_amount - params.input_value + base_fee
+        # the change would be below the dust threshold if the excess is smaller than this
+        cost_of_change = fee_estimator_w(base_weight + params.change_weight) - base_fee + params.dust_threshold
+
+        buckets = sorted(buckets, key=lambda bkt: bkt.effective_value, reverse=True)
+        values = [bkt.effective_value for bkt in buckets]
+        fees = [bkt.value - bkt.effective_value for bkt in buckets]
+        available = sum(values)  # effective value of the buckets not yet decided upon
+        if available < target:
+            return None
+        selected = []  # type: List[int]
+        selected_value = 0
+        selected_fee = 0
+        best = None
+        best_waste = None
+        i = 0
+        for _ in range(BNB_MAX_TRIES):
+            backtrack = False
+            excess = selected_value - target
+            if (excess + available < 0 or excess >= cost_of_change
+                    or (best_waste is not None and selected_fee + max(excess, 0) >= best_waste)):
+                backtrack = True
+            elif excess >= 0:
+                selection = [buckets[j] for j in selected]
+                if sufficient_funds(selection, bucket_value_sum=sum(bkt.value for bkt in selection)):
+                    best = selection
+                    best_waste = selected_fee + excess
+                backtrack = True
+            if backtrack:
+                if not selected:
+                    break  # explored everything
+                # exclude the last included bucket, and move on from there
+                i -= 1
+                while i > selected[-1]:
+                    available += values[i]
+                    i -= 1
+                selected.pop()
+                selected_value -= values[i]
+                selected_fee -= fees[i]
+            else:
+                available -= values[i]
+                # excluding a bucket and then including one of the same value is the
+                # same selection as the other way around, which was already visited
+                if not (i > 0 and values[i] == values[i - 1] and fees[i] == fees[i - 1]
+                        and (not selected or selected[-1] != i - 1)):
+                    selected.append(i)
+                    selected_value += values[i]
+                    selected_fee += fees[i]
+            i += 1
+        return best
+
+    def _tx_and_change(self, buckets, *, tx_from_buckets):
+        # estimate the change without constructing the tx, as only the winner gets built
+        params = self.spend_params
+        tx_weight = self._get_tx_weight(buckets, base_weight=params.base_weight)
+        excess = (params.input_value + sum(bkt.value for bkt in buckets) - params.spent_amount
+                  - params.fee_estimator_w(tx_weight + params.change_weight))
+        change = excess if excess >= params.dust_threshold else 0
+        return None, change
+
 
 COIN_CHOOSERS = {
     'Privacy': CoinChooserPrivacy,
+    'BranchAndBound': CoinChooserBranchAndBound,
 }
 
 def get_name(config):
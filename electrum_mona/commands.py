@@ -93,6 +93,7 @@ class Command:
         self.requires_network = 'n' in s
         self.requires_wallet = 'w' in s
         self.requires_password = 'p' in s
+        self.modifies_state = 'm' in s
         self.description = func.__doc__
         self.help = self.description.split('.')[0] if self.description else None
         varnames = func.__code__.co_varnames[1:func.__code__.co_argcount]
@@ -211,7 +212,7 @@ class Commands:
         }
         return response
 
-    @command('n')
+    @command('nm')
     async def stop(self):
         """Stop daemon"""
         # TODO it would be nice if this could stop the GUI too
@@ -224,7 +225,7 @@ class Commands:
         return [{'path': path, 'synchronized': w.is_up_to_date()}
                 for path, w in self.daemon.get_wallets().items()]
 
-    @command('n')
+    @command('nm')
     async def load_wallet(self, wallet_path=None, password=None):
         """Open wallet in daemon"""
         wallet = self.daemon.load_wallet(wallet_path, password, manual_upgrades=False)
@@ -233,12 +234,12 @@ class Commands:
         response = wallet is not None
         return response
 
-    @command('n')
+    @command('nm')
     async def close_wallet(self, wallet_path=None):
         """Close wallet"""
         return await self.daemon._stop_wallet(wallet_path)
 
-    @command('')
+    @command('m')
     async def create(self, passphrase=None, password=None, encrypt_file=True, seed_type=None, wallet_path=None):
         """Create a new wallet.
         If you want to be prompted for an argument, type '?' or ':' (concealed)
@@ -255,7 +256,7 @@ class Commands:
             'msg': d['msg'],
         }
 
-    @command('')
+    @command('m')
     async def restore(self, text, passphrase=None, password=None, encrypt_file=True, wallet_path=None):
         """Restore a wallet from text. Text can be a seed phrase, a master
         public key, a master private key, a list of bitcoin addresses
@@ -274,7 +275,7 @@ class Commands:
             'msg': d['msg'],
         }
 
-    @command('wp')
+    @command('wpm')
     async def password(self, password=None, new_password=None, wallet: Abstract_Wallet = None):
         """Change wallet password. """
         if wallet.storage.is_encrypted_with_hw_device() and new_password:
@@ -305,7 +306,7 @@ class Commands:
                 pass
         return value
 
-    @command('')
+    @command('m')
     async def setconfig(self, key, value):
         """Set a configuration variable. 'value' may be a string or a Python expression."""
         value = self._setconfig_normalize_value(key, value)
@@ -431,7 +432,7 @@ class Commands:
         tx = tx_from_any(tx)
         return tx.to_json()
 
-    @command('n')
+    @command('nm')
     async def broadcast(self, tx):
         """Broadcast a transaction to the network. """
         tx = Transaction(tx)
@@ -446,23 +447,23 @@ class Commands:
         address = bitcoin.hash160_to_p2sh(hash_160(bfh(redeem_script)))
         return {'address':address, 'redeemScript':redeem_script}
 
-    @command('w')
+    @command('wm')
     async def freeze(self, address: str, wallet: Abstract_Wallet = None):
         """Freeze address. Freeze the funds at one of your wallet\'s addresses"""
         return wallet.set_frozen_state_of_addresses([address], True)
 
-    @command('w')
+    @command('wm')
     async def unfreeze(self, address: str, wallet: Abstract_Wallet = None):
         """Unfreeze address. Unfreeze the funds at one of your wallet\'s address"""
         return wallet.set_frozen_state_of_addresses([address], False)
 
-    @command('w')
+    @command('wm')
     async def freeze_utxo(self, coin: str, wallet: Abstract_Wallet = None):
         """Freeze a UTXO so that the wallet will not spend it."""
         wallet.set_frozen_state_of_coins([coin], True)
         return True
 
-    @command('w')
+    @command('wm')
     async def unfreeze_utxo(self, coin: str, wallet: Abstract_Wallet = None):
         """Unfreeze a UTXO so that the wallet might spend it."""
         wallet.set_frozen_state_of_coins([coin], False)
@@ -572,7 +573,7 @@ class Commands:
         s = wallet.get_seed(password)
         return s
 
-    @command('wp')
+    @command('wpm')
     async def importprivkey(self, privkey, password=None, wallet: Abstract_Wallet = None):
         """Import a private key."""
         if not wallet.can_import_privkey():
@@ -592,7 +593,7 @@ class Commands:
             raise Exception('cannot verify alias', x)
         return out['address']
 
-    @command('n')
+    @command('nm')
     async def sweep(self, privkey, destination, fee=None, nocheck=False, imax=100):
         """Sweep private keys. Returns a transaction that spends UTXOs from
         privkey to a destination address. The transaction is not
@@ -626,7 +627,7 @@ class Commands:
         message = util.to_bytes(message)
         return ecc.verify_message_with_address(address, sig, message)
 
-    @command('wp')
+    @command('wpm')
     async def payto(self, destination, amount, fee=None, feerate=None, from_addr=None, from_coins=None, change_addr=None,
                     nocheck=False, unsigned=False, rbf=None, password=None, locktime=None, addtransaction=False, wallet: Abstract_Wallet = None):
         """Create a transaction. """
@@ -654,7 +655,7 @@ class Commands:
             await self.addtransaction(result, wallet=wallet)
         return result
 
-    @command('wp')
+    @command('wpm')
     async def paytomany(self, outputs, fee=None, feerate=None, from_addr=None, from_coins=None, change_addr=None,
                         nocheck=False, unsigned=False, rbf=None, password=None, locktime=None, addtransaction=False, wallet: Abstract_Wallet = None):
         """Create a multi-output transaction. """
@@ -713,7 +714,7 @@ class Commands:
         lightning_history = wallet.lnworker.get_history() if wallet.lnworker else []
         return json_normalize(lightning_history)
 
-    @command('w')
+    @command('wm')
     async def setlabel(self, key, label, wallet: Abstract_Wallet = None):
         """Assign a label to an item. Item may be a bitcoin address or a
         transaction ID"""
@@ -832,12 +833,12 @@ class Commands:
                    if f == wallet.get_request_status(wallet.get_key_for_receive_request(req))]
         return [wallet.export_request(x) for x in out]
 
-    @command('w')
+    @command('wm')
     async def createnewaddress(self, wallet: Abstract_Wallet = None):
         """Create a new receiving address, beyond the gap limit of the wallet"""
         return wallet.create_new_address(False)
 
-    @command('w')
+    @command('wm')
     async def changegaplimit(self, new_limit, iknowwhatimdoing=False, wallet: Abstract_Wallet = None):
         """Change the gap limit of the wallet."""
         if not iknowwhatimdoing:
@@ -867,7 +868,7 @@ class Commands:
         An address is considered as used if it has received a transaction, or if it is used in a payment request."""
         return wallet.get_unused_address()
 
-    @command('w')
+    @command('wm')
     async def add_request(self, amount, memo='', expiration=3600, force=False, wallet: Abstract_Wallet = None):
         """Create a payment request, using the first unused address of the wallet.
         The address will be considered as used after this operation.
@@ -885,14 +886,14 @@ class Commands:
         wallet.save_db()
         return wallet.export_request(req)
 
-    @command('wn')
+    @command('wnm')
     async def add_lightning_request(self, amount, memo='', expiration=3600, wallet: Abstract_Wallet = None):
         amount_sat = int(satoshis(amount))
         key = await wallet.lnworker._add_request_coro(amount_sat, memo, expiration)
         wallet.save_db()
         return wallet.get_formatted_request(key)
 
-    @command('w')
+    @command('wm')
     async def addtransaction(self, tx, wallet: Abstract_Wallet = None):
         """ Add a transaction to the wallet history """
         tx = Transaction(tx)
@@ -901,7 +902,7 @@ class Commands:
         wallet.save_db()
         return tx.txid()
 
-    @command('wp')
+    @command('wpm')
     async def signrequest(self, address, password=None, wallet: Abstract_Wallet = None):
         "Sign payment request with an OpenAlias"
         alias = self.config.get('alias')
@@ -910,26 +911,26 @@ class Commands:
         alias_addr = wallet.contacts.resolve(alias)['address']
         wallet.sign_payment_request(address, alias, alias_addr, password)
 
-    @command('w')
+    @command('wm')
     async def rmrequest(self, address, wallet: Abstract_Wallet = None):
         """Remove a payment request"""
         result = wallet.remove_payment_request(address)
         wallet.save_db()
         return result
 
-    @command('w')
+    @command('wm')
     async def clear_requests(self, wallet: Abstract_Wallet = None):
         """Remove all payment requests"""
         wallet.clear_requests()
         return True
 
-    @command('w')
+    @command('wm')
     async def clear_invoices(self, wallet: Abstract_Wallet = None):
         """Remove all invoices"""
         wallet.clear_invoices()
         return True
 
-    @command('n')
+    @command('nm')
     async def notify(self, address: str, URL: Optional[str]):
         """Watch an address. Every time the address changes, a http POST is sent to the URL.
         Call with an empty URL to stop watching an address.
@@ -966,7 +967,7 @@ class Commands:
             fee_level = Decimal(fee_level)
         return self.config.fee_per_kb(dyn=dyn, mempool=mempool, fee_level=fee_level)
 
-    @command('w')
+    @command('wm')
     async def removelocaltx(self, txid, wallet: Abstract_Wallet = None):
         """Remove a 'local' transaction from the wallet, and its dependent
         transactions.
@@ -999,7 +1000,7 @@ class Commands:
         return sorted(known_commands.keys())
 
     # lightning network commands
-    @command('wn')
+    @command('wnm')
     async def add_peer(self, connection_string, timeout=20, gossip=False, wallet: Abstract_Wallet = None):
         lnworker = self.network.lngossip if gossip else wallet.lnworker
         await lnworker.add_peer(connection_string)
@@ -1014,9 +1015,10 @@ class Commands:
             'initialized':p.is_initialized(),
             'features': str(LnFeatures(p.features)),
             'channels': [c.funding_outpoint.to_str() for c in p.channels.values()],
+            'outgoing_messages': p.outgoing.get_stats(),
         } for p in lnworker.peers.values()]
 
-    @command('wpn')
+    @command('wpnm')
     async def open_channel(self, connection_string, amount, push_amount=0, password=None, wallet: Abstract_Wallet = None):
         funding_sat = satoshis(amount)
         push_sat = satoshis(push_amount)
@@ -1040,7 +1042,7 @@ class Commands:
         invoice = LNInvoice.from_bech32(invoice)
         return invoice.to_debug_json()
 
-    @command('wn')
+    @command('wnm')
     async def lnpay(self, invoice, attempts=1, timeout=30, wallet: Abstract_Wallet = None):
         lnworker = wallet.lnworker
         lnaddr = lnworker._check_invoice(invoice)
@@ -1095,22 +1097,22 @@ class Commands:
     async def dumpgraph(self, wallet: Abstract_Wallet = None):
         return wallet.lnworker.channel_db.to_dict()
 
-    @command('n')
+    @command('nm')
     async def inject_fees(self, fees):
         # e.g. use from Qt console:  inject_fees("{25: 1009, 10: 15962, 5: 18183, 2: 23239}")
         fee_est = ast.literal_eval(fees)
         self.network.update_fee_estimates(fee_est=fee_est)
 
-    @command('wn')
+    @command('wnm')
     async def enable_htlc_settle(self, b: bool, wallet: Abstract_Wallet = None):
         wallet.lnworker.enable_htlc_settle = b
 
-    @command('n')
+    @command('nm')
     async def clear_ln_blacklist(self):
         if self.network.path_finder:
             self.network.path_finder.liquidity_hints.clear_blacklist()
 
-    @command('n')
+    @command('nm')
     async def reset_liquidity_hints(self):
         if self.network.path_finder:
             self.network.path_finder.liquidity_hints.reset_liquidity_hints()
@@ -1120,14 +1122,14 @@ class Commands:
         l = wallet.get_invoices()
         return [wallet.export_invoice(x) for x in l]
 
-    @command('wn')
+    @command('wnm')
     async def close_channel(self, channel_point, force=False, wallet: Abstract_Wallet = None):
         txid, index = channel_point.split(':')
         chan_id, _ = channel_id_from_funding_tx(txid, int(index))
         coro = wallet.lnworker.force_close_channel(chan_id) if force else wallet.lnworker.close_channel(chan_id)
         return await coro
 
-    @command('wn')
+    @command('wnm')
     async def request_force_close(self, channel_point, connection_string=None, wallet: Abstract_Wallet = None):
         """
         Requests the remote to force close a channel.
@@ -1144,7 +1146,7 @@ class Commands:
         chan_id, _ = channel_id_from_funding_tx(txid, int(index))
         return wallet.lnworker.export_channel_backup(chan_id)
 
-    @command('w')
+    @command('wm')
     async def import_channel_backup(self, encrypted, wallet: Abstract_Wallet = None):
         return wallet.lnworker.import_channel_backup(encrypted)
 
@@ -1165,7 +1167,33 @@ class Commands:
         """ return the local watchtower's ctn of channel. used in regtests """
         return await self.network.local_watchtower.sweepstore.get_ctn(channel_point, None)
 
-    @command('wnp')
+    @command('')
+    async def get_rpc_stats(self):
+        """ return per-method request counts and latency histograms of the JSON-RPC server """
+        if not self.daemon or not self.daemon.commands_server:
+            raise Exception("JSON-RPC server not running")
+        return self.daemon.commands_server.get_stats()
+
+    @command('n')
+    async def get_gossip_stats(self):
+        """ return the number of gossip messages verified and rejected, and the verification rates """
+        if not self.network.channel_db:
+            raise Exception("gossip is disabled")
+        return {
+            'signatures': self.network.channel_db.get_verification_stats(),
+            'channel_announcements': self.network.channel_db.ca_verifier.get_stats(),
+        }
+
+    @command('n')
+    async def get_sql_stats(self):
+        """ return queue depths and per-method latencies of the SQL databases """
+        dbs = {
+            'gossip': self.network.channel_db,
+            'watchtower': self.network.local_watchtower.sweepstore if self.network.local_watchtower else None,
+        }
+        return {name: db.get_stats() for name, db in dbs.items() if db}
+
+    @command('wnpm')
     async def normal_swap(self, onchain_amount, lightning_amount, password=None, wallet: Abstract_Wallet = None):
         """
         Normal submarine swap: send on-chain BTC, receive on Lightning
@@ -1196,7 +1224,7 @@ class Commands:
             'onchain_amount': format_satoshis(onchain_amount_sat),
         }
 
-    @command('wn')
+    @command('wnm')
     async def reverse_swap(self, lightning_amount, onchain_amount, wallet: Abstract_Wallet = None):
         """Reverse submarine swap: send on Lightning, receive on-chain
         """
@@ -24,12 +24,14 @@
 # SOFTWARE.
 import asyncio
 import ast
+import bisect
+import contextlib
 import os
 import time
 import traceback
 import sys
 import threading
-from typing import Dict, Optional, Tuple, Iterable, Callable, Union, Sequence, Mapping, TYPE_CHECKING
+from typing import Dict, Optional, Tuple, Iterable, Callable, Union, Sequence, Mapping, List, TYPE_CHECKING
 from base64 import b64decode, b64encode
 from collections import defaultdict
 import json
@@ -147,20 +149,92 @@ class AuthenticationInvalidOrMissing(AuthenticationError):
 class AuthenticationCredentialsInvalid(AuthenticationError):
     pass
 
+
+# a failed attempt is answered after this long, doubling with each consecutive
+# failure from the same client. Further requests from it wait until then.
+AUTH_FAILURE_DELAY = 0.050
+AUTH_FAILURE_MAX_DELAY = 10.0
+# bound on the number of clients whose failures are remembered
+AUTH_FAILURE_MAX_CLIENTS = 1000
+
+# upper bounds of the latency histogram buckets, in milliseconds
+RPC_LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# JSON-RPC 2.0 error codes
+JSONRPC_INVALID_REQUEST = -32600
+JSONRPC_METHOD_NOT_FOUND = -32601
+
+
+class RpcStats:
+    """Counts requests, and how long they waited for a slot and ran, per method."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = defaultdict(int)  # type: Dict[str, int]
+        self.errors = defaultdict(int)  # type: Dict[str, int]
+        self.wait_time = defaultdict(float)  # type: Dict[str, float]
+        self.max_wait_time = defaultdict(float)  # type: Dict[str, float]
+        self.total_time = defaultdict(float)  # type: Dict[str, float]
+        self.max_total_time = defaultdict(float)  # type: Dict[str, float]
+        self.histogram = defaultdict(lambda: [0] * (len(RPC_LATENCY_BUCKETS_MS) + 1))  # type: Dict[str, List[int]]
+
+    def add(self, name: str, wait_time: float, total_time: float, *, error: bool) -> None:
+        bucket = bisect.bisect_left(RPC_LATENCY_BUCKETS_MS, 1000 * total_time)
+        with self.lock:
+            self.count[name] += 1
+            if error:
+                self.errors[name] += 1
+            self.wait_time[name] += wait_time
+            self.max_wait_time[name] = max(self.max_wait_time[name], wait_time)
+            self.total_time[name] += total_time
+            self.max_total_time[name] = max(self.max_total_time[name], total_time)
+            self.histogram[name][bucket] += 1
+
+    def get_stats(self) -> Dict[str, dict]:
+        labels = [f'<={b}ms' for b in RPC_LATENCY_BUCKETS_MS] + [f'>{RPC_LATENCY_BUCKETS_MS[-1]}ms']
+        with self.lock:
+            return {
+                name: {
+                    'count': self.count[name],
+                    'errors': self.errors[name],
+                    'avg_wait_ms': 1000 * self.wait_time[name] / self.count[name],
+                    'max_wait_ms': 1000 * self.max_wait_time[name],
+                    'avg_ms': 1000 * self.total_time[name] / self.count[name],
+                    'max_ms': 1000 * self.max_total_time[name],
+                    'histogram': dict(zip(labels, self.histogram[name])),
+                }
+                for name in sorted(self.count)
+            }
+
+
 class AuthenticatedServer(Logger):
 
-    def __init__(self, rpc_user, rpc_password):
+    def __init__(self, rpc_user, rpc_password, *, max_concurrent_reads=32, max_concurrent_writes=8):
         Logger.__init__(self)
         self.rpc_user = rpc_user
         self.rpc_password = rpc_password
+        # client -> (number of consecutive failures, refused until)
+        self._auth_failures = {}  # type: Dict[str, Tuple[int, float]]
         self.auth_lock = asyncio.Lock()
         self._methods = {}  # type: Dict[str, Callable]
-
-    def register_method(self, f):
+        self._modifies_state = {}  # type: Dict[str, bool]
+        self._limited = {}  # type: Dict[str, bool]
+        self._read_semaphore = asyncio.Semaphore(max_concurrent_reads)
+        self._write_semaphore = asyncio.Semaphore(max_concurrent_writes)
+        self.max_concurrent_reads = max_concurrent_reads
+        self.max_concurrent_writes = max_concurrent_writes
+        self.stats = RpcStats()
+
+    def register_method(self, f, *, modifies_state=False, limited=True):
+        """Registers f under its name. Calls to methods that modify state
+        are limited by max_concurrent_writes, others by max_concurrent_reads,
+        unless limited is False."""
         assert f.__name__ not in self._methods, f"name collision for {f.__name__}"
         self._methods[f.__name__] = f
+        self._modifies_state[f.__name__] = modifies_state
+        self._limited[f.__name__] = limited
 
-    async def authenticate(self, headers):
+    def authenticate(self, headers):
         if self.rpc_password == '':
             # RPC authentication is disabled
             return
@@ -175,53 +249,161 @@ class AuthenticatedServer(Logger):
         username, _, password = credentials.partition(':')
         if not (constant_time_compare(username, self.rpc_user)
                 and constant_time_compare(password, self.rpc_password)):
-            await asyncio.sleep(0.050)
             raise AuthenticationCredentialsInvalid('Invalid Credentials')
 
+    def _is_throttled(self, client: str) -> bool:
+        return self._get_auth_backoff(client) > 0
+
+    def _get_auth_backoff(self, client: str) -> float:
+        """Returns how long client has to wait before its next attempt."""
+        failure = self._auth_failures.get(client)
+        return max(0.0, failure[1] - time.monotonic()) if failure is not None else 0.0
+
+    def _add_auth_failure(self, client: str) -> None:
+        """Records a failed attempt by client."""
+        now = time.monotonic()
+        num_failures, refused_until = self._auth_failures.pop(client, (0, 0))
+        if now >= refused_until + AUTH_FAILURE_MAX_DELAY:
+            # the previous failures were long ago
+            num_failures = 0
+        num_failures += 1
+        delay = min(AUTH_FAILURE_DELAY * 2 ** (num_failures - 1), AUTH_FAILURE_MAX_DELAY)
+        self._auth_failures[client] = (num_failures, now + delay)
+        if len(self._auth_failures) > AUTH_FAILURE_MAX_CLIENTS:
+            # forget the clients that failed longest ago
+            for oldest in list(self._auth_failures)[:len(self._auth_failures) // 2]:
+                del self._auth_failures[oldest]
+
+    def _check_auth(self, request, client: str) -> Optional[web.Response]:
+        """Returns the response to a request that is not authenticated, or None."""
+        try:
+            self.authenticate(request.headers)
+        except AuthenticationInvalidOrMissing:
+            return web.Response(headers={"WWW-Authenticate": "Basic realm=Electrum"},
+                                text='Unauthorized', status=401)
+        except AuthenticationCredentialsInvalid:
+            self._add_auth_failure(client)
+            return web.Response(text='Forbidden', status=403)
+        return None
+
     async def handle(self, request):
-        async with self.auth_lock:
-            try:
-                await self.authenticate(request.headers)
-            except AuthenticationInvalidOrMissing:
-                return web.Response(headers={"WWW-Authenticate": "Basic realm=Electrum"},
-                                    text='Unauthorized', status=401)
-            except AuthenticationCredentialsInvalid:
-                return web.Response(text='Forbidden', status=403)
+        client = request.remote or ''
+        if client in self._auth_failures:
+            # the credentials of a client that failed are compared one request
+            # at a time, each after the backoff of the previous failure, so
+            # that concurrent guesses cannot get around it
+            async with self.auth_lock:
+                await asyncio.sleep(self._get_auth_backoff(client))
+                response = self._check_auth(request, client)
+        else:
+            # authenticate synchronously: a failure is recorded before any
+            # other request is looked at
+            response = self._check_auth(request, client)
+        if response is not None:
+            if response.status == 403:
+                await asyncio.sleep(self._get_auth_backoff(client))
+            return response
         try:
             request = await request.text()
             request = json.loads(request)
-            method = request['method']
-            _id = request['id']
-            params = request.get('params', [])  # type: Union[Sequence, Mapping]
-            if method not in self._methods:
-                raise Exception(f"attempting to use unregistered method: {method}")
-            f = self._methods[method]
         except Exception as e:
             self.logger.exception("invalid request")
             return web.Response(text='Invalid Request', status=500)
+        if isinstance(request, list):
+            return await self._handle_batch(request)
+        try:
+            _id, f, params = self._parse_request(request)
+        except Exception as e:
+            self.logger.exception("invalid request")
+            return web.Response(text='Invalid Request', status=500)
+        return web.json_response(await self._run_request(_id, f, params))
+
+    async def _handle_batch(self, requests: list):
+        """Runs the requests of a JSON-RPC batch concurrently, within the
+        concurrency limits, and returns their responses in the same order."""
+        if not requests:
+            return web.json_response(self._error_response(None, JSONRPC_INVALID_REQUEST, 'Invalid Request'))
+
+        async def run(request):
+            try:
+                _id, f, params = self._parse_request(request)
+            except Exception as e:
+                self.logger.info(f"invalid request in batch: {e!r}")
+                if not isinstance(request, dict):
+                    return self._error_response(None, JSONRPC_INVALID_REQUEST, 'Invalid Request')
+                unknown_method = 'method' in request and request['method'] not in self._methods
+                code = JSONRPC_METHOD_NOT_FOUND if unknown_method else JSONRPC_INVALID_REQUEST
+                return self._error_response(request.get('id'), code, str(e))
+            return await self._run_request(_id, f, params)
+
+        responses = await asyncio.gather(*[run(request) for request in requests])
+        return web.json_response(responses)
+
+    def _parse_request(self, request: dict) -> Tuple[object, Callable, Union[Sequence, Mapping]]:
+        method = request['method']
+        _id = request['id']
+        params = request.get('params', [])  # type: Union[Sequence, Mapping]
+        if method not in self._methods:
+            raise Exception(f"attempting to use unregistered method: {method}")
+        return _id, self._methods[method], params
+
+    @staticmethod
+    def _error_response(_id, code: int, message: str) -> dict:
+        return {
+            'id': _id,
+            'jsonrpc': '2.0',
+            'error': {
+                'code': code,
+                'message': message,
+            },
+        }
+
+    async def _run_request(self, _id, f, params) -> dict:
+        name = f.__name__
+        if not self._limited[name]:
+            semaphore = contextlib.nullcontext()
+        elif self._modifies_state[name]:
+            semaphore = self._write_semaphore
+        else:
+            semaphore = self._read_semaphore
         response = {
             'id': _id,
             'jsonrpc': '2.0',
         }
-        try:
-            if isinstance(params, dict):
-                response['result'] = await f(**params)
-            else:
-                response['result'] = await f(*params)
-        except BaseException as e:
-            self.logger.exception("internal error while executing RPC")
-            response['error'] = {
-                'code': 1,
-                'message': str(e),
-            }
-        return web.json_response(response)
+        t0 = time.monotonic()
+        async with semaphore:
+            t1 = time.monotonic()
+            try:
+                if isinstance(params, dict):
+                    response['result'] = await f(**params)
+                else:
+                    response['result'] = await f(*params)
+            except BaseException as e:
+                self.logger.exception("internal error while executing RPC")
+                response['error'] = {
+                    'code': 1,
+                    'message': str(e),
+                }
+        self.stats.add(name, t1 - t0, time.monotonic() - t0, error='error' in response)
+        return response
+
+    def get_stats(self) -> dict:
+        return {
+            'max_concurrent_reads': self.max_concurrent_reads,
+            'max_concurrent_writes': self.max_concurrent_writes,
+            'throttled_clients': sum(self._is_throttled(client) for client in list(self._auth_failures)),
+            'methods': self.stats.get_stats(),
+        }
 
 
 class CommandsServer(AuthenticatedServer):
 
     def __init__(self, daemon, fd):
         rpc_user, rpc_password = get_rpc_credentials(daemon.config)
-        AuthenticatedServer.__init__(self, rpc_user, rpc_password)
+        AuthenticatedServer.__init__(
+            self, rpc_user, rpc_password,
+            max_concurrent_reads=daemon.config.get('rpc_max_concurrent_reads', 32),
+            max_concurrent_writes=daemon.config.get('rpc_max_concurrent_writes', 8))
         self.daemon = daemon
         self.fd = fd
         self.config = daemon.config
@@ -230,11 +412,14 @@ class CommandsServer(AuthenticatedServer):
         self.app = web.Application()
         self.app.router.add_post("/", self.handle)
         self.register_method(self.ping)
-        self.register_method(self.gui)
+        self.register_method(self.gui, modifies_state=True)
         self.cmd_runner = Commands(config=self.config, network=self.daemon.network, daemon=self.daemon)
-        for cmdname in known_commands:
-            self.register_method(getattr(self.cmd_runner, cmdname))
-        self.register_method(self.run_cmdline)
+        for cmdname, cmd in known_commands.items():
+            # stop must not wait behind long running commands
+            self.register_method(getattr(self.cmd_runner, cmdname), modifies_state=cmd.modifies_state,
+                                 limited=cmdname != 'stop')
+        # the command line may run any command
+        self.register_method(self.run_cmdline, modifies_state=True)
 
     async def run(self):
         self.runner = web.AppRunner(self.app)
@@ -297,7 +482,7 @@ class WatchTowerServer(AuthenticatedServer):
         self.app = web.Application()
         self.app.router.add_post("/", self.handle)
         self.register_method(self.get_ctn)
-        self.register_method(self.add_sweep_tx)
+        self.register_method(self.add_sweep_tx, modifies_state=True)
 
     async def run(self):
         self.runner = web.AppRunner(self.app)
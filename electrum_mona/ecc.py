@@ -26,7 +26,7 @@
 import base64
 import hashlib
 import functools
-from typing import Union, Tuple, Optional
+from typing import Union, Tuple, Optional, Sequence, List
 from ctypes import (
     byref, c_byte, c_int, c_uint, c_char_p, c_size_t, c_void_p, create_string_buffer,
     CFUNCTYPE, POINTER, cast
@@ -36,7 +36,7 @@ from .util import bfh, bh2u, assert_bytes, to_bytes, InvalidPassword, profiler,
 from .crypto import (sha256d, aes_encrypt_with_iv, aes_decrypt_with_iv, hmac_oneshot)
 from . import constants
 from .logging import get_logger
-from .ecc_fast import _libsecp256k1, SECP256K1_EC_UNCOMPRESSED
+from .ecc_fast import _libsecp256k1, SECP256K1_EC_COMPRESSED, SECP256K1_EC_UNCOMPRESSED
 
 _logger = get_logger(__name__)
 
@@ -137,6 +137,40 @@ class InvalidECPointException(Exception):
     """e.g. not on curve, or infinity"""
 
 
+def add_tweaks_to_pubkey(pubkey: bytes, tweaks: Sequence[bytes], *, compressed: bool = True) -> List[bytes]:
+    """Returns pubkey + tweak*G for each 32 byte tweak, serialized.
+    pubkey is parsed only once, so this is much faster than ECPubkey
+    arithmetic when deriving many keys from the same parent.
+    Raises InvalidECPointException if a tweak is not a valid secret,
+    or if a result is the point at infinity.
+    """
+    parent_ptr = create_string_buffer(64)
+    ret = _libsecp256k1.secp256k1_ec_pubkey_parse(
+        _libsecp256k1.ctx, parent_ptr, pubkey, len(pubkey))
+    if not ret:
+        raise InvalidECPointException('public key could not be parsed or is invalid')
+    flags = SECP256K1_EC_COMPRESSED if compressed else SECP256K1_EC_UNCOMPRESSED
+    size = 33 if compressed else 65
+    tweak_ptr = create_string_buffer(64)
+    child_ptr = create_string_buffer(64)
+    array_of_pubkey_ptrs = (c_char_p * 2)(cast(parent_ptr, c_char_p), cast(tweak_ptr, c_char_p))
+    child_serialized = create_string_buffer(size)
+    child_size = c_size_t(size)
+    children = []
+    for tweak in tweaks:
+        ret = _libsecp256k1.secp256k1_ec_pubkey_create(_libsecp256k1.ctx, tweak_ptr, tweak)
+        if not ret:
+            raise InvalidECPointException('Invalid secret scalar (not within curve order)')
+        ret = _libsecp256k1.secp256k1_ec_pubkey_combine(_libsecp256k1.ctx, child_ptr, array_of_pubkey_ptrs, 2)
+        if not ret:
+            raise InvalidECPointException('point at infinity')
+        child_size.value = size
+        _libsecp256k1.secp256k1_ec_pubkey_serialize(
+            _libsecp256k1.ctx, child_serialized, byref(child_size), child_ptr, flags)
+        children.append(child_serialized.raw)
+    return children
+
+
 @functools.total_ordering
 class ECPubkey(object):
 
@@ -39,7 +39,8 @@ import functools
 
 import aiorpcx
 from aiorpcx import TaskGroup
-from aiorpcx import RPCSession, Notification, NetAddress, NewlineFramer
+from aiorpcx import RPCSession, Notification, NetAddress
+from aiorpcx.framing import FramerBase
 from aiorpcx.curio import timeout_after, TaskTimeout
 from aiorpcx.jsonrpc import JSONRPC, CodeMessageError
 from aiorpcx.rawsocket import RSClient
@@ -70,6 +71,7 @@ ca_path = certifi.where()
 BUCKET_NAME_OF_ONION_SERVERS = 'onion'
 
 MAX_INCOMING_MSG_SIZE = 1_000_000  # in bytes
+DEFAULT_REQUEST_BATCH_SIZE = 50  # max number of requests coalesced into a JSON-RPC batch
 
 _KNOWN_NETWORK_PROTOCOLS = {'t', 's'}
 PREFERRED_NETWORK_PROTOCOL = 's'
@@ -132,6 +134,63 @@ def assert_list_or_tuple(val: Any) -> None:
         raise RequestCorrupted(f'{val!r} should be a list or tuple')
 
 
+class BatchResponseTooLarge(Exception):
+    """The response to a batch request was dropped for exceeding the max message size."""
+
+
+class _NewlineFramer(FramerBase):
+    """Newline separated messages, like aiorpcx's NewlineFramer, except that
+    an incoming message larger than max_size is skipped here instead of being
+    reported to the session. on_dropped is called with its first bytes, as
+    soon as the buffered part exceeds max_size.
+    """
+
+    def __init__(self, *, max_size: int, on_dropped):
+        self.max_size = max_size
+        self.on_dropped = on_dropped
+        self.queue = asyncio.Queue()
+        self.received_bytes = self.queue.put_nowait
+        self.residual = b''
+        self.exception = None
+
+    def frame(self, message):
+        return message + b'\n'
+
+    def fail(self, exception):
+        self.exception = exception
+        self.received_bytes(b'')
+
+    async def receive_message(self):
+        parts = []
+        buffer_size = 0
+        dropping = False
+        while True:
+            part = self.residual
+            self.residual = b''
+            if not part:
+                part = await self.queue.get()
+                if self.exception:
+                    raise self.exception
+            npos = part.find(b'\n')
+            if npos != -1:
+                part, self.residual = part[:npos], part[npos + 1:]
+            if not dropping:
+                parts.append(part)
+                buffer_size += len(part)
+                if self.max_size and buffer_size > self.max_size:
+                    dropping = True
+                    self.on_dropped(b''.join(parts)[:self.max_size])
+                    parts = []
+            if npos == -1:
+                continue
+            if dropping:
+                # skip to the start of the next message
+                dropping = False
+                buffer_size = 0
+                continue
+            return b''.join(parts)
+
+
 class NotificationSession(RPCSession):
 
     def __init__(self, *args, interface: 'Interface', **kwargs):
@@ -142,6 +201,14 @@ class NotificationSession(RPCSession):
         self._msg_counter = itertools.count(start=1)
         self.interface = interface
         self.cost_hard_limit = 0  # disable aiorpcx resource limits
+        # only one batch is in flight at a time, so that a dropped batch
+        # response can be told apart from the others
+        self._batch_lock = asyncio.Lock()
+        # resolved when the response to the batch in flight is dropped
+        self._batch_dropped = None  # type: Optional[asyncio.Future]
+        # lowered when the response to a batch of this size was too large,
+        # raised again as smaller batches get through
+        self.max_batch_size = None  # type: Optional[int]
 
     async def handle_request(self, request):
         self.maybe_log(f"--> {request}")
@@ -181,6 +248,82 @@ class NotificationSession(RPCSession):
             self.maybe_log(f"--> {response} (id: {msg_id})")
             return response
 
+    async def send_batch_requests(self, requests: Sequence[Tuple[str, Sequence]], *,
+                                  timeout=None) -> List[Any]:
+        """Sends (method, params) requests as a single JSON-RPC batch.
+        Returns the results in the order of the requests. If the server
+        returned an error for a request, the CodeMessageError is put in
+        place of its result, instead of being raised.
+        """
+        if not requests:
+            return []
+        if len(requests) == 1:
+            method, params = requests[0]
+            try:
+                return [await self.send_request(method, params, timeout=timeout)]
+            except CodeMessageError as e:
+                return [e]
+        max_batch_size = self.max_batch_size
+        if max_batch_size is not None and len(requests) > max_batch_size:
+            results = []
+            for i in range(0, len(requests), max_batch_size):
+                results += await self.send_batch_requests(requests[i:i + max_batch_size], timeout=timeout)
+            return results
+        try:
+            results = await self._send_batch_requests(requests, timeout=timeout)
+        except BatchResponseTooLarge:
+            # the response did not fit in a message. split the batch, and
+            # send smaller ones for a while
+            half = (len(requests) + 1) // 2
+            self.max_batch_size = half
+            self.interface.logger.info(f"response to a batch of {len(requests)} requests was too large. "
+                                       f"sending at most {half} requests per batch")
+            return (await self.send_batch_requests(requests[:half], timeout=timeout)
+                    + await self.send_batch_requests(requests[half:], timeout=timeout))
+        if self.max_batch_size is not None and len(requests) >= self.max_batch_size:
+            self.max_batch_size *= 2
+        return results
+
+    async def _send_batch_requests(self, requests: Sequence[Tuple[str, Sequence]], *,
+                                   timeout=None) -> List[Any]:
+        msg_id = next(self._msg_counter)
+        self.maybe_log(f"<-- batch {requests} (id: {msg_id})")
+
+        async def send_batch():
+            async with self.send_batch() as batch:
+                for method, params in requests:
+                    batch.add_request(method, params)
+            return batch.results
+
+        async def send_batch_or_raise_if_dropped():
+            dropped = self._batch_dropped = asyncio.Future()
+            task = asyncio.ensure_future(send_batch())
+            try:
+                await asyncio.wait([task, dropped], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                self._batch_dropped = None
+                if not task.done():
+                    task.cancel()
+            if not task.done() or task.cancelled():
+                # the response to our batch was dropped, we will never get it
+                raise BatchResponseTooLarge()
+            return task.result()
+        async with self._batch_lock:
+            try:
+                # see note in send_request re TaskTimeout
+                results = await asyncio.wait_for(send_batch_or_raise_if_dropped(), timeout)
+            except (TaskTimeout, asyncio.TimeoutError) as e:
+                raise RequestTimedOut(f'batch request timed out: {len(requests)} requests (id: {msg_id})') from e
+        self.maybe_log(f"--> {results} (id: {msg_id})")
+        return list(results)
+
+    def _on_dropped_msg(self, prefix: bytes) -> None:
+        self.interface.logger.info(f"dropped incoming message over {len(prefix):,d} bytes")
+        # responses to batches are arrays, those to single requests are objects
+        dropped = self._batch_dropped
+        if prefix.lstrip()[:1] == b'[' and dropped is not None and not dropped.done():
+            dropped.set_result(None)
+
     def set_default_timeout(self, timeout):
         self.sent_request_timeout = timeout
         self.max_send_delay = timeout
@@ -197,6 +340,28 @@ class NotificationSession(RPCSession):
             self.cache[key] = result
         await queue.put(params + [result])
 
+    async def subscribe_many(self, method: str, params_list: Sequence[List], queue: asyncio.Queue):
+        """Same as subscribe, for many params at once. The subscriptions
+        that are not cached yet are sent as a single batch request.
+        Raises the first error returned by the server, if any.
+        """
+        keys = [self.get_hashable_key_for_rpc_call(method, params) for params in params_list]
+        for key in keys:
+            self.subscriptions[key].append(queue)
+        to_request = [(key, params) for key, params in zip(keys, params_list)
+                      if key not in self.cache]
+        results = await self.send_batch_requests([(method, params) for key, params in to_request])
+        error = None
+        for (key, params), result in zip(to_request, results):
+            if isinstance(result, CodeMessageError):
+                error = error or result
+            else:
+                self.cache[key] = result
+        if error is not None:
+            raise error
+        for key, params in zip(keys, params_list):
+            await queue.put(params + [self.cache[key]])
+
     def unsubscribe(self, queue):
         """Unsubscribe a callback to free object references to enable GC."""
         # note: we can't unsubscribe from the server, so we keep receiving
@@ -219,7 +384,7 @@ class NotificationSession(RPCSession):
         # overridden so that max_size can be customized
         max_size = int(self.interface.network.config.get('network_max_incoming_msg_size',
                                                          MAX_INCOMING_MSG_SIZE))
-        return NewlineFramer(max_size=max_size)
+        return _NewlineFramer(max_size=max_size, on_dropped=self._on_dropped_msg)
 
 
 class NetworkException(Exception): pass
@@ -908,6 +1073,14 @@ class Interface(Logger):
             self._ipaddr_bucket = do_bucket()
         return self._ipaddr_bucket
 
+    def get_request_batch_size(self) -> int:
+        batch_size = max(1, int(self.network.config.get('network_request_batch_size',
+                                                        DEFAULT_REQUEST_BATCH_SIZE)))
+        if self.session and self.session.max_batch_size is not None:
+            # responses to larger batches did not fit in a message
+            batch_size = min(batch_size, self.session.max_batch_size)
+        return batch_size
+
     async def get_merkle_for_transaction(self, tx_hash: str, tx_height: int) -> dict:
         if not is_hash256_str(tx_hash):
             raise Exception(f"{repr(tx_hash)} is not a txid")
@@ -915,7 +1088,28 @@ class Interface(Logger):
             raise Exception(f"{repr(tx_height)} is not a block height")
         # do request
         res = await self.session.send_request('blockchain.transaction.get_merkle', [tx_hash, tx_height])
-        # check response
+        self._check_merkle_for_transaction(res)
+        return res
+
+    async def get_merkles_for_transactions(
+            self, items: Sequence[Tuple[str, int]]) -> List[Union[dict, CodeMessageError]]:
+        """Batched version of get_merkle_for_transaction.
+        items is a list of (tx_hash, tx_height) pairs.
+        """
+        for tx_hash, tx_height in items:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+            if not is_non_negative_integer(tx_height):
+                raise Exception(f"{repr(tx_height)} is not a block height")
+        results = await self.session.send_batch_requests(
+            [('blockchain.transaction.get_merkle', [tx_hash, tx_height]) for tx_hash, tx_height in items])
+        for res in results:
+            if not isinstance(res, CodeMessageError):
+                self._check_merkle_for_transaction(res)
+        return results
+
+    @classmethod
+    def _check_merkle_for_transaction(cls, res) -> None:
         block_height = assert_dict_contains_field(res, field_name='block_height')
         merkle = assert_dict_contains_field(res, field_name='merkle')
         pos = assert_dict_contains_field(res, field_name='pos')
@@ -925,13 +1119,29 @@ class Interface(Logger):
         assert_list_or_tuple(merkle)
         for item in merkle:
             assert_hash256_str(item)
-        return res
 
     async def get_transaction(self, tx_hash: str, *, timeout=None) -> str:
         if not is_hash256_str(tx_hash):
             raise Exception(f"{repr(tx_hash)} is not a txid")
         raw = await self.session.send_request('blockchain.transaction.get', [tx_hash], timeout=timeout)
-        # validate response
+        self._check_transaction(tx_hash, raw)
+        return raw
+
+    async def get_transactions(self, tx_hashes: Sequence[str], *,
+                               timeout=None) -> List[Union[str, CodeMessageError]]:
+        """Batched version of get_transaction."""
+        for tx_hash in tx_hashes:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+        results = await self.session.send_batch_requests(
+            [('blockchain.transaction.get', [tx_hash]) for tx_hash in tx_hashes], timeout=timeout)
+        for tx_hash, raw in zip(tx_hashes, results):
+            if not isinstance(raw, CodeMessageError):
+                self._check_transaction(tx_hash, raw)
+        return results
+
+    @classmethod
+    def _check_transaction(cls, tx_hash: str, raw) -> None:
         if not is_hex_str(raw):
             raise RequestCorrupted(f"received garbage (non-hex) as tx data (txid {tx_hash}): {raw!r}")
         tx = Transaction(raw)
@@ -941,14 +1151,29 @@ class Interface(Logger):
             raise RequestCorrupted(f"cannot deserialize received transaction (txid {tx_hash})") from e
         if tx.txid() != tx_hash:
             raise RequestCorrupted(f"received tx does not match expected txid {tx_hash} (got {tx.txid()})")
-        return raw
 
     async def get_history_for_scripthash(self, sh: str) -> List[dict]:
         if not is_hash256_str(sh):
             raise Exception(f"{repr(sh)} is not a scripthash")
         # do request
         res = await self.session.send_request('blockchain.scripthash.get_history', [sh])
-        # check response
+        self._check_history_for_scripthash(sh, res)
+        return res
+
+    async def get_history_for_scripthashes(self, shs: Sequence[str]) -> List[Union[List[dict], CodeMessageError]]:
+        """Batched version of get_history_for_scripthash."""
+        for sh in shs:
+            if not is_hash256_str(sh):
+                raise Exception(f"{repr(sh)} is not a scripthash")
+        results = await self.session.send_batch_requests(
+            [('blockchain.scripthash.get_history', [sh]) for sh in shs])
+        for sh, res in zip(shs, results):
+            if not isinstance(res, CodeMessageError):
+                self._check_history_for_scripthash(sh, res)
+        return results
+
+    @classmethod
+    def _check_history_for_scripthash(cls, sh: str, res) -> None:
         assert_list_or_tuple(res)
         prev_height = 1
         for tx_item in res:
@@ -971,7 +1196,6 @@ class Interface(Logger):
             # a recently mined tx could be included in both last block and mempool?
             # Still, it's simplest to just disregard the response.
             raise RequestCorrupted(f"server history has non-unique txids for sh={sh}")
-        return res
 
     async def listunspent_for_scripthash(self, sh: str) -> List[dict]:
         if not is_hash256_str(sh):
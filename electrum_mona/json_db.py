@@ -25,6 +25,9 @@
 import threading
 import copy
 import json
+import hashlib
+import re
+from typing import Sequence, List, Tuple, Optional, Dict
 
 from . import util
 from .logging import Logger
@@ -32,9 +35,10 @@ from .logging import Logger
 JsonDBJsonEncoder = util.MyEncoder
 
 def modifier(func):
+    # note: this does not mark the db as modified. changes have to be made
+    #       through StoredDict/StoredObject, or reported with mark_dirty
     def wrapper(self, *args, **kwargs):
         with self.lock:
-            self._modified = True
             return func(self, *args, **kwargs)
     return wrapper
 
@@ -48,14 +52,19 @@ def locked(func):
 class StoredObject:
 
     db = None
+    _db_path = None
 
     def __setattr__(self, key, value):
         if self.db:
-            self.db.set_modified(True)
+            if self._db_path is not None:
+                self.db.mark_dirty(self._db_path)
+            else:
+                self.db.set_modified(True)
         object.__setattr__(self, key, value)
 
-    def set_db(self, db):
-        self.db = db
+    def set_db(self, db, path=None):
+        object.__setattr__(self, 'db', db)
+        object.__setattr__(self, '_db_path', path)
 
     def to_json(self):
         d = dict(vars(self))
@@ -74,9 +83,20 @@ class StoredDict(dict):
         self.db = db
         self.lock = self.db.lock if self.db else threading.RLock()
         self.path = path
-        # recursively convert dicts to StoredDict
+        # recursively convert dicts to StoredDict.
+        # this is loading, not modifying: nothing is written to the journal
         for k, v in list(data.items()):
-            self.__setitem__(k, v)
+            self._setitem(k, v, track=False)
+
+    def _set_db_and_path(self, db, path):
+        # recursively set db and path
+        self.db = db
+        self.path = path
+        for k, v in dict.items(self):
+            if isinstance(v, StoredDict):
+                v._set_db_and_path(db, path + [k])
+            elif isinstance(v, StoredObject):
+                v.set_db(db, path + [k])
 
     def convert_key(self, key):
         """Convert int keys to str keys, as only those are allowed in json."""
@@ -87,17 +107,19 @@ class StoredDict(dict):
 
     @locked
     def __setitem__(self, key, v):
+        self._setitem(key, v, track=True)
+
+    def _setitem(self, key, v, *, track: bool):
         key = self.convert_key(key)
-        is_new = key not in self
-        # early return to prevent unnecessary disk writes
-        if not is_new and self[key] == v:
-            return
+        # early return to prevent unnecessary disk writes.
+        # note: the same list or set might have been mutated in place
+        if track and dict.__contains__(self, key):
+            old = dict.__getitem__(self, key)
+            if old == v and not (old is v and isinstance(v, (list, set))):
+                return
         # recursively set db and path
         if isinstance(v, StoredDict):
-            v.db = self.db
-            v.path = self.path + [key]
-            for k, vv in v.items():
-                v[k] = vv
+            v._set_db_and_path(self.db, self.path + [key])
         # recursively convert dict to StoredDict.
         # _convert_dict is called breadth-first
         elif isinstance(v, dict):
@@ -111,18 +133,18 @@ class StoredDict(dict):
                 v = self.db._convert_value(self.path, key, v)
         # set parent of StoredObject
         if isinstance(v, StoredObject):
-            v.set_db(self.db)
+            v.set_db(self.db, self.path + [key])
         # set item
         dict.__setitem__(self, key, v)
-        if self.db:
-            self.db.set_modified(True)
+        if self.db and track:
+            self.db.mark_dirty(self.path + [key])
 
     @locked
     def __delitem__(self, key):
         key = self.convert_key(key)
         dict.__delitem__(self, key)
         if self.db:
-            self.db.set_modified(True)
+            self.db.mark_dirty(self.path + [key])
 
     @locked
     def __getitem__(self, key):
@@ -142,9 +164,15 @@ class StoredDict(dict):
         else:
             r = dict.pop(self, key, v)
         if self.db:
-            self.db.set_modified(True)
+            self.db.mark_dirty(self.path + [key])
         return r
 
+    @locked
+    def clear(self):
+        dict.clear(self)
+        if self.db:
+            self.db.mark_dirty(self.path)
+
     @locked
     def get(self, key, default=None):
         key = self.convert_key(key)
@@ -153,6 +181,74 @@ class StoredDict(dict):
 
 
 
+JOURNAL_SEPARATOR = ',\n'
+# Each write appends one record, holding all the entries of that write,
+# and the sha256 of their serialization:
+#   ,\n{"sha256": "<hex>", "entries": [<entry>, ...]}
+_JOURNAL_RECORD_START = re.compile(r'\s*,\s*\{"sha256": "([0-9a-f]{64})", "entries": ')
+
+
+def format_journal_record(entries: Sequence[str]) -> str:
+    """Frames the serialized entries of one write, so that they are either
+    all replayed or, if the record was not fully written, none of them."""
+    entries_json = '[' + ', '.join(entries) + ']'
+    checksum = hashlib.sha256(entries_json.encode('utf-8')).hexdigest()
+    return f'{JOURNAL_SEPARATOR}{{"sha256": "{checksum}", "entries": {entries_json}}}'
+
+
+def parse_journal(s: str) -> Tuple[object, List[dict]]:
+    """Parses a json document that might be followed by journal records,
+    as written by JsonDB.get_journal_data. A truncated or corrupted last
+    record (e.g. if we crashed while appending it) is ignored as a whole.
+    Raises ValueError if the document itself cannot be parsed.
+    """
+    decoder = json.JSONDecoder()
+    s = s.strip()
+    data, pos = decoder.raw_decode(s)
+    entries = []  # type: List[dict]
+    while True:
+        m = _JOURNAL_RECORD_START.match(s, pos)
+        if not m:
+            break
+        start = m.end()
+        try:
+            record_entries, end = decoder.raw_decode(s, start)
+        except ValueError:
+            break
+        if not s.startswith('}', end):
+            break
+        if hashlib.sha256(s[start:end].encode('utf-8')).hexdigest() != m.group(1):
+            break
+        entries.extend(record_entries)
+        pos = end + 1
+    return data, entries
+
+
+def apply_journal(data: dict, entries: Sequence[dict]) -> None:
+    """Replays journal entries on plain (json-decoded) data, in place."""
+    for entry in entries:
+        path = entry['path']
+        d = data
+        for key in path[:-1]:
+            d = d.setdefault(key, {})
+        if entry['op'] == 'set':
+            d[path[-1]] = entry['value']
+        elif entry['op'] == 'del':
+            d.pop(path[-1], None)
+        else:
+            raise ValueError(f"unknown journal op: {entry['op']!r}")
+
+
+def load_journaled(s: str) -> object:
+    """Parses a json document, and replays the journal records that follow it."""
+    data, entries = parse_journal(s)
+    if entries:
+        if not isinstance(data, dict):
+            raise ValueError("journal found after a json document that is not a dict")
+        apply_journal(data, entries)
+    return data
+
+
 class JsonDB(Logger):
 
     def __init__(self, data):
@@ -160,14 +256,70 @@ class JsonDB(Logger):
         self.lock = threading.RLock()
         self.data = data
         self._modified = False
+        # Paths that were modified since the last write. Only changes made through
+        # StoredDict/StoredObject are tracked; for anything else, a full snapshot
+        # will be written. The first write after loading is always a full one.
+        self._dirty_paths = {}  # type: Dict[Tuple[str, ...], None]
+        self._full_write_needed = True
 
     def set_modified(self, b):
         with self.lock:
             self._modified = b
+            if b:
+                # we do not know what changed
+                self._full_write_needed = True
 
     def modified(self):
         return self._modified
 
+    @locked
+    def mark_dirty(self, path: Sequence[str]) -> None:
+        self._dirty_paths[tuple(path)] = None
+        self._modified = True
+
+    @locked
+    def requires_full_write(self) -> bool:
+        # if the root changed, the journal entry would be as big as a snapshot
+        return (self._full_write_needed or not isinstance(self.data, StoredDict)
+                or () in self._dirty_paths)
+
+    @locked
+    def get_journal_data(self) -> str:
+        """Serializes the changes since the last write, to be appended to the
+        last written snapshot. Values are taken at the time of this call,
+        so a path modified many times results in a single entry.
+        """
+        paths = sorted(self._dirty_paths)
+        entries = []  # type: List[str]
+        last = None  # type: Optional[Tuple[str, ...]]
+        for path in paths:
+            # skip paths within a path that is already written in full
+            if last is not None and path[:len(last)] == last:
+                continue
+            last = path
+            found, value = self._lookup_path(path)
+            if found:
+                entry = {'op': 'set', 'path': list(path), 'value': value}
+            else:
+                entry = {'op': 'del', 'path': list(path)}
+            entries.append(json.dumps(entry, cls=JsonDBJsonEncoder))
+        return format_journal_record(entries)
+
+    def _lookup_path(self, path: Sequence[str]) -> Tuple[bool, object]:
+        d = self.data
+        for key in path:
+            if not isinstance(d, dict) or not dict.__contains__(d, key):
+                return False, None
+            d = dict.__getitem__(d, key)
+        return True, d
+
+    @locked
+    def on_written(self, *, full: bool) -> None:
+        self._dirty_paths.clear()
+        if full:
+            self._full_write_needed = False
+        self.set_modified(False)
+
     @locked
     def get(self, key, default=None):
         v = self.data.get(key)
@@ -184,11 +336,18 @@ class JsonDB(Logger):
             self.logger.info(f"json error: cannot save {repr(key)} ({repr(value)})")
             return False
         if value is not None:
-            if self.data.get(key) != value:
+            old = self.data.get(key)
+            if old is value:
+                # mutated in place, after a get()
+                self.mark_dirty([key])
+                return True
+            if old != value:
                 self.data[key] = copy.deepcopy(value)
+                self.mark_dirty([key])
                 return True
         elif key in self.data:
             self.data.pop(key)
+            self.mark_dirty([key])
             return True
         return False
 
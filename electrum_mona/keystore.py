@@ -26,9 +26,13 @@
 
 from unicodedata import normalize
 import hashlib
+import os
+import random
 import re
+import threading
+import concurrent.futures
+from collections import OrderedDict
 from typing import Tuple, TYPE_CHECKING, Union, Sequence, Optional, Dict, List, NamedTuple
-from functools import lru_cache
 from abc import ABC, abstractmethod
 
 from . import bitcoin, ecc, constants, bip32
@@ -55,6 +59,44 @@ if TYPE_CHECKING:
 class CannotDerivePubkey(Exception): pass
 
 
+# derived pubkeys cached per chain, from index 0 on
+PUBKEY_CACHE_SIZE = 10000
+# the cache is kept in the wallet file in chunks of this size, so that only
+# the last chunk changes when it grows
+PUBKEY_CACHE_CHUNK_SIZE = 500
+# pubkeys past the cache that were used last are kept in memory
+NUM_RECENT_PUBKEYS = 1000
+# ranges of pubkeys are derived in parallel, in chunks of this size
+DERIVE_CHUNK_SIZE = 250
+
+_derive_executor = None  # type: Optional[concurrent.futures.ThreadPoolExecutor]
+_derive_executor_lock = threading.Lock()
+
+
+def get_derive_executor() -> concurrent.futures.ThreadPoolExecutor:
+    # libsecp256k1 releases the GIL, so threads derive in parallel
+    global _derive_executor
+    with _derive_executor_lock:
+        if _derive_executor is None:
+            _derive_executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                                                     thread_name_prefix='derive_thread')
+        return _derive_executor
+
+
+def _join_pubkey_cache_chunks(chunks) -> Optional[List[str]]:
+    # chunks are keyed by their index, and all of them but the last are full
+    if not isinstance(chunks, dict):
+        return None
+    pubkeys = []
+    for n in range(len(chunks)):
+        chunk = chunks.get(str(n))
+        if (len(pubkeys) % PUBKEY_CACHE_CHUNK_SIZE or not isinstance(chunk, list)
+                or len(chunk) > PUBKEY_CACHE_CHUNK_SIZE):
+            return None
+        pubkeys += chunk
+    return pubkeys
+
+
 class KeyStore(Logger, ABC):
     type: str
 
@@ -338,6 +380,12 @@ class Deterministic_KeyStore(Software_KeyStore):
 
 class MasterPublicKeyMixin(ABC):
 
+    def __init__(self):
+        # pubkeys derived for each chain (0: receiving, 1: change), as hex
+        self._pubkey_cache = {0: [], 1: []}  # type: Dict[int, List[str]]
+        self._recent_pubkeys = OrderedDict()  # type: OrderedDict[Tuple[int, int], bytes]
+        self._pubkey_cache_lock = threading.Lock()
+
     @abstractmethod
     def get_master_public_key(self) -> str:
         pass
@@ -371,13 +419,117 @@ class MasterPublicKeyMixin(ABC):
         """
         pass
 
-    @abstractmethod
     def derive_pubkey(self, for_change: int, n: int) -> bytes:
         """Returns pubkey at given path.
         May raise CannotDerivePubkey.
         """
+        return self.derive_pubkeys_range(for_change, n, 1)[0]
+
+    def derive_pubkeys_range(self, for_change: int, start: int, count: int) -> Sequence[bytes]:
+        """Returns the pubkeys at paths (for_change, start) to (for_change, start+count-1).
+        May raise CannotDerivePubkey.
+        """
+        for_change = int(for_change)
+        if for_change not in (0, 1) or start < 0:
+            raise CannotDerivePubkey("forbidden path")
+        with self._pubkey_cache_lock:
+            cache = self._pubkey_cache[for_change]
+            pubkeys = [bfh(pk) for pk in cache[start:start+count]]
+            while len(pubkeys) < count:
+                key = (for_change, start + len(pubkeys))
+                if key not in self._recent_pubkeys:
+                    break
+                self._recent_pubkeys.move_to_end(key)
+                pubkeys.append(self._recent_pubkeys[key])
+        first = start + len(pubkeys)
+        count -= len(pubkeys)
+        if count <= 0:
+            return pubkeys
+        if count < 2 * DERIVE_CHUNK_SIZE or (os.cpu_count() or 1) == 1:
+            new_pubkeys = self._derive_pubkeys_range(for_change, first, count)
+        else:
+            chunks = [(n, min(DERIVE_CHUNK_SIZE, first + count - n))
+                      for n in range(first, first + count, DERIVE_CHUNK_SIZE)]
+            results = get_derive_executor().map(lambda chunk: self._derive_pubkeys_range(for_change, *chunk), chunks)
+            new_pubkeys = [pk for result in results for pk in result]
+        with self._pubkey_cache_lock:
+            cache = self._pubkey_cache[for_change]
+            if first == len(cache):
+                cache.extend(pk.hex() for pk in new_pubkeys[:PUBKEY_CACHE_SIZE - first])
+            end = first + len(new_pubkeys)
+            for n in range(max(first, PUBKEY_CACHE_SIZE, end - NUM_RECENT_PUBKEYS), end):
+                self._recent_pubkeys[(for_change, n)] = new_pubkeys[n - first]
+            while len(self._recent_pubkeys) > NUM_RECENT_PUBKEYS:
+                self._recent_pubkeys.popitem(last=False)
+        return pubkeys + new_pubkeys
+
+    def extend_pubkey_cache(self, for_change: int, count: int) -> None:
+        """Makes sure the first count pubkeys of a chain are cached."""
+        count = min(count, PUBKEY_CACHE_SIZE)
+        with self._pubkey_cache_lock:
+            num_cached = len(self._pubkey_cache[for_change])
+        if num_cached < count:
+            self.derive_pubkeys_range(for_change, num_cached, count - num_cached)
+
+    @abstractmethod
+    def _derive_pubkeys_range(self, for_change: int, start: int, count: int) -> Sequence[bytes]:
+        """Derives pubkeys without using the cache. for_change is 0 or 1."""
         pass
 
+    def set_pubkey_cache(self, d: Dict[str, object]) -> bool:
+        """Uses the pubkeys kept in d, e.g. a dict of the wallet file, if they
+        were derived by this keystore. Otherwise d is reset.
+        Returns whether d was left unchanged.
+        """
+        unchanged = True
+        mpk = self.get_master_public_key()
+        chains = {for_change: _join_pubkey_cache_chunks(d.get(str(for_change))) for for_change in (0, 1)}
+        if d.get('mpk') != mpk or not self._check_pubkey_cache(chains):
+            d.clear()
+            d.update({'mpk': mpk, '0': {}, '1': {}})
+            chains = {0: [], 1: []}
+            unchanged = False
+        with self._pubkey_cache_lock:
+            for for_change in (0, 1):
+                if len(chains[for_change]) > len(self._pubkey_cache[for_change]):
+                    self._pubkey_cache[for_change] = chains[for_change]
+        return unchanged
+
+    def update_pubkey_cache(self, d: Dict[str, object]) -> Sequence[Tuple[str, str]]:
+        """Adds the pubkeys derived since set_pubkey_cache(d) or the last
+        update to d. Returns the (chain, chunk) keys of the chunks that changed.
+        """
+        changed = []
+        with self._pubkey_cache_lock:
+            for for_change in (0, 1):
+                chain = str(for_change)
+                chunks = d[chain]
+                cache = self._pubkey_cache[for_change]
+                num_stored = sum(len(chunk) for chunk in chunks.values())
+                if len(cache) <= num_stored:
+                    continue
+                first = num_stored - num_stored % PUBKEY_CACHE_CHUNK_SIZE
+                for n in range(first, len(cache), PUBKEY_CACHE_CHUNK_SIZE):
+                    chunk = str(n // PUBKEY_CACHE_CHUNK_SIZE)
+                    chunks[chunk] = cache[n:n+PUBKEY_CACHE_CHUNK_SIZE]
+                    changed.append((chain, chunk))
+        return changed
+
+    def _check_pubkey_cache(self, chains: Dict[int, Optional[List[str]]]) -> bool:
+        # like Deterministic_Wallet.try_detecting_internal_addresses_corruption,
+        # check the first few pubkeys, the last one, and a few random ones
+        for for_change, pubkeys in chains.items():
+            if pubkeys is None:
+                return False
+            indices = set(range(min(len(pubkeys), 5)))
+            indices |= set(random.sample(range(len(pubkeys)), min(len(pubkeys), 5)))
+            if pubkeys:
+                indices.add(len(pubkeys) - 1)
+            for n in indices:
+                if pubkeys[n] != self._derive_pubkeys_range(for_change, n, 1)[0].hex():
+                    return False
+        return True
+
     def get_pubkey_derivation(
             self,
             pubkey: bytes,
@@ -438,10 +590,10 @@ class MasterPublicKeyMixin(ABC):
 class Xpub(MasterPublicKeyMixin):
 
     def __init__(self, *, derivation_prefix: str = None, root_fingerprint: str = None):
+        MasterPublicKeyMixin.__init__(self)
         self.xpub = None
-        self.xpub_receive = None
-        self.xpub_change = None
         self._xpub_bip32_node = None  # type: Optional[BIP32Node]
+        self._chain_bip32_nodes = {}  # type: Dict[int, BIP32Node]
 
         # "key origin" info (subclass should persist these):
         self._derivation_prefix = derivation_prefix  # type: Optional[str]
@@ -523,20 +675,12 @@ class Xpub(MasterPublicKeyMixin):
             self._derivation_prefix = derivation_prefix
         self.is_requesting_to_be_rewritten_to_wallet_file = True
 
-    @lru_cache(maxsize=None)
-    def derive_pubkey(self, for_change: int, n: int) -> bytes:
-        for_change = int(for_change)
-        if for_change not in (0, 1):
-            raise CannotDerivePubkey("forbidden path")
-        xpub = self.xpub_change if for_change else self.xpub_receive
-        if xpub is None:
-            rootnode = self.get_bip32_node_for_xpub()
-            xpub = rootnode.subkey_at_public_derivation((for_change,)).to_xpub()
-            if for_change:
-                self.xpub_change = xpub
-            else:
-                self.xpub_receive = xpub
-        return self.get_pubkey_from_xpub(xpub, (n,))
+    def _derive_pubkeys_range(self, for_change: int, start: int, count: int) -> Sequence[bytes]:
+        node = self._chain_bip32_nodes.get(for_change)
+        if node is None:
+            node = self.get_bip32_node_for_xpub().subkey_at_public_derivation((for_change,))
+            self._chain_bip32_nodes[for_change] = node
+        return bip32.CKD_pub_range(node.eckey.get_public_key_bytes(compressed=True), node.chaincode, start, count)
 
     @classmethod
     def get_pubkey_from_xpub(self, xpub: str, sequence) -> bytes:
@@ -641,6 +785,7 @@ class Old_KeyStore(MasterPublicKeyMixin, Deterministic_KeyStore):
     type = 'old'
 
     def __init__(self, d):
+        MasterPublicKeyMixin.__init__(self)
         Deterministic_KeyStore.__init__(self, d)
         self.mpk = d.get('mpk')
         self._root_fingerprint = None
@@ -706,12 +851,13 @@ class Old_KeyStore(MasterPublicKeyMixin, Deterministic_KeyStore):
         public_key = master_public_key + z*ecc.GENERATOR
         return public_key.get_public_key_bytes(compressed=False)
 
-    @lru_cache(maxsize=None)
-    def derive_pubkey(self, for_change, n) -> bytes:
-        for_change = int(for_change)
-        if for_change not in (0, 1):
-            raise CannotDerivePubkey("forbidden path")
-        return self.get_pubkey_from_mpk(self.mpk, for_change, n)
+    def _derive_pubkeys_range(self, for_change: int, start: int, count: int) -> Sequence[bytes]:
+        tweaks = [(self.get_sequence(self.mpk, for_change, n) % ecc.CURVE_ORDER).to_bytes(32, byteorder='big')
+                  for n in range(start, start + count)]
+        try:
+            return ecc.add_tweaks_to_pubkey(bfh('04' + self.mpk), tweaks, compressed=False)
+        except ecc.InvalidECPointException:
+            return [self.get_pubkey_from_mpk(self.mpk, for_change, n) for n in range(start, start + count)]
 
     def _get_private_key_from_stretched_exponent(self, for_change, n, secexp):
         secexp = (secexp + self.get_sequence(self.mpk, for_change, n)) % ecc.CURVE_ORDER
@@ -0,0 +1,249 @@
+# Copyright (C) 2021 The Electrum developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENCE or http://www.opensource.org/licenses/mit-license.php
+
+# Compact, columnar representation of the public channel graph, for path finding.
+#
+# Nodes are numbered with integers. Every channel k has two directed edges:
+# 2*k (node1 -> node2) and 2*k+1 (node2 -> node1), so the edge in the other
+# direction of e is e ^ 1. Policy fields of edges are kept in parallel arrays.
+# As path finding searches backwards (from the payee), incoming edges of
+# nodes are indexed in CSR form (in_offsets, in_edges). Channels added after
+# the last compaction are kept in a small overflow index (extra_in_edges),
+# and are merged into the CSR arrays once there are enough of them.
+
+import threading
+from array import array
+from collections import deque
+from typing import TYPE_CHECKING, Dict, List, Optional, Iterator, Tuple
+
+from .lnutil import ShortChannelID
+from .util import profiler
+
+if TYPE_CHECKING:
+    from .channel_db import ChannelDB, ChannelInfo, Policy
+
+
+# edge flags
+EDGE_HAS_POLICY = 1 << 0
+EDGE_DISABLED = 1 << 1
+EDGE_REMOVED = 1 << 2
+
+# compact once the overflow index holds this fraction of all edges
+COMPACTION_THRESHOLD = 0.1
+
+# how many changes a ChangeLog remembers
+CHANGELOG_MAXLEN = 10_000
+
+
+class ChangeLog:
+    """Bounded log of the channels that changed, so that results derived
+    from the graph (e.g. path finding searches) can be checked for staleness.
+    """
+
+    def __init__(self, maxlen: int = CHANGELOG_MAXLEN):
+        self.lock = threading.Lock()
+        self.version = 0
+        self._changes = deque(maxlen=maxlen)  # (version, short_channel_id, node1_id, node2_id)
+        self._first_version = 0  # changes up to this version are forgotten
+
+    def record(self, short_channel_id: ShortChannelID,
+               node1_id: Optional[bytes] = None, node2_id: Optional[bytes] = None) -> None:
+        """Records a change of a channel. The node ids are None if unknown."""
+        with self.lock:
+            self.version += 1
+            if len(self._changes) == self._changes.maxlen:
+                self._first_version = self._changes[0][0]
+            self._changes.append((self.version, short_channel_id, node1_id, node2_id))
+
+    def invalidate(self) -> None:
+        """Records that everything might have changed."""
+        with self.lock:
+            self.version += 1
+            self._changes.clear()
+            self._first_version = self.version
+
+    def get_changes_since(self, version: int) -> Optional[List[Tuple[ShortChannelID, Optional[bytes], Optional[bytes]]]]:
+        """Returns the changes after version, as (short_channel_id, node1_id, node2_id),
+        or None if they are not known anymore.
+        """
+        with self.lock:
+            if version < self._first_version:
+                return None
+            return [change[1:] for change in self._changes if change[0] > version]
+
+
+class CompactChannelGraph:
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # nodes
+        self.node_ids = []  # type: List[bytes]
+        self.node_index = {}  # type: Dict[bytes, int]
+        # channels
+        self.chan_scids = []  # type: List[ShortChannelID]
+        self.chan_index = {}  # type: Dict[ShortChannelID, int]
+        self.chan_capacity_sat = array('q')  # -1 if unknown
+        # directed edges
+        self.edge_start = array('i')
+        self.edge_flags = array('B')
+        self.edge_fee_base_msat = array('q')
+        self.edge_fee_proportional_millionths = array('q')
+        self.edge_cltv_expiry_delta = array('i')
+        self.edge_htlc_minimum_msat = array('q')
+        self.edge_htlc_maximum_msat = array('q')  # -1 if unknown
+        # incoming edges of nodes
+        self.csr = (array('i', [0]), array('i'))  # type: Tuple[array, array]  # in_offsets, in_edges
+        self.extra_in_edges = {}  # type: Dict[int, List[int]]
+        self.num_extra_edges = 0
+
+    @classmethod
+    @profiler
+    def from_channel_db(cls, channel_db: 'ChannelDB') -> 'CompactChannelGraph':
+        graph = cls()
+        with channel_db.lock:
+            channels = list(channel_db._channels.values())
+            policies = dict(channel_db._policies)
+        for channel_info in channels:
+            graph._add_channel(channel_info)
+        for e in range(len(graph.edge_start)):
+            k = e >> 1
+            graph._set_policy(e, policies.get((graph._start_node_id(e), graph.chan_scids[k])))
+        graph.compact()
+        return graph
+
+    def num_nodes(self) -> int:
+        return len(self.node_ids)
+
+    def num_channels(self) -> int:
+        return len(self.chan_scids)
+
+    def _start_node_id(self, e: int) -> bytes:
+        return self.node_ids[self.edge_start[e]]
+
+    def _get_or_add_node(self, node_id: bytes) -> int:
+        idx = self.node_index.get(node_id)
+        if idx is None:
+            idx = len(self.node_ids)
+            self.node_ids.append(node_id)
+            self.node_index[node_id] = idx
+        return idx
+
+    def _add_channel(self, channel_info: 'ChannelInfo') -> int:
+        k = len(self.chan_scids)
+        scid = channel_info.short_channel_id
+        self.chan_scids.append(scid)
+        self.chan_index[scid] = k
+        capacity_sat = channel_info.capacity_sat
+        self.chan_capacity_sat.append(capacity_sat if capacity_sat is not None else -1)
+        n1 = self._get_or_add_node(channel_info.node1_id)
+        n2 = self._get_or_add_node(channel_info.node2_id)
+        for start, end in ((n1, n2), (n2, n1)):
+            e = len(self.edge_start)
+            self.edge_start.append(start)
+            self.edge_flags.append(0)
+            self.edge_fee_base_msat.append(0)
+            self.edge_fee_proportional_millionths.append(0)
+            self.edge_cltv_expiry_delta.append(0)
+            self.edge_htlc_minimum_msat.append(0)
+            self.edge_htlc_maximum_msat.append(-1)
+            self.extra_in_edges.setdefault(end, []).append(e)
+            self.num_extra_edges += 1
+        return k
+
+    def _set_policy(self, e: int, policy: Optional['Policy']) -> None:
+        removed = self.edge_flags[e] & EDGE_REMOVED
+        if policy is None:
+            self.edge_flags[e] = removed
+            return
+        flags = removed | EDGE_HAS_POLICY
+        if policy.is_disabled():
+            flags |= EDGE_DISABLED
+        self.edge_flags[e] = flags
+        self.edge_fee_base_msat[e] = policy.fee_base_msat
+        self.edge_fee_proportional_millionths[e] = policy.fee_proportional_millionths
+        self.edge_cltv_expiry_delta[e] = policy.cltv_expiry_delta
+        self.edge_htlc_minimum_msat[e] = policy.htlc_minimum_msat
+        htlc_maximum_msat = policy.htlc_maximum_msat
+        self.edge_htlc_maximum_msat[e] = htlc_maximum_msat if htlc_maximum_msat is not None else -1
+
+    def update_channel(self, channel_db: 'ChannelDB', short_channel_id: ShortChannelID) -> None:
+        """Updates the channel and its policies from channel_db.
+        Called by channel_db every time the channel changes.
+        """
+        channel_info = channel_db._channels.get(short_channel_id)
+        with self.lock:
+            k = self.chan_index.get(short_channel_id)
+            if channel_info is None:
+                if k is not None:
+                    self.edge_flags[2*k] = EDGE_REMOVED
+                    self.edge_flags[2*k+1] = EDGE_REMOVED
+                return
+            if k is not None and self.edge_flags[2*k] & EDGE_REMOVED:
+                # re-added; the old slot might have different endpoints
+                del self.chan_index[short_channel_id]
+                k = None
+            if k is None:
+                k = self._add_channel(channel_info)
+            else:
+                capacity_sat = channel_info.capacity_sat
+                self.chan_capacity_sat[k] = capacity_sat if capacity_sat is not None else -1
+            for e in (2*k, 2*k+1):
+                self._set_policy(e, channel_db._policies.get((self._start_node_id(e), short_channel_id)))
+            if self.num_extra_edges > COMPACTION_THRESHOLD * len(self.edge_start) + 100:
+                self.compact()
+
+    def compact(self) -> None:
+        """Rebuilds the CSR index of incoming edges, so that it includes the overflow index."""
+        with self.lock:
+            num_nodes = len(self.node_ids)
+            counts = [0] * (num_nodes + 1)
+            edge_end = self._get_edge_ends()
+            for e, end in enumerate(edge_end):
+                if not self.edge_flags[e] & EDGE_REMOVED:
+                    counts[end + 1] += 1
+            for i in range(num_nodes):
+                counts[i + 1] += counts[i]
+            in_offsets = array('i', counts)
+            in_edges = array('i', bytes(in_offsets.itemsize * counts[-1]))
+            pos = counts[:-1]
+            for e, end in enumerate(edge_end):
+                if not self.edge_flags[e] & EDGE_REMOVED:
+                    in_edges[pos[end]] = e
+                    pos[end] += 1
+            # path finding might be running concurrently, hence the order.
+            # (an edge might be seen twice, which is harmless)
+            self.csr = in_offsets, in_edges
+            self.extra_in_edges = {}
+            self.num_extra_edges = 0
+
+    def _get_edge_ends(self) -> List[int]:
+        # the end of edge e is the start of edge e ^ 1
+        edge_start = self.edge_start
+        return [edge_start[e ^ 1] for e in range(len(edge_start))]
+
+    def get_incoming_edges(self, node_idx: int) -> Iterator[int]:
+        """Yields the edges ending at node_idx, including removed ones."""
+        in_offsets, in_edges = self.csr
+        if node_idx + 1 < len(in_offsets):
+            for pos in range(in_offsets[node_idx], in_offsets[node_idx + 1]):
+                yield in_edges[pos]
+        extra = self.extra_in_edges.get(node_idx)
+        if extra:
+            yield from extra
+
+    def get_memory_usage(self) -> Dict[str, int]:
+        """Approximate size of the arrays, in bytes, excluding node ids and scids."""
+        arrays = {
+            'capacity': self.chan_capacity_sat,
+            'edge_start': self.edge_start,
+            'edge_flags': self.edge_flags,
+            'edge_fee_base': self.edge_fee_base_msat,
+            'edge_fee_proportional': self.edge_fee_proportional_millionths,
+            'edge_cltv': self.edge_cltv_expiry_delta,
+            'edge_htlc_min': self.edge_htlc_minimum_msat,
+            'edge_htlc_max': self.edge_htlc_maximum_msat,
+            'in_offsets': self.csr[0],
+            'in_edges': self.csr[1],
+        }
+        return {name: a.itemsize * len(a) for name, a in arrays.items()}
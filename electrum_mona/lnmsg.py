@@ -1,6 +1,7 @@
 import os
 import csv
 import io
+import struct
 from typing import Callable, Tuple, Any, Dict, List, Sequence, Union, Optional
 from collections import OrderedDict
 
@@ -276,6 +277,235 @@ def _resolve_field_count(field_count_str: str, *, vars_dict: dict, allow_any=Fal
     return field_count
 
 
+# field types whose size is known from the count alone
+_FIELD_TYPE_LEN = {
+    'byte': 1,
+    'u8': 1,
+    'u16': 2,
+    'u32': 4,
+    'u64': 8,
+    'chain_hash': 32,
+    'channel_id': 32,
+    'sha256': 32,
+    'signature': 64,
+    'point': 33,
+    'short_channel_id': 8,
+}
+_INT_FIELD_STRUCT_FORMAT = {'u8': 'B', 'u16': 'H', 'u32': 'I', 'u64': 'Q'}
+
+# A compiled scheme is a list of steps. Each step reads/writes one or more fields,
+# and returns False if the rest of the fields should be skipped (optional fields).
+# (field_name, field_type, field_count_str, is_optional)
+_SchemeField = Tuple[str, str, str, bool]
+_DecoderStep = Callable[[io.BytesIO, dict], bool]
+_EncoderStep = Callable[[io.BytesIO, dict], bool]
+_FIELD_NOT_PRESENT = object()
+
+
+def _get_static_field_count(field_count_str: str) -> Optional[int]:
+    if field_count_str == "":
+        return 1
+    try:
+        return int(field_count_str)
+    except ValueError:
+        return None
+
+
+def _compile_field_count(field_count_str: str, *, allow_any: bool) -> Callable[[dict], Union[int, str]]:
+    """Same as _resolve_field_count, with the parsing of field_count_str done only once."""
+    static_count = _get_static_field_count(field_count_str)
+    if static_count is not None:
+        return lambda vars_dict: static_count
+    if field_count_str == "...":
+        return lambda vars_dict: _resolve_field_count(field_count_str, vars_dict=vars_dict, allow_any=allow_any)
+
+    def get_count(vars_dict: dict) -> int:
+        field_count = vars_dict[field_count_str]
+        if isinstance(field_count, (bytes, bytearray)):
+            field_count = int.from_bytes(field_count, byteorder="big")
+        assert isinstance(field_count, int)
+        return field_count
+    return get_count
+
+
+def _is_fixed_size_field(field_type: str, field_count_str: str) -> bool:
+    count = _get_static_field_count(field_count_str)
+    if count is None or count < 0 or field_type not in _FIELD_TYPE_LEN:
+        return False
+    # note: _read_field only accepts counts 0 and 1 for ints
+    return field_type not in _INT_FIELD_STRUCT_FORMAT or count <= 1
+
+
+def _compile_field_reader(field: _SchemeField, *, allow_any: bool) -> _DecoderStep:
+    field_name, field_type, field_count_str, is_optional = field
+    get_count = _compile_field_count(field_count_str, allow_any=allow_any)
+    type_len = _FIELD_TYPE_LEN.get(field_type)
+    if (type_len is not None and field_type not in _INT_FIELD_STRUCT_FORMAT
+            and _get_static_field_count(field_count_str) is None and field_count_str != "..."):
+        # variable length array, e.g. features
+        def read_array(fd: io.BytesIO, parsed: dict) -> bool:
+            count = get_count(parsed)
+            if count == 0:
+                parsed[field_name] = b""
+                return True
+            total_len = count * type_len
+            buf = fd.read(total_len)
+            if len(buf) != total_len:
+                if is_optional:
+                    return False  # optional feature field not present
+                raise UnexpectedEndOfStream()
+            parsed[field_name] = buf
+            return True
+        return read_array
+
+    def read_field(fd: io.BytesIO, parsed: dict) -> bool:
+        count = get_count(parsed)
+        try:
+            parsed[field_name] = _read_field(fd=fd, field_type=field_type, count=count)
+        except UnexpectedEndOfStream:
+            if is_optional:
+                return False  # optional feature field not present
+            raise
+        return True
+    return read_field
+
+
+def _compile_struct_reader(fields: Sequence[_SchemeField]) -> _DecoderStep:
+    """Reads consecutive fixed size fields with a single struct.unpack."""
+    fmt = '>'
+    for field_name, field_type, field_count_str, is_optional in fields:
+        count = _get_static_field_count(field_count_str)
+        if field_type in _INT_FIELD_STRUCT_FORMAT and count == 1:
+            fmt += _INT_FIELD_STRUCT_FORMAT[field_type]
+        else:
+            fmt += f"{count * _FIELD_TYPE_LEN[field_type]}s"
+    s = struct.Struct(fmt)
+    size = s.size
+    unpack = s.unpack
+    field_names = tuple(field[0] for field in fields)
+    slow_steps = [_compile_field_reader(field, allow_any=False) for field in fields]
+
+    def read_struct(fd: io.BytesIO, parsed: dict) -> bool:
+        buf = fd.read(size)
+        if len(buf) == size:
+            parsed.update(zip(field_names, unpack(buf)))
+            return True
+        # not enough data: read field by field, to find out which field is missing
+        fd.seek(fd.tell() - len(buf))
+        for step in slow_steps:
+            if not step(fd, parsed):
+                return False
+        return True
+    return read_struct
+
+
+def _compile_decoder(fields: Sequence[_SchemeField], *, allow_any: bool,
+                     read_tlv_stream: Callable[..., dict] = None) -> Callable[[io.BytesIO, dict], None]:
+    """Returns a function that decodes fields from fd into a dict.
+    If read_tlv_stream is given, fields named 'tlvs' are decoded as tlv streams.
+    """
+    steps = []  # type: List[_DecoderStep]
+    fixed_size_fields = []  # type: List[_SchemeField]
+    for field in list(fields) + [None]:
+        if field is not None and _is_fixed_size_field(field[1], field[2]) \
+                and not (read_tlv_stream and field[0] == "tlvs"):
+            fixed_size_fields.append(field)
+            continue
+        if fixed_size_fields:
+            steps.append(_compile_struct_reader(fixed_size_fields))
+            fixed_size_fields = []
+        if field is None:
+            break
+        if read_tlv_stream and field[0] == "tlvs":
+            tlv_stream_name = field[1]
+
+            def read_tlvs(fd: io.BytesIO, parsed: dict, tlv_stream_name=tlv_stream_name) -> bool:
+                parsed[tlv_stream_name] = read_tlv_stream(fd=fd, tlv_stream_name=tlv_stream_name)
+                return True
+            steps.append(read_tlvs)
+        else:
+            steps.append(_compile_field_reader(field, allow_any=allow_any))
+
+    def decode(fd: io.BytesIO, parsed: dict) -> None:
+        for step in steps:
+            if not step(fd, parsed):
+                break
+    return decode
+
+
+def _compile_field_writer(field: _SchemeField, *, allow_any: bool, missing_as_zero: bool) -> _EncoderStep:
+    field_name, field_type, field_count_str, is_optional = field
+    get_count = _compile_field_count(field_count_str, allow_any=allow_any)
+
+    def get_value(kwargs: dict):
+        try:
+            return kwargs[field_name]
+        except KeyError:
+            if not missing_as_zero:
+                raise
+            if is_optional:
+                return _FIELD_NOT_PRESENT  # optional feature field not present
+            return 0  # default mandatory fields to zero
+
+    if not _is_fixed_size_field(field_type, field_count_str):
+        def write_field(fd: io.BytesIO, kwargs: dict) -> bool:
+            count = get_count(kwargs)
+            value = get_value(kwargs)
+            if value is _FIELD_NOT_PRESENT:
+                return False
+            _write_field(fd=fd, field_type=field_type, count=count, value=value)
+            return True
+        return write_field
+
+    # same as _write_field, with the checks on field_type and count done only once
+    count = _get_static_field_count(field_count_str)
+    total_len = count * _FIELD_TYPE_LEN[field_type]
+    int_allowed = count == 1 or field_type == 'byte'
+
+    def write_fixed_size_field(fd: io.BytesIO, kwargs: dict) -> bool:
+        value = get_value(kwargs)
+        if value is _FIELD_NOT_PRESENT:
+            return False
+        if count == 0:
+            return True
+        if int_allowed and isinstance(value, int):
+            value = int.to_bytes(value, length=total_len, byteorder="big", signed=False)
+        if not isinstance(value, (bytes, bytearray)):
+            raise Exception(f"can only write bytes into fd. got: {value!r}")
+        if total_len != len(value):
+            raise UnexpectedFieldSizeForEncoder(f"expected: {total_len}, got {len(value)}")
+        fd.write(value)
+        return True
+    return write_fixed_size_field
+
+
+def _compile_encoder(fields: Sequence[_SchemeField], *, allow_any: bool, missing_as_zero: bool,
+                     write_tlv_stream: Callable[..., None] = None) -> Callable[[io.BytesIO, dict], None]:
+    """Returns a function that encodes the fields of a dict into fd.
+    If write_tlv_stream is given, fields named 'tlvs' are encoded as tlv streams.
+    If missing_as_zero is True, missing mandatory fields are written as zeroes,
+    and missing optional fields end the encoding.
+    """
+    steps = []  # type: List[_EncoderStep]
+    for field in fields:
+        if write_tlv_stream and field[0] == "tlvs":
+            tlv_stream_name = field[1]
+
+            def write_tlvs(fd: io.BytesIO, kwargs: dict, tlv_stream_name=tlv_stream_name) -> bool:
+                if tlv_stream_name in kwargs:
+                    write_tlv_stream(fd=fd, tlv_stream_name=tlv_stream_name, **(kwargs[tlv_stream_name]))
+                return True
+            steps.append(write_tlvs)
+        else:
+            steps.append(_compile_field_writer(field, allow_any=allow_any, missing_as_zero=missing_as_zero))
+
+    def encode(fd: io.BytesIO, kwargs: dict) -> None:
+        for step in steps:
+            if not step(fd, kwargs):
+                break
+    return encode
+
+
 def _parse_msgtype_intvalue_for_onion_wire(value: str) -> int:
     msg_type_int = 0
     for component in value.split("|"):
@@ -349,33 +579,38 @@ class LNSerializer:
                 else:
                     pass  # TODO
 
+        # compile the schemes, so that they are not interpreted row by row for every message
+        self._msg_decoder_from_type = {}  # type: Dict[bytes, Callable[[io.BytesIO, dict], None]]
+        self._msg_encoder_from_type = {}  # type: Dict[bytes, Callable[[io.BytesIO, dict], None]]
+        for msg_type_bytes, scheme in self.msg_scheme_from_type.items():
+            # msgdata,<msgname>,<fieldname>,<typename>,[<count>][,<option>]
+            fields = [(row[2], row[3], row[4], len(row) > 5) for row in scheme if row[0] == "msgdata"]
+            self._msg_decoder_from_type[msg_type_bytes] = _compile_decoder(
+                fields, allow_any=False, read_tlv_stream=self.read_tlv_stream)
+            self._msg_encoder_from_type[msg_type_bytes] = _compile_encoder(
+                fields, allow_any=False, missing_as_zero=True, write_tlv_stream=self.write_tlv_stream)
+        self._tlv_record_decoders = {}  # type: Dict[str, Dict[int, Callable[[io.BytesIO, dict], None]]]
+        self._tlv_record_encoders = {}  # type: Dict[str, Dict[int, Callable[[io.BytesIO, dict], None]]]
+        for tlv_stream_name, scheme_map in self.in_tlv_stream_get_tlv_record_scheme_from_type.items():
+            self._tlv_record_decoders[tlv_stream_name] = {}
+            self._tlv_record_encoders[tlv_stream_name] = {}
+            for tlv_record_type, scheme in scheme_map.items():
+                # tlvdata,<tlvstreamname>,<tlvname>,<fieldname>,<typename>,[<count>][,<option>]
+                fields = [(row[3], row[4], row[5], False) for row in scheme if row[0] == "tlvdata"]
+                self._tlv_record_decoders[tlv_stream_name][tlv_record_type] = _compile_decoder(
+                    fields, allow_any=True)
+                self._tlv_record_encoders[tlv_stream_name][tlv_record_type] = _compile_encoder(
+                    fields, allow_any=True, missing_as_zero=False)
+
     def write_tlv_stream(self, *, fd: io.BytesIO, tlv_stream_name: str, **kwargs) -> None:
         scheme_map = self.in_tlv_stream_get_tlv_record_scheme_from_type[tlv_stream_name]
-        for tlv_record_type, scheme in scheme_map.items():  # note: tlv_record_type is monotonically increasing
+        encoders = self._tlv_record_encoders[tlv_stream_name]
+        for tlv_record_type in scheme_map:  # note: tlv_record_type is monotonically increasing
             tlv_record_name = self.in_tlv_stream_get_record_name_from_type[tlv_stream_name][tlv_record_type]
             if tlv_record_name not in kwargs:
                 continue
             with io.BytesIO() as tlv_record_fd:
-                for row in scheme:
-                    if row[0] == "tlvtype":
-                        pass
-                    elif row[0] == "tlvdata":
-                        # tlvdata,<tlvstreamname>,<tlvname>,<fieldname>,<typename>,[<count>][,<option>]
-                        assert tlv_stream_name == row[1]
-                        assert tlv_record_name == row[2]
-                        field_name = row[3]
-                        field_type = row[4]
-                        field_count_str = row[5]
-                        field_count = _resolve_field_count(field_count_str,
-                                                           vars_dict=kwargs[tlv_record_name],
-                                                           allow_any=True)
-                        field_value = kwargs[tlv_record_name][field_name]
-                        _write_field(fd=tlv_record_fd,
-                                     field_type=field_type,
-                                     count=field_count,
-                                     value=field_value)
-                    else:
-                        raise Exception(f"unexpected row in scheme: {row!r}")
+                encoders[tlv_record_type](tlv_record_fd, kwargs[tlv_record_name])
                 _write_tlv_record(fd=fd, tlv_type=tlv_record_type, tlv_val=tlv_record_fd.getvalue())
 
     def read_tlv_stream(self, *, fd: io.BytesIO, tlv_stream_name: str) -> Dict[str, Dict[str, Any]]:
@@ -400,26 +635,7 @@ class LNSerializer:
             tlv_record_name = self.in_tlv_stream_get_record_name_from_type[tlv_stream_name][tlv_record_type]
             parsed[tlv_record_name] = {}
             with io.BytesIO(tlv_record_val) as tlv_record_fd:
-                for row in scheme:
-                    #print(f"row: {row!r}")
-                    if row[0] == "tlvtype":
-                        pass
-                    elif row[0] == "tlvdata":
-                        # tlvdata,<tlvstreamname>,<tlvname>,<fieldname>,<typename>,[<count>][,<option>]
-                        assert tlv_stream_name == row[1]
-                        assert tlv_record_name == row[2]
-                        field_name = row[3]
-                        field_type = row[4]
-                        field_count_str = row[5]
-                        field_count = _resolve_field_count(field_count_str,
-                                                           vars_dict=parsed[tlv_record_name],
-                                                           allow_any=True)
-                        #print(f">> count={field_count}. parsed={parsed}")
-                        parsed[tlv_record_name][field_name] = _read_field(fd=tlv_record_fd,
-                                                                          field_type=field_type,
-                                                                          count=field_count)
-                    else:
-                        raise Exception(f"unexpected row in scheme: {row!r}")
+                self._tlv_record_decoders[tlv_stream_name][tlv_record_type](tlv_record_fd, parsed[tlv_record_name])
                 if _num_remaining_bytes_to_read(tlv_record_fd) > 0:
                     raise MsgTrailingGarbage(f"TLV record ({tlv_stream_name}/{tlv_record_name}) has extra trailing garbage")
         return parsed
@@ -429,41 +645,11 @@ class LNSerializer:
         Encode kwargs into a Lightning message (bytes)
         of the type given in the msg_type string
         """
-        #print(f">>> encode_msg. msg_type={msg_type}, payload={kwargs!r}")
         msg_type_bytes = self.msg_type_from_name[msg_type]
-        scheme = self.msg_scheme_from_type[msg_type_bytes]
+        encoder = self._msg_encoder_from_type[msg_type_bytes]
         with io.BytesIO() as fd:
             fd.write(msg_type_bytes)
-            for row in scheme:
-                if row[0] == "msgtype":
-                    pass
-                elif row[0] == "msgdata":
-                    # msgdata,<msgname>,<fieldname>,<typename>,[<count>][,<option>]
-                    field_name = row[2]
-                    field_type = row[3]
-                    field_count_str = row[4]
-                    #print(f">>> encode_msg. msgdata. field_name={field_name!r}. field_type={field_type!r}. field_count_str={field_count_str!r}")
-                    field_count = _resolve_field_count(field_count_str, vars_dict=kwargs)
-                    if field_name == "tlvs":
-                        tlv_stream_name = field_type
-                        if tlv_stream_name in kwargs:
-                            self.write_tlv_stream(fd=fd, tlv_stream_name=tlv_stream_name, **(kwargs[tlv_stream_name]))
-                        continue
-                    try:
-                        field_value = kwargs[field_name]
-                    except KeyError:
-                        if len(row) > 5:
-                            break  # optional feature field not present
-                        else:
-                            field_value = 0  # default mandatory fields to zero
-                    #print(f">>> encode_msg. writing field: {field_name}. value={field_value!r}. field_type={field_type!r}. count={field_count!r}")
-                    _write_field(fd=fd,
-                                 field_type=field_type,
-                                 count=field_count,
-                                 value=field_value)
-                    #print(f">>> encode_msg. so far: {fd.getvalue().hex()}")
-                else:
-                    raise Exception(f"unexpected row in scheme: {row!r}")
+            encoder(fd, kwargs)
             return fd.getvalue()
 
     def decode_msg(self, data: bytes) -> Tuple[str, dict]:
@@ -474,7 +660,6 @@ class LNSerializer:
         Returns message type string and parsed message contents dict,
         or raises FailedToParseMsg.
         """
-        #print(f"decode_msg >>> {data.hex()}")
         assert len(data) >= 2
         msg_type_bytes = data[:2]
         msg_type_int = int.from_bytes(msg_type_bytes, byteorder="big", signed=False)
@@ -489,32 +674,7 @@ class LNSerializer:
         msg_type_name = scheme[0][1]
         parsed = {}
         with io.BytesIO(data[2:]) as fd:
-            for row in scheme:
-                #print(f"row: {row!r}")
-                if row[0] == "msgtype":
-                    pass
-                elif row[0] == "msgdata":
-                    field_name = row[2]
-                    field_type = row[3]
-                    field_count_str = row[4]
-                    field_count = _resolve_field_count(field_count_str, vars_dict=parsed)
-                    if field_name == "tlvs":
-                        tlv_stream_name = field_type
-                        d = self.read_tlv_stream(fd=fd, tlv_stream_name=tlv_stream_name)
-                        parsed[tlv_stream_name] = d
-                        continue
-                    #print(f">> count={field_count}. parsed={parsed}")
-                    try:
-                        parsed[field_name] = _read_field(fd=fd,
-                                                         field_type=field_type,
-                                                         count=field_count)
-                    except UnexpectedEndOfStream as e:
-                        if len(row) > 5:
-                            break  # optional feature field not present
-                        else:
-                            raise
-                else:
-                    raise Exception(f"unexpected row in scheme: {row!r}")
+            self._msg_decoder_from_type[msg_type_bytes](fd, parsed)
         return msg_type_name, parsed
 
 
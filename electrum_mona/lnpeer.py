@@ -5,11 +5,12 @@
 # file LICENCE or http://www.opensource.org/licenses/mit-license.php
 
 import zlib
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict, defaultdict, deque
 import asyncio
 import os
 import time
-from typing import Tuple, Dict, TYPE_CHECKING, Optional, Union, Set
+from enum import IntEnum
+from typing import Tuple, Dict, TYPE_CHECKING, Optional, Union, Set, Deque
 from datetime import datetime
 import functools
 
@@ -62,6 +63,124 @@ if TYPE_CHECKING:
 LN_P2P_NETWORK_TIMEOUT = 20
 
 
+class MessagePriority(IntEnum):
+    CHANNEL = 0  # everything else: channel establishment, htlc updates, commitments, closing
+    PING = 1
+    GOSSIP = 2
+
+
+GOSSIP_MESSAGES = (
+    'channel_announcement', 'node_announcement', 'channel_update', 'query_short_channel_ids',
+    'reply_short_channel_ids_end', 'query_channel_range', 'reply_channel_range', 'gossip_timestamp_filter')
+
+# bytes each priority class may write per round, while the others have messages queued
+MESSAGE_PRIORITY_QUANTUM = {
+    MessagePriority.CHANNEL: 2**15,
+    MessagePriority.PING: 2**12,
+    MessagePriority.GOSSIP: 2**12,
+}
+
+
+def get_message_priority(message_name: str) -> MessagePriority:
+    if message_name in ('ping', 'pong'):
+        return MessagePriority.PING
+    if message_name in GOSSIP_MESSAGES:
+        return MessagePriority.GOSSIP
+    return MessagePriority.CHANNEL
+
+
+class MessageLatencyStats:
+    """Counts outgoing messages, and how long they were queued, per priority class."""
+
+    def __init__(self):
+        self.count = defaultdict(int)  # type: Dict[MessagePriority, int]
+        self.num_queued = defaultdict(int)  # type: Dict[MessagePriority, int]  # not written right away
+        self.latency = defaultdict(float)  # type: Dict[MessagePriority, float]
+        self.max_latency = defaultdict(float)  # type: Dict[MessagePriority, float]
+
+    def add(self, priority: MessagePriority, latency: Optional[float]) -> None:
+        """latency is None for messages written right away."""
+        self.count[priority] += 1
+        if latency is not None:
+            self.num_queued[priority] += 1
+            self.latency[priority] += latency
+            self.max_latency[priority] = max(self.max_latency[priority], latency)
+
+    def get_stats(self) -> Dict[str, dict]:
+        return {
+            priority.name.lower(): {
+                'count': self.count[priority],
+                'queued': self.num_queued[priority],
+                'avg_latency_ms': 1000 * self.latency[priority] / self.count[priority],
+                'max_latency_ms': 1000 * self.max_latency[priority],
+            }
+            for priority in sorted(self.count)
+        }
+
+
+class OutgoingMessageScheduler:
+    """Writes the outgoing messages of a peer to its transport.
+
+    Messages are written right away, unless the transport is not keeping up.
+    They are then queued per priority class, and written once it has caught up,
+    with deficit round robin: in each round, a class may write up to its quantum
+    of bytes, so that lower classes are delayed but not starved.
+    Messages of the same class are written in order.
+    """
+
+    def __init__(self, transport: LNTransportBase, taskgroup: TaskGroup):
+        self.transport = transport
+        self.taskgroup = taskgroup
+        self.queues = {p: deque() for p in MessagePriority}  # type: Dict[MessagePriority, Deque[Tuple[bytes, float]]]
+        self.deficits = {p: 0 for p in MessagePriority}  # type: Dict[MessagePriority, int]
+        self.num_queued = 0
+        self.flushing = False
+        self.stats = MessageLatencyStats()
+
+    def send(self, raw_msg: bytes, priority: MessagePriority) -> None:
+        if not self.num_queued and not self.transport.is_write_buffer_full():
+            self.transport.send_bytes(raw_msg)
+            self.stats.add(priority, None)
+            return
+        self.queues[priority].append((raw_msg, time.monotonic()))
+        self.num_queued += 1
+        if not self.flushing:
+            self.flushing = True
+            asyncio.ensure_future(self.taskgroup.spawn(self._flush()))
+
+    async def _flush(self):
+        try:
+            while self.num_queued:
+                await self.transport.drain()
+                self._write_queued()
+        finally:
+            self.flushing = False
+
+    def _write_queued(self):
+        while self.num_queued and not self.transport.is_write_buffer_full():
+            now = time.monotonic()
+            for priority, queue in self.queues.items():
+                if not queue:
+                    continue
+                self.deficits[priority] += MESSAGE_PRIORITY_QUANTUM[priority]
+                while queue and len(queue[0][0]) <= self.deficits[priority]:
+                    raw_msg, queued_time = queue.popleft()
+                    self.num_queued -= 1
+                    self.deficits[priority] -= len(raw_msg)
+                    self.transport.send_bytes(raw_msg)
+                    self.stats.add(priority, now - queued_time)
+                if not queue:
+                    # no credit for idle classes
+                    self.deficits[priority] = 0
+
+    def get_stats(self) -> Dict[str, dict]:
+        stats = self.stats.get_stats()
+        for priority, queue in self.queues.items():
+            if queue:
+                stats.setdefault(priority.name.lower(), {})['queue_depth'] = len(queue)
+        return stats
+
+
 class Peer(Logger):
     LOGGING_SHORTCUT = 'P'
 
@@ -105,6 +224,7 @@ class Peer(Logger):
         self.orphan_channel_updates = OrderedDict()  # type: OrderedDict[ShortChannelID, dict]
         Logger.__init__(self)
         self.taskgroup = SilentTaskGroup()
+        self.outgoing = OutgoingMessageScheduler(self.transport, self.taskgroup)
         # HTLCs offered by REMOTE, that we started removing but are still active:
         self.received_htlcs_pending_removal = set()  # type: Set[Tuple[Channel, int]]
         self.received_htlc_removed_event = asyncio.Event()
@@ -119,7 +239,7 @@ class Peer(Logger):
             raise Exception("tried to send message before we are initialized")
         raw_msg = encode_msg(message_name, **kwargs)
         self._store_raw_msg_if_local_update(raw_msg, message_name=message_name, channel_id=kwargs.get("channel_id"))
-        self.transport.send_bytes(raw_msg)
+        self.outgoing.send(raw_msg, get_message_priority(message_name))
 
     def _store_raw_msg_if_local_update(self, raw_msg: bytes, *, message_name: str, channel_id: Optional[bytes]):
         is_commitment_signed = message_name == "commitment_signed"
@@ -1012,7 +1132,7 @@ class Peer(Logger):
                 # commitment_signed, hence we must not replay them.
                 continue
             for raw_upd_msg in messages:
-                self.transport.send_bytes(raw_upd_msg)
+                self.outgoing.send(raw_upd_msg, MessagePriority.CHANNEL)
                 n_replayed_msgs += 1
         self.logger.info(f'channel_reestablish ({chan.get_id_for_log()}): replayed {n_replayed_msgs} unacked messages')
 
@@ -1201,7 +1321,7 @@ class Peer(Logger):
             # so that channel can be used to to receive payments
             self.logger.info(f"sending channel update for outgoing edge ({chan.get_id_for_log()})")
             chan_upd = chan.get_outgoing_gossip_channel_update()
-            self.transport.send_bytes(chan_upd)
+            self.outgoing.send(chan_upd, MessagePriority.GOSSIP)
 
     def send_announcement_signatures(self, chan: Channel):
         chan_ann = chan.construct_channel_announcement_without_sigs()
@@ -23,9 +23,9 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import queue
-from collections import defaultdict
-from typing import Sequence, List, Tuple, Optional, Dict, NamedTuple, TYPE_CHECKING, Set
+from collections import defaultdict, OrderedDict
+from heapq import heappush, heappop
+from typing import Sequence, List, Tuple, Optional, Dict, NamedTuple, TYPE_CHECKING, Set, Iterator
 import time
 from threading import RLock
 import attr
@@ -36,14 +36,20 @@ from .logging import Logger
 from .lnutil import (NUM_MAX_EDGES_IN_PAYMENT_PATH, ShortChannelID, LnFeatures,
                      NBLOCK_CLTV_EXPIRY_TOO_FAR_INTO_FUTURE)
 from .channel_db import ChannelDB, Policy, NodeInfo
+from .lngraph import EDGE_HAS_POLICY, EDGE_DISABLED, EDGE_REMOVED, ChangeLog
 
 if TYPE_CHECKING:
     from .lnchannel import Channel
+    from .lngraph import CompactChannelGraph
 
 DEFAULT_PENALTY_BASE_MSAT = 500  # how much base fee we apply for unknown sending capability of a channel
 DEFAULT_PENALTY_PROPORTIONAL_MILLIONTH = 100  # how much relative fee we apply for unknown sending capability of a channel
 BLACKLIST_DURATION = 3600  # how long (in seconds) a channel remains blacklisted
 HINT_DURATION = 3600  # how long (in seconds) a liquidity hint remains valid
+# TODO monacoin is OK?
+MAX_CLTV_EXPIRY_DELTA = 14 * 960  # cltv cannot be more than 2 weeks
+NUM_CACHED_DISTANCE_MAPS = 8  # path finding searches kept for reuse
+DISTANCE_MAP_MAX_AGE = 60  # how long (in seconds) a path finding search can be reused
 
 
 class NoChannelPolicy(Exception):
@@ -107,9 +113,7 @@ class RouteEdge(PathEdge):
 
     def is_sane_to_use(self, amount_msat: int) -> bool:
         # TODO revise ad-hoc heuristics
-        # cltv cannot be more than 2 weeks
-        # TODO monacoin is OK?
-        if self.cltv_expiry_delta > 14 * 960:
+        if self.cltv_expiry_delta > MAX_CLTV_EXPIRY_DELTA:
             return False
         total_fee = self.fee_for_edge(amount_msat)
         if not is_fee_sane(total_fee, payment_amount_msat=amount_msat):
@@ -169,6 +173,11 @@ def is_fee_sane(fee_msat: int, *, payment_amount_msat: int) -> bool:
     return False
 
 
+def get_max_sane_fee_msat(payment_amount_msat: int) -> int:
+    """The largest fee for which is_fee_sane holds."""
+    return max(5_000, payment_amount_msat // 100)
+
+
 class LiquidityHint:
     """Encodes the amounts that can and cannot be sent over the direction of a
     channel and whether the channel is blacklisted.
@@ -313,6 +322,7 @@ class LiquidityHintMgr:
     def __init__(self):
         self.lock = RLock()
         self._liquidity_hints: Dict[ShortChannelID, LiquidityHint] = {}
+        self.hint_changes = ChangeLog()  # used to check cached path finding results
 
     @with_lock
     def get_hint(self, channel_id: ShortChannelID) -> LiquidityHint:
@@ -326,21 +336,25 @@ class LiquidityHintMgr:
     def update_can_send(self, node_from: bytes, node_to: bytes, channel_id: ShortChannelID, amount: int):
         hint = self.get_hint(channel_id)
         hint.update_can_send(node_from < node_to, amount)
+        self.hint_changes.record(channel_id, node_from, node_to)
 
     @with_lock
     def update_cannot_send(self, node_from: bytes, node_to: bytes, channel_id: ShortChannelID, amount: int):
         hint = self.get_hint(channel_id)
         hint.update_cannot_send(node_from < node_to, amount)
+        self.hint_changes.record(channel_id, node_from, node_to)
 
     @with_lock
     def add_htlc(self, node_from: bytes, node_to: bytes, channel_id: ShortChannelID):
         hint = self.get_hint(channel_id)
         hint.add_htlc(node_from < node_to)
+        self.hint_changes.record(channel_id, node_from, node_to)
 
     @with_lock
     def remove_htlc(self, node_from: bytes, node_to: bytes, channel_id: ShortChannelID):
         hint = self.get_hint(channel_id)
         hint.remove_htlc(node_from < node_to)
+        self.hint_changes.record(channel_id, node_from, node_to)
 
     def penalty(self, node_from: bytes, node_to: bytes, channel_id: ShortChannelID, amount: int) -> float:
         """Gives a penalty when sending from node1 to node2 over channel_id with an
@@ -385,6 +399,7 @@ class LiquidityHintMgr:
         hint = self.get_hint(channel_id)
         now = int(time.time())
         hint.blacklist_timestamp = now
+        self.hint_changes.record(channel_id)
 
     @with_lock
     def get_blacklist(self) -> Set[ShortChannelID]:
@@ -395,11 +410,13 @@ class LiquidityHintMgr:
     def clear_blacklist(self):
         for k, v in self._liquidity_hints.items():
             v.blacklist_timestamp = 0
+        self.hint_changes.invalidate()
 
     @with_lock
     def reset_liquidity_hints(self):
         for k, v in self._liquidity_hints.items():
             v.hint_timestamp = 0
+        self.hint_changes.invalidate()
 
     def __repr__(self):
         string = "liquidity hints:\n"
@@ -409,12 +426,71 @@ class LiquidityHintMgr:
         return string
 
 
+class DistanceMap:
+    """State of a path finding search from nodeB towards nodeA, that can be resumed.
+
+    Nodes are settled in order of distance, and only as far as needed by a query;
+    a later query with the same parameters continues from where the previous one stopped.
+    Edges starting at nodeA are not part of the search, as they depend on which of
+    our own channels can be used: they are evaluated for every query.
+    """
+
+    def __init__(
+            self,
+            *,
+            nodeA: bytes,
+            nodeB: bytes,
+            invoice_amount_msat: int,
+            max_fee_msat: Optional[int],
+            max_cltv_delta: Optional[int],
+            private_route_edges: Dict[ShortChannelID, RouteEdge],
+            graph: Optional['CompactChannelGraph'],
+            blacklist: Set[ShortChannelID],
+            channels_version: int,
+            hints_version: int,
+    ):
+        self.lock = RLock()
+        self.nodeA = nodeA
+        self.nodeB = nodeB
+        self.invoice_amount_msat = invoice_amount_msat
+        self.max_fee_msat = max_fee_msat
+        self.max_cltv_delta = max_cltv_delta
+        self.private_route_edges = private_route_edges
+        self.graph = graph
+        self.blacklist = blacklist
+        self.channels_version = channels_version
+        self.hints_version = hints_version
+        self.timestamp = time.monotonic()
+        self.distance = {nodeB: 0}  # type: Dict[bytes, float]
+        self.cltv = {nodeB: 0}  # type: Dict[bytes, int]  # only used with max_cltv_delta
+        self.prev_node = {}  # type: Dict[bytes, PathEdge]
+        self.settled = {}  # type: Dict[bytes, Tuple[int, int]]  # node -> (order, amount_msat)
+        self.heap = [(0, invoice_amount_msat, nodeB)]  # order of fields (in tuple) matters!
+
+    def is_affected_by(self, changes: Sequence[Tuple[ShortChannelID, Optional[bytes], Optional[bytes]]]) -> bool:
+        """Whether the search has looked at any of the changed channels.
+        The channels of a node are looked at when the node is settled.
+        """
+        settled, nodeA = self.settled, self.nodeA
+        for short_channel_id, node1_id, node2_id in changes:
+            if node1_id is None or node2_id is None:
+                return True
+            if node1_id in settled and node2_id != nodeA:
+                return True
+            if node2_id in settled and node1_id != nodeA:
+                return True
+        return False
+
+
 class LNPathFinder(Logger):
 
     def __init__(self, channel_db: ChannelDB):
         Logger.__init__(self)
         self.channel_db = channel_db
         self.liquidity_hints = LiquidityHintMgr()
+        self._distance_maps = OrderedDict()  # type: OrderedDict[tuple, DistanceMap]
+        self._distance_maps_lock = RLock()
+        self.num_distance_map_reuses = 0
 
     def update_liquidity_hints(
             self,
@@ -512,76 +588,321 @@ class LNPathFinder(Logger):
         overall_cost = fee_msat + cltv_cost + liquidity_penalty
         return overall_cost, fee_msat
 
-    def get_distances(
+    def use_compact_graph(self) -> bool:
+        return bool(self.channel_db.network.config.get('lightning_use_compact_graph', True))
+
+    def clear_distance_maps(self) -> None:
+        with self._distance_maps_lock:
+            self._distance_maps.clear()
+
+    def _get_distance_map(
             self,
             *,
             nodeA: bytes,
             nodeB: bytes,
             invoice_amount_msat: int,
-            my_channels: Dict[ShortChannelID, 'Channel'] = None,
-            private_route_edges: Dict[ShortChannelID, RouteEdge] = None,
-    ) -> Dict[bytes, PathEdge]:
-        # note: we don't lock self.channel_db, so while the path finding runs,
-        #       the underlying graph could potentially change... (not good but maybe ~OK?)
+            private_route_edges: Dict[ShortChannelID, RouteEdge],
+            max_fee_msat: Optional[int],
+            max_cltv_delta: Optional[int],
+    ) -> 'DistanceMap':
+        """Returns a cached search for these parameters, if it is still valid, or a new one."""
+        use_compact_graph = self.use_compact_graph()
+        key = (nodeA, nodeB, invoice_amount_msat, max_fee_msat, max_cltv_delta, use_compact_graph,
+               tuple(sorted((bytes(e.short_channel_id), e.start_node, e.end_node, e.fee_base_msat,
+                             e.fee_proportional_millionths, e.cltv_expiry_delta)
+                            for e in private_route_edges.values())))
+        with self._distance_maps_lock:
+            dmap = self._distance_maps.pop(key, None)
+        if dmap is not None:
+            with dmap.lock:
+                if self._update_distance_map_version(dmap):
+                    self.num_distance_map_reuses += 1
+                else:
+                    dmap = None
+        if dmap is None:
+            graph = self.channel_db.get_compact_graph() if use_compact_graph else None
+            dmap = DistanceMap(
+                nodeA=nodeA,
+                nodeB=nodeB,
+                invoice_amount_msat=invoice_amount_msat,
+                max_fee_msat=max_fee_msat,
+                max_cltv_delta=max_cltv_delta,
+                private_route_edges=private_route_edges,
+                graph=graph,
+                blacklist=self.liquidity_hints.get_blacklist(),
+                channels_version=self.channel_db.channel_changes.version,
+                hints_version=self.liquidity_hints.hint_changes.version)
+        with self._distance_maps_lock:
+            self._distance_maps[key] = dmap
+            while len(self._distance_maps) > NUM_CACHED_DISTANCE_MAPS:
+                self._distance_maps.popitem(last=False)
+        return dmap
+
+    def _update_distance_map_version(self, dmap: 'DistanceMap') -> bool:
+        """Checks that nothing the search has looked at changed since it ran,
+        and if so, marks it as up-to-date. Returns whether it can be reused.
+        """
+        if time.monotonic() - dmap.timestamp > DISTANCE_MAP_MAX_AGE:
+            return False  # hints and blacklist entries expire with time
+        channels_version = self.channel_db.channel_changes.version
+        hints_version = self.liquidity_hints.hint_changes.version
+        for changelog, version in ((self.channel_db.channel_changes, dmap.channels_version),
+                                   (self.liquidity_hints.hint_changes, dmap.hints_version)):
+            changes = changelog.get_changes_since(version)
+            if changes is None or dmap.is_affected_by(changes):
+                return False
+        dmap.channels_version = channels_version
+        dmap.hints_version = hints_version
+        return True
 
-        # run Dijkstra
-        # The search is run in the REVERSE direction, from nodeB to nodeA,
-        # to properly calculate compound routing fees.
-        blacklist = self.liquidity_hints.get_blacklist()
-        distance_from_start = defaultdict(lambda: float('inf'))
-        distance_from_start[nodeB] = 0
-        prev_node = {}  # type: Dict[bytes, PathEdge]
-        nodes_to_explore = queue.PriorityQueue()
-        nodes_to_explore.put((0, invoice_amount_msat, nodeB))  # order of fields (in tuple) matters!
+    def _expand_nodes(self, dmap: 'DistanceMap') -> Iterator[bytes]:
+        """Continues the search of dmap, yielding the nodes in the order they are settled.
+        The caller can stop iterating at any point, and the search can be resumed later.
+        """
+        nodeA = dmap.nodeA
+        invoice_amount_msat = dmap.invoice_amount_msat
+        max_amount_msat = invoice_amount_msat + dmap.max_fee_msat if dmap.max_fee_msat is not None else inf
+        max_cltv_delta = dmap.max_cltv_delta
+        track_cltv = max_cltv_delta is not None
+        private_route_edges = dmap.private_route_edges
+        blacklist = dmap.blacklist
+        graph = dmap.graph
+        heap = dmap.heap
+        distance_from_start = dmap.distance
+        cltv_from_start = dmap.cltv
+        prev_node = dmap.prev_node
+        settled = dmap.settled
+
+        def relax(edge_startnode, edge_endnode, edge_channel_id, amount_msat, edge_cost, fee_for_edge_msat, cltv_expiry_delta):
+            alt_dist_to_neighbour = distance_from_start[edge_endnode] + edge_cost
+            if alt_dist_to_neighbour < distance_from_start.get(edge_startnode, inf):
+                # prune paths that would be rejected by is_route_sane_to_use anyway
+                amount_to_forward_msat = amount_msat + fee_for_edge_msat
+                if amount_to_forward_msat > max_amount_msat:
+                    return
+                if track_cltv:
+                    cltv = cltv_from_start[edge_endnode] + cltv_expiry_delta
+                    if cltv > max_cltv_delta:
+                        return
+                    cltv_from_start[edge_startnode] = cltv
+                distance_from_start[edge_startnode] = alt_dist_to_neighbour
+                prev_node[edge_startnode] = PathEdge(
+                    start_node=edge_startnode,
+                    end_node=edge_endnode,
+                    short_channel_id=ShortChannelID(edge_channel_id))
+                heappush(heap, (alt_dist_to_neighbour, amount_to_forward_msat, edge_startnode))
+
+        def explore_channel(edge_channel_id, edge_endnode, amount_msat):
+            assert isinstance(edge_channel_id, bytes)
+            if blacklist and edge_channel_id in blacklist:
+                return
+            channel_info = self.channel_db.get_channel_info(
+                edge_channel_id, private_route_edges=private_route_edges)
+            if channel_info is None:
+                return
+            edge_startnode = channel_info.node2_id if channel_info.node1_id == edge_endnode else channel_info.node1_id
+            if edge_startnode == nodeA:
+                return  # first edge of the path, see _find_first_edge
+            edge_cost, fee_for_edge_msat = self._edge_cost(
+                short_channel_id=edge_channel_id,
+                start_node=edge_startnode,
+                end_node=edge_endnode,
+                payment_amt_msat=amount_msat,
+                private_route_edges=private_route_edges)
+            if edge_cost == inf:
+                return
+            cltv_expiry_delta = 0
+            if track_cltv:
+                route_edge = private_route_edges.get(edge_channel_id)
+                if route_edge is not None:
+                    cltv_expiry_delta = route_edge.cltv_expiry_delta
+                else:
+                    channel_policy = self.channel_db.get_policy_for_node(
+                        edge_channel_id, edge_startnode, private_route_edges=private_route_edges)
+                    cltv_expiry_delta = channel_policy.cltv_expiry_delta
+            relax(edge_startnode, edge_endnode, edge_channel_id, amount_msat, edge_cost, fee_for_edge_msat, cltv_expiry_delta)
+
+        if graph is not None:
+            # Public channels are read from the compact graph, without building RouteEdges.
+            # Private route hints go through _edge_cost, as before.
+            special_chans = set(private_route_edges)
+            special_chans_for_node = defaultdict(set)  # type: Dict[bytes, Set[ShortChannelID]]
+            for route_edge in private_route_edges.values():
+                special_chans_for_node[route_edge.start_node].add(route_edge.short_channel_id)
+                special_chans_for_node[route_edge.end_node].add(route_edge.short_channel_id)
+            node_ids, node_index, chan_scids = graph.node_ids, graph.node_index, graph.chan_scids
+            chan_capacity_sat, edge_start, edge_flags = graph.chan_capacity_sat, graph.edge_start, graph.edge_flags
+            edge_fee_base_msat = graph.edge_fee_base_msat
+            edge_fee_proportional_millionths = graph.edge_fee_proportional_millionths
+            edge_cltv_expiry_delta = graph.edge_cltv_expiry_delta
+            edge_htlc_minimum_msat = graph.edge_htlc_minimum_msat
+            edge_htlc_maximum_msat = graph.edge_htlc_maximum_msat
+            penalty = self.liquidity_hints.penalty
 
         # main loop of search
-        while nodes_to_explore.qsize() > 0:
-            dist_to_edge_endnode, amount_msat, edge_endnode = nodes_to_explore.get()
-            if edge_endnode == nodeA:
-                break
-            if dist_to_edge_endnode != distance_from_start[edge_endnode]:
-                # queue.PriorityQueue does not implement decrease_priority,
-                # so instead of decreasing priorities, we add items again into the queue.
-                # so there are duplicates in the queue, that we discard now:
+        while heap:
+            dist_to_edge_endnode, amount_msat, edge_endnode = heappop(heap)
+            if dist_to_edge_endnode != distance_from_start[edge_endnode] or edge_endnode in settled:
+                # instead of decreasing priorities, we add items again into the heap.
+                # so there are duplicates in the heap, that we discard now:
                 continue
-            for edge_channel_id in self.channel_db.get_channels_for_node(
-                    edge_endnode, my_channels=my_channels, private_route_edges=private_route_edges):
-                assert isinstance(edge_channel_id, bytes)
-                if blacklist and edge_channel_id in blacklist:
-                    continue
-                channel_info = self.channel_db.get_channel_info(
-                    edge_channel_id, my_channels=my_channels, private_route_edges=private_route_edges)
-                if channel_info is None:
+            settled[edge_endnode] = len(settled), amount_msat
+            if graph is None:
+                for edge_channel_id in self.channel_db.get_channels_for_node(
+                        edge_endnode, private_route_edges=private_route_edges):
+                    explore_channel(edge_channel_id, edge_endnode, amount_msat)
+                yield edge_endnode
+                continue
+            node_idx = node_index.get(edge_endnode)
+            special_chans_here = special_chans_for_node.get(edge_endnode) or set()
+            if node_idx is not None:
+                for e in graph.get_incoming_edges(node_idx):
+                    flags = edge_flags[e]
+                    k = e >> 1
+                    edge_channel_id = chan_scids[k]
+                    if edge_channel_id in special_chans:
+                        if not flags & EDGE_REMOVED and edge_channel_id not in special_chans_here:
+                            explore_channel(edge_channel_id, edge_endnode, amount_msat)
+                        continue
+                    # same checks as in _edge_cost
+                    if flags & (EDGE_REMOVED | EDGE_DISABLED) or not flags & EDGE_HAS_POLICY:
+                        continue
+                    if not edge_flags[e ^ 1] & EDGE_HAS_POLICY:
+                        continue  # channels that did not publish both policies often fail
+                    if blacklist and edge_channel_id in blacklist:
+                        continue
+                    if amount_msat < edge_htlc_minimum_msat[e]:
+                        continue
+                    capacity_sat = chan_capacity_sat[k]
+                    if capacity_sat >= 0 and amount_msat // 1000 > capacity_sat:
+                        continue
+                    htlc_maximum_msat = edge_htlc_maximum_msat[e]
+                    if htlc_maximum_msat >= 0 and amount_msat > htlc_maximum_msat:
+                        continue
+                    cltv_expiry_delta = edge_cltv_expiry_delta[e]
+                    if cltv_expiry_delta > MAX_CLTV_EXPIRY_DELTA:
+                        continue
+                    fee_msat = fee_for_edge_msat(amount_msat, edge_fee_base_msat[e], edge_fee_proportional_millionths[e])
+                    if amount_msat + fee_msat > max_amount_msat:
+                        continue  # over the fee budget, skip computing the cost
+                    if not is_fee_sane(fee_msat, payment_amount_msat=amount_msat):
+                        continue
+                    edge_startnode = node_ids[edge_start[e]]
+                    if edge_startnode == nodeA:
+                        continue  # first edge of the path, see _find_first_edge
+                    cltv_cost = cltv_expiry_delta * amount_msat * 15 / 1_000_000_000
+                    liquidity_penalty = penalty(edge_startnode, edge_endnode, edge_channel_id, amount_msat)
+                    edge_cost = fee_msat + cltv_cost + liquidity_penalty
+                    relax(edge_startnode, edge_endnode, edge_channel_id, amount_msat, edge_cost, fee_msat, cltv_expiry_delta)
+            for edge_channel_id in special_chans_here:
+                explore_channel(edge_channel_id, edge_endnode, amount_msat)
+            yield edge_endnode
+
+    def _find_first_edge(
+            self,
+            dmap: 'DistanceMap',
+            *,
+            my_channels: Dict[ShortChannelID, 'Channel'],
+            private_route_edges: Dict[ShortChannelID, RouteEdge],
+    ) -> Optional[PathEdge]:
+        """Finds the best edge from nodeA to a node reached by the search,
+        expanding the search only as far as needed.
+        """
+        nodeA = dmap.nodeA
+        chans_for_peer = defaultdict(list)  # type: Dict[bytes, List[ShortChannelID]]
+        for edge_channel_id in self.channel_db.get_channels_for_node(
+                nodeA, my_channels=my_channels, private_route_edges=private_route_edges):
+            channel_info = self.channel_db.get_channel_info(
+                edge_channel_id, my_channels=my_channels, private_route_edges=private_route_edges)
+            if channel_info is None:
+                continue
+            edge_endnode = channel_info.node2_id if channel_info.node1_id == nodeA else channel_info.node1_id
+            chans_for_peer[edge_endnode].append(edge_channel_id)
+        best_dist = inf
+        best_edge = None
+
+        def explore_peer(edge_endnode):
+            nonlocal best_dist, best_edge
+            amount_msat = dmap.settled[edge_endnode][1]
+            for edge_channel_id in chans_for_peer[edge_endnode]:
+                if dmap.blacklist and edge_channel_id in dmap.blacklist:
                     continue
-                edge_startnode = channel_info.node2_id if channel_info.node1_id == edge_endnode else channel_info.node1_id
                 is_mine = edge_channel_id in my_channels
-                if is_mine:
-                    if edge_startnode == nodeA:  # payment outgoing, on our channel
-                        if not my_channels[edge_channel_id].can_pay(amount_msat, check_frozen=True):
-                            continue
-                    else:  # payment incoming, on our channel. (funny business, cycle weirdness)
-                        assert edge_endnode == nodeA, (bh2u(edge_startnode), bh2u(edge_endnode))
-                        if not my_channels[edge_channel_id].can_receive(amount_msat, check_frozen=True):
-                            continue
-                edge_cost, fee_for_edge_msat = self._edge_cost(
+                if is_mine and not my_channels[edge_channel_id].can_pay(amount_msat, check_frozen=True):
+                    continue
+                edge_cost, _ = self._edge_cost(
                     short_channel_id=edge_channel_id,
-                    start_node=edge_startnode,
+                    start_node=nodeA,
                     end_node=edge_endnode,
                     payment_amt_msat=amount_msat,
-                    ignore_costs=(edge_startnode == nodeA),
+                    ignore_costs=True,
                     is_mine=is_mine,
                     my_channels=my_channels,
                     private_route_edges=private_route_edges)
-                alt_dist_to_neighbour = distance_from_start[edge_endnode] + edge_cost
-                if alt_dist_to_neighbour < distance_from_start[edge_startnode]:
-                    distance_from_start[edge_startnode] = alt_dist_to_neighbour
-                    prev_node[edge_startnode] = PathEdge(
-                        start_node=edge_startnode,
+                alt_dist = dmap.distance[edge_endnode] + edge_cost
+                if alt_dist < best_dist:
+                    best_dist = alt_dist
+                    best_edge = PathEdge(
+                        start_node=nodeA,
                         end_node=edge_endnode,
                         short_channel_id=ShortChannelID(edge_channel_id))
-                    amount_to_forward_msat = amount_msat + fee_for_edge_msat
-                    nodes_to_explore.put((alt_dist_to_neighbour, amount_to_forward_msat, edge_startnode))
 
+        # peers reached by a previous run of the search, in the order they were settled
+        for edge_endnode in sorted((n for n in chans_for_peer if n in dmap.settled),
+                                   key=lambda n: dmap.settled[n][0]):
+            explore_peer(edge_endnode)
+        # nodes are settled in order of distance, so we can stop when
+        # no unsettled node can lead to a shorter path
+        heap = dmap.heap
+        if heap and heap[0][0] < best_dist:
+            for node_id in self._expand_nodes(dmap):
+                if node_id in chans_for_peer:
+                    explore_peer(node_id)
+                if not heap or heap[0][0] >= best_dist:
+                    break
+        return best_edge
+
+    def get_distances(
+            self,
+            *,
+            nodeA: bytes,
+            nodeB: bytes,
+            invoice_amount_msat: int,
+            my_channels: Dict[ShortChannelID, 'Channel'] = None,
+            private_route_edges: Dict[ShortChannelID, RouteEdge] = None,
+            max_fee_msat: int = None,
+            max_cltv_delta: int = None,
+    ) -> Dict[bytes, PathEdge]:
+        """Runs Dijkstra, in the REVERSE direction, from nodeB to nodeA,
+        to properly calculate compound routing fees.
+
+        Paths whose fees (excluding the first edge) exceed max_fee_msat, or whose
+        cltv deltas (excluding the first edge) add up to more than max_cltv_delta,
+        are pruned. The search is cached, and is reused by subsequent calls with
+        the same parameters (e.g. payment retries over a different channel of ours)
+        as long as the parts of the graph it looked at did not change.
+        """
+        # note: we don't lock self.channel_db, so while the path finding runs,
+        #       the underlying graph could potentially change... (not good but maybe ~OK?)
+        if my_channels is None:
+            my_channels = {}
+        if private_route_edges is None:
+            private_route_edges = {}
+        if nodeA == nodeB:
+            return {}
+        dmap = self._get_distance_map(
+            nodeA=nodeA,
+            nodeB=nodeB,
+            invoice_amount_msat=invoice_amount_msat,
+            private_route_edges=private_route_edges,
+            max_fee_msat=max_fee_msat,
+            max_cltv_delta=max_cltv_delta)
+        with dmap.lock:
+            first_edge = self._find_first_edge(
+                dmap, my_channels=my_channels, private_route_edges=private_route_edges)
+            prev_node = dict(dmap.prev_node)
+        if first_edge is not None:
+            prev_node[nodeA] = first_edge
         return prev_node
 
     @profiler
@@ -593,6 +914,8 @@ class LNPathFinder(Logger):
             invoice_amount_msat: int,
             my_channels: Dict[ShortChannelID, 'Channel'] = None,
             private_route_edges: Dict[ShortChannelID, RouteEdge] = None,
+            max_fee_msat: int = None,
+            max_cltv_delta: int = None,
     ) -> Optional[LNPaymentPath]:
         """Return a path from nodeA to nodeB."""
         assert type(nodeA) is bytes
@@ -606,7 +929,9 @@ class LNPathFinder(Logger):
             nodeB=nodeB,
             invoice_amount_msat=invoice_amount_msat,
             my_channels=my_channels,
-            private_route_edges=private_route_edges)
+            private_route_edges=private_route_edges,
+            max_fee_msat=max_fee_msat,
+            max_cltv_delta=max_cltv_delta)
 
         if nodeA not in prev_node:
             return None  # no path found
@@ -669,6 +994,8 @@ class LNPathFinder(Logger):
             path = None,
             my_channels: Dict[ShortChannelID, 'Channel'] = None,
             private_route_edges: Dict[ShortChannelID, RouteEdge] = None,
+            max_fee_msat: int = None,
+            max_cltv_delta: int = None,
     ) -> Optional[LNPaymentRoute]:
         route = None
         if not path:
@@ -677,7 +1004,9 @@ class LNPathFinder(Logger):
                 nodeB=nodeB,
                 invoice_amount_msat=invoice_amount_msat,
                 my_channels=my_channels,
-                private_route_edges=private_route_edges)
+                private_route_edges=private_route_edges,
+                max_fee_msat=max_fee_msat,
+                max_cltv_delta=max_cltv_delta)
         if path:
             route = self.create_route_from_path(
                 path, my_channels=my_channels, private_route_edges=private_route_edges)
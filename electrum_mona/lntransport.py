@@ -83,6 +83,15 @@ def act1_initiator_message(hs, epriv, epub):
     return msg, temp_k1
 
 
+# bounds of the size of socket reads in read_messages, which adapts to the incoming data rate
+READ_SIZE_MIN = 2**12
+READ_SIZE_MAX = 2**17
+# send_bytes writes to the socket once this much is pending, even if the flush is scheduled
+SEND_BUFFER_MAX = 2**16
+# pending bytes above which the connection is not keeping up, see is_write_buffer_full
+WRITE_BUFFER_HIGH = 2**16
+
+
 def create_ephemeral_key() -> (bytes, bytes):
     privkey = ecc.ECPrivkey.generate_random_key()
     return privkey.get_secret_bytes(), privkey.get_public_key_bytes()
@@ -93,6 +102,10 @@ class LNTransportBase:
     writer: StreamWriter
     privkey: bytes
 
+    def __init__(self):
+        # encrypted messages not written yet, see send_bytes
+        self._send_buffer = bytearray()
+
     def name(self) -> str:
         raise NotImplementedError()
 
@@ -102,33 +115,74 @@ class LNTransportBase:
         c = aead_encrypt(self.sk, self.sn(), b'', msg)
         assert len(lc) == 18
         assert len(c) == len(msg) + 16
-        self.writer.write(lc+c)
+        # messages sent during the same event loop iteration are written together
+        flush_scheduled = bool(self._send_buffer)
+        self._send_buffer += lc
+        self._send_buffer += c
+        if len(self._send_buffer) >= SEND_BUFFER_MAX:
+            self._flush_send_buffer()
+        elif not flush_scheduled:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:  # not called from the event loop
+                self._flush_send_buffer()
+            else:
+                loop.call_soon(self._flush_send_buffer)
+
+    def _flush_send_buffer(self) -> None:
+        if not self._send_buffer:
+            return
+        # note: the writer might keep a reference to the data, so it is not reused
+        data, self._send_buffer = self._send_buffer, bytearray()
+        self.writer.write(data)
+
+    def is_write_buffer_full(self) -> bool:
+        """Whether the messages sent have not been written to the socket yet.
+        Callers can then hold back their less urgent messages.
+        """
+        pending = len(self._send_buffer) + self.writer.transport.get_write_buffer_size()
+        return pending >= WRITE_BUFFER_HIGH
+
+    async def drain(self) -> None:
+        """Waits until the socket has caught up with the messages sent."""
+        self._flush_send_buffer()
+        await self.writer.drain()
 
     async def read_messages(self):
         buffer = bytearray()
+        pos = 0  # start of the next message in buffer
+        read_size = READ_SIZE_MIN
         while True:
             rn_l, rk_l = self.rn()
             rn_m, rk_m = self.rn()
+            length = None
             while True:
-                if len(buffer) >= 18:
-                    lc = bytes(buffer[:18])
-                    l = aead_decrypt(rk_l, rn_l, b'', lc)
+                if length is None and len(buffer) - pos >= 18:
+                    l = aead_decrypt(rk_l, rn_l, b'', buffer[pos:pos+18])
                     length = int.from_bytes(l, 'big')
-                    offset = 18 + length + 16
-                    if len(buffer) >= offset:
-                        c = bytes(buffer[18:offset])
-                        del buffer[:offset]  # much faster than: buffer=buffer[offset:]
-                        msg = aead_decrypt(rk_m, rn_m, b'', c)
-                        yield msg
-                        break
+                if length is not None and len(buffer) - pos >= 18 + length + 16:
+                    offset = pos + 18 + length + 16
+                    msg = aead_decrypt(rk_m, rn_m, b'', buffer[pos+18:offset])
+                    pos = offset
+                    yield msg
+                    break
+                # drop the messages already read, before the buffer grows
+                if pos:
+                    del buffer[:pos]
+                    pos = 0
+                missing = (18 if length is None else 18 + length + 16) - len(buffer)
                 try:
-                    s = await self.reader.read(2**10)
+                    s = await self.reader.read(max(missing, read_size))
                 except asyncio.CancelledError:
                     raise
                 except Exception:
                     s = None
                 if not s:
                     raise LightningPeerConnectionClosed()
+                if len(s) >= read_size:
+                    read_size = min(2 * read_size, READ_SIZE_MAX)
+                elif len(s) < read_size // 4:
+                    read_size = max(read_size // 2, READ_SIZE_MIN)
                 buffer += s
 
     def rn(self):
@@ -155,6 +209,7 @@ class LNTransportBase:
         self.s_ck = ck
 
     def close(self):
+        self._flush_send_buffer()
         self.writer.close()
 
     def remote_pubkey(self) -> Optional[bytes]:
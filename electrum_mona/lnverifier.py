@@ -25,9 +25,12 @@
 
 import asyncio
 import threading
-from typing import TYPE_CHECKING, Dict, Set
+import time
+from collections import defaultdict
+from typing import TYPE_CHECKING, Dict, Set, List, Sequence, Optional
 
 import aiorpcx
+from aiorpcx import TaskGroup
 
 from . import bitcoin
 from . import ecc
@@ -45,6 +48,61 @@ if TYPE_CHECKING:
     from .lnrouter import ChannelDB
 
 
+# max number of blocks whose channels are being verified at the same time.
+# note: requests are also limited by the _network_request_semaphore
+MAX_CONCURRENT_BLOCKS = 20
+
+
+class ChannelVerificationStats:
+    """Counts channel announcements verified against the blockchain."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.num_verified = 0
+        self.num_rejected = 0  # funding output not found, or not matching
+        self.num_blocks = 0
+        self.num_txs = 0
+        # time during which at least one block was being verified
+        self.seconds = 0.0
+        self._num_active_blocks = 0
+        self._active_since = None  # type: Optional[float]
+
+    def start_block(self) -> None:
+        with self.lock:
+            if self._num_active_blocks == 0:
+                self._active_since = time.monotonic()
+            self._num_active_blocks += 1
+
+    def end_block(self, num_txs: int) -> None:
+        with self.lock:
+            self.num_blocks += 1
+            self.num_txs += num_txs
+            self._num_active_blocks -= 1
+            if self._num_active_blocks == 0:
+                self.seconds += time.monotonic() - self._active_since
+
+    def add_channel(self, *, valid: bool) -> None:
+        with self.lock:
+            if valid:
+                self.num_verified += 1
+            else:
+                self.num_rejected += 1
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            seconds = self.seconds
+            if self._num_active_blocks:
+                seconds += time.monotonic() - self._active_since
+            return {
+                'verified': self.num_verified,
+                'rejected': self.num_rejected,
+                'blocks': self.num_blocks,
+                'txs': self.num_txs,
+                'seconds': seconds,
+                'channels_per_sec': self.num_verified / seconds if seconds else 0,
+            }
+
+
 class LNChannelVerifier(NetworkJobOnDefaultServer):
     """ Verify channel announcements for the Channel DB """
 
@@ -58,11 +116,13 @@ class LNChannelVerifier(NetworkJobOnDefaultServer):
         self.unverified_channel_info = {}  # type: Dict[ShortChannelID, dict]  # scid -> msg_dict
         # channel announcements that seem to be invalid:
         self.blacklist = set()  # type: Set[ShortChannelID]
+        self.stats = ChannelVerificationStats()
         NetworkJobOnDefaultServer.__init__(self, network)
 
     def _reset(self):
         super()._reset()
         self.started_verifying_channel = set()  # type: Set[ShortChannelID]
+        self._block_semaphore = asyncio.Semaphore(MAX_CONCURRENT_BLOCKS)
 
     # TODO make async; and rm self.lock completely
     def add_new_channel_info(self, short_channel_id: ShortChannelID, msg: dict) -> bool:
@@ -74,6 +134,13 @@ class LNChannelVerifier(NetworkJobOnDefaultServer):
             self.unverified_channel_info[short_channel_id] = msg
             return True
 
+    def get_stats(self) -> dict:
+        """Progress and throughput of the verification."""
+        stats = self.stats.get_stats()
+        stats['unverified'] = len(self.unverified_channel_info)
+        stats['in_progress'] = len(self.started_verifying_channel)
+        return stats
+
     async def _run_tasks(self, *, taskgroup):
         await super()._run_tasks(taskgroup=taskgroup)
         async with taskgroup as group:
@@ -91,6 +158,8 @@ class LNChannelVerifier(NetworkJobOnDefaultServer):
         with self.lock:
             unverified_channel_info = list(self.unverified_channel_info)
 
+        # channels in the same block share the header
+        scids_by_height = defaultdict(list)  # type: Dict[int, List[ShortChannelID]]
         for short_channel_id in unverified_channel_info:
             if short_channel_id in self.started_verifying_channel:
                 continue
@@ -98,34 +167,53 @@ class LNChannelVerifier(NetworkJobOnDefaultServer):
             # only resolve short_channel_id if headers are available.
             if block_height <= 0 or block_height > local_height:
                 continue
+            scids_by_height[block_height].append(short_channel_id)
+
+        for block_height, short_channel_ids in sorted(scids_by_height.items()):
             header = blockchain.read_header(block_height)
             if header is None:
                 if block_height < constants.net.max_checkpoint():
                     await self.taskgroup.spawn(self.network.request_chunk(block_height, None, can_return_early=True))
                 continue
-            self.started_verifying_channel.add(short_channel_id)
-            await self.taskgroup.spawn(self.verify_channel(block_height, short_channel_id))
-            #self.logger.info(f'requested short_channel_id {bh2u(short_channel_id)}')
+            # released when the block is done
+            await self._block_semaphore.acquire()
+            self.started_verifying_channel.update(short_channel_ids)
+            await self.taskgroup.spawn(self.verify_channels_in_block(block_height, short_channel_ids))
 
-    async def verify_channel(self, block_height: int, short_channel_id: ShortChannelID):
+    async def verify_channels_in_block(self, block_height: int, short_channel_ids: Sequence[ShortChannelID]):
         # we are verifying channel announcements as they are from untrusted ln peers.
         # we use electrum servers to do this. however we don't trust electrum servers either...
+        self.stats.start_block()
+        # channels funded by the same tx share its requests
+        scids_by_txpos = defaultdict(list)  # type: Dict[int, List[ShortChannelID]]
+        for short_channel_id in short_channel_ids:
+            scids_by_txpos[short_channel_id.txpos].append(short_channel_id)
+        try:
+            # we need to wait if header sync/reorg is still ongoing, hence lock:
+            async with self.network.bhi_lock:
+                header = self.network.blockchain().read_header(block_height)
+            async with TaskGroup() as group:
+                for txpos, scids in scids_by_txpos.items():
+                    await group.spawn(self._verify_channels_in_tx(block_height, header, txpos, scids))
+        finally:
+            self.stats.end_block(len(scids_by_txpos))
+            self._block_semaphore.release()
+
+    async def _verify_channels_in_tx(self, block_height: int, header: Optional[dict], txpos: int,
+                                     short_channel_ids: Sequence[ShortChannelID]):
         try:
             async with self._network_request_semaphore:
-                result = await self.network.get_txid_from_txpos(
-                    block_height, short_channel_id.txpos, True)
+                result = await self.network.get_txid_from_txpos(block_height, txpos, True)
         except aiorpcx.jsonrpc.RPCError:
             # the electrum server is complaining about the txpos for given block.
             # it is not clear what to do now, but let's believe the server.
-            self._blacklist_short_channel_id(short_channel_id)
+            for short_channel_id in short_channel_ids:
+                self._blacklist_short_channel_id(short_channel_id)
             return
         tx_hash = result['tx_hash']
         merkle_branch = result['merkle']
-        # we need to wait if header sync/reorg is still ongoing, hence lock:
-        async with self.network.bhi_lock:
-            header = self.network.blockchain().read_header(block_height)
         try:
-            verify_tx_is_in_block(tx_hash, merkle_branch, short_channel_id.txpos, header, block_height)
+            verify_tx_is_in_block(tx_hash, merkle_branch, txpos, header, block_height)
         except MerkleVerificationFailure as e:
             # the electrum server sent an incorrect proof. blame is on server, not the ln peer
             raise GracefulDisconnect(e) from e
@@ -149,7 +237,10 @@ class LNChannelVerifier(NetworkJobOnDefaultServer):
             # if we connect to a diff server at some point, let's try again.
             self.logger.info(f"received tx does not match expected txid ({tx_hash} != {tx.txid()})")
             return
-        # check funding output
+        for short_channel_id in short_channel_ids:
+            self._verify_funding_output(tx, short_channel_id)
+
+    def _verify_funding_output(self, tx: Transaction, short_channel_id: ShortChannelID):
         chan_ann_msg = self.unverified_channel_info[short_channel_id]
         redeem_script = funding_output_script_from_keys(chan_ann_msg['bitcoin_key_1'], chan_ann_msg['bitcoin_key_2'])
         expected_address = bitcoin.redeem_script_to_address('p2wsh', redeem_script)
@@ -162,10 +253,12 @@ class LNChannelVerifier(NetworkJobOnDefaultServer):
             # FIXME what now? best would be to ban the originating ln peer.
             self.logger.info(f"funding output script mismatch for {short_channel_id}")
             self._remove_channel_from_unverified_db(short_channel_id)
+            self.stats.add_channel(valid=False)
             return
         # put channel into channel DB
         self.channel_db.add_verified_channel_info(chan_ann_msg, capacity_sat=actual_output.value)
         self._remove_channel_from_unverified_db(short_channel_id)
+        self.stats.add_channel(valid=True)
 
     def _remove_channel_from_unverified_db(self, short_channel_id: ShortChannelID):
         with self.lock:
@@ -176,6 +269,8 @@ class LNChannelVerifier(NetworkJobOnDefaultServer):
         self.blacklist.add(short_channel_id)
         with self.lock:
             self.unverified_channel_info.pop(short_channel_id, None)
+        self.started_verifying_channel.discard(short_channel_id)
+        self.stats.add_channel(valid=False)
 
 
 def verify_sig_for_channel_update(chan_upd: dict, node_id: bytes) -> bool:
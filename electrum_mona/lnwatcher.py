@@ -9,7 +9,7 @@ from enum import IntEnum, auto
 from typing import NamedTuple, Dict
 
 from . import util
-from .sql_db import SqlDB, sql
+from .sql_db import SqlDB, sql, sql_read
 from .wallet_db import WalletDB
 from .util import bh2u, bfh, log_exceptions, ignore_exceptions, TxMinedInfo, random_shuffled_copy
 from .address_synchronizer import AddressSynchronizer, TX_HEIGHT_LOCAL, TX_HEIGHT_UNCONF_PARENT, TX_HEIGHT_UNCONFIRMED
@@ -52,8 +52,14 @@ PRIMARY KEY(outpoint)
 
 class SweepStore(SqlDB):
 
+    # sweep transactions must survive a power failure
+    PRAGMAS = SqlDB.PRAGMAS + (('synchronous', 'FULL'),)
+
+    # lookups are served concurrently with writes
+    NUM_READERS = 2
+
     def __init__(self, path, network):
-        super().__init__(network.asyncio_loop, path)
+        super().__init__(network.asyncio_loop, path, num_readers=self.NUM_READERS)
 
     def create_database(self):
         c = self.conn.cursor()
@@ -61,13 +67,13 @@ class SweepStore(SqlDB):
         c.execute(create_sweep_txs)
         self.conn.commit()
 
-    @sql
+    @sql_read
     def get_sweep_tx(self, funding_outpoint, prevout):
         c = self.conn.cursor()
         c.execute("SELECT tx FROM sweep_txs WHERE funding_outpoint=? AND prevout=?", (funding_outpoint, prevout))
         return [Transaction(bh2u(r[0])) for r in c.fetchall()]
 
-    @sql
+    @sql_read
     def list_sweep_tx(self):
         c = self.conn.cursor()
         c.execute("SELECT funding_outpoint FROM sweep_txs")
@@ -78,18 +84,20 @@ class SweepStore(SqlDB):
         c = self.conn.cursor()
         assert Transaction(raw_tx).is_complete()
         c.execute("""INSERT INTO sweep_txs (funding_outpoint, ctn, prevout, tx) VALUES (?,?,?,?)""", (funding_outpoint, ctn, prevout, bfh(raw_tx)))
-        self.conn.commit()
 
-    @sql
+    @sql_read
     def get_num_tx(self, funding_outpoint):
         c = self.conn.cursor()
         c.execute("SELECT count(*) FROM sweep_txs WHERE funding_outpoint=?", (funding_outpoint,))
         return int(c.fetchone()[0])
 
-    @sql
-    def get_ctn(self, outpoint, addr):
-        if not self._has_channel(outpoint):
-            self._add_channel(outpoint, addr)
+    async def get_ctn(self, outpoint, addr):
+        if not await self._has_channel(outpoint):
+            await self._add_channel(outpoint, addr)
+        return await self._get_max_ctn(outpoint)
+
+    @sql_read
+    def _get_max_ctn(self, outpoint):
         c = self.conn.cursor()
         c.execute("SELECT max(ctn) FROM sweep_txs WHERE funding_outpoint=?", (outpoint,))
         return int(c.fetchone()[0] or 0)
@@ -98,33 +106,33 @@ class SweepStore(SqlDB):
     def remove_sweep_tx(self, funding_outpoint):
         c = self.conn.cursor()
         c.execute("DELETE FROM sweep_txs WHERE funding_outpoint=?", (funding_outpoint,))
-        self.conn.commit()
 
+    @sql
     def _add_channel(self, outpoint, address):
         c = self.conn.cursor()
-        c.execute("INSERT INTO channel_info (address, outpoint) VALUES (?,?)", (address, outpoint))
-        self.conn.commit()
+        # note: concurrent get_ctn calls might both try to add the channel
+        c.execute("INSERT OR IGNORE INTO channel_info (address, outpoint) VALUES (?,?)", (address, outpoint))
 
     @sql
     def remove_channel(self, outpoint):
         c = self.conn.cursor()
         c.execute("DELETE FROM channel_info WHERE outpoint=?", (outpoint,))
-        self.conn.commit()
 
+    @sql_read
     def _has_channel(self, outpoint):
         c = self.conn.cursor()
         c.execute("SELECT * FROM channel_info WHERE outpoint=?", (outpoint,))
         r = c.fetchone()
         return r is not None
 
-    @sql
+    @sql_read
     def get_address(self, outpoint):
         c = self.conn.cursor()
         c.execute("SELECT address FROM channel_info WHERE outpoint=?", (outpoint,))
         r = c.fetchone()
         return r[0] if r else None
 
-    @sql
+    @sql_read
     def list_channels(self):
         c = self.conn.cursor()
         c.execute("SELECT outpoint, address FROM channel_info")
@@ -68,7 +68,7 @@ from .lnonion import OnionFailureCode, OnionRoutingFailure
 from .lnmsg import decode_msg
 from .i18n import _
 from .lnrouter import (RouteEdge, LNPaymentRoute, LNPaymentPath, is_route_sane_to_use,
-                       NoChannelPolicy, LNPathInconsistent)
+                       NoChannelPolicy, LNPathInconsistent, get_max_sane_fee_msat)
 from .address_synchronizer import TX_HEIGHT_LOCAL
 from . import lnsweep
 from .lnwatcher import LNWalletWatcher
@@ -490,6 +490,7 @@ class LNGossip(LNWorker):
             if len(self.unknown_ids) == 0:
                 self.channel_db.prune_old_policies(self.max_age)
                 self.channel_db.prune_orphaned_channels()
+            self.channel_db.maybe_save_snapshot()
             await asyncio.sleep(120)
 
     async def add_new_ids(self, ids: Iterable[bytes]):
@@ -537,15 +538,14 @@ class LNGossip(LNWorker):
         await self.channel_db.data_loaded.wait()
         self.logger.debug(f'process_gossip {len(chan_anns)} {len(node_anns)} {len(chan_upds)}')
         # channel announcements
+        # note: signatures are verified in parallel, and only verified payloads are added
         def process_chan_anns():
-            for payload in chan_anns:
-                self.channel_db.verify_channel_announcement(payload)
+            self.channel_db.verify_channel_announcements(chan_anns)
             self.channel_db.add_channel_announcements(chan_anns)
         await run_in_thread(process_chan_anns)
         # node announcements
         def process_node_anns():
-            for payload in node_anns:
-                self.channel_db.verify_node_announcement(payload)
+            self.channel_db.verify_node_announcements(node_anns)
             self.channel_db.add_node_announcements(node_anns)
         await run_in_thread(process_node_anns)
         # channel updates
@@ -1624,7 +1624,10 @@ class LNWallet(LNWorker):
                 invoice_amount_msat=amount_msat,
                 path=full_path,
                 my_channels=scid_to_my_channels,
-                private_route_edges=private_route_edges)
+                private_route_edges=private_route_edges,
+                # prune paths that is_route_sane_to_use would reject
+                max_fee_msat=get_max_sane_fee_msat(amount_msat),
+                max_cltv_delta=lnutil.NBLOCK_CLTV_EXPIRY_TOO_FAR_INTO_FUTURE - min_cltv_expiry)
         except NoChannelPolicy as e:
             raise NoPathFound() from e
         if not route:
@@ -32,7 +32,7 @@ import socket
 import json
 import sys
 import asyncio
-from typing import NamedTuple, Optional, Sequence, List, Dict, Tuple, TYPE_CHECKING, Iterable, Set, Any
+from typing import NamedTuple, Optional, Sequence, List, Dict, Tuple, TYPE_CHECKING, Iterable, Set, Any, Union
 import traceback
 import concurrent
 from concurrent import futures
@@ -670,10 +670,9 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         with self.interfaces_lock: interfaces = list(self.interfaces.values())
         pref_height = self._blockchain_preferred_block['height']
         pref_hash   = self._blockchain_preferred_block['hash']
-        # shortcut for common case
-        if pref_height == 0:
-            return
-        # maybe try switching chains; starting with most desirable first
+        # maybe try switching chains; starting with most desirable first.
+        # without a preference (height 0) every chain matches, and the one
+        # with the most work comes first
         matching_chains = blockchain.get_chains_that_contain_header(pref_height, pref_hash)
         chains_to_try = list(matching_chains) + [blockchain.get_best_chain()]
         for rank, chain in enumerate(chains_to_try):
@@ -877,6 +876,18 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
     async def get_merkle_for_transaction(self, tx_hash: str, tx_height: int) -> dict:
         return await self.interface.get_merkle_for_transaction(tx_hash=tx_hash, tx_height=tx_height)
 
+    @best_effort_reliable
+    @catch_server_exceptions
+    async def get_merkles_for_transactions(
+            self, items: Sequence[Tuple[str, int]]) -> List[Union[dict, UntrustedServerReturnedError]]:
+        """Batched version of get_merkle_for_transaction. Errors returned by
+        the server for single items are put in place of their results.
+        """
+        results = await self.interface.get_merkles_for_transactions(items)
+        return [UntrustedServerReturnedError(original_exception=res)
+                if isinstance(res, aiorpcx.jsonrpc.CodeMessageError) else res
+                for res in results]
+
     @best_effort_reliable
     async def broadcast_transaction(self, tx: 'Transaction', *, timeout=None) -> None:
         if timeout is None:
@@ -0,0 +1,158 @@
+# Copyright (C) 2021 The Electrum developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENCE or http://www.opensource.org/licenses/mit-license.php
+
+# Proof-of-work hash engines for block headers.
+# Monacoin used scrypt up to height 450000, and Lyra2REv2 since then.
+# There can be several engines for the same algorithm; they are
+# listed in POW_ENGINES in order of preference (fastest first).
+
+import sys
+from typing import Sequence, List, Dict, Type, Optional
+
+from . import scrypt
+
+try:
+    import lyra2re2_hash
+except ImportError as e:
+    sys.exit("Please run 'sudo pip3 install lyra2re2-hash'")
+
+
+POW_ALGO_SCRYPT = 'scrypt'
+POW_ALGO_LYRA2REV2 = 'lyra2rev2'
+
+LYRA2REV2_START_HEIGHT = 450000
+
+
+def get_pow_algo_for_height(height: int) -> str:
+    if height < LYRA2REV2_START_HEIGHT:
+        return POW_ALGO_SCRYPT
+    return POW_ALGO_LYRA2REV2
+
+
+class PowEngine:
+    """Computes the proof-of-work hash of serialized 80-byte headers."""
+
+    name = None  # type: str
+    algo = None  # type: str
+    # vectorized engines are only worth it for at least this many headers
+    min_batch_size = 1
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return True
+
+    def hash(self, header: bytes) -> bytes:
+        raise NotImplementedError()
+
+    def hash_many(self, headers: Sequence[bytes]) -> List[bytes]:
+        return [self.hash(header) for header in headers]
+
+
+class ScryptHashlibEngine(PowEngine):
+    name = 'scrypt-hashlib'
+    algo = POW_ALGO_SCRYPT
+
+    @classmethod
+    def is_available(cls):
+        return scrypt.HAS_HASHLIB_SCRYPT
+
+    def hash(self, header):
+        return scrypt.scrypt_1024_1_1_80_hashlib(header)
+
+
+class ScryptNumpyEngine(PowEngine):
+    name = 'scrypt-numpy'
+    algo = POW_ALGO_SCRYPT
+    min_batch_size = 32
+
+    @classmethod
+    def is_available(cls):
+        return scrypt.HAS_NUMPY
+
+    def hash(self, header):
+        return self.hash_many([header])[0]
+
+    def hash_many(self, headers):
+        return scrypt.scrypt_1024_1_1_80_many_numpy(headers)
+
+
+class ScryptPythonEngine(PowEngine):
+    name = 'scrypt-python'
+    algo = POW_ALGO_SCRYPT
+
+    def hash(self, header):
+        return scrypt.scrypt_1024_1_1_80(header)
+
+
+class Lyra2REv2Engine(PowEngine):
+    name = 'lyra2rev2'
+    algo = POW_ALGO_LYRA2REV2
+
+    def hash(self, header):
+        return lyra2re2_hash.getPoWHash(header)
+
+
+POW_ENGINES = {
+    POW_ALGO_SCRYPT: [ScryptHashlibEngine, ScryptNumpyEngine, ScryptPythonEngine],
+    POW_ALGO_LYRA2REV2: [Lyra2REv2Engine],
+}  # type: Dict[str, List[Type[PowEngine]]]
+
+_engine_instances = {}  # type: Dict[Type[PowEngine], PowEngine]
+
+
+def register_pow_engine(klass: Type[PowEngine], *, preferred: bool = False) -> None:
+    engines = POW_ENGINES.setdefault(klass.algo, [])
+    if klass in engines:
+        engines.remove(klass)
+    if preferred:
+        engines.insert(0, klass)
+    else:
+        engines.append(klass)
+
+
+def get_available_pow_engines(algo: str) -> Sequence[PowEngine]:
+    result = []
+    for klass in POW_ENGINES.get(algo, []):
+        if not klass.is_available():
+            continue
+        if klass not in _engine_instances:
+            _engine_instances[klass] = klass()
+        result.append(_engine_instances[klass])
+    return result
+
+
+def get_pow_engine(algo: str, *, batch_size: int = 1, name: str = None) -> PowEngine:
+    """Returns the preferred available engine for algo, that is
+    suitable for hashing batch_size headers at once.
+    """
+    engines = get_available_pow_engines(algo)
+    if name is not None:
+        engines = [engine for engine in engines if engine.name == name]
+    for engine in engines:
+        if batch_size >= engine.min_batch_size:
+            return engine
+    raise Exception(f"no pow engine available for {algo!r} (name={name!r})")
+
+
+def pow_hash_raw_header(raw_header: bytes, height: int) -> int:
+    """Returns the proof-of-work hash of a serialized header, as an integer."""
+    engine = get_pow_engine(get_pow_algo_for_height(height))
+    return int.from_bytes(engine.hash(raw_header), byteorder='little')
+
+
+def pow_hash_raw_headers(raw_headers: Sequence[bytes], heights: Sequence[int]) -> List[int]:
+    """Same as pow_hash_raw_header, for many headers.
+    Headers are grouped by algorithm so that vectorized engines can be used.
+    """
+    assert len(raw_headers) == len(heights), (len(raw_headers), len(heights))
+    result = [None] * len(raw_headers)  # type: List[Optional[int]]
+    by_algo = {}  # type: Dict[str, List[int]]
+    for i, height in enumerate(heights):
+        by_algo.setdefault(get_pow_algo_for_height(height), []).append(i)
+    for algo, indices in by_algo.items():
+        engine = get_pow_engine(algo, batch_size=len(indices))
+        hashes = engine.hash_many([raw_headers[i] for i in indices])
+        for i, powhash in zip(indices, hashes):
+            result[i] = int.from_bytes(powhash, byteorder='little')
+    return result
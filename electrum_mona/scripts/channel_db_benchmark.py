@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Builds a synthetic gossip database, and prints how long ChannelDB.load_data
+# takes to load it from the raw gossip messages, and from the snapshot.
+# usage: channel_db_benchmark.py [<number of nodes> [<number of channels>]]
+
+import asyncio
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from electrum_mona import constants, util
+from electrum_mona.channel_db import ChannelDB
+from electrum_mona.lnmsg import encode_msg, decode_msg
+from electrum_mona.lnutil import ShortChannelID
+from electrum_mona.simple_config import SimpleConfig
+from electrum_mona.util import print_msg, create_and_start_event_loop
+
+try:
+    num_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    num_channels = int(sys.argv[2]) if len(sys.argv) > 2 else 80000
+except Exception:
+    print_msg("usage: channel_db_benchmark.py [<number of nodes> [<number of channels>]]")
+    sys.exit(1)
+
+rand = random.Random(0)
+loop, stop_loop, loop_thread = create_and_start_event_loop()
+util.callback_mgr.asyncio_loop = loop
+electrum_path = tempfile.mkdtemp()
+config = SimpleConfig({'electrum_path': electrum_path})
+chain_hash = constants.net.rev_genesis_bytes()
+
+
+class FakeNetwork:
+    asyncio_loop = loop
+    interface = None
+    def __init__(self):
+        self.config = config
+
+
+def node_id(i: int) -> bytes:
+    return b'\x02' + i.to_bytes(32, 'big')
+
+
+def wait(fut):
+    async def f():
+        return await fut
+    return asyncio.run_coroutine_threadsafe(f(), loop).result()
+
+
+def with_raw(raw: bytes) -> dict:
+    payload = decode_msg(raw)[1]
+    payload['raw'] = raw
+    return payload
+
+
+def populate(channel_db: ChannelDB):
+    pairs = set()
+    while len(pairs) < num_channels:
+        n1, n2 = rand.randrange(num_nodes), rand.randrange(num_nodes)
+        if n1 != n2:
+            pairs.add(tuple(sorted([node_id(n1), node_id(n2)])))
+    for i, (id1, id2) in enumerate(sorted(pairs)):
+        scid = ShortChannelID.from_components(500000 + i, 1, 0)
+        channel_db.add_channel_announcements(with_raw(encode_msg(
+            'channel_announcement', short_channel_id=scid, node_id_1=id1, node_id_2=id2,
+            bitcoin_key_1=id1, bitcoin_key_2=id2, chain_hash=chain_hash, len=0, features=b'')))
+        for direction in (0, 1):
+            channel_db.add_channel_update(with_raw(encode_msg(
+                'channel_update', short_channel_id=scid, chain_hash=chain_hash, timestamp=int(time.time()),
+                message_flags=b'\x00', channel_flags=bytes([direction]), cltv_expiry_delta=rand.choice([40, 144]),
+                htlc_minimum_msat=1000, fee_base_msat=rand.choice([0, 1000]),
+                fee_proportional_millionths=rand.randint(1, 500))), verify=False, verbose=False)
+    for i in range(num_nodes):
+        channel_db.add_node_announcements(with_raw(encode_msg(
+            'node_announcement', node_id=node_id(i), features=b'', flen=0, timestamp=1,
+            alias=f'node{i}'.encode().ljust(32, b'\x00'), rgb_color=b'\x00' * 3,
+            addrlen=7, addresses=b'\x01\x7f\x00\x00\x01\x26\x07')))
+
+
+def load() -> float:
+    channel_db = ChannelDB(FakeNetwork())
+    t0 = time.monotonic()
+    wait(channel_db.load_data())
+    dt = time.monotonic() - t0
+    channel_db.stop()
+    wait(channel_db.stopped_event.wait())
+    return dt
+
+
+try:
+    channel_db = ChannelDB(FakeNetwork())
+    wait(channel_db.load_data())
+    t0 = time.monotonic()
+    populate(channel_db)
+    wait(channel_db._db_save_node_addresses([]))  # wait for pending writes
+    print_msg(f"synthetic gossip db: {num_nodes} nodes, {channel_db.num_channels} channels, "
+              f"{channel_db.num_policies} policies, built in {time.monotonic() - t0:.1f} sec")
+    channel_db.stop()  # writes the snapshot
+    wait(channel_db.stopped_event.wait())
+    print_msg(f"db size: {os.path.getsize(channel_db.path) / 1e6:.1f} MB, "
+              f"snapshot size: {os.path.getsize(channel_db.snapshot_path) / 1e6:.1f} MB")
+    print_msg(f"load_data from snapshot: {load():.2f} sec")
+    os.remove(channel_db.snapshot_path)
+    print_msg(f"load_data from raw messages: {load():.2f} sec")
+finally:
+    loop.call_soon_threadsafe(stop_loop.set_result, 1)
+    loop_thread.join(timeout=1)
+    shutil.rmtree(electrum_path)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# Compares the coin choosers on a synthetic wallet: fee paid, time taken
+# to choose coins, and number of inputs, for payments of various amounts.
+# usage: coinchooser_benchmark.py [<number of coins>] [<feerate in sat/vbyte>]
+
+import random
+import sys
+import time
+from decimal import Decimal
+
+from electrum_mona import bitcoin
+from electrum_mona.coinchooser import COIN_CHOOSERS
+from electrum_mona.crypto import sha256
+from electrum_mona.transaction import PartialTxInput, PartialTxOutput, TxOutpoint
+from electrum_mona.util import print_msg
+
+try:
+    num_coins = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    feerate = Decimal(sys.argv[2]) if len(sys.argv) > 2 else Decimal(10)
+except Exception:
+    print_msg("usage: coinchooser_benchmark.py [<number of coins>] [<feerate in sat/vbyte>]")
+    sys.exit(1)
+
+
+# payment amounts, in satoshis
+AMOUNTS = [50_000, 1_000_000, 12_345_678, 100_000_000, 1_000_000_000]
+DUST_THRESHOLD = 546
+# size of the p2wpkh input that will later spend a change output
+CHANGE_SPEND_VSIZE = 68
+
+
+def make_address(i: int) -> str:
+    return bitcoin.hash_to_segwit_addr(sha256(f'address {i}')[:20], witver=0)
+
+
+def make_coins(n: int):
+    r = random.Random(n)
+    coins = []
+    for i in range(n):
+        txin = PartialTxInput(prevout=TxOutpoint(sha256(f'coin {i}'), i % 4))
+        # some addresses received more than one coin
+        txin._trusted_address = make_address(r.randrange(n * 4 // 5))
+        # log-uniform between 0.0001 and 10 coins
+        txin._trusted_value_sats = int(10 ** r.uniform(4, 9))
+        txin.block_height = r.choice([0] + [600000 + i] * 9)
+        coins.append(txin)
+    return coins
+
+
+def fee_estimator_vb(size):
+    return round(Decimal(size) * feerate)
+
+
+def timed(klass):
+    # measures choose_buckets apart from bucketize_coins, which all choosers share
+    class TimedCoinChooser(klass):
+        def choose_buckets(self, *args):
+            t0 = time.monotonic()
+            result = super().choose_buckets(*args)
+            self.selection_time = time.monotonic() - t0
+            return result
+    return TimedCoinChooser
+
+
+coins = make_coins(num_coins)
+print_msg(f"{num_coins} coins, {sum(c.value_sats() for c in coins) / 1e8:,.2f} total, feerate {feerate} sat/vbyte")
+for name, klass in sorted(COIN_CHOOSERS.items()):
+    total_fee = total_change_spend_fee = total_time = total_selection_time = total_inputs = num_changeless = 0
+    for amount in AMOUNTS:
+        outputs = [PartialTxOutput.from_address_and_value(make_address(-1), amount)]
+        coin_chooser = timed(klass)(enable_output_value_rounding=False)
+        t0 = time.monotonic()
+        tx = coin_chooser.make_tx(coins=coins, inputs=[], outputs=outputs, change_addrs=[make_address(-2)],
+                                  fee_estimator_vb=fee_estimator_vb, dust_threshold=DUST_THRESHOLD)
+        dt = time.monotonic() - t0
+        total_fee += tx.get_fee()
+        total_change_spend_fee += (len(tx.outputs()) - 1) * fee_estimator_vb(CHANGE_SPEND_VSIZE)
+        total_time += dt
+        total_selection_time += coin_chooser.selection_time
+        total_inputs += len(tx.inputs())
+        num_changeless += len(tx.outputs()) == 1
+        print_msg(f"{name}, {amount / 1e8} coins: fee {tx.get_fee()} sat, {len(tx.inputs())} inputs, "
+                  f"{len(tx.outputs()) - 1} change outputs, "
+                  f"{coin_chooser.selection_time * 1000:,.1f} ms selection, {dt * 1000:,.1f} ms total")
+    print_msg(f"{name}, total: fee {total_fee} sat ({total_fee + total_change_spend_fee} sat "
+              f"including spending the change), {total_inputs} inputs, "
+              f"{num_changeless}/{len(AMOUNTS)} without change, "
+              f"{total_selection_time * 1000:,.1f} ms selection, {total_time * 1000:,.1f} ms total")
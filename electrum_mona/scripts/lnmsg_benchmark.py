@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# Prints the throughput of LNSerializer, in messages per second,
+# for the message types that are the most frequent during gossip sync and payments.
+# usage: lnmsg_benchmark.py [<number of messages per type>]
+
+import os
+import sys
+import time
+
+from electrum_mona.lnmsg import encode_msg, decode_msg
+from electrum_mona.util import print_msg
+
+try:
+    num_msgs = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+except Exception:
+    print_msg("usage: lnmsg_benchmark.py [<number of messages per type>]")
+    sys.exit(1)
+
+
+SAMPLE_MSGS = [
+    ('channel_update', dict(
+        signature=os.urandom(64), chain_hash=os.urandom(32), short_channel_id=os.urandom(8),
+        timestamp=1600000000, message_flags=b'\x01', channel_flags=b'\x00', cltv_expiry_delta=144,
+        htlc_minimum_msat=1000, fee_base_msat=1000, fee_proportional_millionths=100,
+        htlc_maximum_msat=10**10)),
+    ('channel_announcement', dict(
+        node_signature_1=os.urandom(64), node_signature_2=os.urandom(64),
+        bitcoin_signature_1=os.urandom(64), bitcoin_signature_2=os.urandom(64),
+        len=0, features=b'', chain_hash=os.urandom(32), short_channel_id=os.urandom(8),
+        node_id_1=os.urandom(33), node_id_2=os.urandom(33),
+        bitcoin_key_1=os.urandom(33), bitcoin_key_2=os.urandom(33))),
+    ('node_announcement', dict(
+        signature=os.urandom(64), flen=2, features=b'\x02\x00', timestamp=1600000000,
+        node_id=os.urandom(33), rgb_color=b'\x01\x02\x03', alias=os.urandom(32),
+        addrlen=7, addresses=b'\x01' + os.urandom(6))),
+    ('reply_channel_range', dict(
+        chain_hash=os.urandom(32), first_blocknum=500000, number_of_blocks=1000, sync_complete=1,
+        len=8001, encoded_short_ids=b'\x00' + os.urandom(8000))),
+    ('update_add_htlc', dict(
+        channel_id=os.urandom(32), id=1, amount_msat=100000, payment_hash=os.urandom(32),
+        cltv_expiry=500000, onion_routing_packet=os.urandom(1366))),
+    ('commitment_signed', dict(
+        channel_id=os.urandom(32), signature=os.urandom(64), num_htlcs=3, htlc_signature=os.urandom(3 * 64))),
+    ('init', dict(
+        gflen=0, globalfeatures=b'', flen=3, features=b'\x08\xa2\xa2',
+        init_tlvs={'networks': {'chains': os.urandom(32)}})),
+]
+
+
+def measure(f, *args, **kwargs) -> float:
+    t0 = time.perf_counter()
+    for i in range(num_msgs):
+        f(*args, **kwargs)
+    return num_msgs / (time.perf_counter() - t0)
+
+
+print_msg(f"{'message type':<22} {'decode msgs/sec':>16} {'encode msgs/sec':>16}")
+for msg_type, payload in SAMPLE_MSGS:
+    raw = encode_msg(msg_type, **payload)
+    assert decode_msg(raw)[0] == msg_type
+    decode_rate = measure(decode_msg, raw)
+    encode_rate = measure(encode_msg, msg_type, **payload)
+    print_msg(f"{msg_type:<22} {decode_rate:>16,.0f} {encode_rate:>16,.0f}")
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+# Builds a synthetic lightning graph in a ChannelDB, and compares path finding
+# latency and memory with and without the compact graph representation,
+# and the latency of repeated queries (payment retries) and of fee/cltv budgets.
+# usage: lnrouter_benchmark.py [<number of nodes> [<number of channels> [<number of queries>]]]
+
+import asyncio
+import gc
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from electrum_mona import constants
+from electrum_mona.channel_db import ChannelDB
+from electrum_mona.lngraph import CompactChannelGraph
+from electrum_mona.lnrouter import LNPathFinder, get_max_sane_fee_msat
+from electrum_mona.lnutil import ShortChannelID, NBLOCK_CLTV_EXPIRY_TOO_FAR_INTO_FUTURE
+from electrum_mona.simple_config import SimpleConfig
+from electrum_mona.util import print_msg, create_and_start_event_loop
+
+try:
+    num_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    num_channels = int(sys.argv[2]) if len(sys.argv) > 2 else 80000
+    num_queries = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+except Exception:
+    print_msg("usage: lnrouter_benchmark.py [<number of nodes> [<number of channels> [<number of queries>]]]")
+    sys.exit(1)
+
+rand = random.Random(0)
+loop, stop_loop, loop_thread = create_and_start_event_loop()
+electrum_path = tempfile.mkdtemp()
+config = SimpleConfig({'electrum_path': electrum_path})
+
+
+class FakeNetwork:
+    asyncio_loop = loop
+    interface = None
+    def __init__(self):
+        self.config = config
+
+
+def node_id(i: int) -> bytes:
+    return b'\x02' + i.to_bytes(32, 'big')
+
+
+def populate(channel_db: ChannelDB):
+    # preferential attachment, so that there are hubs, as in the real network
+    endpoints = [0, 1]
+    chan_anns = []
+    pairs = set()
+    while len(chan_anns) < num_channels:
+        n1 = rand.randrange(num_nodes) if rand.random() < 0.5 else rand.choice(endpoints)
+        n2 = rand.choice(endpoints) if len(endpoints) > num_nodes // 2 else rand.randrange(num_nodes)
+        if n1 == n2 or (n1, n2) in pairs:
+            continue
+        pairs.add((n1, n2))
+        endpoints += [n1, n2]
+        id1, id2 = sorted([node_id(n1), node_id(n2)])
+        chan_anns.append({
+            'node_id_1': id1, 'node_id_2': id2,
+            'bitcoin_key_1': id1, 'bitcoin_key_2': id2,
+            'short_channel_id': ShortChannelID.from_components(500000 + len(chan_anns), 1, 0),
+            'chain_hash': constants.net.rev_genesis_bytes(),
+            'len': 0, 'features': b'',
+        })
+    channel_db.add_channel_announcements(chan_anns, trusted=True)
+    for ann in chan_anns:
+        for direction in (b'\x00', b'\x01'):
+            channel_db.add_channel_update({
+                'short_channel_id': ann['short_channel_id'],
+                'message_flags': b'\x00',
+                'channel_flags': direction,
+                'cltv_expiry_delta': rand.choice([40, 80, 144]),
+                'htlc_minimum_msat': 1000,
+                'fee_base_msat': rand.choice([0, 1000]),
+                'fee_proportional_millionths': rand.randint(1, 500),
+                'chain_hash': constants.net.rev_genesis_bytes(),
+                'timestamp': 0,
+            }, verify=False, verbose=False)
+
+
+def measure_queries(path_finder: LNPathFinder, queries, **kwargs) -> float:
+    path_finder.clear_distance_maps()
+    t0 = time.monotonic()
+    for nodeA, nodeB, amount_msat in queries:
+        path_finder.find_path_for_payment(nodeA=nodeA, nodeB=nodeB, invoice_amount_msat=amount_msat, **kwargs)
+    return (time.monotonic() - t0) / len(queries)
+
+
+def measure_retries(path_finder: LNPathFinder, queries) -> float:
+    # every query is run twice, as when a payment is retried; the second one is measured
+    path_finder.clear_distance_maps()
+    dt = 0
+    for nodeA, nodeB, amount_msat in queries:
+        path_finder.find_path_for_payment(nodeA=nodeA, nodeB=nodeB, invoice_amount_msat=amount_msat)
+        t0 = time.monotonic()
+        path_finder.find_path_for_payment(nodeA=nodeA, nodeB=nodeB, invoice_amount_msat=amount_msat)
+        dt += time.monotonic() - t0
+    return dt / len(queries)
+
+
+try:
+    tracemalloc.start()
+    channel_db = ChannelDB(FakeNetwork())
+    channel_db.data_loaded.set()
+    t0 = time.monotonic()
+    populate(channel_db)
+    gc.collect()
+    mem, _ = tracemalloc.get_traced_memory()
+    print_msg(f"synthetic graph: {num_nodes} nodes, {channel_db.num_channels} channels, "
+              f"{len(channel_db._policies)} policies, built in {time.monotonic() - t0:.1f} sec")
+    print_msg(f"memory after populating ChannelDB: {mem / 1e6:.1f} MB")
+
+    t0 = time.monotonic()
+    graph = CompactChannelGraph.from_channel_db(channel_db)
+    dt = time.monotonic() - t0
+    gc.collect()
+    mem2, _ = tracemalloc.get_traced_memory()
+    arrays_size = sum(graph.get_memory_usage().values())
+    print_msg(f"compact graph: built in {dt:.2f} sec, memory {(mem2 - mem) / 1e6:.1f} MB "
+              f"(of which arrays: {arrays_size / 1e6:.1f} MB)")
+    tracemalloc.stop()
+    channel_db._compact_graph = graph
+
+    path_finder = LNPathFinder(channel_db)
+    nodes = list(graph.node_ids)
+    queries = [(rand.choice(nodes), rand.choice(nodes), rand.choice([10_000, 1_000_000, 100_000_000]))
+               for i in range(num_queries)]
+    for use_compact_graph in (False, True):
+        config.set_key('lightning_use_compact_graph', use_compact_graph)
+        latency = measure_queries(path_finder, queries)
+        print_msg(f"find_path_for_payment, compact graph {'on ' if use_compact_graph else 'off'}: "
+                  f"{latency * 1000:.1f} ms per query")
+    latency = measure_retries(path_finder, queries)
+    print_msg(f"find_path_for_payment, repeated query: {latency * 1000:.2f} ms per query")
+    latency = sum(measure_queries(path_finder, [q], max_fee_msat=get_max_sane_fee_msat(q[2]),
+                                  max_cltv_delta=NBLOCK_CLTV_EXPIRY_TOO_FAR_INTO_FUTURE - 144)
+                  for q in queries) / len(queries)
+    print_msg(f"find_path_for_payment, with fee and cltv budgets: {latency * 1000:.1f} ms per query")
+finally:
+    channel_db.stop()
+    asyncio.run_coroutine_threadsafe(channel_db.stopped_event.wait(), loop).result()
+    loop.call_soon_threadsafe(stop_loop.set_result, 1)
+    loop_thread.join(timeout=1)
+    shutil.rmtree(electrum_path)
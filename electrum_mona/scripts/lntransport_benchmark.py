@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Measures the throughput of LNTransport over a loopback connection,
+# for gossip-sized and HTLC-sized messages.
+# usage: lntransport_benchmark.py [<number of messages per size>]
+
+import asyncio
+import sys
+import time
+
+from electrum_mona.ecc import ECPrivkey
+from electrum_mona.lnutil import LNPeerAddr
+from electrum_mona.lntransport import LNTransport, LNResponderTransport
+from electrum_mona.util import print_msg
+
+try:
+    num_msgs = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+except Exception:
+    print_msg("usage: lntransport_benchmark.py [<number of messages per size>]")
+    sys.exit(1)
+
+
+# channel_update, channel_announcement, update_add_htlc (with its onion)
+MSG_SIZES = [('gossip', 138), ('gossip', 432), ('htlc', 1452)]
+# messages sent per event loop iteration
+BURST_SIZE = 50
+
+
+async def bench(msg_size: int) -> float:
+    responder_key = ECPrivkey.generate_random_key()
+    initiator_key = ECPrivkey.generate_random_key()
+    msg = bytes(msg_size)
+    done = asyncio.get_running_loop().create_future()
+
+    async def on_connect(reader, writer):
+        t = LNResponderTransport(responder_key.get_secret_bytes(), reader, writer)
+        await t.handshake()
+        n = 0
+        async for _ in t.read_messages():
+            n += 1
+            if n == num_msgs:
+                break
+        done.set_result(time.monotonic())
+        t.close()
+
+    server = await asyncio.start_server(on_connect, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        peer_addr = LNPeerAddr('127.0.0.1', port, responder_key.get_public_key_bytes())
+        t = LNTransport(initiator_key.get_secret_bytes(), peer_addr, proxy=None)
+        await t.handshake()
+        t0 = time.monotonic()
+        for i in range(0, num_msgs, BURST_SIZE):
+            for j in range(min(BURST_SIZE, num_msgs - i)):
+                t.send_bytes(msg)
+            await asyncio.sleep(0)
+            await t.writer.drain()
+        t1 = await done
+        t.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+    return t1 - t0
+
+
+async def main():
+    for name, msg_size in MSG_SIZES:
+        dt = await bench(msg_size)
+        print_msg(f"{name}, {msg_size} bytes: {num_msgs / dt:,.0f} msgs/sec, "
+                  f"{num_msgs * msg_size / dt / 1e6:.1f} MB/sec")
+
+
+asyncio.run(main())
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+# Prints the hashes/sec of each available proof-of-work engine.
+# usage: pow_benchmark.py [<number of headers>]
+
+import os
+import sys
+import time
+
+from electrum_mona import powhash
+from electrum_mona.util import print_msg
+
+try:
+    num_headers = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+except Exception:
+    print_msg("usage: pow_benchmark.py [<number of headers>]")
+    sys.exit(1)
+
+headers = [os.urandom(80) for i in range(num_headers)]
+
+for algo, engine_classes in powhash.POW_ENGINES.items():
+    for klass in engine_classes:
+        if not klass.is_available():
+            print_msg(f"{klass.name:>16}: not available")
+            continue
+        engine = klass()
+        t0 = time.monotonic()
+        engine.hash(headers[0])
+        dt_single = time.monotonic() - t0
+        t0 = time.monotonic()
+        engine.hash_many(headers)
+        dt_many = time.monotonic() - t0
+        print_msg(f"{klass.name:>16}: {1 / dt_single:10.2f} hashes/sec (single), "
+                  f"{num_headers / dt_many:10.2f} hashes/sec (batch of {num_headers})")
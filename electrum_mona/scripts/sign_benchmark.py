@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+# Measures how long it takes to sign transactions with many inputs,
+# for segwit and legacy inputs.
+# usage: sign_benchmark.py [<number of inputs> ...]
+
+import sys
+import time
+
+from electrum_mona.crypto import sha256
+from electrum_mona.ecc import ECPrivkey
+from electrum_mona.transaction import PartialTransaction, PartialTxInput, PartialTxOutput, TxOutpoint
+from electrum_mona.util import print_msg
+
+try:
+    sizes = [int(x) for x in sys.argv[1:]] or [10, 100, 1000]
+except Exception:
+    print_msg("usage: sign_benchmark.py [<number of inputs> ...]")
+    sys.exit(1)
+
+
+SCRIPT_TYPES = ['p2wpkh', 'p2wpkh-p2sh', 'p2pkh']
+
+
+def make_tx(num_inputs: int, script_type: str):
+    keypairs = {}
+    inputs = []
+    for i in range(num_inputs):
+        privkey = ECPrivkey(sha256(f'sign_benchmark {i}'))
+        pubkey = privkey.get_public_key_bytes(compressed=True)
+        keypairs[pubkey.hex()] = (privkey.get_secret_bytes(), True)
+        txin = PartialTxInput(prevout=TxOutpoint(sha256(f'prevout {i}'), i % 3), nsequence=0xfffffffd)
+        txin.script_type = script_type
+        txin.pubkeys = [pubkey]
+        txin.num_sig = 1
+        txin._trusted_value_sats = 100000 + i
+        inputs.append(txin)
+    outputs = [PartialTxOutput(scriptpubkey=bytes.fromhex('0014') + sha256(f'output {i}')[:20], value=50000)
+               for i in range(2)]
+    tx = PartialTransaction.from_io(inputs, outputs, locktime=600000, version=2)
+    return tx, keypairs
+
+
+for script_type in SCRIPT_TYPES:
+    for num_inputs in sizes:
+        tx, keypairs = make_tx(num_inputs, script_type)
+        t0 = time.monotonic()
+        tx.sign(keypairs)
+        dt = time.monotonic() - t0
+        assert tx.is_complete()
+        print_msg(f"{script_type}, {num_inputs} inputs: {dt * 1000:,.1f} ms, "
+                  f"{num_inputs / dt:,.0f} inputs/sec")
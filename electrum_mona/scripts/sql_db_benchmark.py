@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# Measures the write throughput of the SQL thread for gossip (ChannelDB),
+# and the latency of committed writes in the watchtower (SweepStore),
+# and of its reads during a burst of writes.
+# usage: sql_db_benchmark.py [<number of gossip messages> [<number of sweepstore writes>]]
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from electrum_mona import util
+from electrum_mona.channel_db import ChannelDB
+from electrum_mona.lnutil import ShortChannelID
+from electrum_mona.lnwatcher import SweepStore
+from electrum_mona.simple_config import SimpleConfig
+from electrum_mona.util import print_msg, create_and_start_event_loop
+
+try:
+    num_msgs = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    num_sweepstore_writes = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+except Exception:
+    print_msg("usage: sql_db_benchmark.py [<number of gossip messages> [<number of sweepstore writes>]]")
+    sys.exit(1)
+
+loop, stop_loop, loop_thread = create_and_start_event_loop()
+util.callback_mgr.asyncio_loop = loop
+electrum_path = tempfile.mkdtemp()
+config = SimpleConfig({'electrum_path': electrum_path})
+
+
+class FakeNetwork:
+    asyncio_loop = loop
+    interface = None
+    def __init__(self):
+        self.config = config
+
+
+def run(coro):
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+async def wait(fut):
+    return await fut
+
+
+async def stop(db):
+    db.stop()
+    await db.stopped_event.wait()
+
+
+async def sweepstore_latencies(sweepstore: SweepStore, concurrency: int) -> float:
+    # get_ctn commits a new row for every unknown channel
+    latencies = []
+
+    async def worker(k):
+        for i in range(k, num_sweepstore_writes, concurrency):
+            t0 = time.monotonic()
+            await sweepstore.get_ctn(f'{concurrency}:{i}', 'address')
+            latencies.append(time.monotonic() - t0)
+    await asyncio.gather(*[worker(k) for k in range(concurrency)])
+    return sum(latencies) / len(latencies)
+
+
+async def sweepstore_read_latency(sweepstore: SweepStore) -> float:
+    # reads while 10 writers keep the SQL thread busy
+    latencies = []
+    writes = asyncio.ensure_future(sweepstore_latencies(sweepstore, 10))
+    while not writes.done():
+        t0 = time.monotonic()
+        await sweepstore.get_num_tx('unknown')
+        latencies.append(time.monotonic() - t0)
+    await writes
+    return sum(latencies) / len(latencies)
+
+
+try:
+    channel_db = ChannelDB(FakeNetwork())
+    msg = os.urandom(136)
+    t0 = time.monotonic()
+    for i in range(num_msgs // 2):
+        scid = ShortChannelID.from_components(500000 + i, 1, 0)
+        channel_db._db_save_channel(scid, msg)
+        channel_db._db_save_policy(scid + b'\x02' * 33, msg)
+    fut = channel_db._db_save_node_addresses([])
+    t1 = time.monotonic()
+    run(wait(fut))
+    dt = time.monotonic() - t0
+    print_msg(f"gossip writes: {num_msgs} in {dt:.2f} sec ({num_msgs / dt:,.0f} msgs/sec), "
+              f"of which queueing: {t1 - t0:.2f} sec")
+    run(stop(channel_db))
+
+    sweepstore = SweepStore(os.path.join(electrum_path, 'watchtower_db'), FakeNetwork())
+    for concurrency in (1, 10):
+        t0 = time.monotonic()
+        latency = run(sweepstore_latencies(sweepstore, concurrency))
+        dt = time.monotonic() - t0
+        print_msg(f"sweepstore, {concurrency} concurrent writers: {latency * 1000:.2f} ms per write, "
+                  f"{num_sweepstore_writes / dt:,.0f} writes/sec")
+    latency = run(sweepstore_read_latency(sweepstore))
+    print_msg(f"sweepstore, reads during writes: {latency * 1000:.2f} ms per read "
+              f"({sweepstore.num_readers} readers)")
+    print_msg(f"{sweepstore.get_stats()}")
+    run(stop(sweepstore))
+finally:
+    loop.call_soon_threadsafe(stop_loop.set_result, 1)
+    loop_thread.join(timeout=1)
+    shutil.rmtree(electrum_path)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+# Measures how fast raw transactions are parsed and their txid computed,
+# over a corpus of synthetic transactions of typical sizes.
+# usage: tx_parse_benchmark.py [<number of transactions per kind>]
+
+import os
+import sys
+import time
+
+from electrum_mona import bitcoin
+from electrum_mona.bitcoin import construct_witness
+from electrum_mona.transaction import Transaction, TxInput, TxOutput, TxOutpoint
+from electrum_mona.util import print_msg
+
+try:
+    num_txs = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+except Exception:
+    print_msg("usage: tx_parse_benchmark.py [<number of transactions per kind>]")
+    sys.exit(1)
+
+
+def make_tx(num_inputs: int, num_outputs: int, *, segwit: bool) -> bytes:
+    tx = Transaction(None)
+    tx._inputs = []
+    for i in range(num_inputs):
+        txin = TxInput(prevout=TxOutpoint(os.urandom(32), i), nsequence=0xfffffffd)
+        if segwit:  # p2wpkh
+            txin.script_sig = b''
+            txin.witness = bytes.fromhex(construct_witness([os.urandom(72), os.urandom(33)]))
+        else:  # p2pkh
+            txin.script_sig = bytes.fromhex(bitcoin.construct_script([os.urandom(72), os.urandom(33)]))
+        tx._inputs.append(txin)
+    tx._outputs = [TxOutput(scriptpubkey=bytes.fromhex('0014') + os.urandom(20), value=10000 + i)
+                   for i in range(num_outputs)]
+    tx._version = 2
+    tx._locktime = 600000
+    return bytes.fromhex(tx.serialize_to_network())
+
+
+CORPUS = [
+    ('p2wpkh 1-in 2-out', 1, 2, True),
+    ('p2pkh 2-in 2-out', 2, 2, False),
+    ('p2wpkh 10-in 2-out', 10, 2, True),
+    ('p2wpkh 2-in 100-out', 2, 100, True),
+]
+
+
+for name, num_inputs, num_outputs, segwit in CORPUS:
+    raw_txs = [make_tx(num_inputs, num_outputs, segwit=segwit) for i in range(100)]
+    raw_txs = [raw_txs[i % len(raw_txs)] for i in range(num_txs)]
+    num_bytes = sum(len(raw) for raw in raw_txs)
+    t0 = time.monotonic()
+    for raw in raw_txs:
+        tx = Transaction(raw)
+        tx.deserialize()
+        tx.txid()
+    dt = time.monotonic() - t0
+    print_msg(f"{name} ({len(raw_txs[0])} bytes): {num_txs / dt:,.0f} txs/sec, {num_bytes / dt / 1e6:.1f} MB/sec")
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# Builds a synthetic wallet file with many transactions, and prints
+# how long WalletDB takes to load it, and how much memory it holds.
+# usage: walletdb_benchmark.py [<number of transactions>]
+
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from electrum_mona.crypto import sha256d
+from electrum_mona.util import print_msg
+from electrum_mona.wallet_db import WalletDB, FINAL_SEED_VERSION
+
+try:
+    num_txs = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+except Exception:
+    print_msg("usage: walletdb_benchmark.py [<number of transactions>]")
+    sys.exit(1)
+
+
+def make_raw_tx() -> bytes:
+    # legacy tx, one input and two p2pkh outputs
+    p2pkh = bytes.fromhex('1976a914') + os.urandom(20) + bytes.fromhex('88ac')
+    return (bytes.fromhex('02000000')
+            + b'\x01' + os.urandom(32) + b'\x00\x00\x00\x00'
+            + b'\x6a' + os.urandom(0x6a) + b'\xfd\xff\xff\xff'
+            + b'\x02' + (100000).to_bytes(8, 'little') + p2pkh + (200000).to_bytes(8, 'little') + p2pkh
+            + b'\x00\x00\x00\x00')
+
+
+def make_wallet_str() -> str:
+    addr = 'MJNDhNyzYPbcFE5uZAg2j6YyUQVdLDhuP3'
+    transactions, txo, verified_tx, history = {}, {}, {}, []
+    for i in range(num_txs):
+        raw = make_raw_tx()
+        txid = sha256d(raw)[::-1].hex()
+        transactions[txid] = raw.hex()
+        txo[txid] = {addr: {"0": [100000, False]}}
+        verified_tx[txid] = [i + 1, 1600000000 + i, 1, '00' * 32]
+        history.append([txid, i + 1])
+    data = {
+        'seed_version': FINAL_SEED_VERSION,
+        'wallet_type': 'imported',
+        'addresses': {addr: {}},
+        'addr_history': {addr: history},
+        'transactions': transactions,
+        'txi': {},
+        'txo': txo,
+        'verified_tx3': verified_tx,
+    }
+    return json.dumps(data)
+
+
+wallet_str = make_wallet_str()
+print_msg(f"synthetic wallet: {num_txs} txs, {len(wallet_str) / 1e6:.1f} MB")
+
+t0 = time.monotonic()
+db = WalletDB(wallet_str, manual_upgrades=False)
+print_msg(f"load: {time.monotonic() - t0:.2f} sec")
+del db
+
+# again, to measure memory (tracing makes it slower)
+gc.collect()
+tracemalloc.start()
+db = WalletDB(wallet_str, manual_upgrades=False)
+gc.collect()
+mem, _ = tracemalloc.get_traced_memory()
+print_msg(f"memory after load: {mem / 1e6:.1f} MB")
+
+t0 = time.monotonic()
+for txid in db.list_transactions():
+    db.get_transaction(txid).outputs()
+dt = time.monotonic() - t0
+gc.collect()
+mem, peak = tracemalloc.get_traced_memory()
+print_msg(f"parse all txs: {dt:.2f} sec, memory after: {mem / 1e6:.1f} MB, peak: {peak / 1e6:.1f} MB")
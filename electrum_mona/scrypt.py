@@ -18,6 +18,88 @@
 
 import hashlib
 import hmac
+from typing import Sequence, List
+
+HAS_HASHLIB_SCRYPT = hasattr(hashlib, 'scrypt')
+
+HAS_NUMPY = False
+try:
+    import numpy
+except ImportError:
+    pass
+else:
+    HAS_NUMPY = True
+
+
+def scrypt_1024_1_1_80_hashlib(header):
+    """scrypt(N=1024, r=1, p=1) via OpenSSL, as exposed by hashlib."""
+    if not isinstance(header, bytes) or len(header) != 80:
+        raise ValueError('header must be 80 bytes')
+    return hashlib.scrypt(header, salt=header, n=1024, r=1, p=1, dklen=32)
+
+
+# (target, addend1, addend2, rotation) for each step of a salsa20 double round.
+# Every step updates four independent words at once, so it can be done
+# with a single vectorized operation.
+_SALSA_STEPS = (
+    ((4, 9, 14, 3), (0, 5, 10, 15), (12, 1, 6, 11), 7),
+    ((8, 13, 2, 7), (4, 9, 14, 3), (0, 5, 10, 15), 9),
+    ((12, 1, 6, 11), (8, 13, 2, 7), (4, 9, 14, 3), 13),
+    ((0, 5, 10, 15), (12, 1, 6, 11), (8, 13, 2, 7), 18),
+    ((1, 6, 11, 12), (0, 5, 10, 15), (3, 4, 9, 14), 7),
+    ((2, 7, 8, 13), (1, 6, 11, 12), (0, 5, 10, 15), 9),
+    ((3, 4, 9, 14), (2, 7, 8, 13), (1, 6, 11, 12), 13),
+    ((0, 5, 10, 15), (3, 4, 9, 14), (2, 7, 8, 13), 18),
+)
+# max number of headers hashed together; the scratchpad takes 128 KiB per header
+NUMPY_SCRYPT_BATCH_SIZE = 256
+
+
+def _xor_salsa8_numpy(B, Bx):
+    """B ^= Bx; B = salsa20/8(B). Both are (16, n) uint32 arrays."""
+    B ^= Bx
+    x = B.copy()
+    for i in range(4):
+        for target, a, b, rot in _SALSA_STEPS:
+            t = x[a,] + x[b,]
+            x[target,] ^= (t << numpy.uint32(rot)) | (t >> numpy.uint32(32 - rot))
+    B += x
+
+
+def _scrypt_1024_1_1_80_numpy(headers):
+    n = len(headers)
+    B = b''.join(hashlib.pbkdf2_hmac('sha256', h, h, 1, 128) for h in headers)
+    X = numpy.frombuffer(B, dtype='<u4').reshape(n, 32).T.astype(numpy.uint32)
+    V = numpy.empty((1024, 32, n), dtype=numpy.uint32)
+    for i in range(1024):
+        V[i] = X
+        _xor_salsa8_numpy(X[:16], X[16:])
+        _xor_salsa8_numpy(X[16:], X[:16])
+    cols = numpy.arange(n)
+    for i in range(1024):
+        k = X[16] & 1023
+        X ^= V[k, :, cols].T
+        _xor_salsa8_numpy(X[:16], X[16:])
+        _xor_salsa8_numpy(X[16:], X[:16])
+    B = X.T.astype('<u4').tobytes()
+    return [hashlib.pbkdf2_hmac('sha256', h, B[i*128:(i+1)*128], 1, 32)
+            for i, h in enumerate(headers)]
+
+
+def scrypt_1024_1_1_80_many_numpy(headers: Sequence[bytes]) -> List[bytes]:
+    """Hashes many headers at once, vectorizing salsa20/8 across headers
+    with numpy. This only pays off for large batches.
+    """
+    if not HAS_NUMPY:
+        raise Exception('numpy not available')
+    for header in headers:
+        if not isinstance(header, bytes) or len(header) != 80:
+            raise ValueError('header must be 80 bytes')
+    result = []
+    for i in range(0, len(headers), NUMPY_SCRYPT_BATCH_SIZE):
+        result += _scrypt_1024_1_1_80_numpy(headers[i:i+NUMPY_SCRYPT_BATCH_SIZE])
+    return result
+
 
 def scrypt_1024_1_1_80(header):
     if not isinstance(header, bytes) or len(header) != 80:
@@ -261,6 +343,8 @@ if __name__ == '__main__':
 
     for header, hash in vectors:
         assert scrypt_1024_1_1_80(unhexlify(header)) == unhexlify(hash)
+        if HAS_HASHLIB_SCRYPT:
+            assert scrypt_1024_1_1_80_hashlib(unhexlify(header)) == unhexlify(hash)
 
     dt = (default_timer() - t0) / len(vectors)
     print("%.1f ms/hash" % (dt*1000))
@@ -4,24 +4,132 @@ import queue
 import threading
 import asyncio
 import sqlite3
+import time
+from collections import defaultdict
+from typing import NamedTuple, Callable, Dict, List, Tuple, Any, Optional
 
 from .logging import Logger
 from .util import test_read_write_permissions
 
 
+# max number of requests executed in a single transaction
+SQL_MAX_BATCH_SIZE = 1000
+# how often the SQL threads check that the event loop is running, when idle
+SQL_IDLE_TIMEOUT = 1.0
+
+
+class SqlRequest(NamedTuple):
+    future: asyncio.Future
+    func: Callable
+    args: tuple
+    kwargs: dict
+    batched: bool
+    time: float  # when it was queued
+
+
 def sql(func):
     """wrapper for sql methods"""
     def wrapper(self: 'SqlDB', *args, **kwargs):
-        assert threading.currentThread() != self.sql_thread
+        assert threading.current_thread() not in self.sql_threads
+        f = self.asyncio_loop.create_future()
+        self.db_requests.put(SqlRequest(f, func, args, kwargs, False, time.monotonic()))
+        return f
+    return wrapper
+
+
+def sql_batched(func):
+    """wrapper for sql methods that write rows, e.g. with executemany.
+    Consecutive calls are executed together: func is called with the list
+    of the argument tuples of the calls, and all futures get its result.
+    """
+    def wrapper(self: 'SqlDB', *args):
+        assert threading.current_thread() not in self.sql_threads
         f = self.asyncio_loop.create_future()
-        self.db_requests.put((f, func, args, kwargs))
+        self.db_requests.put(SqlRequest(f, func, args, {}, True, time.monotonic()))
         return f
     return wrapper
 
 
+def sql_read(func):
+    """wrapper for sql methods that only read.
+    If the db has readers, they run on a read-only connection, concurrently
+    with other reads and writes. They see the last committed writes.
+    """
+    def wrapper(self: 'SqlDB', *args, **kwargs):
+        assert threading.current_thread() not in self.sql_threads
+        f = self.asyncio_loop.create_future()
+        q = self.db_read_requests if self.num_readers else self.db_requests
+        q.put(SqlRequest(f, func, args, kwargs, False, time.monotonic()))
+        return f
+    return wrapper
+
+
+class SqlStats:
+    """Counts requests, and how long they waited in the queue and ran, per method."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = defaultdict(int)  # type: Dict[str, int]
+        self.wait_time = defaultdict(float)  # type: Dict[str, float]
+        self.max_wait_time = defaultdict(float)  # type: Dict[str, float]
+        self.run_time = defaultdict(float)  # type: Dict[str, float]
+        self.max_run_time = defaultdict(float)  # type: Dict[str, float]
+
+    def add(self, name: str, wait_times: List[float], run_time: float) -> None:
+        """Adds a call of method name, that ran the requests with the given wait times."""
+        with self.lock:
+            self.count[name] += len(wait_times)
+            self.wait_time[name] += sum(wait_times)
+            self.max_wait_time[name] = max(self.max_wait_time[name], max(wait_times))
+            self.run_time[name] += run_time
+            self.max_run_time[name] = max(self.max_run_time[name], run_time)
+
+    def get_stats(self) -> Dict[str, dict]:
+        with self.lock:
+            return {
+                name: {
+                    'count': self.count[name],
+                    'avg_wait_ms': 1000 * self.wait_time[name] / self.count[name],
+                    'max_wait_ms': 1000 * self.max_wait_time[name],
+                    'avg_run_ms': 1000 * self.run_time[name] / self.count[name],
+                    'max_run_ms': 1000 * self.max_run_time[name],
+                }
+                for name in sorted(self.count)
+            }
+
+
+def _set_future_results(results):
+    # called in the event loop, once per batch of requests
+    for future, result, exception in results:
+        if future.cancelled():
+            continue
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+
 class SqlDB(Logger):
-    
-    def __init__(self, asyncio_loop: asyncio.BaseEventLoop, path, commit_interval=None):
+
+    # note: with WAL, readers do not block the writer and vice versa,
+    #       and commits append to the log instead of rewriting pages.
+    #       with synchronous=NORMAL, commits are not fsynced (checkpoints are),
+    #       so the last commits might be lost on power failure, but not corrupted.
+    PRAGMAS = (
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('temp_store', 'MEMORY'),
+        ('cache_size', -16000),  # KiB
+    )
+
+    def __init__(self, asyncio_loop: asyncio.BaseEventLoop, path, commit_interval=None, commit_latency=1.0,
+                 num_readers=0):
+        """If commit_interval is None, every batch of requests is committed
+        before their futures are set. Otherwise, commits happen once
+        commit_interval requests are pending, or the oldest of them
+        has been waiting for commit_latency seconds.
+        num_readers is the number of read-only connections, for sql_read methods.
+        """
         Logger.__init__(self)
         self.asyncio_loop = asyncio_loop
         self.stopping = False
@@ -29,46 +137,150 @@ class SqlDB(Logger):
         self.path = path
         test_read_write_permissions(path)
         self.commit_interval = commit_interval
+        self.commit_latency = commit_latency
+        self.num_readers = num_readers
+        self.stats = SqlStats()
+        self._thread_local = threading.local()
         self.db_requests = queue.Queue()
+        self.db_read_requests = queue.Queue()
         self.sql_thread = threading.Thread(target=self.run_sql)
+        # note: readers are started once the database has been created
+        self.reader_threads = [threading.Thread(target=self.run_sql_reader) for i in range(num_readers)]
+        self.sql_threads = [self.sql_thread] + self.reader_threads
         self.sql_thread.start()
 
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """The connection of the current SQL thread."""
+        return self._thread_local.conn
+
+    @conn.setter
+    def conn(self, conn: sqlite3.Connection):
+        self._thread_local.conn = conn
+
     def stop(self):
         self.stopping = True
+        # wake up the SQL threads
+        self.db_requests.put(None)
+        for t in self.reader_threads:
+            self.db_read_requests.put(None)
 
     def filesize(self):
         return os.stat(self.path).st_size
 
+    def get_stats(self) -> Dict[str, Any]:
+        """Queue depths, and latencies per method, for monitoring."""
+        return {
+            'write_queue_depth': self.db_requests.qsize(),
+            'read_queue_depth': self.db_read_requests.qsize(),
+            'num_readers': self.num_readers,
+            'methods': self.stats.get_stats(),
+        }
+
+    @classmethod
+    def _get_requests(cls, q: queue.Queue, timeout: float, max_requests: int) -> List[Optional[SqlRequest]]:
+        """Returns the requests queued in q, up to max_requests.
+        Waits at most timeout seconds for the first one.
+        """
+        try:
+            requests = [q.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(requests) < max_requests:
+            try:
+                requests.append(q.get_nowait())
+            except queue.Empty:
+                break
+        return requests
+
+    def _run_requests(self, requests: List[SqlRequest]) -> List[Tuple[asyncio.Future, Any, Optional[BaseException]]]:
+        """Runs requests in the current transaction. Returns (future, result, exception) tuples."""
+        results = []
+        i = 0
+        while i < len(requests):
+            batch = [requests[i]]
+            i += 1
+            if batch[0].batched:
+                while i < len(requests) and requests[i].func is batch[0].func and requests[i].batched:
+                    batch.append(requests[i])
+                    i += 1
+                args, kwargs = ([r.args for r in batch],), {}
+            else:
+                args, kwargs = batch[0].args, batch[0].kwargs
+            func = batch[0].func
+            t0 = time.monotonic()
+            try:
+                result, exception = func(self, *args, **kwargs), None
+            except BaseException as e:
+                result, exception = None, e
+            t1 = time.monotonic()
+            self.stats.add(func.__name__, [t0 - r.time for r in batch], t1 - t0)
+            results.extend((r.future, result, exception) for r in batch)
+        return results
+
     def run_sql(self):
         self.logger.info("SQL thread started")
         self.conn = sqlite3.connect(self.path)
+        for name, value in self.PRAGMAS:
+            self.conn.execute(f"PRAGMA {name}={value}")
         self.logger.info("Creating database")
         self.create_database()
-        i = 0
-        while not self.stopping and self.asyncio_loop.is_running():
-            try:
-                future, func, args, kwargs = self.db_requests.get(timeout=0.1)
-            except queue.Empty:
-                continue
-            try:
-                result = func(self, *args, **kwargs)
-            except BaseException as e:
-                self.asyncio_loop.call_soon_threadsafe(future.set_exception, e)
-                continue
-            if not future.cancelled():
-                self.asyncio_loop.call_soon_threadsafe(future.set_result, result)
-            # note: in sweepstore session.commit() is called inside
-            # the sql-decorated methods, so commiting to disk is awaited
-            if self.commit_interval:
-                i = (i + 1) % self.commit_interval
-                if i == 0:
-                    self.conn.commit()
+        for t in self.reader_threads:
+            t.start()
+        num_uncommitted = 0
+        first_uncommitted_time = None
+        while self.asyncio_loop.is_running():
+            if num_uncommitted:
+                timeout = max(0, first_uncommitted_time + self.commit_latency - time.monotonic())
+            else:
+                timeout = SQL_IDLE_TIMEOUT
+            # when stopping, pending requests are still executed
+            requests = self._get_requests(self.db_requests, 0 if self.stopping else timeout, SQL_MAX_BATCH_SIZE)
+            if self.stopping and not requests:
+                break
+            requests = [r for r in requests if r is not None]
+            if requests and not num_uncommitted:
+                first_uncommitted_time = time.monotonic()
+            results = self._run_requests(requests)
+            num_uncommitted += len(requests)
+            # note: if commit_interval is None, futures are set after the commit,
+            #       so that awaiting a request means that it has been written to disk.
+            if num_uncommitted and (self.commit_interval is None
+                                    or num_uncommitted >= self.commit_interval
+                                    or time.monotonic() - first_uncommitted_time >= self.commit_latency):
+                self.conn.commit()
+                num_uncommitted = 0
+            if results:
+                self.asyncio_loop.call_soon_threadsafe(_set_future_results, results)
         # write
+        self.before_close()
         self.conn.commit()
         self.conn.close()
+        for t in self.reader_threads:
+            if t.is_alive():
+                t.join()
 
         self.logger.info("SQL thread terminated")
         self.asyncio_loop.call_soon_threadsafe(self.stopped_event.set)
 
+    def run_sql_reader(self):
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA query_only=ON")
+        while self.asyncio_loop.is_running():
+            # reads are not batched, so that a slow read does not delay others
+            requests = self._get_requests(self.db_read_requests, 0 if self.stopping else SQL_IDLE_TIMEOUT, 1)
+            if self.stopping and not requests:
+                break
+            requests = [r for r in requests if r is not None]
+            if not requests:
+                continue
+            results = self._run_requests(requests)
+            self.asyncio_loop.call_soon_threadsafe(_set_future_results, results)
+        self.conn.close()
+
     def create_database(self):
         raise NotImplementedError()
+
+    def before_close(self):
+        """Called in the SQL thread, before the last commit."""
+        pass
@@ -63,6 +63,9 @@ class WalletStorage(Logger):
         self.logger.info(f"wallet path {self.path}")
         self.pubkey = None
         self.decrypted = ''
+        # sizes of the last full write, and of what was appended since
+        self._snapshot_size = 0
+        self._journal_size = 0
         try:
             test_read_write_permissions(self.path)
         except IOError as e:
@@ -97,8 +100,30 @@ class WalletStorage(Logger):
         os.replace(temp_path, self.path)
         os.chmod(self.path, mode)
         self._file_exists = True
+        self._snapshot_size = len(s)
+        self._journal_size = 0
         self.logger.info(f"saved {self.path}")
 
+    def append(self, data: str) -> None:
+        """Appends to the file written by the last call to write().
+        Only for plaintext storage.
+        """
+        assert not self.is_encrypted()
+        assert self.file_exists()
+        with open(self.path, "a", encoding='utf-8') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_size += len(data)
+        self.logger.info(f"appended {len(data)} bytes to {self.path}")
+
+    def has_appended_data(self) -> bool:
+        return self._journal_size > 0
+
+    def needs_consolidation(self) -> bool:
+        """Whether the appended data outgrew the last full write."""
+        return self._journal_size > self._snapshot_size
+
     def file_exists(self) -> bool:
         return self._file_exists
 
@@ -24,7 +24,7 @@
 # SOFTWARE.
 import asyncio
 import hashlib
-from typing import Dict, List, TYPE_CHECKING, Tuple, Set
+from typing import Dict, List, TYPE_CHECKING, Tuple, Set, Sequence, Optional
 from collections import defaultdict
 import logging
 
@@ -32,7 +32,7 @@ from aiorpcx import TaskGroup, run_in_thread, RPCError
 
 from . import util
 from .transaction import Transaction, PartialTransaction
-from .util import bh2u, make_aiohttp_session, NetworkJobOnDefaultServer, random_shuffled_copy
+from .util import bh2u, make_aiohttp_session, NetworkJobOnDefaultServer, random_shuffled_copy, chunks
 from .bitcoin import address_to_scripthash, is_address
 from .logging import Logger
 from .interface import GracefulDisconnect, NetworkTimeout
@@ -54,6 +54,16 @@ def history_status(h):
     return bh2u(hashlib.sha256(status.encode('ascii')).digest())
 
 
+def get_pending_items(queue: asyncio.Queue, first_item, limit: int) -> list:
+    """Returns first_item, followed by the items that are already
+    waiting in queue, so that at most limit items are returned.
+    """
+    items = [first_item]
+    while len(items) < limit and not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
 class SynchronizerBase(NetworkJobOnDefaultServer):
     """Subscribe over the network to a set of addresses, and monitor their statuses.
     Every time a status changes, run a coroutine provided by the subclass.
@@ -103,30 +113,42 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         """Handle the change of the status of an address."""
         raise NotImplementedError()  # implemented by subclasses
 
+    async def _on_address_statuses(self, statuses: Sequence[Tuple[str, Optional[str]]]):
+        """Handle the change of the statuses of several addresses.
+        Subclasses that can batch their requests should override this.
+        """
+        for addr, status in statuses:
+            await self.taskgroup.spawn(self._on_address_status, addr, status)
+
     async def send_subscriptions(self):
-        async def subscribe_to_address(addr):
-            h = address_to_scripthash(addr)
-            self.scripthash_to_address[h] = addr
-            self._requests_sent += 1
+        async def subscribe_to_addresses(addrs):
+            hashes = [address_to_scripthash(addr) for addr in addrs]
+            for addr, h in zip(addrs, hashes):
+                self.scripthash_to_address[h] = addr
+            self._requests_sent += len(addrs)
             try:
                 async with self._network_request_semaphore:
-                    await self.session.subscribe('blockchain.scripthash.subscribe', [h], self.status_queue)
+                    await self.session.subscribe_many('blockchain.scripthash.subscribe',
+                                                      [[h] for h in hashes], self.status_queue)
             except RPCError as e:
                 if e.message == 'history too large':  # no unique error code
                     raise GracefulDisconnect(e, log_level=logging.ERROR) from e
                 raise
-            self._requests_answered += 1
-            self.requested_addrs.remove(addr)
+            self._requests_answered += len(addrs)
+            for addr in addrs:
+                self.requested_addrs.remove(addr)
 
         while True:
             addr = await self.add_queue.get()
-            await self.taskgroup.spawn(subscribe_to_address, addr)
+            addrs = get_pending_items(self.add_queue, addr, self.interface.get_request_batch_size())
+            await self.taskgroup.spawn(subscribe_to_addresses, addrs)
 
     async def handle_status(self):
         while True:
-            h, status = await self.status_queue.get()
-            addr = self.scripthash_to_address[h]
-            await self.taskgroup.spawn(self._on_address_status, addr, status)
+            item = await self.status_queue.get()
+            items = get_pending_items(self.status_queue, item, self.interface.get_request_batch_size())
+            statuses = [(self.scripthash_to_address[h], status) for h, status in items]
+            await self.taskgroup.spawn(self._on_address_statuses, statuses)
             self._processed_some_notifications = True
 
     def num_requests_sent_and_answered(self) -> Tuple[int, int]:
@@ -164,46 +186,62 @@ class Synchronizer(SynchronizerBase):
                 and not self._stale_histories)
 
     async def _on_address_status(self, addr, status):
-        history = self.wallet.db.get_addr_history(addr)
-        if history_status(history) == status:
-            return
-        # No point in requesting history twice for the same announced status.
-        # However if we got announced a new status, we should request history again:
-        if (addr, status) in self.requested_histories:
+        await self._on_address_statuses([(addr, status)])
+
+    async def _on_address_statuses(self, statuses):
+        # only the latest announced status of an address matters
+        statuses = dict(statuses)
+        to_request = []
+        for addr, status in statuses.items():
+            history = self.wallet.db.get_addr_history(addr)
+            if history_status(history) == status:
+                continue
+            # No point in requesting history twice for the same announced status.
+            # However if we got announced a new status, we should request history again:
+            if (addr, status) in self.requested_histories:
+                continue
+            self.requested_histories.add((addr, status))
+            self._stale_histories.pop(addr, asyncio.Future()).cancel()
+            to_request.append((addr, status))
+        if not to_request:
             return
-        # request address history
-        self.requested_histories.add((addr, status))
-        self._stale_histories.pop(addr, asyncio.Future()).cancel()
-        h = address_to_scripthash(addr)
-        self._requests_sent += 1
+        # request address histories, in a single batch
+        hashes = [address_to_scripthash(addr) for addr, status in to_request]
+        self._requests_sent += len(hashes)
         async with self._network_request_semaphore:
-            result = await self.interface.get_history_for_scripthash(h)
-        self._requests_answered += 1
-        self.logger.info(f"receiving history {addr} {len(result)}")
-        hist = list(map(lambda item: (item['tx_hash'], item['height']), result))
-        # tx_fees
-        tx_fees = [(item['tx_hash'], item.get('fee')) for item in result]
-        tx_fees = dict(filter(lambda x:x[1] is not None, tx_fees))
-        # Check that the status corresponds to what was announced
-        if history_status(hist) != status:
-            # could happen naturally if history changed between getting status and history (race)
-            self.logger.info(f"error: status mismatch: {addr}. we'll wait a bit for status update.")
-            # The server is supposed to send a new status notification, which will trigger a new
-            # get_history. We shall wait a bit for this to happen, otherwise we disconnect.
-            async def disconnect_if_still_stale():
-                timeout = self.network.get_network_timeout_seconds(NetworkTimeout.Generic)
-                await asyncio.sleep(timeout)
-                raise SynchronizerFailure(f"timeout reached waiting for addr {addr}: history still stale")
-            self._stale_histories[addr] = await self.taskgroup.spawn(disconnect_if_still_stale)
-        else:
-            self._stale_histories.pop(addr, asyncio.Future()).cancel()
-            # Store received history
-            self.wallet.receive_history_callback(addr, hist, tx_fees)
-            # Request transactions we don't have
-            await self._request_missing_txs(hist)
+            results = await self.interface.get_history_for_scripthashes(hashes)
+        self._requests_answered += len(hashes)
+        missing_hist = []
+        for (addr, status), result in zip(to_request, results):
+            if isinstance(result, Exception):
+                raise result
+            self.logger.info(f"receiving history {addr} {len(result)}")
+            hist = list(map(lambda item: (item['tx_hash'], item['height']), result))
+            # tx_fees
+            tx_fees = [(item['tx_hash'], item.get('fee')) for item in result]
+            tx_fees = dict(filter(lambda x:x[1] is not None, tx_fees))
+            # Check that the status corresponds to what was announced
+            if history_status(hist) != status:
+                # could happen naturally if history changed between getting status and history (race)
+                self.logger.info(f"error: status mismatch: {addr}. we'll wait a bit for status update.")
+                # The server is supposed to send a new status notification, which will trigger a new
+                # get_history. We shall wait a bit for this to happen, otherwise we disconnect.
+                async def disconnect_if_still_stale(addr=addr):
+                    timeout = self.network.get_network_timeout_seconds(NetworkTimeout.Generic)
+                    await asyncio.sleep(timeout)
+                    raise SynchronizerFailure(f"timeout reached waiting for addr {addr}: history still stale")
+                self._stale_histories[addr] = await self.taskgroup.spawn(disconnect_if_still_stale)
+            else:
+                self._stale_histories.pop(addr, asyncio.Future()).cancel()
+                # Store received history
+                self.wallet.receive_history_callback(addr, hist, tx_fees)
+                missing_hist.extend(hist)
+        # Request transactions we don't have
+        await self._request_missing_txs(missing_hist)
 
-        # Remove request; this allows up_to_date to be True
-        self.requested_histories.discard((addr, status))
+        # Remove requests; this allows up_to_date to be True
+        for addr, status in to_request:
+            self.requested_histories.discard((addr, status))
 
     async def _request_missing_txs(self, hist, *, allow_server_not_finding_tx=False):
         # "hist" is a list of [tx_hash, tx_height] lists
@@ -219,23 +257,26 @@ class Synchronizer(SynchronizerBase):
 
         if not transaction_hashes: return
         async with TaskGroup() as group:
-            for tx_hash in transaction_hashes:
-                await group.spawn(self._get_transaction(tx_hash, allow_server_not_finding_tx=allow_server_not_finding_tx))
+            for tx_hashes in chunks(transaction_hashes, self.interface.get_request_batch_size()):
+                await group.spawn(self._get_transactions(tx_hashes, allow_server_not_finding_tx=allow_server_not_finding_tx))
 
-    async def _get_transaction(self, tx_hash, *, allow_server_not_finding_tx=False):
-        self._requests_sent += 1
+    async def _get_transactions(self, tx_hashes: Sequence[str], *, allow_server_not_finding_tx=False):
+        self._requests_sent += len(tx_hashes)
         try:
             async with self._network_request_semaphore:
-                raw_tx = await self.interface.get_transaction(tx_hash)
-        except RPCError as e:
-            # most likely, "No such mempool or blockchain transaction"
-            if allow_server_not_finding_tx:
-                self.requested_tx.pop(tx_hash)
-                return
-            else:
-                raise
+                raw_txs = await self.interface.get_transactions(tx_hashes)
         finally:
-            self._requests_answered += 1
+            self._requests_answered += len(tx_hashes)
+        for tx_hash, raw_tx in zip(tx_hashes, raw_txs):
+            if isinstance(raw_tx, Exception):
+                # most likely, "No such mempool or blockchain transaction"
+                if allow_server_not_finding_tx and isinstance(raw_tx, RPCError):
+                    self.requested_tx.pop(tx_hash)
+                    continue
+                raise raw_tx
+            self._receive_transaction(tx_hash, raw_tx)
+
+    def _receive_transaction(self, tx_hash: str, raw_tx: str):
         tx = Transaction(raw_tx)
         if tx_hash != tx.txid():
             raise SynchronizerFailure(f"received tx does not match expected txid ({tx_hash} != {tx.txid()})")
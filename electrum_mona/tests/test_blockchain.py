@@ -1,11 +1,15 @@
 import shutil
 import tempfile
 import os
+import random
+from unittest import mock
 
 from electrum_mona import constants, blockchain
 from electrum_mona.simple_config import SimpleConfig
-from electrum_mona.blockchain import Blockchain, deserialize_header, hash_header
+from electrum_mona.blockchain import (Blockchain, DGWv3State, HeadersFileView, deserialize_header, hash_header, MAX_TARGET,
+                                      hash_raw_header, serialize_header, work_from_target)
 from electrum_mona.util import bh2u, bfh, make_dir
+from electrum_mona.bitcoin import hash_encode
 
 from . import ElectrumTestCase
 
@@ -228,53 +232,225 @@ class TestBlockchain(ElectrumTestCase):
 #        for b in (chain_u, chain_l, chain_z):
 #            self.assertTrue(all([b.can_connect(b.read_header(i), False) for i in range(b.height())]))
 
+    def test_reading_headers_through_mmap_after_swap(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEFOP':
+            self._append_header(chain_u, self.HEADERS[name])
+        # map the files before they get rewritten and renamed by the swap
+        self.assertEqual(self.HEADERS['P'], chain_u.read_header(7))
+        chain_l = chain_u.fork(self.HEADERS['G'])
+        for name in 'HIJ':
+            self._append_header(chain_l, self.HEADERS[name])
+        self.assertEqual(0, chain_l.forkpoint)
+        self.assertEqual(6, chain_u.forkpoint)
+        for chain, names in ((chain_l, 'ABCDEFGHIJ'), (chain_u, 'ABCDEFOP')):
+            for height, name in enumerate(names):
+                header = self.HEADERS[name]
+                self.assertEqual(header, chain.read_header(height))
+                self.assertEqual(bfh(blockchain.serialize_header(header)), chain.read_raw_header(height))
+                self.assertEqual((header['timestamp'], header['bits']), chain.read_timestamp_and_bits(height))
+                if height > 0:
+                    self.assertEqual(hash_header(header), chain.get_hash(height))
+        self.assertIsNone(chain_l.read_header(10))
+        self.assertIsNone(chain_l.read_raw_header(-1))
+
+    def test_headers_view_appends_without_remapping(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCD':
+            self._append_header(chain_u, self.HEADERS[name])
+        self.assertEqual(self.HEADERS['D'], chain_u.read_header(3))
+        view = chain_u._headers_view
+        for name in 'EFOP':
+            self._append_header(chain_u, self.HEADERS[name])
+        # headers appended since the file was mapped are read from memory
+        self.assertIs(view, chain_u._headers_view)
+        self.assertEqual(4, view.num_unmapped())
+        for height, name in enumerate('ABCDEFOP'):
+            header = self.HEADERS[name]
+            self.assertEqual(header, chain_u.read_header(height))
+            version, prev_block_hash, merkle_root, timestamp, bits, nonce = view.fields(height)
+            self.assertEqual([header[k] for k in ('version', 'prev_block_hash', 'merkle_root', 'timestamp', 'bits', 'nonce')],
+                             [version, hash_encode(prev_block_hash), hash_encode(merkle_root), timestamp, bits, nonce])
+            self.assertEqual(hash_header(header), hash_encode(view.block_hash(height)))
+        # the file is mapped again once enough headers piled up
+        with mock.patch.object(HeadersFileView, 'MAX_UNMAPPED', 4):
+            self._append_header(chain_u, self.HEADERS['Q'])
+        self.assertIsNone(chain_u._headers_view)
+        self.assertEqual(self.HEADERS['Q'], chain_u.read_header(8))
+        self.assertEqual(0, chain_u._headers_view.num_unmapped())
+
+    def test_dgwv3_state_cached_at_tip(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEF':
+            self._append_header(chain_u, self.HEADERS[name])
+        chain_u.get_dgwv3_state(chain_u.height())
+        for name in 'OPQ':
+            self._append_header(chain_u, self.HEADERS[name])
+        # the window was carried forward by save_header
+        cached = chain_u._get_cached_dgwv3_state(chain_u.height())
+        self.assertIsNotNone(cached)
+        chain_u._dgw_state = None
+        fresh = chain_u.get_dgwv3_state(chain_u.height())
+        self.assertEqual(list(fresh._entries), list(cached._entries))
+        # a write to another chain while a header is saved leaves no cached window
+        get_cached = chain_u._get_cached_dgwv3_state
+        def get_cached_then_other_write(height):
+            state = get_cached(height)
+            blockchain._bump_headers_write_counter()
+            return state
+        with mock.patch.object(chain_u, '_get_cached_dgwv3_state', get_cached_then_other_write):
+            self._append_header(chain_u, self.HEADERS['R'])
+        self.assertIsNone(chain_u._get_cached_dgwv3_state(chain_u.height()))
+        # forking and swapping rewrites files, which invalidates the cache
+        chain_l = chain_u.fork(self.HEADERS['G'])
+        for name in 'HIJK':
+            self._append_header(chain_l, self.HEADERS[name])
+        self.assertIsNone(chain_u._get_cached_dgwv3_state(chain_u.height()))
+
+    def test_chainwork_index_persisted(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        # headers are written directly, as verification is not what is tested here
+        all_bits = [random.choice([0x1e0ffff0, 0x1d00ffff, 0x1b0404cb]) for _ in range(2016 * 2 + 100)]
+        header = dict(self.HEADERS['A'])
+        data = b''
+        for height, bits in enumerate(all_bits):
+            header.update(block_height=height, bits=bits)
+            data += bfh(serialize_header(header))
+        chain_u.write(data, 0)
+
+        def expected_work(height):
+            return sum(work_from_target(Blockchain.bits_to_target(bits)) for bits in all_bits[:height + 1])
+
+        with mock.patch.object(constants.net, 'TESTNET', False):
+            self.assertEqual(expected_work(2015), chain_u.get_chainwork(2015))
+            self.assertEqual(expected_work(chain_u.height()), chain_u.get_chainwork())
+            self.assertEqual(expected_work(3000), chain_u.get_chainwork(3000))
+            # a fresh instance reads the per-header totals back from disk,
+            # and answers for any height without reading headers
+            chain2 = Blockchain(config=self.config, forkpoint=0, parent=None,
+                                forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+            self.assertEqual(len(all_bits), len(chain2._get_chainwork_index()))
+            with mock.patch.object(chain2, '_work_of_header', side_effect=AssertionError):
+                for height in (0, 1000, 2015, 2016, 3000, 4031, chain2.height()):
+                    self.assertEqual(expected_work(height), chain2.get_chainwork(height))
+            # rewriting headers invalidates the affected chunks
+            all_bits[2500:] = [0x1d00ffff] * (len(all_bits) - 2500)
+            header.update(bits=0x1d00ffff)
+            data = b''
+            for height in range(2500, len(all_bits)):
+                header.update(block_height=height)
+                data += bfh(serialize_header(header))
+            chain_u.write(data, 2500 * blockchain.HEADER_SIZE)
+            self.assertEqual(2500, len(chain_u._get_chainwork_index()))
+            self.assertEqual(expected_work(chain_u.height()), chain_u.get_chainwork())
+            self.assertEqual(expected_work(4031), chain_u.get_chainwork(4031))
+
+    def test_swap_with_parent_compares_chainwork(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+
+        def serialize_headers(first_height, all_bits, nonce):
+            header = dict(self.HEADERS['A'], nonce=nonce)
+            data = b''
+            for height, bits in enumerate(all_bits, start=first_height):
+                header.update(block_height=height, bits=bits)
+                data += bfh(serialize_header(header))
+            return data
+
+        chain_u.write(serialize_headers(0, [0x1e0ffff0] * 10, nonce=0), 0)
+        # a fork at height 5 that is shorter, but has more work
+        fork_data = serialize_headers(5, [0x1d00ffff] * 2, nonce=1)
+        chain_l = Blockchain(config=self.config, forkpoint=5, parent=chain_u,
+                             forkpoint_hash=hash_raw_header(bh2u(fork_data[:blockchain.HEADER_SIZE])),
+                             prev_hash=chain_u.get_hash(4))
+        open(chain_l.path(), 'w+').close()
+        blockchain.blockchains[chain_l.get_id()] = chain_l
+        chain_l.write(fork_data, 0)
+        with mock.patch.object(constants.net, 'TESTNET', False):
+            chain_l.swap_with_parent()
+        self.assertIs(chain_l, blockchain.get_best_chain())
+        self.assertEqual(6, chain_l.height())
+        self.assertEqual(9, chain_u.height())
+        self.assertEqual(5, chain_u.forkpoint)
+
+    def test_chainwork_index_follows_swap(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEFOP':
+            self._append_header(chain_u, self.HEADERS[name])
+        chain_l = chain_u.fork(self.HEADERS['G'])
+        for name in 'HIJ':
+            self._append_header(chain_l, self.HEADERS[name])
+        files = os.listdir(os.path.join(self.data_dir, 'forks'))
+        self.assertTrue(all(os.path.exists(os.path.join(self.data_dir, 'forks', fn[:-len('.chainwork')]))
+                            for fn in files if fn.endswith('.chainwork')))
+        self.assertEqual(9, chain_l.get_chainwork())
+        self.assertEqual(7, chain_u.get_chainwork())
+
     def get_chains_that_contain_header_helper(self, header: dict):
         height = header['block_height']
         header_hash = hash_header(header)
         return blockchain.get_chains_that_contain_header(height, header_hash)
 
-#    def test_get_chains_that_contain_header(self):
-#        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
-#            config=self.config, forkpoint=0, parent=None,
-#            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
-#        open(chain_u.path(), 'w+').close()
-#        self._append_header(chain_u, self.HEADERS['A'])
-#        self._append_header(chain_u, self.HEADERS['B'])
-#        self._append_header(chain_u, self.HEADERS['C'])
-#        self._append_header(chain_u, self.HEADERS['D'])
-#        self._append_header(chain_u, self.HEADERS['E'])
-#        self._append_header(chain_u, self.HEADERS['F'])
-#        self._append_header(chain_u, self.HEADERS['O'])
-#        self._append_header(chain_u, self.HEADERS['P'])
-#        self._append_header(chain_u, self.HEADERS['Q'])
+    def test_get_chains_that_contain_header(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        self._append_header(chain_u, self.HEADERS['A'])
+        self._append_header(chain_u, self.HEADERS['B'])
+        self._append_header(chain_u, self.HEADERS['C'])
+        self._append_header(chain_u, self.HEADERS['D'])
+        self._append_header(chain_u, self.HEADERS['E'])
+        self._append_header(chain_u, self.HEADERS['F'])
+        self._append_header(chain_u, self.HEADERS['O'])
+        self._append_header(chain_u, self.HEADERS['P'])
+        self._append_header(chain_u, self.HEADERS['Q'])
 
-#        chain_l = chain_u.fork(self.HEADERS['G'])
-#        self._append_header(chain_l, self.HEADERS['H'])
-#        self._append_header(chain_l, self.HEADERS['I'])
-#        self._append_header(chain_l, self.HEADERS['J'])
-#        self._append_header(chain_l, self.HEADERS['K'])
-#        self._append_header(chain_l, self.HEADERS['L'])
+        chain_l = chain_u.fork(self.HEADERS['G'])
+        self._append_header(chain_l, self.HEADERS['H'])
+        self._append_header(chain_l, self.HEADERS['I'])
+        self._append_header(chain_l, self.HEADERS['J'])
+        self._append_header(chain_l, self.HEADERS['K'])
+        self._append_header(chain_l, self.HEADERS['L'])
 
-#        chain_z = chain_l.fork(self.HEADERS['M'])
+        chain_z = chain_l.fork(self.HEADERS['M'])
 
-#        self.assertEqual([chain_l, chain_z, chain_u], self.get_chains_that_contain_header_helper(self.HEADERS['A']))
-#        self.assertEqual([chain_l, chain_z, chain_u], self.get_chains_that_contain_header_helper(self.HEADERS['C']))
-#        self.assertEqual([chain_l, chain_z, chain_u], self.get_chains_that_contain_header_helper(self.HEADERS['F']))
-#        self.assertEqual([chain_l, chain_z], self.get_chains_that_contain_header_helper(self.HEADERS['G']))
-#        self.assertEqual([chain_l, chain_z], self.get_chains_that_contain_header_helper(self.HEADERS['I']))
-#        self.assertEqual([chain_z], self.get_chains_that_contain_header_helper(self.HEADERS['M']))
-#        self.assertEqual([chain_l], self.get_chains_that_contain_header_helper(self.HEADERS['K']))
+        # note: the hash at height 0 is constants.net.GENESIS, which is not header A here
+        self.assertEqual([chain_l, chain_z, chain_u], self.get_chains_that_contain_header_helper(self.HEADERS['B']))
+        self.assertEqual([chain_l, chain_z, chain_u], self.get_chains_that_contain_header_helper(self.HEADERS['C']))
+        self.assertEqual([chain_l, chain_z, chain_u], self.get_chains_that_contain_header_helper(self.HEADERS['F']))
+        self.assertEqual([chain_l, chain_z], self.get_chains_that_contain_header_helper(self.HEADERS['G']))
+        self.assertEqual([chain_l, chain_z], self.get_chains_that_contain_header_helper(self.HEADERS['I']))
+        self.assertEqual([chain_z], self.get_chains_that_contain_header_helper(self.HEADERS['M']))
+        self.assertEqual([chain_l], self.get_chains_that_contain_header_helper(self.HEADERS['K']))
 
-#        self._append_header(chain_z, self.HEADERS['N'])
-#        self._append_header(chain_z, self.HEADERS['X'])
-#        self._append_header(chain_z, self.HEADERS['Y'])
-#        self._append_header(chain_z, self.HEADERS['Z'])
+        self._append_header(chain_z, self.HEADERS['N'])
+        self._append_header(chain_z, self.HEADERS['X'])
+        self._append_header(chain_z, self.HEADERS['Y'])
+        self._append_header(chain_z, self.HEADERS['Z'])
 
-#        self.assertEqual([chain_z, chain_l, chain_u], self.get_chains_that_contain_header_helper(self.HEADERS['A']))
-#        self.assertEqual([chain_z, chain_l, chain_u], self.get_chains_that_contain_header_helper(self.HEADERS['C']))
-#        self.assertEqual([chain_z, chain_l, chain_u], self.get_chains_that_contain_header_helper(self.HEADERS['F']))
-#        self.assertEqual([chain_u], self.get_chains_that_contain_header_helper(self.HEADERS['O']))
-#        self.assertEqual([chain_z, chain_l], self.get_chains_that_contain_header_helper(self.HEADERS['I']))
+        self.assertEqual([chain_z, chain_l, chain_u], self.get_chains_that_contain_header_helper(self.HEADERS['B']))
+        self.assertEqual([chain_z, chain_l, chain_u], self.get_chains_that_contain_header_helper(self.HEADERS['C']))
+        self.assertEqual([chain_z, chain_l, chain_u], self.get_chains_that_contain_header_helper(self.HEADERS['F']))
+        self.assertEqual([chain_u], self.get_chains_that_contain_header_helper(self.HEADERS['O']))
+        self.assertEqual([chain_z, chain_l], self.get_chains_that_contain_header_helper(self.HEADERS['I']))
 
 
 class TestVerifyHeader(ElectrumTestCase):
@@ -287,6 +463,8 @@ class TestVerifyHeader(ElectrumTestCase):
     def setUp(self):
         super().setUp()
         self.header = deserialize_header(bfh(self.valid_header), 100)
+        self.chain = Blockchain(config=SimpleConfig({'electrum_path': self.electrum_path}), forkpoint=0,
+                                parent=None, forkpoint_hash=constants.net.GENESIS, prev_hash=None)
 
     def test_valid_header(self):
         #Blockchain.verify_header(self.header, self.prev_hash, self.target)
@@ -319,25 +497,139 @@ class TestVerifyHeader(ElectrumTestCase):
 
         # before DGWv3 with checkpoint(height=2015)
         headers1 = {2015: {'version': 2, 'prev_block_hash': 'f9cba205f996e98f61f87e32ae57fc0a5befa6cd632dd257f3e239f390010622', 'merkle_root': 'af68c1f62b965172df1d81fba95f193cb8e42431bad79a4bfbcc370d301d5710', 'timestamp': 1388536705, 'bits': 503936911, 'nonce': 780010496, 'block_height': 2015}}
-        bits = Blockchain.get_target(self, 2015, headers1)
+        bits = self.chain.get_target(2015, headers1)
         self.assertEqual(bits, 65339010432214603900175979833807329994044402934458085644623414103638016)
 
         # before DGWv3 without checkpoint(height=2016)
         headers2 = {2015: {'version': 2, 'prev_block_hash': 'f9cba205f996e98f61f87e32ae57fc0a5befa6cd632dd257f3e239f390010622', 'merkle_root': 'af68c1f62b965172df1d81fba95f193cb8e42431bad79a4bfbcc370d301d5710', 'timestamp': 1388536705, 'bits': 503936911, 'nonce': 780010496, 'block_height': 2015}}
-        bits = Blockchain.get_target(self, 2016, headers2)
+        bits = self.chain.get_target(2016, headers2)
         self.assertEqual(bits, 0)
 
         # after DGWv3 with checkpoint(height=461663)
         headers3 = {461663: {'version': 3, 'prev_block_hash': '9c87f1e27717aec18617496970b9744dd855f997128fab6733e709fd95d97870', 'merkle_root': '7f22e9001ab92b14a1b057ce07c4f2acecb693f3a645004f36c2246b7ea86c3b', 'timestamp': 1444439492, 'bits': 469801026, 'nonce': 928239, 'block_height': 461663}}
-        bits = Blockchain.get_target(self, 461663, headers3)
+        bits = self.chain.get_target(461663, headers3)
         self.assertEqual(bits, 62635231089126922960074598435273835921110428291665699134377033728)
 
         # after DGWv3 without checkpoint(height=461664)
         headers4 = {461663: {'version': 3, 'prev_block_hash': '9c87f1e27717aec18617496970b9744dd855f997128fab6733e709fd95d97870', 'merkle_root': '7f22e9001ab92b14a1b057ce07c4f2acecb693f3a645004f36c2246b7ea86c3b', 'timestamp': 1444439492, 'bits': 469801026, 'nonce': 928239, 'block_height': 461663}}
-        bits = Blockchain.get_target(self, 461664, headers4)
+        bits = self.chain.get_target(461664, headers4)
         self.assertEqual(bits, 0)
 
         # after DGWv3 after checkpoint(2206543)
         headers5 = {2206513: {'version': 536870912, 'prev_block_hash': '79f9cf8a46f1c823db1005a5f879bbc5e0c3250c516986b80679a900a465b37f', 'merkle_root': 'df6f4798d813f2e2545c538c579a97b95c4af4f522ac49401483a19e0de8d47d', 'timestamp': 1609444650, 'bits': 436604928, 'nonce': 2204928177, 'block_height': 2206513}, 2206514: {'version': 536870912, 'prev_block_hash': 'a3a9fa4099bfb3b251490be1e9f5a509cad82dc44c217d9a7ff1ac44f6e1b2fb', 'merkle_root': '06a9bb6b66584de4d3f9d5bfc44fcd894f7df4419787263918702370fb9cf0d7', 'timestamp': 1609444702, 'bits': 436625476, 'nonce': 329943414, 'block_height': 2206514}, 2206515: {'version': 536870912, 'prev_block_hash': '109b0bd3ea80416d1a97c0340b277feac76f6ee0297f3dfba00ece9f53f836f7', 'merkle_root': '71b4078000d4c47602222ff594c525d6b975c82dd25b3fd7fa67d3bad86d8386', 'timestamp': 1609444825, 'bits': 436632771, 'nonce': 1451552657, 'block_height': 2206515}, 2206516: {'version': 536870912, 'prev_block_hash': '1fb8ed778b8e8102ee7ceea672dc06d7f6faccc47582e909530ce6e46d7374d4', 'merkle_root': '57796791a3ea547a780a6bb8c6cab38c9565069af5f0616f7e205cc4f71cab04', 'timestamp': 1609444842, 'bits': 436624710, 'nonce': 2528808502, 'block_height': 2206516}, 2206517: {'version': 536870912, 'prev_block_hash': '5d389d2b68474a5f19e6a92e2e92ce567e948ad5aa0bf4e459aa87f5a5fca637', 'merkle_root': '5cbc97c215a95e75fe4bcbd5789bfb8a86792a738247b68426938b40e1504a4b', 'timestamp': 1609444994, 'bits': 436607628, 'nonce': 3198985056, 'block_height': 2206517}, 2206518: {'version': 536870912, 'prev_block_hash': '84815942d62032fcb2c5bc3b8991c09dde040190f63b9d9ebe46b340b2cd3d6c', 'merkle_root': 'c0da13cb17bff5bc2a2331ad6d41ba30eba738efffdefd3c38183faa9234612c', 'timestamp': 1609445310, 'bits': 436632069, 'nonce': 1627859591, 'block_height': 2206518}, 2206519: {'version': 536870912, 'prev_block_hash': 'c45cc191df1a721c6fa95201cb5e731825160f254f3ca5ff1ca9760a5822ee8b', 'merkle_root': '37860a177a12504292339d5c2f0e6ada37a3602b1d1734e6ae9d4c41ea59f54d', 'timestamp': 1609445334, 'bits': 436631610, 'nonce': 2638329250, 'block_height': 2206519}, 2206520: {'version': 536870912, 'prev_block_hash': 'adf2460927e1e4aad0bf1523323e07b127c35345add7a747f31a7c91121ff63e', 'merkle_root': '9170108d7c0c9259592afa4de3d3e7050e08a735d124318c734e2abf8f6664a6', 'timestamp': 1609445589, 'bits': 436576387, 'nonce': 3625981221, 'block_height': 2206520}, 2206521: {'version': 536870912, 'prev_block_hash': 'a21753dbaf91b13f9201907987a94f24ec733c5c135c98a9e745802ddd99eeca', 'merkle_root': '14fc0e2c98fddfcc4dfc4a06ecfa25789cef80a3db7a3eb6fe1c1f7b5c58a09e', 'timestamp': 1609445713, 'bits': 436624231, 'nonce': 3913376559, 'block_height': 2206521}, 2206522: {'version': 536870912, 'prev_block_hash': 'c015a44dca079df75b4359cef86a56c0c83daafd99ee7f4e4e6a3b973e3cf68d', 'merkle_root': '846fff888522311773f8e799934ba37dff875e768540dcdf3096cff3faaa70d0', 'timestamp': 1609445772, 'bits': 436630768, 'nonce': 2444283459, 'block_height': 2206522}, 2206523: {'version': 536870912, 'prev_block_hash': '4a68c57457302e8dfcce11b2bfd687dfd676d7ee73b6de4f8c7c1ea7c7caa8d5', 'merkle_root': 'f89d5a02a3e60fa0d0a76548755ee10f657fe8cf14d20c195df661c0395dc2df', 'timestamp': 1609445813, 'bits': 436632462, 'nonce': 1189974575, 'block_height': 2206523}, 2206524: {'version': 536870912, 'prev_block_hash': 'f8fb4f308a3059f427ab617976f0f8f997f9f85c23ee1155204b30897ae32004', 'merkle_root': '1d4de9345567a065e1524fd56465f59eee2732fb3d4d29c41447ba2aa676dedc', 'timestamp': 1609445829, 'bits': 436624998, 'nonce': 3623875361, 'block_height': 2206524}, 2206525: {'version': 536870912, 'prev_block_hash': '1a397adbec8fbabcbb17194f4785f2e47f4335b76c04a30421dfaa422f04cd15', 'merkle_root': '428a9bc92c90cb7e924415f9d9677fc76edb82289b1145be99611200c3ee0a34', 'timestamp': 1609445845, 'bits': 436616917, 'nonce': 632717637, 'block_height': 2206525}, 2206526: {'version': 536870912, 'prev_block_hash': 'e3dc75e8dfa601bb91615cbb3d50b216f3d6c83f3f6e991d982d95aa88025ab4', 'merkle_root': '836f81e989916f694c674fcf8da11167b8a6f26e86b1e04d51514c22c430bd23', 'timestamp': 1609445997, 'bits': 436606062, 'nonce': 2130612094, 'block_height': 2206526}, 2206527: {'version': 536870912, 'prev_block_hash': '240eff2862051667cd689d214d896f8e78eec3a844a368be841ec00a6005eacf', 'merkle_root': '1c685361ea5fbac52a4b876c4c7bf5c60d94f6c31523319dd31e3f1c87f4d01e', 'timestamp': 1609446064, 'bits': 436621155, 'nonce': 3355082659, 'block_height': 2206527}, 2206528: {'version': 536870912, 'prev_block_hash': '17cf5b52259574e136520b7810928dcbf8e6d2725fca5271ecdb1288de78b79c', 'merkle_root': 'e53478cb75d397b9d168a23d9d6b18d241029ccce75966f2a1635d88d4f55507', 'timestamp': 1609446097, 'bits': 436622203, 'nonce': 2427283207, 'block_height': 2206528}, 2206529: {'version': 536870912, 'prev_block_hash': 'ceceb35eb792cd7728b779d8bde0c063948964608b2fb5fc08e28b97389f70b0', 'merkle_root': '00e724c066d68c04fa033cc228f4faf9139360f16e24f11ff8f6bcb5d09c2f56', 'timestamp': 1609446108, 'bits': 436617031, 'nonce': 12246852, 'block_height': 2206529}, 2206530: {'version': 536870912, 'prev_block_hash': '9fbeb81d66a9690389e6fa4af51fb5cb58b5e1985814a0e3c9282a0b743bc9c1', 'merkle_root': '900a55f729f0ffc485573f14a2eb6ad98e09f062d3b4f14d29ee86b674f80631', 'timestamp': 1609446465, 'bits': 436610673, 'nonce': 3113809169, 'block_height': 2206530}, 2206531: {'version': 536870912, 'prev_block_hash': '83e32b6cec70692839a31254d7e1e54cde9e4ebd609909aea911c1ccb6f3bcea', 'merkle_root': '8753aefb0807ce00d6dd08af39c9546d9d99b5058b71325fcee16e825ebad1d5', 'timestamp': 1609446495, 'bits': 436652811, 'nonce': 4034390885, 'block_height': 2206531}, 2206532: {'version': 536870912, 'prev_block_hash': '4972be8a70cc57ec5ac8797a70ddfe649e53399b956d9dc6f7c441980398a148', 'merkle_root': 'fba036cbf0ae13be324c0cadbb1f5394df5e31730d3f26446acbe71cfa8c8cad', 'timestamp': 1609446538, 'bits': 436651818, 'nonce': 3995783605, 'block_height': 2206532}, 2206533: {'version': 536870912, 'prev_block_hash': 'ee827023ec8ff367ca696f1ef15428a938f659eede017edb73c5e18926a4be45', 'merkle_root': '3a77f5c65e241bc0f98e7c769856ba8ceab5ee6acac2f6e4179d5c8cccf7a9e7', 'timestamp': 1609446687, 'bits': 436624837, 'nonce': 3037641522, 'block_height': 2206533}, 2206534: {'version': 536870912, 'prev_block_hash': '1ecbba9436fc30f6f754d3bf23dce7ea14b043c87b9f6ced3724687ae4c4e4a5', 'merkle_root': 'b35280e639c58d2fbd6c68259d6a36c36fa22079fd5c395c2671bedf3f7fb6e0', 'timestamp': 1609446816, 'bits': 436644078, 'nonce': 570649684, 'block_height': 2206534}, 2206535: {'version': 536870912, 'prev_block_hash': '4f244738562a8d5043647226bf365562b21c7969307adfae62c27f55efd15bb7', 'merkle_root': '9a5d1d4dfc02cd2deea1ad45fcf009e1c71aefdcf37b2e246e2984ef1de16900', 'timestamp': 1609446927, 'bits': 436667852, 'nonce': 3209124518, 'block_height': 2206535}, 2206536: {'version': 536870912, 'prev_block_hash': '8458f4914392ca79bed665183325028a9dc923a5bd9adcffb71504418df4c85b', 'merkle_root': 'c8a0b1dc4eaf05a864a3e4b18d80c0a01241c5467efc77abfb6dbe8a62c0d17f', 'timestamp': 1609446940, 'bits': 436678347, 'nonce': 1558666374, 'block_height': 2206536}, 2206537: {'version': 536870912, 'prev_block_hash': '950e1e6fde2374c4e6b5c6410de17aa06cc529e744f37dd0c32c64dd1d7bb746', 'merkle_root': 'aed89fdc09cdf3893d35a62df0182c943cc3a0309b4251d5f9923c85acc08c70', 'timestamp': 1609447234, 'bits': 436655004, 'nonce': 1640074009, 'block_height': 2206537}, 2206538: {'version': 536870912, 'prev_block_hash': '28bc9fdd7ab0d15f567645e174c7e3ea7027ef90611e730b5462a6282946d0b9', 'merkle_root': '72a363391d361998612c938f3ced45273d810eec5d23c1ba6154f4ed9725679b', 'timestamp': 1609447281, 'bits': 436703536, 'nonce': 4023305371, 'block_height': 2206538}, 2206539: {'version': 536870912, 'prev_block_hash': '7a558e121576bf037355022758126a6dcff6eb1196d1a6637f9b0d66631f178f', 'merkle_root': 'b5508485f20a33c62f5b54c0ae8e93a5fb448f6d59493fed8e7c44a0c80d83c8', 'timestamp': 1609447384, 'bits': 436694408, 'nonce': 739444754, 'block_height': 2206539}, 2206540: {'version': 536870912, 'prev_block_hash': '918ffd6a492a437afc25cc54921f9f62b7c8ba84529b5c4de36afc1693e7fe32', 'merkle_root': 'd5aeafdb55ea5e1ed86fc03b6789964bf2bc1f828782cd356d1a31ecb49b9887', 'timestamp': 1609447413, 'bits': 436713926, 'nonce': 1895755322, 'block_height': 2206540}, 2206541: {'version': 536870912, 'prev_block_hash': '02755cd1cec2f837100165b0106050b2eb4ed7869b19e2605a7c828e7d515452', 'merkle_root': '1ce0429268d986fdd324b6fbb3119126288bffd7adf71b50dc2abac011956d3f', 'timestamp': 1609447455, 'bits': 436694298, 'nonce': 2787690507, 'block_height': 2206541}, 2206542: {'version': 536870912, 'prev_block_hash': 'd227495a03fec3ae3ab4d33389f8ddff2924bf52b4e397fef064e47d2b80b3be', 'merkle_root': 'e59c530f17cd030c80090c5aff4a998890b92472d723843248f63ff04a3fd141', 'timestamp': 1609447500, 'bits': 436641834, 'nonce': 3636446255, 'block_height': 2206542}, 2206543: {'version': 536870912, 'prev_block_hash': '30594681b22092a3ba73b532accc7835f117984098164cd10bb9a8c4272e33f3', 'merkle_root': '66ad5a4a7c9037f69d47a1103a8a3ecc1103b75891b2ac0280567431cfccd549', 'timestamp': 1609447533, 'bits': 436644373, 'nonce': 850699273, 'block_height': 2206543}}
-        bits = Blockchain.get_target(self, 2206543, headers5)
+        bits = self.chain.get_target(2206543, headers5)
         self.assertEqual(bits, 10709251786800936527318757626382864578020150972591414166005562)
+
+
+class TestCheckPow(ElectrumTestCase):
+
+    # mainnet headers #2206542 and #2206543 (Lyra2REv2)
+    HEADERS = [
+        {'version': 536870912, 'prev_block_hash': 'd227495a03fec3ae3ab4d33389f8ddff2924bf52b4e397fef064e47d2b80b3be', 'merkle_root': 'e59c530f17cd030c80090c5aff4a998890b92472d723843248f63ff04a3fd141', 'timestamp': 1609447500, 'bits': 436641834, 'nonce': 3636446255, 'block_height': 2206542},
+        {'version': 536870912, 'prev_block_hash': '30594681b22092a3ba73b532accc7835f117984098164cd10bb9a8c4272e33f3', 'merkle_root': '66ad5a4a7c9037f69d47a1103a8a3ecc1103b75891b2ac0280567431cfccd549', 'timestamp': 1609447533, 'bits': 436644373, 'nonce': 850699273, 'block_height': 2206543},
+    ]
+
+    def _pow_items(self, headers):
+        return [(h['block_height'], bfh(blockchain.serialize_header(h)), Blockchain.bits_to_target(h['bits']))
+                for h in headers]
+
+    def test_valid_pow(self):
+        items = self._pow_items(self.HEADERS)
+        self.assertIsNone(blockchain.check_pow_of_raw_headers(items))
+        self.assertIsNone(blockchain.check_pow_of_raw_headers_in_parallel(items, num_workers=2))
+
+    def test_insufficient_pow(self):
+        bad_header = dict(self.HEADERS[1])
+        bad_header['nonce'] = 42
+        items = self._pow_items([self.HEADERS[0], bad_header])
+        for failure in (blockchain.check_pow_of_raw_headers(items),
+                        blockchain.check_pow_of_raw_headers_in_parallel(items, num_workers=2)):
+            self.assertIsNotNone(failure)
+            height, powhash, target = failure
+            self.assertEqual(2206543, height)
+            self.assertGreater(powhash, target)
+
+
+def _reference_get_target_dgwv3(height, chain):
+    # the original, non-incremental DGWv3 implementation
+    last = chain.get(height - 1)
+    BlockReading = last
+    nActualTimespan = 0
+    LastBlockTime = 0
+    PastBlocksMin = 24
+    PastBlocksMax = 24
+    CountBlocks = 0
+    PastDifficultyAverage = 0
+    PastDifficultyAveragePrev = 0
+    if height < len(constants.net.CHECKPOINTS)*2016 + PastBlocksMax:
+        return 0
+    if last is None or height-1 < 450024:
+        return MAX_TARGET
+    for i in range(1, PastBlocksMax + 1):
+        CountBlocks += 1
+        if CountBlocks <= PastBlocksMin:
+            if CountBlocks == 1:
+                PastDifficultyAverage = Blockchain.bits_to_target(BlockReading.get('bits'))
+            else:
+                bnNum = Blockchain.bits_to_target(BlockReading.get('bits'))
+                PastDifficultyAverage = ((PastDifficultyAveragePrev * CountBlocks)+(bnNum)) // (CountBlocks + 1)
+            PastDifficultyAveragePrev = PastDifficultyAverage
+        if LastBlockTime > 0:
+            nActualTimespan += LastBlockTime - BlockReading.get('timestamp')
+        LastBlockTime = BlockReading.get('timestamp')
+        BlockReading = chain.get((height-1) - CountBlocks)
+    bnNew = PastDifficultyAverage
+    nTargetTimespan = CountBlocks * 90
+    nActualTimespan = max(nActualTimespan, nTargetTimespan//3)
+    nActualTimespan = min(nActualTimespan, nTargetTimespan*3)
+    bnNew *= nActualTimespan
+    bnNew //= nTargetTimespan
+    return min(bnNew, MAX_TARGET)
+
+
+class TestDGWv3State(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.chain = Blockchain(config=SimpleConfig({'electrum_path': self.electrum_path}), forkpoint=0,
+                                parent=None, forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+
+    def _make_headers(self, start_height, count):
+        rand = random.Random(42)
+        headers = {}
+        timestamp = 1609444650
+        for height in range(start_height, start_height + count):
+            # timestamps are not monotonic, and spacing varies enough to hit the clamps
+            timestamp += rand.choice([rand.randint(-100, 30), rand.randint(0, 200), rand.randint(200, 2000)])
+            bits = (rand.randint(0x19, 0x1e) << 24) | rand.randint(0x8000, 0x7fffff)
+            headers[height] = {'version': 536870912, 'prev_block_hash': '00'*32, 'merkle_root': '00'*32,
+                               'timestamp': timestamp, 'bits': bits, 'nonce': 0, 'block_height': height}
+        return headers
+
+    def test_targets_identical_to_reference(self):
+        first_height = len(constants.net.CHECKPOINTS) * 2016
+        headers = self._make_headers(first_height - 24, 524)
+        state = DGWv3State.from_headers(first_height - 1, [headers[h] for h in range(first_height - 24, first_height)])
+        for height in range(first_height, first_height + 500):
+            expected = _reference_get_target_dgwv3(height, headers)
+            # from scratch
+            self.assertEqual(expected, self.chain.get_target(height, headers))
+            # rolling
+            self.assertEqual(expected, self.chain.get_target(height, headers, dgw_state=state))
+            state.push(headers[height])
+
+    def test_missing_headers(self):
+        first_height = len(constants.net.CHECKPOINTS) * 2016
+        headers = self._make_headers(first_height, 48)
+        height = first_height + 48
+        entries = [(headers[h]['bits'], headers[h]['timestamp']) for h in range(height - 24, height)]
+        state = DGWv3State(height - 1, entries[:-1] + [None])
+        self.assertEqual(MAX_TARGET, state.get_next_target())
+        state = DGWv3State(height - 1, entries[:5] + [None] + entries[6:])
+        with self.assertRaises(blockchain.MissingHeader):
+            state.get_next_target()
+        # the hole eventually slides out of the window
+        for h in range(height, height + 6):
+            self.assertEqual(h - 1, state.height)
+            state.push(dict(headers[h - 24], block_height=h))
+        state.get_next_target()
@@ -1,4 +1,9 @@
-from electrum_mona.coinchooser import CoinChooserPrivacy
+from decimal import Decimal
+
+from electrum_mona import bitcoin
+from electrum_mona.coinchooser import CoinChooserPrivacy, CoinChooserBranchAndBound, COIN_CHOOSERS
+from electrum_mona.crypto import sha256
+from electrum_mona.transaction import PartialTxInput, PartialTxOutput, TxOutpoint
 from electrum_mona.util import NotEnoughFunds
 
 from . import ElectrumTestCase
@@ -18,3 +23,49 @@ class TestCoinChooser(ElectrumTestCase):
             coin_chooser.bucket_candidates_any([], sufficient_funds)
         with self.assertRaises(NotEnoughFunds):
             coin_chooser.bucket_candidates_prefer_confirmed([], sufficient_funds)
+
+
+class TestCoinChooserBranchAndBound(ElectrumTestCase):
+
+    def _make_coin(self, i: int, value: int, *, height: int = 100) -> PartialTxInput:
+        txin = PartialTxInput(prevout=TxOutpoint(sha256(f'coin {i}'), 0))
+        txin._trusted_address = bitcoin.hash_to_segwit_addr(sha256(f'address {i}')[:20], witver=0)
+        txin._trusted_value_sats = value
+        txin.block_height = height
+        return txin
+
+    def _make_tx(self, coins, amount, *, feerate=10):
+        coin_chooser = CoinChooserBranchAndBound(enable_output_value_rounding=False)
+        address = bitcoin.hash_to_segwit_addr(sha256('output')[:20], witver=0)
+        change_address = bitcoin.hash_to_segwit_addr(sha256('change')[:20], witver=0)
+        fee_estimator_vb = lambda size: round(Decimal(size) * feerate)
+        tx = coin_chooser.make_tx(coins=coins, inputs=[], outputs=[PartialTxOutput.from_address_and_value(address, amount)],
+                                  change_addrs=[change_address], fee_estimator_vb=fee_estimator_vb, dust_threshold=546)
+        self.assertGreaterEqual(tx.get_fee(), fee_estimator_vb(tx.estimated_size()))
+        return tx
+
+    def test_registered(self):
+        self.assertIs(CoinChooserBranchAndBound, COIN_CHOOSERS['BranchAndBound'])
+
+    def test_changeless_solution(self):
+        # an input costs 680 sat, the tx without inputs about 420 sat
+        coins = [self._make_coin(i, value) for i, value in enumerate(
+            [5_000_000, 3_000_000, 400_000, 302_000, 200_000, 120_000])]
+        tx = self._make_tx(coins, 500_000)
+        self.assertEqual(1, len(tx.outputs()))
+        self.assertEqual({coins[3].prevout, coins[4].prevout}, {txin.prevout for txin in tx.inputs()})
+        self.assertEqual(2000, tx.get_fee())
+
+    def test_prefers_confirmed_coins(self):
+        coins = [self._make_coin(0, 501_500, height=0), self._make_coin(1, 301_000), self._make_coin(2, 201_000)]
+        tx = self._make_tx(coins, 500_000)
+        self.assertEqual(1, len(tx.outputs()))
+        self.assertEqual({coins[1].prevout, coins[2].prevout}, {txin.prevout for txin in tx.inputs()})
+
+    def test_fallback_with_change(self):
+        coins = [self._make_coin(i, value) for i, value in enumerate([5_000_000, 3_000_000])]
+        tx = self._make_tx(coins, 500_000)
+        self.assertEqual(2, len(tx.outputs()))
+        self.assertEqual(1, len(tx.inputs()))
+        with self.assertRaises(NotEnoughFunds):
+            self._make_tx(coins, 8_000_000)
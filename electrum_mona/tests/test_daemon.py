@@ -0,0 +1,141 @@
+import asyncio
+import json
+import time
+from base64 import b64encode
+from unittest import mock
+
+from electrum_mona.daemon import AuthenticatedServer
+
+from . import ElectrumTestCase
+
+
+class MockRequest:
+
+    def __init__(self, body, *, user='user', password='pass', remote='127.0.0.1'):
+        self.remote = remote
+        self.headers = {}
+        if user is not None:
+            credentials = b64encode(f'{user}:{password}'.encode('utf8')).decode('ascii')
+            self.headers['Authorization'] = f'Basic {credentials}'
+        self._body = body if isinstance(body, str) else json.dumps(body)
+
+    async def text(self):
+        return self._body
+
+
+class TestAuthenticatedServer(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.running = 0
+        self.max_running = 0
+
+        async def echo(*args):
+            return list(args)
+
+        async def slow_write():
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            await asyncio.sleep(0.01)
+            self.running -= 1
+            return True
+
+        async def fail():
+            raise Exception('failed')
+
+        self.server = AuthenticatedServer('user', 'pass', max_concurrent_writes=2)
+        self.server.register_method(echo)
+        self.server.register_method(slow_write, modifies_state=True)
+        self.server.register_method(fail)
+
+    def tearDown(self):
+        self.loop.close()
+        super().tearDown()
+
+    def _handle(self, request):
+        response = self.loop.run_until_complete(self.server.handle(request))
+        if response.content_type == 'application/json':
+            return response.status, json.loads(response.text)
+        return response.status, response.text
+
+    def test_single_request(self):
+        status, response = self._handle(MockRequest({'id': 1, 'method': 'echo', 'params': [1, 'a']}))
+        self.assertEqual(200, status)
+        self.assertEqual({'id': 1, 'jsonrpc': '2.0', 'result': [1, 'a']}, response)
+        status, response = self._handle(MockRequest({'id': 2, 'method': 'fail'}))
+        self.assertEqual({'code': 1, 'message': 'failed'}, response['error'])
+        status, response = self._handle(MockRequest({'id': 3, 'method': 'unknown'}))
+        self.assertEqual((500, 'Invalid Request'), (status, response))
+
+    def test_batch_request(self):
+        status, response = self._handle(MockRequest([
+            {'id': 1, 'method': 'echo', 'params': [1]},
+            {'id': 2, 'method': 'unknown'},
+            {'id': 3, 'method': 'fail'},
+            {'method': 'echo'},
+            'echo',
+            {'id': 4, 'method': 'echo', 'params': [4]},
+        ]))
+        self.assertEqual(200, status)
+        self.assertEqual([1, 2, 3, None, None, 4], [r['id'] for r in response])
+        self.assertEqual([1], response[0]['result'])
+        self.assertEqual(-32601, response[1]['error']['code'])
+        self.assertEqual(1, response[2]['error']['code'])
+        self.assertEqual(-32600, response[3]['error']['code'])
+        self.assertEqual(-32600, response[4]['error']['code'])
+        self.assertEqual([4], response[5]['result'])
+        status, response = self._handle(MockRequest([]))
+        self.assertEqual(-32600, response['error']['code'])
+
+    def test_concurrency_limit(self):
+        status, response = self._handle(MockRequest([{'id': i, 'method': 'slow_write'} for i in range(10)]))
+        self.assertEqual([True] * 10, [r['result'] for r in response])
+        self.assertEqual(2, self.max_running)
+        stats = self.server.get_stats()['methods']['slow_write']
+        self.assertEqual(10, stats['count'])
+        self.assertEqual(10, sum(stats['histogram'].values()))
+        self.assertLess(0, stats['max_wait_ms'])
+
+    @mock.patch('electrum_mona.daemon.AUTH_FAILURE_DELAY', 0.01)
+    def test_failed_auth_delays_next_attempts(self):
+        status, _ = self._handle(MockRequest({'id': 1, 'method': 'echo'}, user=None))
+        self.assertEqual(401, status)
+
+        async def send(password):
+            response = await self.server.handle(MockRequest({'id': 1, 'method': 'echo'}, password=password))
+            return response.status, time.monotonic()
+
+        async def send_all():
+            return await asyncio.gather(*[send('wrong') for i in range(4)], send('pass'))
+
+        t0 = time.monotonic()
+        results = self.loop.run_until_complete(send_all())
+        self.assertEqual([403] * 4 + [200], [status for status, _ in results])
+        # concurrent attempts were compared one at a time, each after the
+        # backoff of the previous failure, which doubles each time
+        self.assertLessEqual(0.01 + 0.02 + 0.04 + 0.08, results[-1][1] - t0)
+        self.assertEqual(4, self.server._auth_failures['127.0.0.1'][0])
+        # other clients are not affected
+        status, _ = self._handle(MockRequest({'id': 1, 'method': 'echo'}, remote='127.0.0.2'))
+        self.assertEqual(200, status)
+        # failures long ago are forgotten
+        self.server._auth_failures['127.0.0.1'] = (4, time.monotonic() - 20)
+        status, _ = self._handle(MockRequest({'id': 1, 'method': 'echo'}, password='wrong'))
+        self.assertEqual(403, status)
+        self.assertEqual(1, self.server._auth_failures['127.0.0.1'][0])
+
+    def test_unlimited_method(self):
+        async def stop():
+            return True
+        self.server.register_method(stop, modifies_state=True, limited=False)
+
+        async def run():
+            # all write slots are taken, e.g. by long running commands
+            for i in range(self.server.max_concurrent_writes):
+                await self.server._write_semaphore.acquire()
+            request = MockRequest({'id': 1, 'method': 'stop'})
+            return await asyncio.wait_for(self.server.handle(request), timeout=1)
+
+        response = self.loop.run_until_complete(run())
+        self.assertEqual({'id': 1, 'jsonrpc': '2.0', 'result': True}, json.loads(response.text))
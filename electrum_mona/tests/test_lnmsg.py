@@ -242,6 +242,25 @@ class TestLNMsg(TestCaseForTestnet):
                           ),
                          decode_msg(bfh("01020000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000043497fd7f826957108f4a30fd9cec3aeba79972084e90ead01ea33090000000000d43100006f00025e6ed0830100009000000000000000c8000001f400000023")))
 
+    def test_decode_msg__truncated(self):
+        msg = bfh("01020000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000043497fd7f826957108f4a30fd9cec3aeba79972084e90ead01ea33090000000000d43100006f00025e6ed0830100009000000000000000c8000001f400000023000000003b9aca00")
+        self.assertEqual(1_000_000_000, decode_msg(msg)[1]['htlc_maximum_msat'])
+        # optional field "htlc_maximum_msat" partially present -> does not get put into dict
+        for cut in range(1, 9):
+            msg_type, parsed = decode_msg(msg[:-cut])
+            self.assertEqual('channel_update', msg_type)
+            self.assertNotIn('htlc_maximum_msat', parsed)
+            self.assertEqual(35, parsed['fee_proportional_millionths'])
+        # mandatory field "fee_proportional_millionths" partially present
+        for cut in range(9, 13):
+            with self.assertRaises(UnexpectedEndOfStream):
+                decode_msg(msg[:-cut])
+        # variable length field "features"
+        msg = encode_msg("node_announcement", flen=2, features=b'\x02\x00', node_id=bytes(33), alias=bytes(32), addrlen=0)
+        self.assertEqual(b'\x02\x00', decode_msg(msg)[1]['features'])
+        with self.assertRaises(UnexpectedEndOfStream):
+            decode_msg(msg[:2 + 64 + 2 + 1])
+
     def test_encode_decode_msg__ints_can_be_passed_as_bytes(self):
         self.assertEqual(bfh("010200000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000b2e06110329c448f1578e48a25a88b639dcfaaa6a6b297d0c6e03bbace06b1a200d43100006f00025e6ed0830100009000000000000000c8000001f400000023000000003b9aca00"),
                          encode_msg(
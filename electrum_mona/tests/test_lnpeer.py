@@ -20,7 +20,7 @@ from electrum_mona import simple_config, lnutil
 from electrum_mona.lnaddr import lnencode, LnAddr, lndecode
 from electrum_mona.bitcoin import COIN, sha256
 from electrum_mona.util import bh2u, create_and_start_event_loop, NetworkRetryManager, bfh
-from electrum_mona.lnpeer import Peer, UpfrontShutdownScriptViolation
+from electrum_mona.lnpeer import Peer, UpfrontShutdownScriptViolation, OutgoingMessageScheduler, MessagePriority
 from electrum_mona.lnutil import LNPeerAddr, Keypair, privkey_to_pubkey
 from electrum_mona.lnutil import LightningPeerConnectionClosed, RemoteMisbehaving
 from electrum_mona.lnutil import PaymentFailure, LnFeatures, HTLCOwner
@@ -251,6 +251,9 @@ class MockTransport:
         while True:
             yield await self.queue.get()
 
+    def is_write_buffer_full(self):
+        return False
+
 class NoFeaturesTransport(MockTransport):
     """
     This answers the init message with a init that doesn't signal any features.
@@ -511,6 +514,55 @@ class TestPeer(TestCaseForTestnet):
         lnaddr2 = lndecode(invoice)  # unlike lnaddr1, this now has a pubkey set
         return lnaddr2, invoice
 
+    def test_outgoing_message_scheduler(self):
+        class Transport:
+            def __init__(self):
+                self.sent = []
+                self.buffered = 0
+                self.drained = asyncio.Event()
+            def send_bytes(self, msg):
+                self.sent.append(msg)
+                self.buffered += len(msg)
+            def is_write_buffer_full(self):
+                return self.buffered >= 2000
+            async def drain(self):
+                await self.drained.wait()
+                self.drained.clear()
+                self.buffered = 0
+
+        async def f():
+            transport = Transport()
+            scheduler = OutgoingMessageScheduler(transport, TaskGroup())
+            gossip = [bytes([i]) * 1000 for i in range(20)]
+            htlcs = [b'htlc%d' % i for i in range(4)]
+            scheduler.send(b'ping', MessagePriority.PING)
+            for msg in gossip:
+                scheduler.send(msg, MessagePriority.GOSSIP)
+            for msg in htlcs[:3]:
+                scheduler.send(msg, MessagePriority.CHANNEL)
+            # written until the transport is full
+            self.assertEqual([b'ping'] + gossip[:2], transport.sent)
+            transport.sent.clear()
+            transport.drained.set()
+            await asyncio.sleep(0.01)
+            # channel messages go first, gossip writes its quantum
+            self.assertEqual(htlcs[:3] + gossip[2:6], transport.sent)
+            transport.sent.clear()
+            scheduler.send(htlcs[3], MessagePriority.CHANNEL)
+            transport.drained.set()
+            await asyncio.sleep(0.01)
+            self.assertEqual(htlcs[3:] + gossip[6:10], transport.sent)
+            while scheduler.num_queued:
+                transport.drained.set()
+                await asyncio.sleep(0.01)
+            self.assertFalse(scheduler.flushing)
+            stats = scheduler.get_stats()
+            self.assertEqual({'count': 4, 'queued': 4}, {k: stats['channel'][k] for k in ('count', 'queued')})
+            self.assertEqual({'count': 1, 'queued': 0}, {k: stats['ping'][k] for k in ('count', 'queued')})
+            self.assertEqual({'count': 20, 'queued': 18}, {k: stats['gossip'][k] for k in ('count', 'queued')})
+            self.assertGreater(stats['gossip']['max_latency_ms'], stats['channel']['max_latency_ms'])
+        run(f())
+
     def test_reestablish(self):
         alice_channel, bob_channel = create_test_channels()
         p1, p2, w1, w2, _q1, _q2 = self.prepare_peers(alice_channel, bob_channel)
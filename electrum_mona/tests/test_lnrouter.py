@@ -1,15 +1,23 @@
 from math import inf
+import random
 import unittest
 import tempfile
 import shutil
 import asyncio
+import os
+import sqlite3
+import time
+from unittest import mock
 
 from electrum_mona.util import bh2u, bfh, create_and_start_event_loop
-from electrum_mona.lnutil import ShortChannelID
+from electrum_mona.lnutil import ShortChannelID, LNPeerAddr
+from electrum_mona.lnmsg import encode_msg, decode_msg
 from electrum_mona.lnonion import (OnionHopsDataSingle, new_onion_packet,
                               process_onion_packet, _decode_onion_error, decode_onion_error,
                               OnionFailureCode, OnionPacket)
-from electrum_mona import bitcoin, lnrouter
+from electrum_mona import bitcoin, lnrouter, ecc, channel_db, util
+from electrum_mona.crypto import sha256d
+from electrum_mona.lnutil import InvalidGossipMsg
 from electrum_mona.constants import BitcoinTestnet
 from electrum_mona.simple_config import SimpleConfig
 from electrum_mona.lnrouter import PathEdge, LiquidityHintMgr, DEFAULT_PENALTY_PROPORTIONAL_MILLIONTH, DEFAULT_PENALTY_BASE_MSAT, fee_for_edge_msat
@@ -140,6 +148,60 @@ class Test_LNRouter(TestCaseForTestnet):
         add_chan_upd({'short_channel_id': channel(7), 'message_flags': b'\x00', 'channel_flags': b'\x00', 'cltv_expiry_delta': 10, 'htlc_minimum_msat': 250, 'fee_base_msat': 100, 'fee_proportional_millionths': 150, 'chain_hash': BitcoinTestnet.rev_genesis_bytes(), 'timestamp': 0})
         add_chan_upd({'short_channel_id': channel(7), 'message_flags': b'\x00', 'channel_flags': b'\x01', 'cltv_expiry_delta': 10, 'htlc_minimum_msat': 250, 'fee_base_msat': 100, 'fee_proportional_millionths': 150, 'chain_hash': BitcoinTestnet.rev_genesis_bytes(), 'timestamp': 0})
 
+    def _make_node_announcements(self, n: int):
+        payloads = []
+        for i in range(n):
+            privkey = ecc.ECPrivkey.from_secret_scalar(i + 1)
+            rest = b'\x00\x00' + i.to_bytes(4, 'big') + privkey.get_public_key_bytes()
+            sig = privkey.sign(sha256d(rest), sigencode=ecc.sig_string_from_r_and_s)
+            payloads.append({
+                'node_id': privkey.get_public_key_bytes(),
+                'signature': sig,
+                'raw': b'\x01\x01' + sig + rest,
+            })
+        return payloads
+
+    def test_verify_gossip_msgs_in_parallel(self):
+        payloads = self._make_node_announcements(100)
+        verify = lnrouter.ChannelDB.verify_node_announcement
+        channel_db.verify_gossip_msgs(verify, payloads, num_workers=4)
+        channel_db.verify_gossip_msgs(verify, payloads, num_workers=0)
+        # one bad signature, in any shard, fails the whole batch
+        for bad_idx in (0, 57, 99):
+            bad_payloads = list(payloads)
+            bad_payloads[bad_idx] = dict(payloads[bad_idx], signature=payloads[bad_idx - 1]['signature'])
+            with self.assertRaises(InvalidGossipMsg):
+                channel_db.verify_gossip_msgs(verify, bad_payloads, num_workers=4)
+
+    def test_gossip_verification_stats(self):
+        self.prepare_graph()
+        payloads = self._make_node_announcements(40)
+        self.cdb.verify_node_announcements(payloads)
+        with self.assertRaises(InvalidGossipMsg):
+            self.cdb.verify_node_announcements([dict(payloads[0], signature=payloads[1]['signature'])])
+        stats = self.cdb.get_verification_stats()
+        self.assertEqual(['node_announcement'], list(stats))
+        self.assertEqual(40, stats['node_announcement']['verified'])
+        self.assertEqual(1, stats['node_announcement']['rejected'])
+        self.assertGreater(stats['node_announcement']['msgs_per_sec'], 0)
+
+    def test_add_channel_updates_prechecks_once(self):
+        self.prepare_graph()
+        now = int(time.time())
+        def update(number, timestamp, fee_base_msat=200):
+            return {'short_channel_id': channel(number), 'message_flags': b'\x00', 'channel_flags': b'\x00', 'cltv_expiry_delta': 10, 'htlc_minimum_msat': 250, 'fee_base_msat': fee_base_msat, 'fee_proportional_millionths': 150, 'chain_hash': BitcoinTestnet.rev_genesis_bytes(), 'timestamp': timestamp}
+        # the second update is deprecated by the first one
+        payloads = [update(1, now - 1000), update(1, now - 970), update(1, now - 900, fee_base_msat=300), update(99, now)]
+        with mock.patch.object(self.cdb, 'verify_channel_updates') as verify, \
+                mock.patch.object(self.cdb, '_precheck_channel_update', wraps=self.cdb._precheck_channel_update) as precheck:
+            categorized = self.cdb.add_channel_updates(payloads)
+        self.assertEqual(4, precheck.call_count)
+        verify.assert_called_once_with([payloads[0], payloads[2]])
+        self.assertEqual([payloads[0], payloads[2]], categorized.good)
+        self.assertEqual([payloads[1]], categorized.deprecated)
+        self.assertEqual([payloads[3]], categorized.orphaned)
+        self.assertEqual(300, self.cdb._policies[(node('b'), channel(1))].fee_base_msat)
+
     def test_find_path_for_payment(self):
         self.prepare_graph()
         amount_to_send = 100000
@@ -157,6 +219,217 @@ class Test_LNRouter(TestCaseForTestnet):
         self.assertEqual(node('b'), route[0].node_id)
         self.assertEqual(channel(3), route[0].short_channel_id)
 
+    def _get_paths_both_ways(self, *, nodeA, nodeB, **kwargs):
+        # note: only the path is compared, as the searches might have been
+        #       cached and expanded further by previous queries
+        def get_path():
+            prev_node = self.path_finder.get_distances(nodeA=nodeA, nodeB=nodeB, **kwargs)
+            path = []
+            edge = prev_node.get(nodeA)
+            while edge is not None:
+                # parallel channels of equal cost can be picked in any order
+                path.append((edge.start_node, edge.end_node))
+                edge = prev_node.get(edge.end_node) if edge.end_node != nodeB else None
+            return path
+        self.config.set_key('lightning_use_compact_graph', False)
+        expected = get_path()
+        self.config.set_key('lightning_use_compact_graph', True)
+        got = get_path()
+        return expected, got
+
+    def test_compact_graph_same_distances(self):
+        self.prepare_graph()
+        rand = random.Random(42)
+        nodes = [node(c) for c in 'fghijklmnopqrstu']
+        for i in range(60):
+            n1, n2 = sorted(rand.sample(nodes, 2))
+            self.cdb.add_channel_announcements({
+                'node_id_1': n1, 'node_id_2': n2,
+                'bitcoin_key_1': n1, 'bitcoin_key_2': n2,
+                'short_channel_id': channel(100 + i),
+                'chain_hash': BitcoinTestnet.rev_genesis_bytes(),
+                'len': 0, 'features': b''
+            }, trusted=True)
+            for direction in (b'\x00', b'\x01'):
+                if rand.random() < 0.1:
+                    continue  # some channels only have one policy
+                self.cdb.add_channel_update({
+                    'short_channel_id': channel(100 + i), 'message_flags': b'\x00',
+                    'channel_flags': direction if rand.random() > 0.05 else bytes([direction[0] | 2]),
+                    'cltv_expiry_delta': rand.choice([10, 40, 144, 20000]),
+                    'htlc_minimum_msat': rand.choice([0, 1000, 500000]),
+                    'fee_base_msat': rand.randint(0, 2000),
+                    'fee_proportional_millionths': rand.randint(0, 5000),
+                    'chain_hash': BitcoinTestnet.rev_genesis_bytes(), 'timestamp': 0}, verify=False)
+        def check_all():
+            for i in range(30):
+                nodeA, nodeB = rand.sample(nodes + [node(c) for c in 'abcde'], 2)
+                expected, got = self._get_paths_both_ways(
+                    nodeA=nodeA, nodeB=nodeB, invoice_amount_msat=rand.choice([1000, 100000, 10_000_000]))
+                self.assertEqual(expected, got)
+        check_all()
+        graph = self.cdb.get_compact_graph()
+        self.assertEqual(self.cdb.num_channels, graph.num_channels())
+        # incremental updates: removed channels, new policies, new channels
+        for i in range(0, 60, 7):
+            self.cdb.remove_channel(channel(100 + i))
+        for i in range(1, 60, 5):
+            self.cdb.add_channel_update({
+                'short_channel_id': channel(100 + i), 'message_flags': b'\x00', 'channel_flags': b'\x01',
+                'cltv_expiry_delta': 10, 'htlc_minimum_msat': 0, 'fee_base_msat': 1, 'fee_proportional_millionths': 1,
+                'chain_hash': BitcoinTestnet.rev_genesis_bytes(), 'timestamp': 100}, verify=False)
+        self.cdb.add_channel_announcements({
+            'node_id_1': node('a'), 'node_id_2': node('v'),
+            'bitcoin_key_1': node('a'), 'bitcoin_key_2': node('v'),
+            'short_channel_id': channel(99),
+            'chain_hash': BitcoinTestnet.rev_genesis_bytes(),
+            'len': 0, 'features': b''
+        }, trusted=True)
+        self.assertTrue(graph.extra_in_edges)
+        check_all()
+        graph.compact()
+        self.assertFalse(graph.extra_in_edges)
+        check_all()
+
+    def test_find_path_with_budget(self):
+        self.prepare_graph()
+        amount_to_send = 100000
+        kwargs = dict(nodeA=node('a'), nodeB=node('e'), invoice_amount_msat=amount_to_send)
+        # B -2-> E has a cltv delta of 99, and a fee of 115 msat
+        path = self.path_finder.find_path_for_payment(max_cltv_delta=99, max_fee_msat=115, **kwargs)
+        self.assertEqual([channel(3), channel(2)], [edge.short_channel_id for edge in path])
+        path = self.path_finder.find_path_for_payment(max_cltv_delta=98, **kwargs)
+        self.assertEqual([channel(6), channel(5)], [edge.short_channel_id for edge in path])
+        # the fee of the first edge is not part of the budget
+        self.assertIsNone(self.path_finder.find_path_for_payment(max_fee_msat=114, **kwargs))
+        self.assertIsNone(self.path_finder.find_path_for_payment(max_cltv_delta=9, **kwargs))
+
+    def test_distance_map_reuse(self):
+        self.prepare_graph()
+        kwargs = dict(nodeA=node('a'), nodeB=node('e'), invoice_amount_msat=100000)
+        path = self.path_finder.find_path_for_payment(**kwargs)
+        self.assertEqual(0, self.path_finder.num_distance_map_reuses)
+        self.assertEqual(path, self.path_finder.find_path_for_payment(**kwargs))
+        self.assertEqual(1, self.path_finder.num_distance_map_reuses)
+        # changes to channels the search did not look at
+        self.cdb.add_channel_announcements({
+            'node_id_1': node('x'), 'node_id_2': node('y'),
+            'bitcoin_key_1': node('x'), 'bitcoin_key_2': node('y'),
+            'short_channel_id': channel(8),
+            'chain_hash': BitcoinTestnet.rev_genesis_bytes(),
+            'len': 0, 'features': b''
+        }, trusted=True)
+        self.path_finder.liquidity_hints.add_htlc(node('x'), node('y'), channel(8))
+        # edges starting at nodeA are evaluated for every query
+        self.path_finder.liquidity_hints.update_cannot_send(node('a'), node('b'), channel(3), 1000)
+        self.assertEqual(path, self.path_finder.find_path_for_payment(**kwargs))
+        self.assertEqual(2, self.path_finder.num_distance_map_reuses)
+        # a change in the explored part of the graph invalidates the search
+        self.path_finder.liquidity_hints.update_cannot_send(node('b'), node('e'), channel(2), 1000)
+        path = self.path_finder.find_path_for_payment(**kwargs)
+        self.assertEqual(2, self.path_finder.num_distance_map_reuses)
+        self.assertEqual([channel(6), channel(5)], [edge.short_channel_id for edge in path])
+        # a reused search gives the same results as a new one
+        rand = random.Random(1)
+        for i in range(20):
+            nodeA, nodeB = rand.sample([node(c) for c in 'abcde'], 2)
+            kwargs = dict(nodeA=nodeA, nodeB=nodeB, invoice_amount_msat=rand.choice([1000, 100000]))
+            path = self.path_finder.find_path_for_payment(**kwargs)
+            self.path_finder.clear_distance_maps()
+            self.assertEqual(path, self.path_finder.find_path_for_payment(**kwargs))
+
+    def _make_gossip_db(self):
+        class fake_network:
+            config = self.config
+            asyncio_loop = self.asyncio_loop
+            interface = None
+        cdb = lnrouter.ChannelDB(fake_network())
+        self._wait(cdb.load_data())
+        return cdb
+
+    def _wait(self, fut):
+        async def wait():
+            return await fut
+        return asyncio.run_coroutine_threadsafe(wait(), self.asyncio_loop).result()
+
+    def _stop_gossip_db(self, cdb):
+        cdb.stop()
+        asyncio.run_coroutine_threadsafe(cdb.stopped_event.wait(), self.asyncio_loop).result()
+
+    def _get_gossip_data(self, cdb):
+        return cdb._channels, cdb._policies, cdb._nodes, dict(cdb._addresses), cdb.num_channels
+
+    def test_channel_db_batched_writes(self):
+        with mock.patch.object(util.callback_mgr, 'asyncio_loop', self.asyncio_loop):
+            cdb = self._make_gossip_db()
+            for i in range(500):
+                cdb._db_save_policy(channel(i) + node('a'), b'msg')
+            cdb._db_delete_policy(node('a'), channel(7))
+            cdb._db_save_policy(channel(0) + node('a'), b'new msg')
+            # pending writes are executed at shutdown
+            self._stop_gossip_db(cdb)
+        conn = sqlite3.connect(cdb.path)
+        try:
+            self.assertEqual('wal', conn.execute("PRAGMA journal_mode").fetchone()[0])
+            rows = dict(conn.execute("SELECT key, msg FROM policy").fetchall())
+        finally:
+            conn.close()
+        self.assertEqual(499, len(rows))
+        self.assertNotIn(channel(7) + node('a'), rows)
+        self.assertEqual(b'new msg', rows[channel(0) + node('a')])
+
+    def test_channel_db_snapshot(self):
+        # load_data triggers callbacks from the SQL thread
+        with mock.patch.object(util.callback_mgr, 'asyncio_loop', self.asyncio_loop):
+            self._test_channel_db_snapshot()
+
+    def _test_channel_db_snapshot(self):
+        chain_hash = BitcoinTestnet.rev_genesis_bytes()
+        cdb = self._make_gossip_db()
+        for i, (n1, n2) in enumerate(['ab', 'bc', 'ac']):
+            raw = encode_msg('channel_announcement', short_channel_id=channel(i + 1),
+                             node_id_1=node(n1), node_id_2=node(n2), bitcoin_key_1=node(n1), bitcoin_key_2=node(n2),
+                             chain_hash=chain_hash, len=0, features=b'')
+            cdb.add_channel_announcements(dict(decode_msg(raw)[1], raw=raw), trusted=True)
+            for direction, optional_fields in ((0, {}), (1, {'htlc_maximum_msat': 10**9})):
+                raw = encode_msg('channel_update', short_channel_id=channel(i + 1), chain_hash=chain_hash,
+                                 timestamp=1600000000, message_flags=bytes([len(optional_fields)]),
+                                 channel_flags=bytes([direction]), cltv_expiry_delta=40 + i,
+                                 htlc_minimum_msat=1000, fee_base_msat=i, fee_proportional_millionths=10 * i,
+                                 **optional_fields)
+                cdb.add_channel_update(dict(decode_msg(raw)[1], raw=raw), verify=False)
+        raw = encode_msg('node_announcement', node_id=node('a'), features=b'\x02\x00', flen=2, timestamp=5,
+                         alias='ノード'.encode('utf8').ljust(32, b'\x00'), rgb_color=b'\x00' * 3,
+                         addrlen=7, addresses=b'\x01\x7f\x00\x00\x01\x26\x07')
+        cdb.add_node_announcements(dict(decode_msg(raw)[1], raw=raw))
+        expected = self._get_gossip_data(cdb)
+        self._stop_gossip_db(cdb)
+        self.assertTrue(os.path.exists(cdb.snapshot_path))
+        # loaded from the snapshot
+        cdb = self._make_gossip_db()
+        self.assertEqual(expected, self._get_gossip_data(cdb))
+        self.assertEqual('ノード', cdb._nodes[node('a')].alias)
+        self.assertEqual(10**9, cdb._policies[(node('c'), channel(2))].htlc_maximum_msat)
+        self.assertIsNone(cdb._policies[(node('b'), channel(2))].htlc_maximum_msat)
+        # a write after the snapshot makes it stale
+        self.config.set_key('lightning_gossip_snapshot_interval', 0)
+        cdb.add_recent_peer(LNPeerAddr('127.0.0.1', 9735, node('b')))
+        expected = self._get_gossip_data(cdb)
+        self._stop_gossip_db(cdb)
+        with mock.patch.object(lnrouter.ChannelDB, '_load_raw_msgs', autospec=True,
+                               side_effect=lnrouter.ChannelDB._load_raw_msgs) as load_raw_msgs:
+            cdb = self._make_gossip_db()
+            load_raw_msgs.assert_called_once()
+        self.assertEqual(expected, self._get_gossip_data(cdb))
+        self._stop_gossip_db(cdb)
+        # corrupted snapshots are rejected
+        with open(cdb.snapshot_path, 'rb') as f:
+            data = bytearray(f.read())
+        channel_db.GossipSnapshot.from_bytes(bytes(data))
+        data[-1] ^= 1
+        with self.assertRaises(ValueError):
+            channel_db.GossipSnapshot.from_bytes(bytes(data))
+
     def test_find_path_liquidity_hints(self):
         self.prepare_graph()
         amount_to_send = 100000
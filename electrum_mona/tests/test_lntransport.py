@@ -2,7 +2,7 @@ import asyncio
 
 from electrum_mona.ecc import ECPrivkey
 from electrum_mona.lnutil import LNPeerAddr
-from electrum_mona.lntransport import LNResponderTransport, LNTransport
+from electrum_mona.lntransport import LNResponderTransport, LNTransport, LNTransportBase
 
 from aiorpcx import TaskGroup
 
@@ -41,6 +41,49 @@ class TestLNTransport(ElectrumTestCase):
         transport = LNResponderTransport(ls_priv, Reader(), Writer())
         asyncio.get_event_loop().run_until_complete(transport.handshake(epriv=e_priv))
 
+    @needs_test_with_all_chacha20_implementations
+    def test_framing(self):
+        messages = [b'', b'short', bytes(range(256)) * 10, b'\x01' * 65535] + [b'gossip' * 23] * 100
+
+        class Writer:
+            def __init__(self):
+                self.writes = []
+            def write(self, data):
+                self.writes.append(bytes(data))
+        class Reader:
+            def __init__(self, data: bytes, chunk_size: int):
+                self.data = data
+                self.chunk_size = chunk_size
+            async def read(self, num_bytes):
+                s, self.data = self.data[:self.chunk_size], self.data[self.chunk_size:]
+                return s
+        def transport():
+            t = LNTransportBase()
+            t.sk = t.rk = bytes(range(32))
+            t.init_counters(bytes(32))
+            return t
+
+        async def f():
+            sender = transport()
+            sender.writer = Writer()
+            for msg in messages:
+                sender.send_bytes(msg)
+            # the big message is written right away, the others once the loop runs
+            self.assertEqual(1, len(sender.writer.writes))
+            await asyncio.sleep(0)
+            self.assertEqual(2, len(sender.writer.writes))
+            data = b''.join(sender.writer.writes)
+            for chunk_size in (7, 1000, len(data)):
+                receiver = transport()
+                receiver.reader = Reader(data, chunk_size)
+                received = []
+                async for msg in receiver.read_messages():
+                    received.append(msg)
+                    if len(received) == len(messages):
+                        break
+                self.assertEqual(messages, received)
+        asyncio.get_event_loop().run_until_complete(f())
+
     @needs_test_with_all_chacha20_implementations
     def test_loop(self):
         loop = asyncio.get_event_loop()
@@ -0,0 +1,134 @@
+import asyncio
+from unittest import mock
+
+import aiorpcx
+
+from electrum_mona import bitcoin
+from electrum_mona.ecc import ECPrivkey
+from electrum_mona.lnutil import ShortChannelID, funding_output_script_from_keys
+from electrum_mona.lnverifier import LNChannelVerifier
+from electrum_mona.transaction import Transaction, TxInput, TxOutput, TxOutpoint
+from electrum_mona.util import create_and_start_event_loop
+from electrum_mona.verifier import SPV
+
+from . import ElectrumTestCase
+
+
+BLOCK_HEIGHT = 600000
+
+
+def make_tx(*addresses: str) -> Transaction:
+    tx = Transaction(None)
+    tx._inputs = [TxInput(prevout=TxOutpoint(bytes(32), len(addresses)), script_sig=b'')]
+    tx._outputs = [TxOutput.from_address_and_value(address, 100000) for address in addresses]
+    tx._version = 2
+    tx._locktime = 0
+    return Transaction(tx.serialize_to_network())
+
+
+def make_chan_ann(i: int) -> dict:
+    return {
+        'bitcoin_key_1': ECPrivkey(bytes([2 * i + 1]) * 32).get_public_key_bytes(),
+        'bitcoin_key_2': ECPrivkey(bytes([2 * i + 2]) * 32).get_public_key_bytes(),
+    }
+
+
+def funding_address(chan_ann: dict) -> str:
+    redeem_script = funding_output_script_from_keys(chan_ann['bitcoin_key_1'], chan_ann['bitcoin_key_2'])
+    return bitcoin.redeem_script_to_address('p2wsh', redeem_script)
+
+
+class MockBlockchain:
+
+    def __init__(self, header):
+        self.header = header
+
+    def height(self):
+        return BLOCK_HEIGHT
+
+    def read_header(self, height):
+        return self.header if height == BLOCK_HEIGHT else None
+
+
+class MockNetwork:
+
+    def __init__(self, asyncio_loop, txs):
+        self.asyncio_loop = asyncio_loop
+        self.interface = None
+        self.bhi_lock = asyncio.Lock()
+        self.txs = txs
+        self.txids = [tx.txid() for tx in txs]
+        merkle_root = SPV.hash_merkle_root(self.txids[1:], self.txids[0], 0)
+        self._blockchain = MockBlockchain({'block_height': BLOCK_HEIGHT, 'merkle_root': merkle_root})
+        self.requests = []
+
+    def blockchain(self):
+        return self._blockchain
+
+    async def get_txid_from_txpos(self, tx_height, tx_pos, merkle):
+        self.requests.append(('id_from_pos', tx_pos))
+        if tx_pos >= len(self.txs):
+            raise aiorpcx.jsonrpc.RPCError(1, 'No tx at position')
+        return {'tx_hash': self.txids[tx_pos], 'merkle': self.txids[1 - tx_pos:2 - tx_pos]}
+
+    async def get_transaction(self, tx_hash):
+        self.requests.append(('get_transaction', tx_hash))
+        return self.txs[self.txids.index(tx_hash)].serialize_to_network()
+
+
+class TestLNChannelVerifier(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+
+    def tearDown(self):
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+        super().tearDown()
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.asyncio_loop).result(timeout=10)
+
+    def test_verify_channels_by_block(self):
+        chan_anns = [make_chan_ann(i) for i in range(4)]
+        # tx 0 funds channels 0 and 1, tx 1 does not fund channel 2,
+        # and there is no tx 2 for channel 3
+        txs = [
+            make_tx(funding_address(chan_anns[0]), funding_address(chan_anns[1])),
+            make_tx(funding_address(chan_anns[0])),
+        ]
+        scids = [
+            ShortChannelID.from_components(BLOCK_HEIGHT, 0, 0),
+            ShortChannelID.from_components(BLOCK_HEIGHT, 0, 1),
+            ShortChannelID.from_components(BLOCK_HEIGHT, 1, 0),
+            ShortChannelID.from_components(BLOCK_HEIGHT, 2, 0),
+        ]
+        network = MockNetwork(self.asyncio_loop, txs)
+        channel_db = mock.Mock()
+        verifier = LNChannelVerifier(network, channel_db)
+        for scid, chan_ann in zip(scids, chan_anns):
+            self.assertTrue(verifier.add_new_channel_info(scid, chan_ann))
+
+        async def verify():
+            await verifier._verify_some_channels()
+            await verifier.taskgroup.join()
+            await verifier.stop()
+        self._run(verify())
+
+        # one request per tx, not per channel
+        self.assertEqual(
+            sorted([('id_from_pos', 0), ('id_from_pos', 1), ('id_from_pos', 2),
+                    ('get_transaction', network.txids[0]), ('get_transaction', network.txids[1])]),
+            sorted(network.requests))
+        self.assertEqual(
+            [mock.call(chan_anns[0], capacity_sat=100000), mock.call(chan_anns[1], capacity_sat=100000)],
+            channel_db.add_verified_channel_info.call_args_list)
+        self.assertEqual({scids[3]}, verifier.blacklist)
+        stats = verifier.get_stats()
+        self.assertEqual(2, stats['verified'])
+        self.assertEqual(2, stats['rejected'])
+        self.assertEqual(1, stats['blocks'])
+        self.assertEqual(3, stats['txs'])
+        self.assertEqual(0, stats['unverified'])
+        self.assertEqual(0, stats['in_progress'])
@@ -1,11 +1,17 @@
 import asyncio
+import json
 import tempfile
 import unittest
 
+from aiorpcx import RPCError
+
 from electrum_mona import constants
 from electrum_mona.simple_config import SimpleConfig
 from electrum_mona import blockchain
-from electrum_mona.interface import Interface, ServerAddr
+from electrum_mona.interface import (Interface, ServerAddr, RequestCorrupted, RequestTimedOut, NotificationSession,
+                                     _RSClient)
+from electrum_mona.synchronizer import get_pending_items
+from electrum_mona.transaction import Transaction
 from electrum_mona.crypto import sha256
 from electrum_mona.util import bh2u
 
@@ -38,6 +44,15 @@ class MockInterface(Interface):
         assert assert_mode in item['mock'], (assert_mode, item)
         return item
 
+class MockBatchSession:
+    def __init__(self, results):
+        self.results = results
+        self.batches = []
+        self.max_batch_size = None
+    async def send_batch_requests(self, requests, *, timeout=None):
+        self.batches.append(requests)
+        return self.results
+
 class TestNetwork(ElectrumTestCase):
 
     @classmethod
@@ -116,6 +131,110 @@ class TestNetwork(ElectrumTestCase):
         self.assertEqual(('catchup', 7), asyncio.get_event_loop().run_until_complete(ifa.sync_until(8, next_height=6)))
         self.assertEqual(self.interface.q.qsize(), 0)
 
+    def test_get_transactions_batched(self):
+        raw_tx = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+        txid = Transaction(raw_tx).txid()
+        other_txid = 'ab' * 32
+        error = RPCError(2, 'No such mempool or blockchain transaction')
+        self.interface.session = MockBatchSession([raw_tx, error])
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(self.interface.get_transactions([txid, other_txid]))
+        self.assertEqual([raw_tx, error], results)
+        self.assertEqual([[('blockchain.transaction.get', [txid]), ('blockchain.transaction.get', [other_txid])]],
+                         self.interface.session.batches)
+        # responses are still validated one by one
+        self.interface.session = MockBatchSession([raw_tx, raw_tx])
+        with self.assertRaises(RequestCorrupted):
+            loop.run_until_complete(self.interface.get_transactions([txid, other_txid]))
+
+    def test_get_history_for_scripthashes_batched(self):
+        sh1, sh2 = '11' * 32, '22' * 32
+        hist1 = [{'tx_hash': 'aa' * 32, 'height': 5}, {'tx_hash': 'bb' * 32, 'height': 0, 'fee': 200}]
+        self.interface.session = MockBatchSession([hist1, []])
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(self.interface.get_history_for_scripthashes([sh1, sh2]))
+        self.assertEqual([hist1, []], results)
+        self.interface.session = MockBatchSession([[], hist1 + hist1[:1]])  # duplicate txid
+        with self.assertRaises(RequestCorrupted):
+            loop.run_until_complete(self.interface.get_history_for_scripthashes([sh1, sh2]))
+
+    def test_request_batch_size(self):
+        self.assertEqual(50, self.interface.get_request_batch_size())
+        self.config.set_key('network_request_batch_size', 3)
+        self.assertEqual(3, self.interface.get_request_batch_size())
+        self.config.set_key('network_request_batch_size', 0)
+        self.assertEqual(1, self.interface.get_request_batch_size())
+
+    def test_batch_split_when_response_too_large(self):
+        batch_sizes = []
+
+        async def handle_client(reader, writer):
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                requests = request if isinstance(request, list) else [request]
+                batch_sizes.append(len(requests))
+                responses = [{'jsonrpc': '2.0', 'id': r['id'], 'result': r['params'][0] * r['params'][1]}
+                             for r in requests]
+                response = responses if isinstance(request, list) else responses[0]
+                # the newline arrives separately, as it would after a large
+                # response is split across reads
+                writer.write(json.dumps(response).encode())
+                await writer.drain()
+                await asyncio.sleep(0.01)
+                writer.write(b'\n')
+                await writer.drain()
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(handle_client, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            session_factory = lambda *args, **kwargs: NotificationSession(*args, **kwargs, interface=self.interface)
+            try:
+                async with _RSClient(session_factory=session_factory, host='127.0.0.1', port=port) as session:
+                    self.interface.session = session
+                    # each result is about 2kB, the response to at most 4 of them fits
+                    requests = [('blockchain.transaction.get', [str(i % 10), 2000]) for i in range(20)]
+                    results = await session.send_batch_requests(requests, timeout=10)
+                    self.assertEqual([str(i % 10) * 2000 for i in range(20)], results)
+                    self.assertIn(20, batch_sizes)
+                    # each request was answered exactly once, in a batch that fit
+                    self.assertEqual(20, sum(n for n in batch_sizes if n <= 4))
+                    self.assertLess(self.interface.get_request_batch_size(), 20)
+                    # smaller responses go in larger batches again
+                    small_requests = [('blockchain.transaction.get', [str(i % 10), 10]) for i in range(20)]
+                    for _ in range(5):
+                        results = await session.send_batch_requests(small_requests, timeout=10)
+                        self.assertEqual([str(i % 10) * 10 for i in range(20)], results)
+                        if batch_sizes[-1] == 20:
+                            break
+                    self.assertEqual(20, batch_sizes[-1])
+                    # a too large response to a single request does not affect the batch in flight
+                    del batch_sizes[:]
+                    single = session.send_request('blockchain.transaction.get', ['x', 20_000], timeout=1)
+                    batch = session.send_batch_requests(requests[:4], timeout=10)
+                    single_result, batch_results = await asyncio.gather(single, batch, return_exceptions=True)
+                    self.assertIsInstance(single_result, RequestTimedOut)
+                    self.assertEqual([str(i % 10) * 2000 for i in range(4)], batch_results)
+                    self.assertEqual([1, 4], batch_sizes)
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        self.interface.network.debug = False
+        self.config.set_key('network_max_incoming_msg_size', 10_000)
+        asyncio.get_event_loop().run_until_complete(run())
+
+    def test_get_pending_items(self):
+        queue = asyncio.Queue()
+        for i in range(1, 6):
+            queue.put_nowait(i)
+        self.assertEqual([0, 1, 2], get_pending_items(queue, 0, 3))
+        self.assertEqual([0, 3, 4, 5], get_pending_items(queue, 0, 10))
+        self.assertEqual([0], get_pending_items(queue, 0, 10))
+
 
 if __name__=="__main__":
     constants.set_regtest()
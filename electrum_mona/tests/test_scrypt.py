@@ -1,6 +1,7 @@
 import unittest
 import threading
 
+from electrum_mona import scrypt, powhash
 from electrum_mona.scrypt import scrypt_1024_1_1_80 as scryptGetHash
 from electrum_mona.util import bfh,bh2u
 from electrum_mona.bitcoin import rev_hex,int_to_hex
@@ -15,3 +16,44 @@ class Test_scrypt(unittest.TestCase):
         powhash = rev_hex(bh2u(scryptGetHash(bfh(serialize_header(header)))))
         self.assertEqual(powhash, '00000000335c88172421df73a1c1f22f4d7c23d8ef34c78d728c4eff3ba24a34')
 
+
+    def _header_bytes(self):
+        header = {'block_height': 12095, 'nonce': 1612451328, 'timestamp': 1389110198, 'version': 2, 'prev_block_hash': 'f73b996a839a34115a22dd1de33098d295cb65643646be14c26db6e021fef111', 'merkle_root': 'e2ee62e8cb194b5aebeb99e4a229e05eb632d104f2bf7997033d59e5b336dbb5', 'bits': 476866422}
+        return bfh(serialize_header(header))
+
+    @unittest.skipUnless(scrypt.HAS_HASHLIB_SCRYPT, "hashlib.scrypt not available")
+    def test_scrypt_hashlib(self):
+        powhash = rev_hex(bh2u(scrypt.scrypt_1024_1_1_80_hashlib(self._header_bytes())))
+        self.assertEqual(powhash, '00000000335c88172421df73a1c1f22f4d7c23d8ef34c78d728c4eff3ba24a34')
+
+    @unittest.skipUnless(scrypt.HAS_NUMPY, "numpy not available")
+    def test_scrypt_numpy(self):
+        headers = [self._header_bytes(), bytes(80)]
+        powhashes = scrypt.scrypt_1024_1_1_80_many_numpy(headers)
+        self.assertEqual(rev_hex(bh2u(powhashes[0])), '00000000335c88172421df73a1c1f22f4d7c23d8ef34c78d728c4eff3ba24a34')
+        self.assertEqual(bh2u(powhashes[1]), '161d0876f3b93b1048cda1bdeaa7332ee210f7131b42013cb43913a6553a4b69')
+
+
+class Test_powhash(unittest.TestCase):
+
+    def test_algo_for_height(self):
+        self.assertEqual(powhash.POW_ALGO_SCRYPT, powhash.get_pow_algo_for_height(449999))
+        self.assertEqual(powhash.POW_ALGO_LYRA2REV2, powhash.get_pow_algo_for_height(450000))
+
+    def test_get_pow_engine(self):
+        engine = powhash.get_pow_engine(powhash.POW_ALGO_SCRYPT, name='scrypt-python')
+        self.assertIsInstance(engine, powhash.ScryptPythonEngine)
+        if scrypt.HAS_HASHLIB_SCRYPT:
+            engine = powhash.get_pow_engine(powhash.POW_ALGO_SCRYPT)
+            self.assertIsInstance(engine, powhash.ScryptHashlibEngine)
+        # vectorized engines are not picked for single headers
+        with self.assertRaises(Exception):
+            powhash.get_pow_engine(powhash.POW_ALGO_SCRYPT, name='scrypt-numpy', batch_size=1)
+
+    def test_all_engines_agree(self):
+        header = bytes(80)
+        expected = bfh('161d0876f3b93b1048cda1bdeaa7332ee210f7131b42013cb43913a6553a4b69')
+        for engine in powhash.get_available_pow_engines(powhash.POW_ALGO_SCRYPT):
+            if engine.min_batch_size > 1:
+                continue  # slow for a single header; covered by test_scrypt_numpy
+            self.assertEqual(expected, engine.hash(header), msg=engine.name)
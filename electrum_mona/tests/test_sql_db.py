@@ -0,0 +1,111 @@
+import asyncio
+import os
+import threading
+from unittest import mock
+
+from electrum_mona.sql_db import SqlDB, SqlRequest, SqlStats, sql, sql_read
+from electrum_mona.util import create_and_start_event_loop
+
+from . import ElectrumTestCase
+
+
+class KeyValueDB(SqlDB):
+
+    def create_database(self):
+        c = self.conn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS kv (k TEXT PRIMARY KEY, v TEXT)")
+        self.conn.commit()
+
+    @sql
+    def put(self, k, v):
+        c = self.conn.cursor()
+        c.execute("REPLACE INTO kv (k, v) VALUES (?,?)", (k, v))
+
+    @sql
+    def wait_for(self, event: threading.Event):
+        event.wait()
+
+    @sql_read
+    def get(self, k):
+        c = self.conn.cursor()
+        c.execute("SELECT v FROM kv WHERE k=?", (k,))
+        r = c.fetchone()
+        return r[0] if r else None
+
+
+class TestSqlDB(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+
+    def tearDown(self):
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+        super().tearDown()
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.asyncio_loop).result(timeout=10)
+
+    def _wait(self, fut):
+        async def wait():
+            return await fut
+        return self._run(wait())
+
+    def _stop(self, db: SqlDB):
+        db.stop()
+        self._run(db.stopped_event.wait())
+
+    def test_batched_requests(self):
+        calls = []
+        def save(db, rows):
+            calls.append(('save', rows))
+        def delete(db, key):
+            calls.append(('delete', key))
+        requests = [SqlRequest(i, save, (i,), {}, True, 0) for i in range(3)]
+        requests += [SqlRequest(3, delete, (3,), {}, False, 0)]
+        requests += [SqlRequest(i, save, (i,), {}, True, 0) for i in range(4, 6)]
+        db = mock.Mock(stats=SqlStats())
+        results = SqlDB._run_requests(db, requests)
+        # consecutive calls are executed together, in order
+        self.assertEqual([('save', [(0,), (1,), (2,)]), ('delete', 3), ('save', [(4,), (5,)])], calls)
+        self.assertEqual(list(range(6)), [future for future, result, exception in results])
+        stats = db.stats.get_stats()
+        self.assertEqual(5, stats['save']['count'])
+        self.assertEqual(1, stats['delete']['count'])
+
+    def test_reads_are_concurrent_with_writes(self):
+        db = KeyValueDB(self.asyncio_loop, os.path.join(self.electrum_path, 'kv_db'), num_readers=2)
+        event = threading.Event()
+        try:
+            self._wait(db.put('a', '1'))
+            # block the writer
+            db.wait_for(event)
+            put_b = db.put('b', '2')
+            self.assertEqual('1', self._wait(db.get('a')))
+            self.assertEqual(None, self._wait(db.get('b')))
+            self.assertFalse(put_b.done())
+            event.set()
+            self._wait(put_b)
+            # writes are committed before their futures are set
+            self.assertEqual('2', self._wait(db.get('b')))
+            stats = db.get_stats()
+            self.assertEqual(2, stats['num_readers'])
+            self.assertEqual(3, stats['methods']['get']['count'])
+            self.assertEqual(2, stats['methods']['put']['count'])
+            self.assertGreater(stats['methods']['put']['max_wait_ms'], 0)
+        finally:
+            event.set()
+            self._stop(db)
+        for t in db.sql_threads:
+            t.join(timeout=1)
+            self.assertFalse(t.is_alive())
+
+    def test_reads_without_readers(self):
+        db = KeyValueDB(self.asyncio_loop, os.path.join(self.electrum_path, 'kv_db'))
+        try:
+            db.put('a', '1')
+            self.assertEqual('1', self._wait(db.get('a')))
+            self.assertEqual(0, db.db_read_requests.qsize())
+        finally:
+            self._stop(db)
@@ -6,6 +6,7 @@ from typing import Optional
 import asyncio
 
 import electrum_mona
+from electrum_mona.json_db import format_journal_record
 from electrum_mona.wallet_db import WalletDB
 from electrum_mona.wallet import Wallet
 from electrum_mona import constants
@@ -47,6 +48,15 @@ class TestStorageUpgrade(WalletTestCase):
         wallet_str = '{"addr_history": {"MJNDhNyzYPbcFE5uZAg2j6YyUQVdLDhuP3": []}, "addresses": {"change": [], "receiving": ["MJNDhNyzYPbcFE5uZAg2j6YyUQVdLDhuP3"]}, "keystore": {"keypairs": {"03c2725dae5de0cbf0101cf57a3aadfb301bc3b432fa8ea38515198e41df12199f": "TPxZYPTaBiwFVo5kVmBYuJctGVDMRaCLNEEu8nsxLednda1zmVGS"}, "type": "imported"}, "pruned_txo": {}, "seed_version": 13, "stored_height": 1244824, "transactions": {}, "tx_fees": {}, "txi": {}, "txo": {}, "use_encryption": false, "verified_tx3": {}, "wallet_type": "standard", "winpos-qt": [314, 230, 840, 400]}'
         self._upgrade_storage(wallet_str)
 
+    def test_upgrade_from_client_2_9_3_importedkeys_with_journal(self):
+        wallet_str = '{"addr_history": {"MJNDhNyzYPbcFE5uZAg2j6YyUQVdLDhuP3": []}, "addresses": {"change": [], "receiving": ["MJNDhNyzYPbcFE5uZAg2j6YyUQVdLDhuP3"]}, "keystore": {"keypairs": {"03c2725dae5de0cbf0101cf57a3aadfb301bc3b432fa8ea38515198e41df12199f": "TPxZYPTaBiwFVo5kVmBYuJctGVDMRaCLNEEu8nsxLednda1zmVGS"}, "type": "imported"}, "pruned_txo": {}, "seed_version": 13, "stored_height": 1244824, "transactions": {}, "tx_fees": {}, "txi": {}, "txo": {}, "use_encryption": false, "verified_tx3": {}, "wallet_type": "standard", "winpos-qt": [314, 230, 840, 400]}'
+        # the journal is replayed before upgrading
+        wallet_str += format_journal_record(['{"op": "set", "path": ["labels"], "value": {"MJNDhNyzYPbcFE5uZAg2j6YyUQVdLDhuP3": "hello"}}'])
+        wallet_str += format_journal_record(['{"op": "del", "path": ["winpos-qt"]}'])
+        db = self._upgrade_storage(wallet_str)
+        self.assertEqual({"MJNDhNyzYPbcFE5uZAg2j6YyUQVdLDhuP3": "hello"}, db.get('labels'))
+        self.assertIsNone(db.get('winpos-qt'))
+
     def test_upgrade_from_client_2_9_3_watchaddresses(self):
         wallet_str = '{"addr_history": {"MFMy9FwJsV6HiN5eZDqDETw4pw52q3UGrb": []}, "addresses": ["MFMy9FwJsV6HiN5eZDqDETw4pw52q3UGrb"], "pruned_txo": {}, "seed_version": 13, "stored_height": 1244820, "transactions": {}, "tx_fees": {}, "txi": {}, "txo": {}, "verified_tx3": {}, "wallet_type": "imported", "winpos-qt": [100, 100, 840, 400]}'
         self._upgrade_storage(wallet_str)
@@ -8,6 +8,7 @@ from electrum_mona.util import bh2u, bfh
 from electrum_mona.bitcoin import (deserialize_privkey, opcodes,
                               construct_script, construct_witness)
 from electrum_mona.ecc import ECPrivkey
+from electrum_mona.crypto import sha256d
 
 from . import ElectrumTestCase, TestCaseForTestnet
 
@@ -354,6 +355,64 @@ class TestTransaction(ElectrumTestCase):
         txid = '51087ece75c697cc872d2e643d646b0f3e1f2666fa1820b7bff4343d50dd680e'
         self._run_naive_tests_on_tx(raw_tx, txid)
 
+    def test_parse_network_tx(self):
+        raw_tx = bfh('010000000001010d350cefa29138de18a2d63a93cffda63721b07a6ecfa80a902f9514104b55ca0000000000fdffffff012a4a824a00000000160014b869999d342a5d42d6dc7af1efc28456da40297a024730440220475bb55814a52ea1036919e4408218c693b8bf93637b9f54c821b5baa3b846e102207276ed7a79493142c11fb01808a4142bbdd525ae7bdccdf8ecb7b8e3c856b4d90121024cdeaca7a53a7e23a1edbe9260794eaa83063534b5f111ee3c67d8b0cb88f0eec8010000')
+        parsed = transaction.parse_network_tx(raw_tx)
+        self.assertEqual('51087ece75c697cc872d2e643d646b0f3e1f2666fa1820b7bff4343d50dd680e', parsed.txid)
+        self.assertEqual(bh2u(sha256d(raw_tx)[::-1]), parsed.wtxid)
+        self.assertEqual(raw_tx[-4-107:-4], parsed.inputs[0].witness)
+        # the cached ids are dropped when the tx changes
+        tx = Transaction(raw_tx)
+        self.assertEqual(parsed.wtxid, tx.wtxid())
+        tx.locktime = 0
+        self.assertNotEqual(parsed.txid, tx.txid())
+        self.assertNotEqual(parsed.wtxid, tx.wtxid())
+        # 5: no marker after the empty input count
+        for i in (0, 3, 5, 6, 50, len(raw_tx) - 1):
+            with self.assertRaises(transaction.SerializationError):
+                transaction.parse_network_tx(raw_tx[:i])
+        with self.assertRaises(transaction.SerializationError):
+            transaction.parse_network_tx(raw_tx + b'\x00')
+
+    def test_sign_many_inputs(self):
+        script_types = ['p2pkh', 'p2wpkh', 'p2wpkh-p2sh']
+        keypairs = {}
+        def make_tx():
+            inputs = []
+            for i in range(2 * transaction.SIGN_IN_PARALLEL_MIN_SIGS):
+                privkey = ECPrivkey(bytes([i + 1]) * 32)
+                pubkey = privkey.get_public_key_bytes(compressed=True)
+                keypairs[pubkey.hex()] = (privkey.get_secret_bytes(), True)
+                txin = PartialTxInput(prevout=TxOutpoint(bytes([i]) * 32, i), nsequence=0xfffffffd)
+                txin.script_type = script_types[i % 3]
+                txin.pubkeys = [pubkey]
+                txin.num_sig = 1
+                txin._trusted_value_sats = 100000 + i
+                inputs.append(txin)
+            outputs = [PartialTxOutput(scriptpubkey=bfh('0014') + bytes([i]) * 20, value=50000) for i in range(2)]
+            return PartialTransaction.from_io(inputs, outputs, locktime=600000, version=2)
+        tx = make_tx()
+        # legacy preimages serialize the whole tx, with all other scripts empty
+        unsigned_txins = ''.join(tx.serialize_input(txin, '') for txin in tx.inputs())
+        sighash_cache = transaction.SighashCache(tx)
+        for i, txin in enumerate(tx.inputs()):
+            preimage = tx.serialize_preimage(i, sighash_cache=sighash_cache)
+            self.assertEqual(tx.serialize_preimage(i), preimage)
+            if not txin.is_segwit():
+                script = tx.get_preimage_script(txin)
+                txins = ''.join(tx.serialize_input(x, script if k == i else '') for k, x in enumerate(tx.inputs()))
+                self.assertEqual(tx.serialize_to_network(include_sigs=False).replace(unsigned_txins, txins) + '01000000',
+                                 preimage)
+        # signing all inputs at once gives the same tx as signing them one by one
+        tx_one_by_one = make_tx()
+        for i, txin in enumerate(tx_one_by_one.inputs()):
+            pubkey = txin.pubkeys[0].hex()
+            sig = tx_one_by_one.sign_txin(i, keypairs[pubkey][0])
+            tx_one_by_one.add_signature_to_txin(txin_idx=i, signing_pubkey=pubkey, sig=sig)
+        tx.sign(keypairs)
+        self.assertTrue(tx.is_complete())
+        self.assertEqual(tx_one_by_one.serialize(), tx.serialize())
+
     def test_txid_input_p2wsh_p2sh_not_multisig(self):
         raw_tx = '0100000000010160f84fdcda039c3ca1b20038adea2d49a53db92f7c467e8def13734232bb610804000000232200202814720f16329ab81cb8867c4d447bd13255931f23e6655944c9ada1797fcf88ffffffff0ba3dcfc04000000001976a91488124a57c548c9e7b1dd687455af803bd5765dea88acc9f44900000000001976a914da55045a0ccd40a56ce861946d13eb861eb5f2d788ac49825e000000000017a914ca34d4b190e36479aa6e0023cfe0a8537c6aa8dd87680c0d00000000001976a914651102524c424b2e7c44787c4f21e4c54dffafc088acf02fa9000000000017a914ee6c596e6f7066466d778d4f9ba633a564a6e95d874d250900000000001976a9146ca7976b48c04fd23867748382ee8401b1d27c2988acf5119600000000001976a914cf47d5dcdba02fd547c600697097252d38c3214a88ace08a12000000000017a914017bef79d92d5ec08c051786bad317e5dd3befcf87e3d76201000000001976a9148ec1b88b66d142bcbdb42797a0fd402c23e0eec288ac718f6900000000001976a914e66344472a224ce6f843f2989accf435ae6a808988ac65e51300000000001976a914cad6717c13a2079066f876933834210ebbe68c3f88ac0347304402201a4907c4706104320313e182ecbb1b265b2d023a79586671386de86bb47461590220472c3db9fc99a728ebb9b555a72e3481d20b181bd059a9c1acadfb853d90c96c01210338a46f2a54112fef8803c8478bc17e5f8fc6a5ec276903a946c1fafb2e3a8b181976a914eda8660085bf607b82bd18560ca8f3a9ec49178588ac00000000'
         txid = 'e9933221a150f78f9f224899f8568ff6422ffcc28ca3d53d87936368ff7c4b1d'
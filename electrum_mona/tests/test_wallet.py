@@ -16,8 +16,10 @@ from electrum_mona.exchange_rate import ExchangeBase, FxThread
 from electrum_mona.util import TxMinedInfo, InvalidPassword
 from electrum_mona.bitcoin import COIN
 from electrum_mona.wallet_db import WalletDB
+from electrum_mona.json_db import parse_journal, load_journaled
 from electrum_mona.simple_config import SimpleConfig
-from electrum_mona import util
+from electrum_mona import util, keystore
+from unittest import mock
 
 from . import ElectrumTestCase
 
@@ -85,6 +87,137 @@ class TestWalletStorage(WalletTestCase):
         for key, value in some_dict.items():
             self.assertEqual(d[key], value)
 
+    def test_journal_appended_and_replayed(self):
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', manual_upgrades=False)
+        db.put('a', 'b')
+        db.write(storage)
+        size = os.path.getsize(self.wallet_path)
+
+        labels = db.get_dict('labels')
+        labels['x'] = 'first'
+        labels['x'] = 'second'
+        labels['y'] = 'z'
+        db.put('a', None)
+        db.write(storage)
+        # only the changes were appended
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        self.assertEqual(json.loads(contents[:size])['a'], 'b')
+        # as a single record
+        self.assertEqual(1, contents.count('\n{', size))
+        self.assertEqual(2, contents.count('"op": ', size))
+        self.assertEqual(json.loads(db.dump()), load_journaled(contents))
+        self.assertFalse(db.modified())
+
+        db2 = WalletDB(WalletStorage(self.wallet_path).read(), manual_upgrades=False)
+        self.assertEqual({'x': 'second', 'y': 'z'}, db2.get('labels'))
+        self.assertIsNone(db2.get('a'))
+        self.assertEqual(db.dump(), db2.dump())
+
+    def test_journal_ignores_truncated_record(self):
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', manual_upgrades=False)
+        db.get_dict('labels')['x'] = 'y'
+        db.write(storage)
+        db.get_dict('labels')['x'] = 'z'
+        db.write(storage)
+        size = os.path.getsize(self.wallet_path)
+        # a write that changed several paths, and was interrupted
+        db.get_dict('labels')['x'] = 'w'
+        db.get_dict('frozen_coins')['a:0'] = True
+        db.write(storage)
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        # cut after the first entry of the record, and just before its closing brace
+        for cut in (contents.index('["labels", "x"]', size), len(contents) - 1):
+            with open(self.wallet_path, "w") as f:
+                f.write(contents[:cut])
+            db2 = WalletDB(WalletStorage(self.wallet_path).read(), manual_upgrades=False)
+            # none of the entries of that write were applied
+            self.assertEqual({'x': 'z'}, db2.get('labels'))
+            self.assertEqual({}, db2.get('frozen_coins', {}))
+        # a record whose contents do not match its checksum is dropped too
+        with open(self.wallet_path, "w") as f:
+            f.write(contents.replace('"w"', '"v"'))
+        db2 = WalletDB(WalletStorage(self.wallet_path).read(), manual_upgrades=False)
+        self.assertEqual({'x': 'z'}, db2.get('labels'))
+
+    def test_journal_root_modified(self):
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', manual_upgrades=False)
+        db.get_dict('labels')['x'] = 'y'
+        db.write(storage)
+        db.get_dict('labels')['x'] = 'z'
+        seed_version = db.get('seed_version')
+        db.data.clear()
+        db.put('seed_version', seed_version)
+        db.put('a', 'b')
+        db.write(storage)
+        # the file was rewritten in full
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual([], parse_journal(f.read())[1])
+        db2 = WalletDB(WalletStorage(self.wallet_path).read(), manual_upgrades=False)
+        self.assertEqual(WalletDB(db.dump(), manual_upgrades=False).dump(), db2.dump())
+        self.assertEqual('b', db2.get('a'))
+        self.assertEqual({}, db2.get('labels', {}))
+
+    def test_journal_put_value_mutated_in_place(self):
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', manual_upgrades=False)
+        db.put('winpos-qt', [1, 2])
+        db.write(storage)
+        winpos = db.get('winpos-qt')
+        winpos.append(3)
+        db.put('winpos-qt', winpos)
+        self.assertTrue(db.modified())
+        db.write(storage)
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(1, len(parse_journal(f.read())[1]))
+        db2 = WalletDB(WalletStorage(self.wallet_path).read(), manual_upgrades=False)
+        self.assertEqual([1, 2, 3], db2.get('winpos-qt'))
+
+    def test_journal_consolidated(self):
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', manual_upgrades=False)
+        db.write(storage)
+        db.get_dict('labels')['x'] = 'y'
+        db.write(storage)
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(1, len(parse_journal(f.read())[1]))
+        # on close, the journal is merged into the json document
+        db.write(storage, consolidate=True)
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual({'x': 'y'}, json.loads(f.read())['labels'])
+        # a journal left behind by a session that did not close the file is
+        # merged on the first write after loading it
+        db.get_dict('labels')['x'] = 'z'
+        db.write(storage)
+        storage2 = WalletStorage(self.wallet_path)
+        db2 = WalletDB(storage2.read(), manual_upgrades=False)
+        self.assertTrue(db2.modified())
+        db2.write(storage2)
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual({'x': 'z'}, json.loads(f.read())['labels'])
+        self.assertEqual(FINAL_SEED_VERSION, db2.get('seed_version'))
+
+    def test_journal_compacted(self):
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', manual_upgrades=False)
+        db.write(storage)
+        labels = db.get_dict('labels')
+        for i in range(200):
+            labels[str(i)] = 'x' * 20
+            db.write(storage)
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        # the file was rewritten as a single json document at some point,
+        # and has not grown back past twice its size since
+        self.assertLess(contents.count('\n{'), 200)
+        self.assertLess(len(contents), 3 * len(json.dumps(json.loads(db.dump()))))
+        db2 = WalletDB(WalletStorage(self.wallet_path).read(), manual_upgrades=False)
+        self.assertEqual(db.dump(), db2.dump())
+
 class FakeExchange(ExchangeBase):
     def __init__(self, rate):
         super().__init__(lambda self: None, lambda self: None)
@@ -105,7 +238,8 @@ class FakeWallet:
         super().__init__()
         self.fiat_value = fiat_value
         self.db = WalletDB("{}", manual_upgrades=True)
-        self.db.transactions = self.db.verified_tx = {'abc':'Tx'}
+        # note: transactions are stored as raw hex
+        self.db.transactions = self.db.verified_tx = {'abc': '02000000000000000000'}
 
     def get_tx_height(self, txid):
         # because we use a current timestamp, and history is empty,
@@ -237,6 +371,100 @@ class TestCreateRestoreWallet(WalletTestCase):
         self.assertEqual(1, len(wallet.get_receiving_addresses()))
 
 
+class TestPubkeyCache(WalletTestCase):
+
+    xpub = 'zpub6nsHdRuY92FsMKdbn9BfjBCG6X8pyhCibNP6uDvpnw2cyrVhecvHRMa3Ne8kdJZxjxgwnpbHLkcR4bfnhHy6auHPJyDTQ3kianeuVLdkCYQ'
+
+    def _load_wallet(self):
+        db = WalletDB(WalletStorage(self.wallet_path).read(), manual_upgrades=False)
+        return Wallet(db, WalletStorage(self.wallet_path), config=self.config)
+
+    def test_derive_pubkeys_range(self):
+        ks = keystore.from_master_key(self.xpub)
+        expected = [ks._derive_pubkeys_range(0, n, 1)[0] for n in range(20)]
+        with mock.patch.object(keystore, 'PUBKEY_CACHE_SIZE', 10), \
+                mock.patch.object(keystore, 'DERIVE_CHUNK_SIZE', 3):
+            self.assertEqual(expected[5:15], ks.derive_pubkeys_range(0, 5, 10))
+            # only ranges starting at the end of the cache are added to it
+            self.assertEqual([], ks._pubkey_cache[0])
+            self.assertEqual(expected[:7], ks.derive_pubkeys_range(0, 0, 7))
+            self.assertEqual(expected, ks.derive_pubkeys_range(0, 0, 20))
+            self.assertEqual(10, len(ks._pubkey_cache[0]))
+        self.assertEqual(expected[12], ks.derive_pubkey(0, 12))
+        self.assertEqual([], ks._pubkey_cache[1])
+        with self.assertRaises(keystore.CannotDerivePubkey):
+            ks.derive_pubkey(2, 0)
+
+    def test_recent_pubkeys_past_cache(self):
+        ks = keystore.from_master_key(self.xpub)
+        expected = [ks._derive_pubkeys_range(0, n, 1)[0] for n in range(16)]
+        with mock.patch.object(keystore, 'PUBKEY_CACHE_SIZE', 10), \
+                mock.patch.object(keystore, 'NUM_RECENT_PUBKEYS', 4), \
+                mock.patch.object(ks, '_derive_pubkeys_range', wraps=ks._derive_pubkeys_range) as derive:
+            self.assertEqual(expected, ks.derive_pubkeys_range(0, 0, 16))
+            # the first 10 are cached, and the last 4 kept in memory
+            self.assertEqual(expected[12:16], ks.derive_pubkeys_range(0, 12, 4))
+            self.assertEqual(expected[12], ks.derive_pubkey(0, 12))
+            self.assertEqual(1, derive.call_count)
+            self.assertEqual(expected[11], ks.derive_pubkey(0, 11))
+            self.assertEqual(2, derive.call_count)
+            # the least recently used one was dropped
+            self.assertEqual(expected[13], ks.derive_pubkey(0, 13))
+            self.assertEqual(3, derive.call_count)
+            self.assertEqual(expected[12], ks.derive_pubkey(0, 12))
+            self.assertEqual(3, derive.call_count)
+        self.assertEqual(4, len(ks._recent_pubkeys))
+
+    @mock.patch.object(keystore, 'PUBKEY_CACHE_CHUNK_SIZE', 8)
+    def test_pubkey_cache_kept_in_wallet_file(self):
+        wallet = restore_wallet_from_text(self.xpub, path=self.wallet_path, gap_limit=20, config=self.config)['wallet']
+        addresses = wallet.get_receiving_addresses()
+        wallet.change_gap_limit(30)
+        wallet.synchronize()
+        # only the chunks the cache grew into are written in the journal
+        self.assertEqual({('pubkey_cache', 'keystore', '0', '2'), ('pubkey_cache', 'keystore', '0', '3')},
+                         {path for path in wallet.db._dirty_paths if path[0] == 'pubkey_cache'})
+        wallet.save_db()
+        wallet = self._load_wallet()
+        chunks = wallet.db.get('pubkey_cache')['keystore']['0']
+        self.assertEqual([8, 8, 8, 6], [len(chunks[str(n)]) for n in range(4)])
+        pubkeys = wallet.keystore._pubkey_cache[0]
+        self.assertEqual(sum((chunks[str(n)] for n in range(4)), []), pubkeys)
+        self.assertEqual(addresses, wallet.get_receiving_addresses()[:20])
+        self.assertEqual(pubkeys[3], wallet.get_public_key(addresses[3]))
+        # a cache that does not match the keystore is not used
+        chunks['0'][0] = chunks['0'][1]
+        wallet.db.put('gap_limit', 30)
+        wallet.save_db()
+        wallet = self._load_wallet()
+        self.assertEqual(addresses, wallet.get_receiving_addresses()[:20])
+        self.assertEqual(wallet.keystore._derive_pubkeys_range(0, 0, 1)[0].hex(),
+                         wallet.db.get('pubkey_cache')['keystore']['0']['0'][0])
+
+    def test_pubkey_cache_chunks(self):
+        ks = keystore.from_master_key(self.xpub)
+        pubkeys = [pk.hex() for pk in ks._derive_pubkeys_range(0, 0, 12)]
+        with mock.patch.object(keystore, 'PUBKEY_CACHE_CHUNK_SIZE', 5):
+            d = {}
+            self.assertFalse(ks.set_pubkey_cache(d))
+            ks.extend_pubkey_cache(0, 7)
+            self.assertEqual([('0', '0'), ('0', '1')], ks.update_pubkey_cache(d))
+            self.assertEqual([], ks.update_pubkey_cache(d))
+            ks.extend_pubkey_cache(0, 12)
+            self.assertEqual([('0', '1'), ('0', '2')], ks.update_pubkey_cache(d))
+            self.assertEqual({'0': pubkeys[:5], '1': pubkeys[5:10], '2': pubkeys[10:]}, d['0'])
+            # chunks are used by another keystore
+            ks2 = keystore.from_master_key(self.xpub)
+            self.assertTrue(ks2.set_pubkey_cache(d))
+            self.assertEqual(pubkeys, ks2._pubkey_cache[0])
+            # but not if a chunk is missing, or one that is not the last is not full
+            for chunks in ({'0': pubkeys[:5], '2': pubkeys[10:]},
+                           {'0': pubkeys[:4], '1': pubkeys[4:9]}):
+                d['0'] = chunks
+                self.assertFalse(keystore.from_master_key(self.xpub).set_pubkey_cache(d))
+                self.assertEqual({}, d['0'])
+
+
 class TestWalletPassword(WalletTestCase):
 
     def setUp(self):
@@ -9,10 +9,10 @@ import copy
 from electrum_mona import storage, bitcoin, keystore, bip32, slip39, wallet
 from electrum_mona import Transaction
 from electrum_mona import SimpleConfig
-from electrum_mona.address_synchronizer import TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT
+from electrum_mona.address_synchronizer import TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT, TX_HEIGHT_LOCAL
 from electrum_mona.wallet import (sweep, Multisig_Wallet, Standard_Wallet, Imported_Wallet,
                              restore_wallet_from_text, Abstract_Wallet, BumpFeeStrategy)
-from electrum_mona.util import bfh, bh2u, create_and_start_event_loop, NotEnoughFunds
+from electrum_mona.util import bfh, bh2u, create_and_start_event_loop, NotEnoughFunds, TxMinedInfo
 from electrum_mona.transaction import (TxOutput, Transaction, PartialTransaction, PartialTxOutput,
                                   PartialTxInput, tx_from_any, TxOutpoint)
 from electrum_mona.mnemonic import seed_type
@@ -3165,3 +3165,101 @@ class TestWalletHistory_DoubleSpend(TestCaseForTestnet):
         w.add_transaction(txC)
         self.assertEqual(999890, sum(w.get_balance()))
 
+    def _assert_history_index_consistent(self, w):
+        # the maintained index must agree with deriving the history from scratch
+        h_index = w.get_history()
+        h_full = w.get_history(domain=w.get_addresses())
+        self.assertEqual([(item.txid, item.delta, item.balance) for item in h_full],
+                         [(item.txid, item.delta, item.balance) for item in h_index])
+        if h_index:
+            self.assertEqual(sum(w.get_balance()), h_index[-1].balance)
+
+    @mock.patch.object(wallet.Abstract_Wallet, 'save_db')
+    def test_history_index_updated_incrementally(self, mock_save_db):
+        w = restore_wallet_from_text("small rapid pattern language comic denial donate extend tide fever burden barrel",
+                                     path='if_this_exists_mocking_failed_648151893',
+                                     gap_limit=5,
+                                     config=self.config)['wallet']  # type: Abstract_Wallet
+        self.assertEqual([], w.get_history())
+        txA = Transaction(self.transactions["a3849040f82705151ba12a4389310b58a17b78025d81116a3338595bdefa1625"])
+        txB = Transaction(self.transactions["0e2182ead6660790290371516cb0b80afa8baebd30dad42b5e58a24ceea17f1c"])
+        txC = Transaction(self.transactions["2c9aa33d9c8ec649f9bfb84af027a5414b760be5231fe9eca4a95b9eb3f8a017"])
+        w.add_unverified_tx(txA.txid(), 1000)
+        w.add_transaction(txA)
+        w.add_transaction(txB)
+        self.assertEqual([txA.txid(), txB.txid()], [item.txid for item in w.get_history()])
+        self._assert_history_index_consistent(w)
+        # position changes
+        with mock.patch('electrum_mona.util.trigger_callback'):
+            w.add_verified_tx(txA.txid(), TxMinedInfo(height=1000, timestamp=1600000000, txpos=3, header_hash='00' * 32))
+        w.add_unverified_tx(txB.txid(), 1001)
+        self._assert_history_index_consistent(w)
+        w.remove_transaction(txB.txid())
+        w.add_transaction(txC)
+        self.assertEqual([txA.txid(), txC.txid()], [item.txid for item in w.get_history()])
+        self._assert_history_index_consistent(w)
+        # reorg
+        blockchain = mock.Mock()
+        blockchain.read_header.return_value = None
+        self.assertEqual({txA.txid()}, w.undo_verifications(blockchain, 999))
+        self._assert_history_index_consistent(w)
+
+    @mock.patch.object(wallet.Abstract_Wallet, 'save_db')
+    def test_addr_caches_follow_tx_heights(self, mock_save_db):
+        w = restore_wallet_from_text("small rapid pattern language comic denial donate extend tide fever burden barrel",
+                                     path='if_this_exists_mocking_failed_648151893',
+                                     gap_limit=5,
+                                     config=self.config)['wallet']  # type: Abstract_Wallet
+        txA = Transaction(self.transactions["a3849040f82705151ba12a4389310b58a17b78025d81116a3338595bdefa1625"])
+        txC = Transaction(self.transactions["2c9aa33d9c8ec649f9bfb84af027a5414b760be5231fe9eca4a95b9eb3f8a017"])
+        w.add_unverified_tx(txA.txid(), TX_HEIGHT_UNCONFIRMED)
+        w.add_transaction(txA)
+        self.assertEqual((0, 1000000, 0), w.get_balance())
+        self.assertEqual({TX_HEIGHT_UNCONFIRMED}, {utxo.block_height for utxo in w.get_utxos()})
+        with mock.patch('electrum_mona.util.trigger_callback'):
+            w.add_verified_tx(txA.txid(), TxMinedInfo(height=1000, timestamp=1600000000, txpos=3, header_hash='00' * 32))
+        self.assertEqual((1000000, 0, 0), w.get_balance())
+        self.assertEqual({1000}, {utxo.block_height for utxo in w.get_utxos()})
+        # spending the coin
+        w.add_transaction(txC)
+        self.assertEqual([txC.txid()], [utxo.prevout.txid.hex() for utxo in w.get_utxos()])
+        self.assertEqual((1000000, -1000000 + 999890, 0), w.get_balance())
+        w.remove_transaction(txC.txid())
+        self.assertEqual([txA.txid()], [utxo.prevout.txid.hex() for utxo in w.get_utxos()])
+        # reorg
+        blockchain = mock.Mock()
+        blockchain.read_header.return_value = None
+        w.undo_verifications(blockchain, 999)
+        self.assertEqual({1000}, {utxo.block_height for utxo in w.get_utxos()})
+        w.add_unverified_tx(txA.txid(), TX_HEIGHT_UNCONFIRMED)
+        self.assertEqual({TX_HEIGHT_UNCONFIRMED}, {utxo.block_height for utxo in w.get_utxos()})
+        self.assertEqual((0, 1000000, 0), w.get_balance())
+
+    @mock.patch.object(wallet.Abstract_Wallet, 'save_db')
+    def test_addr_coins_updated_per_tx(self, mock_save_db):
+        w = restore_wallet_from_text("small rapid pattern language comic denial donate extend tide fever burden barrel",
+                                     path='if_this_exists_mocking_failed_648151893',
+                                     gap_limit=5,
+                                     config=self.config)['wallet']  # type: Abstract_Wallet
+        txA = Transaction(self.transactions["a3849040f82705151ba12a4389310b58a17b78025d81116a3338595bdefa1625"])
+        txC = Transaction(self.transactions["2c9aa33d9c8ec649f9bfb84af027a5414b760be5231fe9eca4a95b9eb3f8a017"])
+        # coins are kept up to date per tx, addresses are not rescanned
+        with mock.patch.object(w, 'get_address_history', side_effect=AssertionError):
+            # child first
+            w.add_transaction(txC)
+            self.assertEqual([txC.txid()], [utxo.prevout.txid.hex() for utxo in w.get_utxos()])
+            w.add_transaction(txA)
+            self.assertEqual([txC.txid()], [utxo.prevout.txid.hex() for utxo in w.get_utxos()])
+            self.assertEqual((0, 999890, 0), w.get_balance())
+            spent = [utxo for utxo in w.get_utxos(confirmed_spending_only=True) if utxo.spent_height is not None]
+            self.assertEqual([txA.txid()], [utxo.prevout.txid.hex() for utxo in spent])
+            addr = spent[0].address
+            self.assertEqual({}, w.get_addr_utxo(addr))
+            self.assertEqual([TX_HEIGHT_LOCAL], [utxo.spent_height for utxo in w.get_addr_outputs(addr).values()])
+            w.remove_transaction(txC.txid())
+            self.assertEqual([txA.txid()], [utxo.prevout.txid.hex() for utxo in w.get_utxos()])
+            self.assertEqual([None], [utxo.spent_height for utxo in w.get_addr_utxo(addr).values()])
+            w.remove_transaction(txA.txid())
+            self.assertEqual([], w.get_utxos())
+            self.assertEqual(({}, {}), w.get_addr_io(addr))
+
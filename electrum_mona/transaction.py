@@ -32,6 +32,10 @@ import traceback
 import sys
 import io
 import base64
+import hashlib
+import os
+import threading
+import concurrent.futures
 from typing import (Sequence, Union, NamedTuple, Tuple, Optional, Iterable,
                     Callable, List, Dict, Set, TYPE_CHECKING)
 from collections import defaultdict
@@ -164,9 +168,9 @@ class TxOutput:
 
 
 class BIP143SharedTxDigestFields(NamedTuple):
-    hashPrevouts: str
-    hashSequence: str
-    hashOutputs: str
+    hashPrevouts: bytes
+    hashSequence: bytes
+    hashOutputs: bytes
 
 
 class TxOutpoint(NamedTuple):
@@ -494,21 +498,6 @@ def get_address_from_output_script(_bytes: bytes, *, net=None) -> Optional[str]:
     return None
 
 
-def parse_input(vds: BCDataStream) -> TxInput:
-    prevout_hash = vds.read_bytes(32)[::-1]
-    prevout_n = vds.read_uint32()
-    prevout = TxOutpoint(txid=prevout_hash, out_idx=prevout_n)
-    script_sig = vds.read_bytes(vds.read_compact_size())
-    nsequence = vds.read_uint32()
-    return TxInput(prevout=prevout, script_sig=script_sig, nsequence=nsequence)
-
-
-def parse_witness(vds: BCDataStream, txin: TxInput) -> None:
-    n = vds.read_compact_size()
-    witness_elements = list(vds.read_bytes(vds.read_compact_size()) for i in range(n))
-    txin.witness = bfh(construct_witness(witness_elements))
-
-
 def parse_output(vds: BCDataStream) -> TxOutput:
     value = vds.read_int64()
     if value > TOTAL_COIN_SUPPLY_LIMIT_IN_BTC * COIN:
@@ -519,6 +508,175 @@ def parse_output(vds: BCDataStream) -> TxOutput:
     return TxOutput(value=value, scriptpubkey=scriptpubkey)
 
 
+_INT32 = struct.Struct('<i')
+_UINT16 = struct.Struct('<H')
+_UINT32 = struct.Struct('<I')
+_INT64 = struct.Struct('<q')
+_UINT64 = struct.Struct('<Q')
+
+
+class ParsedTx(NamedTuple):
+    version: int
+    inputs: List[TxInput]
+    outputs: List[TxOutput]
+    locktime: int
+    txid: str
+    wtxid: str
+
+
+def _read_compact_size(raw: bytes, pos: int) -> Tuple[int, int]:
+    """Returns the compact size at pos, and the position after it."""
+    try:
+        size = raw[pos]
+        if size < 253:
+            return size, pos + 1
+        if size == 253:
+            return _UINT16.unpack_from(raw, pos + 1)[0], pos + 3
+        if size == 254:
+            return _UINT32.unpack_from(raw, pos + 1)[0], pos + 5
+        return _UINT64.unpack_from(raw, pos + 1)[0], pos + 9
+    except (IndexError, struct.error) as e:
+        raise SerializationError('attempt to read past end of buffer') from e
+
+
+def parse_network_tx(raw: bytes) -> ParsedTx:
+    """Parses a transaction in network serialization.
+    Fields are sliced from raw, and txid and wtxid are hashed from
+    its byte ranges, instead of serializing the transaction again.
+    """
+    n = len(raw)
+    if n < 4:
+        raise SerializationError('attempt to read past end of buffer')
+    version = _INT32.unpack_from(raw, 0)[0]
+    n_vin, pos = _read_compact_size(raw, 4)
+    is_segwit = (n_vin == 0)
+    if is_segwit:
+        if pos >= n:
+            raise SerializationError('attempt to read past end of buffer')
+        marker = raw[pos:pos+1]
+        if marker != b'\x01':
+            raise ValueError('invalid txn marker byte: {}'.format(marker))
+        n_vin, pos = _read_compact_size(raw, pos + 1)
+    if n_vin < 1:
+        raise SerializationError('tx needs to have at least 1 input')
+    inputs = []
+    for i in range(n_vin):
+        if pos + 36 > n:
+            raise SerializationError('attempt to read past end of buffer')
+        prevout = TxOutpoint(txid=raw[pos:pos+32][::-1], out_idx=_UINT32.unpack_from(raw, pos + 32)[0])
+        script_len, pos = _read_compact_size(raw, pos + 36)
+        end = pos + script_len
+        if end + 4 > n:
+            raise SerializationError('attempt to read past end of buffer')
+        nsequence = _UINT32.unpack_from(raw, end)[0]
+        inputs.append(TxInput(prevout=prevout, script_sig=raw[pos:end], nsequence=nsequence))
+        pos = end + 4
+    n_vout, pos = _read_compact_size(raw, pos)
+    if n_vout < 1:
+        raise SerializationError('tx needs to have at least 1 output')
+    outputs = []
+    for i in range(n_vout):
+        if pos + 8 > n:
+            raise SerializationError('attempt to read past end of buffer')
+        value = _INT64.unpack_from(raw, pos)[0]
+        if value > TOTAL_COIN_SUPPLY_LIMIT_IN_BTC * COIN:
+            raise SerializationError('invalid output amount (too large)')
+        if value < 0:
+            raise SerializationError('invalid output amount (negative)')
+        script_len, pos = _read_compact_size(raw, pos + 8)
+        end = pos + script_len
+        if end > n:
+            raise SerializationError('attempt to read past end of buffer')
+        outputs.append(TxOutput(value=value, scriptpubkey=raw[pos:end]))
+        pos = end
+    outputs_end = pos
+    if is_segwit:
+        for txin in inputs:
+            # the serialized witness is kept as is
+            witness_start = pos
+            num_elements, pos = _read_compact_size(raw, pos)
+            for j in range(num_elements):
+                size, pos = _read_compact_size(raw, pos)
+                pos += size
+                if pos > n:
+                    raise SerializationError('attempt to read past end of buffer')
+            txin.witness = raw[witness_start:pos]
+    if pos + 4 != n:
+        if pos + 4 > n:
+            raise SerializationError('attempt to read past end of buffer')
+        raise SerializationError('extra junk at the end')
+    locktime = _UINT32.unpack_from(raw, pos)[0]
+    view = memoryview(raw)
+    wtxid = hashlib.sha256(hashlib.sha256(view).digest()).digest()[::-1].hex()
+    if is_segwit:
+        # without marker, flag and witnesses
+        h = hashlib.sha256(view[:4])
+        h.update(view[6:outputs_end])
+        h.update(view[pos:])
+        txid = hashlib.sha256(h.digest()).digest()[::-1].hex()
+    else:
+        txid = wtxid
+    return ParsedTx(version=version, inputs=inputs, outputs=outputs, locktime=locktime, txid=txid, wtxid=wtxid)
+
+
+# size of a txin with an empty script: outpoint, script length, nSequence
+_EMPTY_TXIN_SIZE = 36 + 1 + 4
+
+
+class SighashCache:
+    """Parts of the sighash preimages that are shared by all inputs of a tx,
+    so that signing n inputs does not serialize the tx n times.
+    Fields are computed when first needed; the cache must not be used
+    after the tx is modified.
+    """
+
+    def __init__(self, tx: 'Transaction'):
+        self.tx = tx
+        self.version = _UINT32.pack(tx.version & 0xffffffff)
+        self.locktime = _UINT32.pack(tx.locktime)
+        self._bip143_fields = None  # type: Optional[BIP143SharedTxDigestFields]
+        self._legacy_txins = None  # type: Optional[bytes]
+        self._outputs = None  # type: Optional[bytes]
+
+    def bip143_shared_txdigest_fields(self) -> BIP143SharedTxDigestFields:
+        if self._bip143_fields is None:
+            self._bip143_fields = self.tx._calc_bip143_shared_txdigest_fields()
+        return self._bip143_fields
+
+    def legacy_txins(self) -> bytes:
+        """All inputs with empty scripts, without their count.
+        Input k is at offset k * _EMPTY_TXIN_SIZE.
+        """
+        if self._legacy_txins is None:
+            self._legacy_txins = b''.join(txin.prevout.serialize_to_network() + b'\x00' + _UINT32.pack(txin.nsequence)
+                                          for txin in self.tx.inputs())
+        return self._legacy_txins
+
+    def outputs(self) -> bytes:
+        """All outputs, with their count."""
+        if self._outputs is None:
+            outputs = self.tx.outputs()
+            self._outputs = bfh(var_int(len(outputs))) + b''.join(o.serialize_to_network() for o in outputs)
+        return self._outputs
+
+
+# inputs are signed in parallel from this many signatures on
+SIGN_IN_PARALLEL_MIN_SIGS = 16
+
+_sign_executor = None  # type: Optional[concurrent.futures.ThreadPoolExecutor]
+_sign_executor_lock = threading.Lock()
+
+
+def get_sign_executor() -> concurrent.futures.ThreadPoolExecutor:
+    # libsecp256k1 and hashlib release the GIL, so threads sign in parallel
+    global _sign_executor
+    with _sign_executor_lock:
+        if _sign_executor is None:
+            _sign_executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                                                   thread_name_prefix='sign_thread')
+        return _sign_executor
+
+
 # pay & redeem scripts
 
 def multisig_script(public_keys: Sequence[str], m: int) -> str:
@@ -551,6 +709,7 @@ class Transaction:
         self._version = 2
 
         self._cached_txid = None  # type: Optional[str]
+        self._cached_wtxid = None  # type: Optional[str]
 
     @property
     def locktime(self):
@@ -598,30 +757,13 @@ class Transaction:
         if self._inputs is not None:
             return
 
-        raw_bytes = bfh(self._cached_network_ser)
-        vds = BCDataStream()
-        vds.write(raw_bytes)
-        self._version = vds.read_int32()
-        n_vin = vds.read_compact_size()
-        is_segwit = (n_vin == 0)
-        if is_segwit:
-            marker = vds.read_bytes(1)
-            if marker != b'\x01':
-                raise ValueError('invalid txn marker byte: {}'.format(marker))
-            n_vin = vds.read_compact_size()
-        if n_vin < 1:
-            raise SerializationError('tx needs to have at least 1 input')
-        self._inputs = [parse_input(vds) for i in range(n_vin)]
-        n_vout = vds.read_compact_size()
-        if n_vout < 1:
-            raise SerializationError('tx needs to have at least 1 output')
-        self._outputs = [parse_output(vds) for i in range(n_vout)]
-        if is_segwit:
-            for txin in self._inputs:
-                parse_witness(vds, txin)
-        self._locktime = vds.read_uint32()
-        if vds.can_read_more():
-            raise SerializationError('extra junk at the end')
+        parsed = parse_network_tx(bfh(self._cached_network_ser))
+        self._version = parsed.version
+        self._inputs = parsed.inputs
+        self._outputs = parsed.outputs
+        self._locktime = parsed.locktime
+        self._cached_txid = parsed.txid
+        self._cached_wtxid = parsed.wtxid
 
     @classmethod
     def get_siglist(self, txin: 'PartialTxInput', *, estimate_size=False):
@@ -773,9 +915,9 @@ class Transaction:
     def _calc_bip143_shared_txdigest_fields(self) -> BIP143SharedTxDigestFields:
         inputs = self.inputs()
         outputs = self.outputs()
-        hashPrevouts = bh2u(sha256d(b''.join(txin.prevout.serialize_to_network() for txin in inputs)))
-        hashSequence = bh2u(sha256d(bfh(''.join(int_to_hex(txin.nsequence, 4) for txin in inputs))))
-        hashOutputs = bh2u(sha256d(bfh(''.join(o.serialize_to_network().hex() for o in outputs))))
+        hashPrevouts = sha256d(b''.join(txin.prevout.serialize_to_network() for txin in inputs))
+        hashSequence = sha256d(b''.join(_UINT32.pack(txin.nsequence) for txin in inputs))
+        hashOutputs = sha256d(b''.join(o.serialize_to_network() for o in outputs))
         return BIP143SharedTxDigestFields(hashPrevouts=hashPrevouts,
                                           hashSequence=hashSequence,
                                           hashOutputs=hashOutputs)
@@ -787,6 +929,7 @@ class Transaction:
     def invalidate_ser_cache(self):
         self._cached_network_ser = None
         self._cached_txid = None
+        self._cached_wtxid = None
 
     def serialize(self) -> str:
         if not self._cached_network_ser:
@@ -852,6 +995,8 @@ class Transaction:
 
     def wtxid(self) -> Optional[str]:
         self.deserialize()
+        if self._cached_wtxid is not None:
+            return self._cached_wtxid
         if not self.is_complete():
             return None
         try:
@@ -1844,59 +1989,72 @@ class PartialTransaction(Transaction):
         except MissingTxInputAmount:
             return None
 
-    def serialize_preimage(self, txin_index: int, *,
-                           bip143_shared_txdigest_fields: BIP143SharedTxDigestFields = None) -> str:
-        nVersion = int_to_hex(self.version, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
-        inputs = self.inputs()
-        outputs = self.outputs()
-        txin = inputs[txin_index]
+    def serialize_preimage(self, txin_index: int, *, sighash_cache: SighashCache = None) -> str:
+        return self.serialize_preimage_bytes(txin_index, sighash_cache=sighash_cache).hex()
+
+    def serialize_preimage_bytes(self, txin_index: int, *, sighash_cache: SighashCache = None) -> bytes:
+        if sighash_cache is None:
+            sighash_cache = SighashCache(self)
+        txin = self.inputs()[txin_index]
         sighash = txin.sighash if txin.sighash is not None else SIGHASH_ALL
         if sighash != SIGHASH_ALL:
             raise Exception("only SIGHASH_ALL signing is supported!")
-        nHashType = int_to_hex(sighash, 4)
-        preimage_script = self.get_preimage_script(txin)
+        nHashType = _UINT32.pack(sighash)
+        preimage_script = bfh(self.get_preimage_script(txin))
+        scriptCode = bfh(var_int(len(preimage_script))) + preimage_script
+        outpoint = txin.prevout.serialize_to_network()
+        nSequence = _UINT32.pack(txin.nsequence)
         if txin.is_segwit():
-            if bip143_shared_txdigest_fields is None:
-                bip143_shared_txdigest_fields = self._calc_bip143_shared_txdigest_fields()
-            hashPrevouts = bip143_shared_txdigest_fields.hashPrevouts
-            hashSequence = bip143_shared_txdigest_fields.hashSequence
-            hashOutputs = bip143_shared_txdigest_fields.hashOutputs
-            outpoint = txin.prevout.serialize_to_network().hex()
-            scriptCode = var_int(len(preimage_script) // 2) + preimage_script
-            amount = int_to_hex(txin.value_sats(), 8)
-            nSequence = int_to_hex(txin.nsequence, 4)
-            preimage = nVersion + hashPrevouts + hashSequence + outpoint + scriptCode + amount + nSequence + hashOutputs + nLocktime + nHashType
+            fields = sighash_cache.bip143_shared_txdigest_fields()
+            amount = _UINT64.pack(txin.value_sats())
+            preimage = b''.join((sighash_cache.version, fields.hashPrevouts, fields.hashSequence,
+                                 outpoint, scriptCode, amount, nSequence,
+                                 fields.hashOutputs, sighash_cache.locktime, nHashType))
         else:
-            txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, preimage_script if txin_index==k else '')
-                                                   for k, txin in enumerate(inputs))
-            txouts = var_int(len(outputs)) + ''.join(o.serialize_to_network().hex() for o in outputs)
-            preimage = nVersion + txins + txouts + nLocktime + nHashType
+            # all inputs but this one have empty scripts
+            txins = memoryview(sighash_cache.legacy_txins())
+            start = txin_index * _EMPTY_TXIN_SIZE
+            preimage = b''.join((sighash_cache.version, bfh(var_int(len(self.inputs()))),
+                                 txins[:start], outpoint, scriptCode, nSequence, txins[start + _EMPTY_TXIN_SIZE:],
+                                 sighash_cache.outputs(), sighash_cache.locktime, nHashType))
         return preimage
 
     def sign(self, keypairs) -> None:
         # keypairs:  pubkey_hex -> (secret_bytes, is_compressed)
-        bip143_shared_txdigest_fields = self._calc_bip143_shared_txdigest_fields()
+        sighash_cache = SighashCache(self)
+        # The signatures are created first, in parallel for large txs,
+        # and then added in the same order as when signing one by one.
+        # Signatures are deterministic, so the result is the same.
+        to_sign = []  # type: List[Tuple[int, str]]
         for i, txin in enumerate(self.inputs()):
-            pubkeys = [pk.hex() for pk in txin.pubkeys]
-            for pubkey in pubkeys:
-                if txin.is_complete():
-                    break
-                if pubkey not in keypairs:
-                    continue
-                _logger.info(f"adding signature for {pubkey}")
-                sec, compressed = keypairs[pubkey]
-                sig = self.sign_txin(i, sec, bip143_shared_txdigest_fields=bip143_shared_txdigest_fields)
-                self.add_signature_to_txin(txin_idx=i, signing_pubkey=pubkey, sig=sig)
+            if txin.is_complete():
+                continue
+            for pubkey in [pk.hex() for pk in txin.pubkeys]:
+                if pubkey in keypairs:
+                    to_sign.append((i, pubkey))
+
+        def sign_txin(item: Tuple[int, str]) -> str:
+            i, pubkey = item
+            sec, compressed = keypairs[pubkey]
+            return self.sign_txin(i, sec, sighash_cache=sighash_cache)
+
+        if len(to_sign) >= SIGN_IN_PARALLEL_MIN_SIGS and (os.cpu_count() or 1) > 1:
+            sigs = list(get_sign_executor().map(sign_txin, to_sign))
+        else:
+            sigs = list(map(sign_txin, to_sign))
+        for (i, pubkey), sig in zip(to_sign, sigs):
+            if self.inputs()[i].is_complete():
+                continue
+            _logger.info(f"adding signature for {pubkey}")
+            self.add_signature_to_txin(txin_idx=i, signing_pubkey=pubkey, sig=sig)
 
         _logger.debug(f"is_complete {self.is_complete()}")
         self.invalidate_ser_cache()
 
-    def sign_txin(self, txin_index, privkey_bytes, *, bip143_shared_txdigest_fields=None) -> str:
+    def sign_txin(self, txin_index, privkey_bytes, *, sighash_cache: SighashCache = None) -> str:
         txin = self.inputs()[txin_index]
         txin.validate_data(for_signing=True)
-        pre_hash = sha256d(bfh(self.serialize_preimage(txin_index,
-                                                       bip143_shared_txdigest_fields=bip143_shared_txdigest_fields)))
+        pre_hash = sha256d(self.serialize_preimage_bytes(txin_index, sighash_cache=sighash_cache))
         privkey = ecc.ECPrivkey(privkey_bytes)
         sig = privkey.sign_transaction(pre_hash)
         sig = bh2u(sig) + '01'  # SIGHASH_ALL
@@ -1948,12 +2106,13 @@ class PartialTransaction(Transaction):
             return
         if len(self.inputs()) != len(signatures):
             raise Exception('expected {} signatures; got {}'.format(len(self.inputs()), len(signatures)))
+        sighash_cache = SighashCache(self)
         for i, txin in enumerate(self.inputs()):
             pubkeys = [pk.hex() for pk in txin.pubkeys]
             sig = signatures[i]
             if bfh(sig) in list(txin.part_sigs.values()):
                 continue
-            pre_hash = sha256d(bfh(self.serialize_preimage(i)))
+            pre_hash = sha256d(self.serialize_preimage_bytes(i, sighash_cache=sighash_cache))
             sig_string = ecc.sig_string_from_der_sig(bfh(sig[:-2]))
             for recid in range(4):
                 try:
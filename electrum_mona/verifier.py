@@ -22,11 +22,11 @@
 # SOFTWARE.
 
 import asyncio
-from typing import Sequence, Optional, TYPE_CHECKING
+from typing import Sequence, Optional, TYPE_CHECKING, Tuple
 
 import aiorpcx
 
-from .util import bh2u, TxMinedInfo, NetworkJobOnDefaultServer
+from .util import bh2u, TxMinedInfo, NetworkJobOnDefaultServer, chunks
 from .crypto import sha256d
 from .bitcoin import hash_decode, hash_encode
 from .transaction import Transaction
@@ -77,6 +77,7 @@ class SPV(NetworkJobOnDefaultServer):
         local_height = self.blockchain.height()
         unverified = self.wallet.get_unverified_txs()
 
+        to_request = []
         for tx_hash, tx_height in unverified.items():
             # do not request merkle branch if we already requested it
             if tx_hash in self.requested_merkle or tx_hash in self.merkle_roots:
@@ -93,19 +94,25 @@ class SPV(NetworkJobOnDefaultServer):
             # request now
             self.logger.info(f'requested merkle {tx_hash}')
             self.requested_merkle.add(tx_hash)
-            await self.taskgroup.spawn(self._request_and_verify_single_proof, tx_hash, tx_height)
+            to_request.append((tx_hash, tx_height))
+        # request proofs in batches
+        for items in chunks(to_request, self.interface.get_request_batch_size()):
+            await self.taskgroup.spawn(self._request_and_verify_proofs, items)
+
+    async def _request_and_verify_proofs(self, items: Sequence[Tuple[str, int]]):
+        async with self._network_request_semaphore:
+            merkles = await self.network.get_merkles_for_transactions(items)
+        for (tx_hash, tx_height), merkle in zip(items, merkles):
+            if isinstance(merkle, UntrustedServerReturnedError):
+                if not isinstance(merkle.original_exception, aiorpcx.jsonrpc.RPCError):
+                    raise merkle
+                self.logger.info(f'tx {tx_hash} not at height {tx_height}')
+                self.wallet.remove_unverified_tx(tx_hash, tx_height)
+                self.requested_merkle.discard(tx_hash)
+                continue
+            await self._verify_proof(tx_hash, tx_height, merkle)
 
-    async def _request_and_verify_single_proof(self, tx_hash, tx_height):
-        try:
-            async with self._network_request_semaphore:
-                merkle = await self.network.get_merkle_for_transaction(tx_hash, tx_height)
-        except UntrustedServerReturnedError as e:
-            if not isinstance(e.original_exception, aiorpcx.jsonrpc.RPCError):
-                raise
-            self.logger.info(f'tx {tx_hash} not at height {tx_height}')
-            self.wallet.remove_unverified_tx(tx_hash, tx_height)
-            self.requested_merkle.discard(tx_hash)
-            return
+    async def _verify_proof(self, tx_hash: str, tx_height: int, merkle: dict):
         # Verify the hash of the server-provided merkle branch to a
         # transaction matches the merkle root of its block
         if tx_height != merkle.get('block_height'):
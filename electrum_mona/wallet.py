@@ -310,9 +310,9 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
 
         self.lnworker = None
 
-    def save_db(self):
+    def save_db(self, *, consolidate: bool = False):
         if self.storage:
-            self.db.write(self.storage)
+            self.db.write(self.storage, consolidate=consolidate)
 
     def save_backup(self, backup_dir):
         new_db = WalletDB(self.db.dump(), manual_upgrades=False)
@@ -378,7 +378,8 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         finally:  # even if we get cancelled
             if any([ks.is_requesting_to_be_rewritten_to_wallet_file for ks in self.get_keystores()]):
                 self.save_keystore()
-            self.save_db()
+            # leave a file that older versions can at least parse
+            self.save_db(consolidate=True)
 
     def set_up_to_date(self, b):
         super().set_up_to_date(b)
@@ -2730,6 +2731,7 @@ class Imported_Wallet(Simple_Wallet):
             self.db.remove_addr_history(address)
             for tx_hash in transactions_to_remove:
                 self.remove_transaction(tx_hash)
+            self.invalidate_history_index()
         self.set_label(address, None)
         self.remove_payment_request(address)
         self.set_frozen_state_of_addresses([address], False)
@@ -2868,6 +2870,8 @@ class Deterministic_Wallet(Abstract_Wallet):
         self._ephemeral_addr_to_addr_index = {}  # type: Dict[str, Sequence[int]]
         Abstract_Wallet.__init__(self, db, storage, config=config)
         self.gap_limit = db.get('gap_limit', 20)
+        self._pubkey_cache_keystores = {}  # type: Dict[str, KeyStoreWithMPK]
+        self._load_pubkey_caches()
         # generate addresses now. note that without libsecp this might block
         # for a few seconds!
         self.synchronize()
@@ -2954,6 +2958,38 @@ class Deterministic_Wallet(Abstract_Wallet):
         pubkeys = self.derive_pubkeys(for_change, n)
         return self.pubkeys_to_address(pubkeys)
 
+    def derive_addresses(self, for_change: int, start: int, count: int) -> Sequence[str]:
+        """Same as derive_address for n in range(start, start+count)."""
+        for_change = int(for_change)
+        pubkeys = [ks.derive_pubkeys_range(for_change, start, count) for ks in self.get_keystores()]
+        return [self.pubkeys_to_address([pk.hex() for pk in pks]) for pks in zip(*pubkeys)]
+
+    @abstractmethod
+    def _get_keystores_by_name(self) -> Dict[str, KeyStoreWithMPK]:
+        """Returns the keystores, by their key in the wallet file."""
+        pass
+
+    def _load_pubkey_caches(self) -> None:
+        # the pubkeys derived by the keystores are kept in the wallet file
+        caches = self.db.get_dict('pubkey_cache')
+        for name, ks in self._get_keystores_by_name().items():
+            if ks.get_master_public_key() is None:
+                continue
+            if name not in caches:
+                caches[name] = {}
+            if not ks.set_pubkey_cache(caches[name]):
+                self.db.mark_dirty(['pubkey_cache', name])
+            self._pubkey_cache_keystores[name] = ks
+            ks.extend_pubkey_cache(0, self.db.num_receiving_addresses())
+            ks.extend_pubkey_cache(1, self.db.num_change_addresses())
+        self._save_pubkey_caches()
+
+    def _save_pubkey_caches(self) -> None:
+        caches = self.db.get_dict('pubkey_cache')
+        for name, ks in self._pubkey_cache_keystores.items():
+            for chain, chunk in ks.update_pubkey_cache(caches[name]):
+                self.db.mark_dirty(['pubkey_cache', name, chain, chunk])
+
     def export_private_key_for_path(self, path: Union[Sequence[int], str], password: Optional[str]) -> str:
         if isinstance(path, str):
             path = convert_bip32_path_to_list_of_uint32(path)
@@ -2982,30 +3018,37 @@ class Deterministic_Wallet(Abstract_Wallet):
             txinout.bip32_paths[pubkey] = (fp_bytes, der_full)
 
     def create_new_address(self, for_change: bool = False):
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def create_new_addresses(self, for_change: bool, count: int) -> Sequence[str]:
         assert type(for_change) is bool
         with self.lock:
             n = self.db.num_change_addresses() if for_change else self.db.num_receiving_addresses()
-            address = self.derive_address(int(for_change), n)
-            self.db.add_change_address(address) if for_change else self.db.add_receiving_address(address)
-            self.add_address(address)
-            if for_change:
-                # note: if it's actually "old", it will get filtered later
-                self._not_old_change_addresses.append(address)
-            return address
+            addresses = self.derive_addresses(int(for_change), n, count)
+            for address in addresses:
+                self.db.add_change_address(address) if for_change else self.db.add_receiving_address(address)
+                self.add_address(address)
+                if for_change:
+                    # note: if it's actually "old", it will get filtered later
+                    self._not_old_change_addresses.append(address)
+            self._save_pubkey_caches()
+            return addresses
 
     def synchronize_sequence(self, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
         while True:
             num_addr = self.db.num_change_addresses() if for_change else self.db.num_receiving_addresses()
             if num_addr < limit:
-                self.create_new_address(for_change)
+                self.create_new_addresses(for_change, limit - num_addr)
                 continue
             if for_change:
                 last_few_addresses = self.get_change_addresses(slice_start=-limit)
             else:
                 last_few_addresses = self.get_receiving_addresses(slice_start=-limit)
-            if any(map(self.address_is_old, last_few_addresses)):
-                self.create_new_address(for_change)
+            # there must be 'limit' unused addresses after the last used one
+            used = [i for i, addr in enumerate(last_few_addresses) if self.address_is_old(addr)]
+            if used:
+                self.create_new_addresses(for_change, used[-1] + 1)
             else:
                 break
 
@@ -3094,6 +3137,9 @@ class Simple_Deterministic_Wallet(Simple_Wallet, Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return [self.keystore.derive_pubkey(c, i).hex()]
 
+    def _get_keystores_by_name(self):
+        return {'keystore': self.keystore}
+
 
 
 
@@ -3150,6 +3196,9 @@ class Multisig_Wallet(Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return [k.derive_pubkey(c, i).hex() for k in self.get_keystores()]
 
+    def _get_keystores_by_name(self):
+        return dict(self.keystores)
+
     def load_keystore(self):
         self.keystores = {}
         for i in range(self.n):
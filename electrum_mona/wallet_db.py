@@ -27,7 +27,7 @@ import ast
 import json
 import copy
 import threading
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from typing import Dict, Optional, List, Tuple, Set, Iterable, NamedTuple, Sequence, TYPE_CHECKING, Union
 import binascii
 
@@ -40,7 +40,7 @@ from .logging import Logger
 from .lnutil import LOCAL, REMOTE, FeeUpdate, UpdateAddHtlc, LocalConfig, RemoteConfig, Keypair, OnlyPubkeyKeypair, RevocationStore
 from .lnutil import ImportedChannelBackupStorage, OnchainChannelBackupStorage
 from .lnutil import ChannelConstraints, Outpoint, ShachainElement
-from .json_db import StoredDict, JsonDB, locked, modifier
+from .json_db import StoredDict, JsonDB, locked, modifier, parse_journal, apply_journal
 from .plugin import run_hook, plugin_loaders
 from .paymentrequest import PaymentRequest
 from .submarine_swaps import SwapData
@@ -53,10 +53,13 @@ if TYPE_CHECKING:
 
 OLD_SEED_VERSION = 4        # electrum versions < 2.0
 NEW_SEED_VERSION = 11       # electrum versions >= 2.0
-FINAL_SEED_VERSION = 41     # electrum >= 2.7 will set this to prevent
+FINAL_SEED_VERSION = 42     # electrum >= 2.7 will set this to prevent
                             # old versions from overwriting new format
 
 
+_MULTISIG_KEYSTORE_NAMES = frozenset(('x%d/' % i) for i in range(1, 16))
+
+
 class TxFeesValue(NamedTuple):
     fee: Optional[int] = None
     is_calculated_by_us: bool = False
@@ -65,9 +68,14 @@ class TxFeesValue(NamedTuple):
 
 class WalletDB(JsonDB):
 
+    # max number of deserialized transactions kept in memory
+    PARSED_TX_CACHE_SIZE = 1000
+
     def __init__(self, raw, *, manual_upgrades: bool):
         JsonDB.__init__(self, {})
+        self._parsed_txs = OrderedDict()  # type: OrderedDict[str, Transaction]
         self._manual_upgrades = manual_upgrades
+        self._journal_path = None  # type: Optional[str]  # storage that has our last full write
         self._called_after_upgrade_tasks = False
         if raw:  # loading existing db
             self.load_data(raw)
@@ -77,8 +85,13 @@ class WalletDB(JsonDB):
             self._after_upgrade_tasks()
 
     def load_data(self, s):
+        journal = []
         try:
-            self.data = json.loads(s)
+            self.data, journal = parse_journal(s)
+            if journal:
+                if not isinstance(self.data, dict):
+                    raise ValueError("journal found after a json document that is not a dict")
+                apply_journal(self.data, journal)
         except:
             try:
                 d = ast.literal_eval(s)
@@ -96,6 +109,10 @@ class WalletDB(JsonDB):
                 self.data[key] = value
         if not isinstance(self.data, dict):
             raise WalletFileException("Malformed wallet file (not dict)")
+        if journal:
+            # the file was not consolidated when it was last closed.
+            # make sure it is written as a plain json document again
+            self.set_modified(True)
 
         if not self._manual_upgrades and self.requires_split():
             raise WalletFileException("This wallet has multiple accounts and must be split")
@@ -190,6 +207,7 @@ class WalletDB(JsonDB):
         self._convert_version_39()
         self._convert_version_40()
         self._convert_version_41()
+        self._convert_version_42()
         self.put('seed_version', FINAL_SEED_VERSION)  # just to be sure
 
         self._after_upgrade_tasks()
@@ -821,6 +839,14 @@ class WalletDB(JsonDB):
         self.data['imported_channel_backups'] = imported_channel_backups
         self.data['seed_version'] = 41
 
+    def _convert_version_42(self):
+        # nothing to convert: from now on, the wallet file might be followed by
+        # journal records (see JsonDB.get_journal_data), that older versions
+        # cannot parse
+        if not self._is_upgrade_method_needed(41, 41):
+            return
+        self.data['seed_version'] = 42
+
     def _convert_imported(self):
         if not self._is_upgrade_method_needed(0, 13):
             return
@@ -1016,6 +1042,7 @@ class WalletDB(JsonDB):
         if scripthash not in self._prevouts_by_scripthash:
             self._prevouts_by_scripthash[scripthash] = set()
         self._prevouts_by_scripthash[scripthash].add((prevout.to_str(), value))
+        self.mark_dirty(self._prevouts_by_scripthash.path + [scripthash])
 
     @modifier
     def remove_prevout_by_scripthash(self, scripthash: str, *, prevout: TxOutpoint, value: int) -> None:
@@ -1023,6 +1050,7 @@ class WalletDB(JsonDB):
         assert isinstance(prevout, TxOutpoint)
         assert isinstance(value, int)
         self._prevouts_by_scripthash[scripthash].discard((prevout.to_str(), value))
+        self.mark_dirty(self._prevouts_by_scripthash.path + [scripthash])
         if not self._prevouts_by_scripthash[scripthash]:
             self._prevouts_by_scripthash.pop(scripthash)
 
@@ -1044,21 +1072,41 @@ class WalletDB(JsonDB):
         if tx_hash != tx.txid():
             raise Exception(f"trying to add tx to db with inconsistent txid: {tx_hash} != {tx.txid()}")
         # don't allow overwriting complete tx with partial tx
-        tx_we_already_have = self.transactions.get(tx_hash, None)
+        tx_we_already_have = self.get_transaction(tx_hash)
         if tx_we_already_have is None or isinstance(tx_we_already_have, PartialTransaction):
-            self.transactions[tx_hash] = tx
+            self.transactions[tx_hash] = tx.serialize()
+            self._cache_parsed_tx(tx_hash, tx)
 
     @modifier
     def remove_transaction(self, tx_hash: str) -> Optional[Transaction]:
         assert isinstance(tx_hash, str)
-        return self.transactions.pop(tx_hash, None)
+        tx = self.get_transaction(tx_hash)
+        self.transactions.pop(tx_hash, None)
+        self._parsed_txs.pop(tx_hash, None)
+        return tx
 
     @locked
     def get_transaction(self, tx_hash: Optional[str]) -> Optional[Transaction]:
         if tx_hash is None:
             return None
         assert isinstance(tx_hash, str)
-        return self.transactions.get(tx_hash)
+        tx = self._parsed_txs.get(tx_hash)
+        if tx is not None:
+            self._parsed_txs.move_to_end(tx_hash)
+            return tx
+        raw = self.transactions.get(tx_hash)
+        if raw is None:
+            return None
+        # note: for performance, "deserialize=False" so that we will deserialize these on-demand
+        tx = tx_from_any(raw, deserialize=False)
+        self._cache_parsed_tx(tx_hash, tx)
+        return tx
+
+    def _cache_parsed_tx(self, tx_hash: str, tx: Transaction) -> None:
+        self._parsed_txs[tx_hash] = tx
+        self._parsed_txs.move_to_end(tx_hash)
+        while len(self._parsed_txs) > self.PARSED_TX_CACHE_SIZE:
+            self._parsed_txs.popitem(last=False)
 
     @locked
     def list_transactions(self) -> Sequence[str]:
@@ -1209,12 +1257,14 @@ class WalletDB(JsonDB):
         assert isinstance(addr, str)
         self._addr_to_addr_index[addr] = (1, len(self.change_addresses))
         self.change_addresses.append(addr)
+        self.mark_dirty(['addresses', 'change'])
 
     @modifier
     def add_receiving_address(self, addr: str) -> None:
         assert isinstance(addr, str)
         self._addr_to_addr_index[addr] = (0, len(self.receiving_addresses))
         self.receiving_addresses.append(addr)
+        self.mark_dirty(['addresses', 'receiving'])
 
     @locked
     def get_address_index(self, address: str) -> Optional[Sequence[int]]:
@@ -1271,7 +1321,7 @@ class WalletDB(JsonDB):
         self.txi = self.get_dict('txi')                          # type: Dict[str, Dict[str, Dict[str, int]]]
         # txid -> address -> output_index -> (value, is_coinbase)
         self.txo = self.get_dict('txo')                          # type: Dict[str, Dict[str, Dict[str, Tuple[int, bool]]]]
-        self.transactions = self.get_dict('transactions')        # type: Dict[str, Transaction]
+        self.transactions = self.get_dict('transactions')        # type: Dict[str, str]  # txid -> raw tx
         self.spent_outpoints = self.get_dict('spent_outpoints')  # txid -> output_index -> next_txid
         self.history = self.get_dict('addr_history')             # address -> list of (txid, height)
         self.verified_tx = self.get_dict('verified_tx3')         # txid -> (height, timestamp, txpos, header_hash)
@@ -1297,15 +1347,14 @@ class WalletDB(JsonDB):
         self.txo.clear()
         self.spent_outpoints.clear()
         self.transactions.clear()
+        self._parsed_txs.clear()
         self.history.clear()
         self.verified_tx.clear()
         self.tx_fees.clear()
         self._prevouts_by_scripthash.clear()
 
     def _convert_dict(self, path, key, v):
-        if key == 'transactions':
-            # note: for performance, "deserialize=False" so that we will deserialize these on-demand
-            v = dict((k, tx_from_any(x, deserialize=False)) for k, x in v.items())
+        # note: 'transactions' are kept as raw strings, see get_transaction
         if key == 'invoices':
             v = dict((k, Invoice.from_json(x)) for k, x in v.items())
         if key == 'payment_requests':
@@ -1344,25 +1393,39 @@ class WalletDB(JsonDB):
     def _should_convert_to_stored_dict(self, key) -> bool:
         if key == 'keystore':
             return False
-        multisig_keystore_names = [('x%d/' % i) for i in range(1, 16)]
-        if key in multisig_keystore_names:
+        if key in _MULTISIG_KEYSTORE_NAMES:
             return False
         return True
 
-    def write(self, storage: 'WalletStorage'):
+    def write(self, storage: 'WalletStorage', *, consolidate: bool = False):
+        """Writes the changes since the last write. With consolidate, the
+        file is left as a plain json document, without journal records.
+        """
         with self.lock:
-            self._write(storage)
+            self._write(storage, consolidate=consolidate)
 
     @profiler
-    def _write(self, storage: 'WalletStorage'):
+    def _write(self, storage: 'WalletStorage', *, consolidate: bool = False):
         if threading.currentThread().isDaemon():
             self.logger.warning('daemon thread cannot write db')
             return
+        if consolidate and storage.path == self._journal_path and storage.has_appended_data():
+            self.set_modified(True)
         if not self.modified():
             return
-        json_str = self.dump(human_readable=not storage.is_encrypted())
-        storage.write(json_str)
-        self.set_modified(False)
+        if (self.requires_full_write()
+                or storage.path != self._journal_path
+                or not storage.file_exists()
+                or storage.is_encrypted()
+                or storage.needs_consolidation()):
+            json_str = self.dump(human_readable=not storage.is_encrypted())
+            storage.write(json_str)
+            self._journal_path = storage.path
+            self.on_written(full=True)
+        else:
+            # only append what changed since the last write
+            storage.append(self.get_journal_data())
+            self.on_written(full=False)
 
     def is_ready_to_be_used_by_wallet(self):
         return not self.requires_upgrade() and self._called_after_upgrade_tasks